@@ -12,7 +12,8 @@ import sys
 import ConfigParser
 import logging
 
-from butility import Version
+from butility import (Version,
+                      PhaseProfiler)
 
 from .base import *
 
@@ -28,6 +29,11 @@ __version__ = Version('0.1.0')
 ## be set at later points as well
 log_env_var = 'BAPP_STARTUP_LOG_LEVEL'
 
+## If set to a file path, the time spent in the phases of application startup and process launches will be 
+## measured. A report will be written to stderr, and a trace-event file to the given path when the process exits.
+## See butility.PhaseProfiler.enable() for details
+profile_env_var = 'BAPP_STARTUP_PROFILE'
+
 ## -- End Constants -- @}
 
 
@@ -77,12 +83,20 @@ def _init_pre_app_loggig():
         #end handle early log-level setup
     # end have env var
 
+def _init_startup_profiler():
+    """Measure startup phases if requested"""
+    trace_path = os.environ.get(profile_env_var)
+    if trace_path:
+        PhaseProfiler.instance().enable(trace_path)
+    # end have env var
+
 ## -- End Initialization Handlers -- @}
 
 
 def _initialize():
     """Initialize the bapp package."""
     _init_pre_app_loggig()
+    _init_startup_profiler()
 
     
 
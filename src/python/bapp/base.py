@@ -8,9 +8,18 @@
 """
 __all__ = ['Application', 'TypeNotFound', 'InstanceNotFound']
 
+import os
+import sys
+import socket
+import logging
+import platform
 from itertools import chain
 
+from butility import (PhaseProfiler,
+                      login_name)
 from bcontext import (ContextStack,
+                      ContextStackSnapshot,
+                      StackSnapshotError,
                       Context)
 
 from .utility import (LogConfigurator,
@@ -18,7 +27,7 @@ from .utility import (LogConfigurator,
 
 import bcontext
 
-
+log = logging.getLogger('bapp.base')
 
 
 # -------------------------
@@ -188,6 +197,35 @@ class Application(object):
         # end set main only if we are the first
 
         return inst
+
+    @classmethod
+    def _restore_snapshot(cls, inst, path, tag):
+        """Restore the context stack of the given instance from the snapshot at the given path, if it is valid
+        @return True if the stack was restored, False if it has to be built"""
+        if not os.path.isfile(path):
+            return False
+        # end handle missing snapshot
+        try:
+            snapshot = ContextStackSnapshot.read(path)
+            if not snapshot.is_valid(tag):
+                log.debug("Snapshot at '%s' is outdated", path)
+                return False
+            # end handle outdated snapshot
+            inst.context().restore(snapshot)
+        except (StackSnapshotError, IOError), err:
+            log.debug("Could not restore snapshot at '%s': %s", path, err)
+            return False
+        # end handle unusable snapshots
+        return True
+
+    @classmethod
+    def _write_snapshot(cls, inst, path, tag):
+        """Write a snapshot of the context stack of the given instance to the given path, if possible"""
+        try:
+            inst.context().snapshot(tag).write(path)
+        except (StackSnapshotError, OSError, IOError), err:
+            log.debug("Could not write snapshot to '%s': %s", path, err)
+        # end ignore failures
         
     ## -- End Subclass Interface -- @}
 
@@ -198,9 +236,12 @@ class Application(object):
     @classmethod
     def new(cls, settings_trees=tuple(), settings_hierarchy=False, 
                  load_plugins_from_trees = False, recursive_plugin_loading = False, plugins_subtree='plug-ins',
+                 lazy_plugin_loading = False,
                  user_settings = True,
                  setup_logging = True,
-                 with_default_contexts = True ):
+                 with_default_contexts = True,
+                 settings_keys = None,
+                 settings_snapshot = None ):
         """Create a new Application instance, configured with all items an application needs to function.
         This is mainly a registry for settings, types and instances providing particular instances.
 
@@ -223,41 +264,89 @@ class Application(object):
         @param recursive_plugin_loading if True, plugins may reside in sub-folders and will be loaded anyway
         @param plugins_subtree the directory within each configuration directory which should be searched
         for plug-ins. That way, you can separate plug-ins from other code
+        @param lazy_plugin_loading if True, plugin files will only be imported once their plugins are needed.
+        See HierarchicalContext.load_plugins() for details
         @param user_settings if True, user settings will be loaded from directory at user.config (within application settings)
         @param setup_logging if True, logging will be configured using the LogConfigurator, which in turn
         is setup using our context
         @param with_default_contexts if True, we will initialize an OSContext and an ApplicationContext
+        @param settings_keys if not None, an iterable of keys like 'logging' or 'packages.maya'. Only values
+        below these keys will be loaded from settings files, and files which don't define any of them will not
+        be parsed if possible. Use it to speed up startup of programs which know all the settings they need.
+        Values of keys not listed here will not be available in the context.
+        @param settings_snapshot if not None, path to a file with a ContextStackSnapshot. If it is valid for
+        the given arguments, and none of the configuration files, directories and plugins it was built from
+        changed, the context stack will be restored from it instead of finding, parsing and merging all
+        configuration files. Otherwise the stack is built as usual, and the snapshot is written to the file
+        for use by the next program. Plugin modules will still be imported when restoring.
         @return a new Application instance
         @note in every program, the Application instance must be initialized before anything that uses the 
         default application is imported. Otherwise, types cannot be registered
         """
-        inst = cls._init_instance()
-
-        # This needs lazy import
-        from .contexts import (OSContext, 
-                               ApplicationContext)
-
-        if with_default_contexts:
-            typ = cls.OSContextType or OSContext
-            inst.context().push(typ('os'))
-
-            typ = cls.ApplicationContextType or ApplicationContext
-            inst.context().push(typ('app', user_settings=user_settings,
-                                           traverse_settings_hierarchy=settings_hierarchy))
-        # end handle ApplicationContext
-
-        if settings_trees:
-            ctx = inst.context().push(cls.HierarchicalContextType(settings_trees,
-                                                            traverse_settings_hierarchy=settings_hierarchy,
-                                                            application=inst))
-            if load_plugins_from_trees:
-                ctx.load_plugins(recurse = recursive_plugin_loading,
-                                 subdirectory = plugins_subtree)
-        # end for each path to push
-
-        if setup_logging:
-            cls.LogConfiguratorType.initialize()
-        # end handle log setup
+        profiler = PhaseProfiler.instance()
+        with profiler.span('Application.new'):
+            inst = cls._init_instance()
+
+            # This needs lazy import
+            from .contexts import (OSContext, 
+                                   ApplicationContext)
+
+            snapshot_tag = None
+            if settings_snapshot is not None:
+                # The OSContext stores information about the host, which is part of all merged settings above it.
+                # Snapshots on shared paths must not be used on other hosts
+                snapshot_tag = repr((cls.__module__, cls.__name__, sys.platform, platform.platform(),
+                                     socket.gethostname(), login_name(), os.path.expanduser('~'),
+                                     [os.path.abspath(tree) for tree in settings_trees], settings_hierarchy,
+                                     load_plugins_from_trees, recursive_plugin_loading, plugins_subtree,
+                                     lazy_plugin_loading, user_settings, with_default_contexts,
+                                     settings_keys and sorted(settings_keys)))
+                with profiler.span('Application.new.restore_snapshot'):
+                    restored = cls._restore_snapshot(inst, settings_snapshot, snapshot_tag)
+                if restored:
+                    if setup_logging:
+                        with profiler.span('LogConfigurator.initialize'):
+                            cls.LogConfiguratorType.initialize()
+                    # end handle log setup
+                    return inst
+                # end handle restored stack
+            # end handle snapshot
+
+            if with_default_contexts:
+                with profiler.span('Application.new.push', context='os'):
+                    typ = cls.OSContextType or OSContext
+                    inst.context().push(typ('os'))
+
+                with profiler.span('Application.new.push', context='app'):
+                    typ = cls.ApplicationContextType or ApplicationContext
+                    inst.context().push(typ('app', user_settings=user_settings,
+                                                   traverse_settings_hierarchy=settings_hierarchy,
+                                                   settings_keys=settings_keys))
+            # end handle ApplicationContext
+
+            if settings_trees:
+                with profiler.span('Application.new.push', context='settings_trees'):
+                    ctx = inst.context().push(cls.HierarchicalContextType(settings_trees,
+                                                                    traverse_settings_hierarchy=settings_hierarchy,
+                                                                    settings_keys=settings_keys,
+                                                                    application=inst))
+                if load_plugins_from_trees:
+                    with profiler.span('Application.new.load_plugins'):
+                        ctx.load_plugins(recurse = recursive_plugin_loading,
+                                         subdirectory = plugins_subtree,
+                                         lazy = lazy_plugin_loading)
+            # end for each path to push
+
+            if settings_snapshot is not None:
+                with profiler.span('Application.new.write_snapshot'):
+                    cls._write_snapshot(inst, settings_snapshot, snapshot_tag)
+            # end handle snapshot
+
+            if setup_logging:
+                with profiler.span('LogConfigurator.initialize'):
+                    cls.LogConfiguratorType.initialize()
+            # end handle log setup
+        # end measure startup
 
         return inst
 
@@ -90,13 +90,15 @@ class ApplicationContext(StackAwareHierarchicalContext):
     __slots__ = ()
     
 
-    def __init__(self, name, user_settings = True, traverse_settings_hierarchy = True):
+    def __init__(self, name, user_settings = True, traverse_settings_hierarchy = True, settings_keys = None):
         """Assure that we load all configuration at bcore and above.
            It also creates some basic services to obtain information about some paths.
            @param user_settings if True, we will load user specfic settings, by default searched in ~/etc
+           @param settings_keys see HierarchicalContext.__init__()
            """
         super(ApplicationContext, self).__init__(self._root_path(),
-                                                 traverse_settings_hierarchy=traverse_settings_hierarchy)
+                                                 traverse_settings_hierarchy=traverse_settings_hierarchy,
+                                                 settings_keys=settings_keys)
 
         if user_settings:
             user_dir = self.user_config_directory()
@@ -132,6 +134,10 @@ class ApplicationContext(StackAwareHierarchicalContext):
         """@return the directory in which the user configuration is to be found """
         return Path('~').expanduser() / cls.config_dir_name
 
+    def snapshot_sources(self):
+        """@return our sources, including the user configuration directory, which may be created later"""
+        return super(ApplicationContext, self).snapshot_sources() + [self.user_config_directory()]
+
     ## -- End Interface -- @}
 
 # end class ApplicationContext
@@ -40,8 +40,11 @@ class PersistentSettings(ChangeTrackingJSONKeyValueStoreModifier):
     This makes the type particularly useful for keeping user settings and possibly serve as file-database.
     @note all this type does is to facilitate setting up your base data for comparison. Changes still need
     to be written back using the save_changes()
+    @note changes are journaled, which makes finding them independent of the size of the data.
     """
     __slots__ = ()
+
+    journal_changes = True
     
     
     def __init__(self, data, settings_path_or_stream, take_ownership = True):
@@ -63,7 +66,9 @@ class PersistentSettings(ChangeTrackingJSONKeyValueStoreModifier):
                 data = deepcopy(data)
             # end handle data copy
             self._base_value_dict = data
+            self._record_changes(self._value_dict)
             self._value_dict = merge_data(self._value_dict, data, delegate_type = _PersistentSettingsMergeDelegate)
+            self._increment_version()
         else:
             # just set the new data directly
             self._set_data(data, take_ownership = take_ownership)
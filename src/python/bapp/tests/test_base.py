@@ -8,11 +8,15 @@
 """
 __all__ = []
 
+import socket
+
 from .base import (preserve_application,
                    TestCoreCaseBase)
                             
 from butility import (InterfaceBase,
                       abstractmethod)
+from butility.tests import with_rw_directory
+from bcontext import ContextStackSnapshot
 
 import bapp
 
@@ -84,6 +88,53 @@ class TestCore(TestCoreCaseBase):
 
         assert len(app.settings().data())
 
+    @with_rw_directory
+    @preserve_application
+    def test_settings_snapshot(self, rw_dir):
+        """Verify applications can be restored from snapshots"""
+        snapshot_file = rw_dir / 'app.snapshot'
+        def new_app(**kwargs):
+            return bapp.Application.new(setup_logging=False,
+                                        settings_trees=(self.fixture_path(''),),
+                                        settings_hierarchy=True,
+                                        settings_snapshot=snapshot_file,
+                                        **kwargs)
+        # end utility
+
+        app = new_app()
+        assert snapshot_file.isfile()
+        mtime = snapshot_file.mtime()
+        expected = app.settings().data()
+
+        restored = new_app()
+        assert restored.settings().data() == expected
+        assert [type(ctx) for ctx in restored.context().stack()] == [type(ctx) for ctx in app.context().stack()]
+        assert restored.context().stack()[-1].hash_map() == app.context().stack()[-1].hash_map()
+        assert snapshot_file.mtime() == mtime, "valid snapshots are not written again"
+
+        # different arguments require a new snapshot
+        tag = ContextStackSnapshot.read(snapshot_file).tag()
+        new_app(user_settings=False)
+        assert ContextStackSnapshot.read(snapshot_file).tag() != tag
+        assert new_app().settings().data() == expected
+
+        # snapshots are specific to their host
+        gethostname = socket.gethostname
+        socket.gethostname = lambda: 'otherhost.example.com'
+        try:
+            other = new_app()
+            assert ContextStackSnapshot.read(snapshot_file).tag() != tag
+            assert other.settings().data().host.name == 'otherhost'
+        finally:
+            socket.gethostname = gethostname
+        # end restore hostname
+        assert new_app().settings().data() == expected
+
+        # unusable snapshots are replaced
+        open(snapshot_file, 'wb').write('garbage')
+        assert new_app().settings().data() == expected
+        ContextStackSnapshot.read(snapshot_file)
+
        
 # end class TestCore
 
@@ -10,14 +10,16 @@ __all__ = ['ApplicationSettingsClient', 'LogConfigurator', 'StackAwareHierarchic
 
 import os
 import warnings
-import hashlib
 import logging
 import logging.config
 
 from butility import (Path,
-                      OrderedDict)
+                      OrderedDict,
+                      concurrent_map,
+                      FileHashCache)
 
-from bkvstore import KeyValueStoreSchema
+from bkvstore import (KeyValueStoreSchema,
+                      YAMLKeyValueStoreModifier)
 from bcontext import HierarchicalContext
 import bapp
 
@@ -94,10 +96,36 @@ class StackAwareHierarchicalContext(HierarchicalContext):
     def _filter_files(self, files):
         """@note our implementation will compare file hashes in our own hash map with ones of other
         instances of this type on the stack to assure we don't accidentally load the same file
-        @note This method will update our _hash_map member"""
-        for config_file in files:
-            self._hash_map[hashlib.md5(open(config_file).read()).digest()] = config_file
+        @note This method will update our _hash_map member
+        @note files are read concurrently if configured in the YAMLKeyValueStoreModifier, and their contents
+        are kept to be parsed when loading the configuration. Files with digests in the FileHashCache are not read.
+        """
+        hashes = FileHashCache.instance()
+
+        def digest(config_file):
+            """@return (digest, content) tuple, content is None if the file wasn't read"""
+            res = hashes.cached_digest(config_file)
+            if res is not None:
+                return res, None
+            # end handle cache hit
+            fp = open(config_file, 'rb')
+            try:
+                content = fp.read()
+            finally:
+                fp.close()
+            # end assure file is closed
+            return hashes.digest(config_file, content), content
+        # end digest
+
+        files = list(files)
+        for config_file, (res, content) in zip(files, concurrent_map(digest, files,
+                                                                    YAMLKeyValueStoreModifier.read_workers())):
+            self._hash_map[res] = config_file
+            if content is not None:
+                self._config_contents[config_file] = content
+            # end keep content for parsing
         #end for each file
+        hashes.flush()
         
         # subtract all existing hashes
         our_files = set(self._hash_map.keys())
@@ -119,6 +147,23 @@ class StackAwareHierarchicalContext(HierarchicalContext):
     
     ## -- End Interface -- @}
 
+    # -------------------------
+    ## @name Snapshot Interface
+    # @{
+
+    def _restore_state(self, state):
+        super(StackAwareHierarchicalContext, self)._restore_state(state)
+        self._hash_map = state['hash_map']
+        self._app = None
+
+    def snapshot_state(self):
+        """@return our state, including our hash map"""
+        state = super(StackAwareHierarchicalContext, self).snapshot_state()
+        state['hash_map'] = self._hash_map
+        return state
+
+    ## -- End Snapshot Interface -- @}
+
 # end class StackAwareHierarchicalContext
 
 
@@ -13,5 +13,6 @@ __version__ = Version("0.1.0")
 
 # make sure people can get the most fundamental implementation in this package
 from .base import *
+from .snapshot import *
 from .hierarchy import *
 from .utility import *
@@ -6,21 +6,27 @@
 @author Sebastian Thiel
 @copyright [GNU Lesser General Public License](https://www.gnu.org/licenses/lgpl.html)
 """
-__all__ = ['Context', 'ContextStack',
+__all__ = ['Context', 'ContextStack', 'LazyPluginModule',
            'StackAutoResolveAdditiveMergeDelegate']
 
 import re
 import logging
 
+from cPickle import ( loads,
+                      dumps,
+                      HIGHEST_PROTOCOL )
+
 from butility import ( OrderedDict,
+                       PersistentOrderedDict,
                        LazyMixin,
                        InterfaceBase,
                        MetaBase,
                        Error,
+                       PythonFileLoader,
                        Path )
 
 from bdiff import ( NoValue,
-                    TwoWayDiff,
+                    IterativeTwoWayDiff,
                     AutoResolveAdditiveMergeDelegate )
 
 from bkvstore import ( KeyValueStoreSchemaValidator,
@@ -28,6 +34,9 @@ from bkvstore import ( KeyValueStoreSchemaValidator,
                        KeyValueStoreSchema,
                        RootKey )
 
+from .snapshot import ( ContextStackSnapshot,
+                        StackSnapshotError )
+
 
 log = logging.getLogger(__name__)
 
@@ -50,6 +59,79 @@ class StackAutoResolveAdditiveMergeDelegate(AutoResolveAdditiveMergeDelegate):
 # end class StackAutoResolveAdditiveMergeDelegate 
 
 
+class LazyPluginModule(object):
+    """A placeholder for a python module which registers plugins when imported.
+    It can be registered in a Context like any plugin, which will import the module once it is
+    queried for an interface that one of the module's plugins implements.
+    The plugins the module registers will then take the place of the placeholder.
+    """
+    __slots__ = (
+                    '_path',        # path to the python file
+                    '_module_name', # name of the module to import the file as
+                    '_interfaces'   # frozenset of qualified names of all interfaces implemented by the plugins
+                )
+
+    def __init__(self, path, module_name, interfaces):
+        """Initialize this instance
+        @param path to the python file to import
+        @param module_name the name of the module to import the file as
+        @param interfaces iterable of qualified names of all interfaces the module's plugins implement, 
+        as obtained by interface_names()"""
+        self._path = path
+        self._module_name = module_name
+        self._interfaces = frozenset(interfaces)
+
+    def __repr__(self):
+        return "%s('%s', '%s')" % (type(self).__name__, self._path, self._module_name)
+
+    # -------------------------
+    ## @name Interface
+    # @{
+
+    @classmethod
+    def qualified_name(cls, interface):
+        """@return a string identifying the given type across processes"""
+        return '%s.%s' % (interface.__module__, interface.__name__)
+
+    @classmethod
+    def interface_names(cls, plugin):
+        """@return set of qualified names of all interfaces the given plugin instance or type implements, 
+        i.e. all types it could be found by in a Context"""
+        types = [type(plugin)]
+        if isinstance(plugin, type):
+            types.append(plugin)
+        # end handle types
+        names = set()
+        for typ in types:
+            for base in getattr(typ, '__mro__', (typ, )):
+                names.add(cls.qualified_name(base))
+            # end for each base
+        # end for each type
+        return names
+
+    def implements(self, interface):
+        """@return True if one of our plugins implements the given interface
+        @note virtual subclasses registered with abstract base classes are not considered"""
+        return self.qualified_name(interface) in self._interfaces
+
+    def path(self):
+        """@return path to our python file"""
+        return self._path
+
+    def module_name(self):
+        """@return name of the module we import"""
+        return self._module_name
+
+    def load(self):
+        """Import our module, which will register its plugins
+        @return the loaded module
+        @throws Exception any exception raised when trying to import the module"""
+        return PythonFileLoader.load_file(self._path, self._module_name)
+        
+    ## -- End Interface -- @}
+
+# end class LazyPluginModule
+
 ## -- End Utilities -- @}
 
 
@@ -60,10 +142,19 @@ class Context(object):
     Each Context has a name which helps to further distinguish it.
 
     A Context maintains a strong pointer to all Plugin instances by default.
+
+    Registrees implementing a particular interface are indexed on first query, and the index is kept 
+    up-to-date during register().
+    LazyPluginModule instances are registered like plugins, and replaced by the plugins their module
+    registers once they are found by a query.
+    @note if a type is registered as virtual subclass of an abstract interface after that interface
+    was queried, it will only be found once the context is reset.
     """
     __slots__ = (
                     '_name',     # name of the Context
                     '_registry', # a list of instances and types 
+                    '_index',    # interface -> list of registrees implementing it, in registration order
+                    '_revision', # incremented whenever the registry changes
                     '_kvstore'   # the contexts context as kvstore
                 )
     
@@ -89,18 +180,54 @@ class Context(object):
     ## @name Utilities
     # @{
     
+    @staticmethod
+    def _implements(item, interface):
+        """@return True if the given registree, an instance or a type, implements interface"""
+        if isinstance(item, LazyPluginModule) and interface is not LazyPluginModule:
+            return item.implements(interface)
+        # end handle placeholders
+        return isinstance(item, interface) or (isinstance(item, type) and issubclass(item, interface))
+
+    def _load_lazy_plugins(self, interface):
+        """Import all modules of LazyPluginModule registrees implementing the given interface, and replace
+        them with the plugins they register"""
+        for placeholder in [item for item in self._registry 
+                                 if isinstance(item, LazyPluginModule) and item.implements(interface)]:
+            count = len(self._registry)
+            try:
+                self.capture_registrations(placeholder.load)
+            except Exception:
+                log.error("Failed to load %s from %s", placeholder.module_name(), placeholder.path(), 
+                                                       exc_info=True)
+            # end handle import errors
+            # the new plugins take the place of the placeholder, just as if they were loaded right away
+            items = self._registry[count:]
+            del self._registry[count:]
+            for pid, item in enumerate(self._registry):
+                if item is placeholder:
+                    self._registry[pid:pid+1] = items
+                    break
+                # end replace placeholder
+            # end for each registree
+            self._index = dict()
+            self._revision += 1
+        # end for each placeholder
+
+    def _matches(self, interface):
+        """@return list of all registrees implementing the given interface, in registration order
+        @note the returned list is owned by our index and must not be changed"""
+        items = self._index.get(interface)
+        if items is None:
+            self._load_lazy_plugins(interface)
+            items = self._index[interface] = [item for item in self._registry if self._implements(item, interface)]
+        # end build index entry
+        return items
+    
     def _filter_registry(self, interface, predicate):
         """Iterate the registry and return a list of matching items, but only consider registrees for which 
         predicate(item) returns True"""
-        items = list()
         # Items that came later will be used first - this way items that came later can override newer ones
-        for item in reversed(self._registry):
-            if (isinstance(item, interface) or (isinstance(item, type) and issubclass(item, interface))) \
-            and predicate(item):
-                items.append(item)
-            # end if registree is suitable
-        # end for each registered item
-        return items
+        return [item for item in reversed(self._matches(interface)) if predicate(item)]
     
     def _contents_str(self):
         """Display the contents of the Context primarily for debugging purposes
@@ -126,6 +253,10 @@ class Context(object):
         """@return our name, which helps to visualize this Context"""
         return self._name
 
+    def revision(self):
+        """@return an integer which changes whenever types or instances are registered, or when we are reset"""
+        return self._revision
+
     def types(self, interface, predicate = lambda cls: True):
         """@return all types implementing \a interface
         @param interface the interface to search for
@@ -162,6 +293,8 @@ class Context(object):
         @return self"""
         self._kvstore = self.KeyValueStoreModifierType(OrderedDict())
         self._registry = list()
+        self._index = dict()
+        self._revision = getattr(self, '_revision', 0) + 1
         return self
 
     def register(self, plugin):
@@ -172,8 +305,35 @@ class Context(object):
         """
         if plugin not in self._registry:
             self._registry.append(plugin)
+            for interface, items in self._index.items():
+                if not self._implements(plugin, interface):
+                    continue
+                # end skip unrelated interfaces
+                if isinstance(plugin, LazyPluginModule):
+                    # placeholders are loaded on next query
+                    del self._index[interface]
+                else:
+                    items.append(plugin)
+                # end update index
+            # end for each indexed interface
+            self._revision += 1
         return plugin
 
+    def capture_registrations(self, function):
+        """Call the given function and assure that all plugins it registers through any ContextStack
+        end up in this Context, instead of the top of the respective stack. 
+        This is useful to import modules containing plugins into contexts not on top of the stack.
+        @param function a callable without arguments
+        @return list of all items registered in this Context by the function, in order"""
+        count = len(self._registry)
+        ContextStack._registration_targets.append(self)
+        try:
+            function()
+        finally:
+            ContextStack._registration_targets.pop()
+        # end assure redirection is undone
+        return self._registry[count:]
+
     def set_settings(self, kvstore):
         """Set our kvstore to the given one.
         @note this method is used for API completeness, the common way of doing this is to derive 
@@ -187,6 +347,68 @@ class Context(object):
     
     ## -- End Edit Interface -- @}
 
+    # -------------------------
+    ## @name Snapshot Interface
+    # Allows to store a context and recreate it in another process, see ContextStackSnapshot
+    # @{
+
+    def _restore_state(self, state):
+        """Initialize this instance from the given state, as obtained by snapshot_state().
+        Subclasses which store additional state must override this method, and set all of their attributes
+        @note __init__() wasn't called on this instance"""
+        self._name = state['name']
+        self.reset()
+        self._kvstore = self.KeyValueStoreModifierType(state['settings'])
+        for reference, pickled in state['registry']:
+            item = ContextStackSnapshot.resolve_type(reference)
+            if pickled is not None:
+                try:
+                    item = loads(pickled)
+                except Exception, err:
+                    raise StackSnapshotError("Could not restore instance of %s: %s" % (item.__name__, err))
+                # end convert exceptions
+            # end handle instances
+            self._registry.append(item)
+        # end for each registree
+
+    def snapshot_state(self):
+        """@return a picklable object with everything needed to recreate this context with from_snapshot_state()
+        in another process, namely our name, our settings and our registry. Types are stored by reference, 
+        instances are pickled.
+        @throws StackSnapshotError if a registered type can't be referenced by name, or if an instance 
+        can't be pickled"""
+        registry = list()
+        for item in self._registry:
+            if isinstance(item, type):
+                registry.append((ContextStackSnapshot.type_reference(item), None))
+            else:
+                try:
+                    pickled = dumps(item, HIGHEST_PROTOCOL)
+                except Exception, err:
+                    raise StackSnapshotError("Could not pickle %r: %s" % (item, err))
+                # end convert exceptions
+                registry.append((ContextStackSnapshot.type_reference(type(item)), pickled))
+            # end handle item type
+        # end for each registree
+        return dict(name=self._name, settings=self.settings()._data(), registry=registry)
+
+    def snapshot_sources(self):
+        """@return list of paths to files and directories our settings and registry were built from.
+        A snapshot of this context is only valid as long as they don't change
+        @note base implementation returns an empty list"""
+        return list()
+
+    @classmethod
+    def from_snapshot_state(cls, state):
+        """@return a new instance of our type, initialized from the given state, as obtained by 
+        snapshot_state(). Types will be imported as needed.
+        @throws StackSnapshotError if a type or instance couldn't be restored"""
+        inst = cls.__new__(cls)
+        inst._restore_state(state)
+        return inst
+
+    ## -- End Snapshot Interface -- @}
+
 # end class Context
 
 
@@ -200,7 +422,9 @@ class ContextStack(LazyMixin):
     __slots__ = (   
                     '_stack',                               # multiple context instances
                     '_kvstore',                             # a cached and combined kvstore
-                    '_num_aggregated_kvstores'              # number contexts aggregated in our current cache
+                    '_snapshots',                           # a list of (context, kvstore) tuples, one per level
+                    '_index',                               # interface -> list of (level, registree) tuples
+                    '_index_revisions'                      # list of (context, revision) tuples our index is valid for
                 )
     
     # -------------------------
@@ -212,13 +436,23 @@ class ContextStack(LazyMixin):
 
     ## The type of validator we create, for example during schema_validator()
     KeyValueStoreValidatorType = KeyValueStoreSchemaValidator
+
+    ## The algorithm we use to merge the settings of all contexts
+    TwoWayDiffAlgorithmType = IterativeTwoWayDiff
     
     ## -- End Configuration -- @}
 
+    ## Contexts which receive all registrations instead of the top of the stack, see 
+    ## Context.capture_registrations()
+    _registration_targets = list()
+
     def __init__(self):
         """Initialize this instance
         @param context if not None, it will be used as default context"""
         self._stack = list() # the stack itself
+        self._snapshots = list()
+        self._index = dict()
+        self._index_revisions = list()
         self.reset()
         
     def _set_cache_(self, name):
@@ -243,15 +477,51 @@ class ContextStack(LazyMixin):
         return otp
         
     def _mark_rebuild_changed_context(self):
-        """Keep our changes and re-apply them to a rebuilt copy
-        @todo implement the change-re-application similar to what the YAMLstore does"""
-        # triggers a rebuild on next access
+        """Trigger a rebuild of our aggregated kvstore on next access.
+        Only the levels above the last valid snapshot will actually be merged"""
         try:
             del(self._kvstore)
         except AttributeError:
             pass
         # ignore missing context
-        self._num_aggregated_kvstores = 0
+
+    def _matches(self, interface):
+        """@return list of (level, registree) tuples of all registrees on our stack which implement the given 
+        interface, most specific context first. The level is the index of the registree's context on the stack.
+        @note the index is rebuilt if contexts were pushed, popped or registered new items"""
+        revisions = [(ctx, ctx.revision()) for ctx in self._stack]
+        if revisions != self._index_revisions:
+            self._index = dict()
+            self._index_revisions = revisions
+        # end invalidate index
+
+        items = self._index.get(interface)
+        if items is None:
+            items = list()
+            for level in reversed(xrange(len(self._stack))):
+                items.extend((level, item) for item in reversed(self._stack[level]._matches(interface)))
+            # end for each context
+            revisions = [(ctx, ctx.revision()) for ctx in self._stack]
+            if revisions != self._index_revisions:
+                # lazy plugins were loaded, which can change the result for other interfaces
+                self._index = dict()
+                self._index_revisions = revisions
+            # end handle changed contexts
+            self._index[interface] = items
+        # end build index entry
+        return items
+
+    def _num_valid_snapshots(self):
+        """@return the amount of snapshots, from the bottom of the stack, which are still valid as the 
+        context they were made for is still at the same position"""
+        count = 0
+        for (snapshot_ctx, kvstore), ctx in zip(self._snapshots, self._stack):
+            if snapshot_ctx is not ctx:
+                break
+            # end stop at first changed level
+            count += 1
+        # end for each snapshot
+        return count
         
     # -------------------------
     ## @name Protocols
@@ -267,29 +537,37 @@ class ContextStack(LazyMixin):
     # Internal Query Interface
     #
     
-    def _aggregated_kvstore(self, aggregated_base=None, start_at = 0):
-        """@return new context as aggregate of all contexts on our stack, bottom up"""
-        # This delegate makes sure we don't let None values override non-null values
-        delegate = StackAutoResolveAdditiveMergeDelegate()
-        alg = TwoWayDiff()
-        
-        for eid in range(start_at, len(self._stack)):
-            ctx = self._stack[eid]
-            base = delegate.result()
-            if base is NoValue:
-                base = aggregated_base or OrderedDict()
+    def _aggregated_kvstore(self):
+        """@return new context as aggregate of all contexts on our stack, bottom up.
+        @note each level of the stack is merged into a new snapshot based on the snapshot of the level below.
+        Snapshots which are still valid will be reused, which makes popping and pushing contexts cheap.
+        Snapshots are immutable, which allows each of them to share all branches which its context doesn't 
+        change with the snapshot below"""
+        num_valid = self._num_valid_snapshots()
+        del(self._snapshots[num_valid:])
+        alg = self.TwoWayDiffAlgorithmType()
+
+        for ctx in self._stack[num_valid:]:
+            base = OrderedDict()
+            if self._snapshots:
+                base = self._snapshots[-1][1]._data()
             # end setup base
+            # This delegate makes sure we don't let None values override non-null values
+            # Using a new delegate each time assures the snapshot below remains unchanged
+            delegate = StackAutoResolveAdditiveMergeDelegate()
             alg.diff(delegate, base, ctx.settings()._data())
-        # end for each Context
-        self._num_aggregated_kvstores = len(self._stack)
-
-        res = delegate.result()
-        if res is NoValue:
-            assert aggregated_base is not None
-            assert isinstance(aggregated_base, OrderedDict)
-            res = aggregated_base
-        # end handle special case with empty dicts
-        return self.ContextType.KeyValueStoreModifierType(res)
+            res = delegate.result()
+            if res is NoValue:
+                res = OrderedDict()
+            # end handle special case with empty dicts
+            res = PersistentOrderedDict.freeze(res, copy_values=False)
+            self._snapshots.append((ctx, self.ContextType.KeyValueStoreModifierType(res)))
+        # end for each Context to aggregate
+
+        if not self._snapshots:
+            return self.ContextType.KeyValueStoreModifierType(OrderedDict())
+        # end handle empty stack
+        return self._snapshots[-1][1]
         
     # -- End Internal Query Interface --
     
@@ -375,6 +653,7 @@ class ContextStack(LazyMixin):
         @return self
         """
         self._stack = list()
+        self._snapshots = list()
         self._mark_rebuild_changed_context()
         return self
 
@@ -389,11 +668,7 @@ class ContextStack(LazyMixin):
         @param predicate f(service) => Bool, returns True for each class implementing
         interface that should be returned
         """
-        res = list()
-        for ctx in reversed(self._stack):
-            res += ctx.types(interface, predicate)
-        # end for each context
-        return res
+        return [item for level, item in self._matches(interface) if isinstance(item, type) and predicate(item)]
     
     def instances(self, interface, predicate = lambda service: True, find_all = False):
         """@return a list of instances implementing \a interface, or an empty list.
@@ -405,12 +680,16 @@ class ContextStack(LazyMixin):
         interface that should be returned
         """
         instances = list()
-        for ctx in reversed(self._stack):
-            instances += ctx.instances(interface, predicate)
-            if instances and not find_all:
+        found_level = None
+        for level, item in self._matches(interface):
+            if level != found_level and found_level is not None and not find_all:
                 break
-            # end abort search early
-        # end for each context
+            # end abort search after the first context with matches
+            if not isinstance(item, type) and predicate(item):
+                instances.append(item)
+                found_level = level
+            # end keep matching instances
+        # end for each registree
         return instances
 
     def settings(self):
@@ -424,8 +703,8 @@ class ContextStack(LazyMixin):
         kvstore = self._kvstore
 
         # Check if we still have to add some contexts, as someone pushed in the meanwhile
-        if self._num_aggregated_kvstores != len(self._stack):
-            kvstore = self._kvstore = self._aggregated_kvstore(kvstore._data(), self._num_aggregated_kvstores)
+        if self._num_valid_snapshots() != len(self._stack):
+            kvstore = self._kvstore = self._aggregated_kvstore()
         # end update kvstore
 
         return kvstore
@@ -524,10 +803,66 @@ class ContextStack(LazyMixin):
     def register(self, plugin):
         """registers plugin as a service providing all interfaces it derives from
             @param plugin any instance or class  
+            @note if registrations are captured by a Context, it will receive the plugin instead
         """
+        if self._registration_targets:
+            self._registration_targets[-1].register(plugin)
+            return
+        # end handle captured registrations
         assert self._stack, "Application has to push at least one context"
         self._stack[-1].register(plugin)
         
     ## -- End Edit Interface -- @}
+
+    # -------------------------
+    ## @name Snapshot Interface
+    # @{
+
+    def snapshot(self, tag=''):
+        """@return a ContextStackSnapshot of all our contexts and the aggregated settings of each level
+        @param tag a string identifying the way our contexts were built, see ContextStackSnapshot.is_valid()
+        @throws StackSnapshotError if one of our contexts can't be stored"""
+        # assure all levels are merged
+        self.settings()
+        levels = list()
+        sources = list()
+        for ctx, (snapshot_ctx, kvstore) in zip(self._stack, self._snapshots):
+            assert ctx is snapshot_ctx
+            levels.append((ContextStackSnapshot.type_reference(type(ctx)), ctx.snapshot_state(), kvstore._data()))
+            sources.extend(ctx.snapshot_sources())
+        # end for each context
+        return ContextStackSnapshot(levels, sources, tag)
+
+    def restore(self, snapshot):
+        """Replace all our contexts with the ones stored in the given snapshot, and use the aggregated 
+        settings it contains instead of merging them again.
+        Modules of registered types will be imported as needed, without registering their plugins anywhere else.
+        @param snapshot a ContextStackSnapshot instance
+        @return self
+        @throws StackSnapshotError if a context couldn't be restored. In that case, we remain unchanged
+        @note the validity of the snapshot isn't checked"""
+        levels = list()
+        def restore_levels():
+            for reference, state, data in snapshot.levels():
+                ctx = ContextStackSnapshot.resolve_type(reference).from_snapshot_state(state)
+                levels.append((ctx, self.ContextType.KeyValueStoreModifierType(
+                                            PersistentOrderedDict.freeze(data, copy_values=False))))
+            # end for each level
+        # end utility
+
+        # plugins registered by modules we import are part of the snapshot already
+        self.ContextType('snapshot imports').capture_registrations(restore_levels)
+
+        self.reset()
+        for ctx, kvstore in levels:
+            self._stack.append(ctx)
+            self._snapshots.append((ctx, kvstore))
+        # end for each level
+        if levels:
+            self._kvstore = levels[-1][1]
+        # end use aggregated settings
+        return self
+
+    ## -- End Snapshot Interface -- @}
 # end class ContextStack
 
@@ -6,23 +6,41 @@
 @author Sebastian Thiel
 @copyright [GNU Lesser General Public License](https://www.gnu.org/licenses/lgpl.html)
 """
-__all__ = ['HierarchicalContext']
+__all__ = ['HierarchicalContext', 'PluginManifestCache']
 
+import os
 import sys
 import logging
 
+from functools import partial
+
 from butility import (LazyMixin,
                       int_bits,
                       Path,
                       PythonFileLoader,
                       tagged_file_paths,
+                      DirectoryCache,
+                      PhaseProfiler,
                       OrderedDict)
-from bkvstore import YAMLKeyValueStoreModifier
-from .base import Context
+from bkvstore import (YAMLKeyValueStoreModifier,
+                      SerializedDataCache)
+from .base import (Context,
+                   LazyPluginModule)
 
 log = logging.getLogger(__name__)
 
 
+class PluginManifestCache(SerializedDataCache):
+    """The cache for manifests of plugin directories, which is enabled by default as it's only used if 
+    plugins are loaded lazily"""
+    __slots__ = ()
+
+    enabled_by_default = True
+
+# end class PluginManifestCache
+
+
+
 
 
 class HierarchicalContext(Context, LazyMixin):
@@ -41,6 +59,9 @@ class HierarchicalContext(Context, LazyMixin):
                     '_config_dirs',     ## Cache for all located configuration directories
                     '_config_files',    ## All files we have loaded so far, in loading-order
                     '_additional_config_files', ## Files provided by the caller, they will be added on top
+                    '_settings_keys',   ## Keys to load from our configuration files, or None to load all
+                    '_config_contents', ## path -> contents of configuration files read by _filter_files()
+                    '_plugin_sources',  ## list of (directory, recurse) tuples of directories we loaded plugins from
                 )
     
     # -------------------------
@@ -55,10 +76,15 @@ class HierarchicalContext(Context, LazyMixin):
                            'sunos5': 'sun',
                            'darwin': 'mac',
                            'win32':  'win'}
+
+    ## A type compatible to the SerializedDataCache, used to cache the manifests of plugin directories
+    ## for lazy plugin loading. If None, lazily loaded plugins will be imported right away
+    PluginManifestCacheType = PluginManifestCache
     
     ## -- End Configuration -- @}
     
-    def __init__(self, tree, load_config = True, traverse_settings_hierarchy = True, config_files = list()):
+    def __init__(self, tree, load_config = True, traverse_settings_hierarchy = True, config_files = list(),
+                 settings_keys = None):
         """Initialize the instance with a directory from which it should search for configuration paths 
         and plug-ins.
         @param tree from which to start finding directories to laod values from. It may either be the 
@@ -71,6 +97,9 @@ class HierarchicalContext(Context, LazyMixin):
         one. Otherwise, we will just consider configuration in the given directory.
         @param config_files an optional list of configuration files which should be loaded on top of all configuration
         files loaded from our directory or directories.
+        @param settings_keys if not None, an iterable of keys like 'section' or 'section.subsection'. Only values
+        below these keys will be loaded from our configuration files, and files not defining any of them will
+        not be parsed if possible. If None, all values will be loaded.
         @note plugins must be loaded separately with load_plugins(), if desired, to assure they end up in this context, not in 
         the previous one which is already on the stack
         @note settings will be delay-loaded, first time they are actually queried
@@ -87,6 +116,9 @@ class HierarchicalContext(Context, LazyMixin):
         # end assure correct type
 
         self._additional_config_files = config_files
+        self._settings_keys = settings_keys
+        self._config_contents = dict()
+        self._plugin_sources = list()
 
         if traverse_settings_hierarchy:
             self._config_dirs = self._traverse_config_trees()
@@ -97,7 +129,7 @@ class HierarchicalContext(Context, LazyMixin):
                 if not tree.endswith(self.config_dir_name):
                     tree /= self.config_dir_name
                 # end normalize
-                if tree.isdir():
+                if DirectoryCache.instance().isdir(tree):
                     self._config_dirs.append(tree)
                 # end obtain valid configuration directory
             # end for each tree
@@ -110,9 +142,13 @@ class HierarchicalContext(Context, LazyMixin):
 
     def _set_cache_(self, name):
         if name == '_kvstore':
-            self._load_configuration()
+            with PhaseProfiler.instance().span('HierarchicalContext._load_configuration'):
+                self._load_configuration()
+            # end measure loading
         elif name == '_config_files':
-            self._config_files = self._find_config_files()
+            with PhaseProfiler.instance().span('HierarchicalContext._find_config_files'):
+                self._config_files = self._find_config_files()
+            # end measure search
         else:
             return super(HierarchicalContext, self)._set_cache_(name)
         #end handle name
@@ -142,7 +178,9 @@ class HierarchicalContext(Context, LazyMixin):
         # We may have no configuration files left here, as the filter could remove them all (in case they
         # are non-unique)
         # for now, no writer
-        return tuple(self._filter_files(config_paths))
+        with PhaseProfiler.instance().span('HierarchicalContext._filter_files', count=len(config_paths)):
+            return tuple(self._filter_files(config_paths))
+        # end measure filtering
         
     def _load_configuration(self):
         """Load all configuration files from our directories.
@@ -152,7 +190,10 @@ class HierarchicalContext(Context, LazyMixin):
         if self._config_files:
             log.debug("Context '%s' initializes its paths", self.name())
             #end for each path
-            self._kvstore = YAMLKeyValueStoreModifier(self._config_files)
+            self._kvstore = YAMLKeyValueStoreModifier(self._config_files, keys=self._settings_keys,
+                                                                          contents=self._config_contents)
+            # contents may be outdated next time
+            self._config_contents = dict()
         else:
             self._kvstore = self.KeyValueStoreModifierType(OrderedDict())
         # end handle yaml store
@@ -161,19 +202,28 @@ class HierarchicalContext(Context, LazyMixin):
         """@return a list of configuration directories, based on our pre-configured configuration directory, 
         including the latter"""
         dirs = list()
+        # the same parent directories are searched by many contexts
+        cache = DirectoryCache.instance()
+
+        for new_path in self._config_tree_candidates():
+            if cache.isdir(new_path):
+                dirs.insert(0, new_path)
+            # end keep existing
+        # end for each candidate
+        return dirs
 
+    def _config_tree_candidates(self):
+        """@return list of all possible configuration directories above our trees, deepest directory first"""
+        candidates = list()
         for path in self._trees:
             path = path.abspath() 
             # prevent to reach root, on linux we would get /etc, which we don't search for anything
             while path.dirname() != path:
-                new_path = path / self.config_dir_name
-                if new_path.isdir():
-                    dirs.insert(0, new_path)
-                # end keep existing
+                candidates.append(path / self.config_dir_name)
                 path = path.dirname()
             # end less loop
         # end for each directory to traverse
-        return dirs
+        return candidates
         
     # -------------------------
     ## @name Subclass Interface
@@ -189,7 +239,8 @@ class HierarchicalContext(Context, LazyMixin):
     def _filter_files(self, files):
         """Filter the given files which are supposed to be loaded by YAMLKeyValueStoreModifier
         @return a sorted list of files that should actually be loaded
-        @note base implementation does nothing"""
+        @note base implementation does nothing. Subclasses reading the files may store their contents in
+        _config_contents to prevent them from being read again when loading the configuration"""
         return files
     
     ## -- End Subclass Interface -- @}
@@ -211,7 +262,69 @@ class HierarchicalContext(Context, LazyMixin):
         nothing was loaded yet"""
         return self._config_files
 
-    def load_plugins(self, recurse = False, subdirectory = 'plug-ins'):
+    def _load_plugins_lazily(self, path, recurse):
+        """Register a LazyPluginModule for each plugin file in the given directory, as described by the
+        cached manifest of the directory. If there is no manifest, all files will be imported and a manifest
+        is created from the plugins they registered"""
+        files = PythonFileLoader.find_files(path, recurse=recurse)
+        if not files:
+            return
+        # end handle no plugins
+
+        cache = key = None
+        if self.PluginManifestCacheType is not None and self.PluginManifestCacheType.is_enabled():
+            cache = self.PluginManifestCacheType()
+            fingerprint = [sys.version]
+            for py_file, mod_name in files:
+                try:
+                    st = os.stat(py_file)
+                except OSError:
+                    fingerprint = None
+                    break
+                # end handle vanished files
+                fingerprint.extend((py_file, mod_name, repr(st.st_mtime), str(st.st_size)))
+            # end for each file
+            if fingerprint is not None:
+                key = cache.key('plugin-manifest', *fingerprint)
+            # end handle fingerprint
+        # end setup cache
+
+        manifest = None
+        if key is not None:
+            manifest = cache.get(key)
+        # end check manifest
+        if manifest is not None:
+            log.debug("Registering lazy plugins of %i files in '%s'", len(manifest), path)
+            for py_file, mod_name, interfaces in manifest:
+                if interfaces:
+                    self.register(LazyPluginModule(py_file, mod_name, interfaces))
+                # end skip files without plugins
+            # end for each file
+            return
+        # end handle cached manifest
+
+        manifest = list()
+        for py_file, mod_name in files:
+            try:
+                items = self.capture_registrations(partial(PythonFileLoader.load_file, py_file, mod_name))
+            except Exception:
+                log.error("Failed to load %s from %s", mod_name, py_file, exc_info=True)
+                # don't cache a manifest which could be incomplete
+                key = None
+                continue
+            # end handle import errors
+            log.info("loaded %s into module %s", py_file, mod_name)
+            interfaces = set()
+            for item in items:
+                interfaces |= LazyPluginModule.interface_names(item)
+            # end for each registered item
+            manifest.append((py_file, mod_name, tuple(sorted(interfaces))))
+        # end for each file
+        if key is not None:
+            cache.set(key, manifest)
+        # end store manifest
+
+    def load_plugins(self, recurse = False, subdirectory = 'plug-ins', lazy = False):
         """Call this method explicitly once this instance was pushed onto the top of the context stack.
         This assures that new instances are properly registered with this Context, and not the previous one
         on the stack
@@ -219,15 +332,66 @@ class HierarchicalContext(Context, LazyMixin):
         plugin directory
         @param subdirectory an optional name of the subdirectory within each configuration directory which 
         is supposed to contain plugin files. If None, the configuration directory itself is used.
+        @param lazy if True, a plugin file will only be imported once a query for types or instances 
+        finds one of the plugins it registered. Which plugins each file registers is taken from a 
+        cached manifest of each plugin directory. If there is none, all files of the directory will be 
+        imported to create it. Files which don't register any plugin will not be imported at all.
         @note plugins should be loaded only AFTER this environment was pushed onto the stack. Otherwise
-        loaded plugins will end up in the previous environment, not in this one"""
+        loaded plugins will end up in the previous environment, not in this one. Lazily loaded plugins
+        will always end up in this context."""
         for path in self._filter_trees(self.config_trees()):
             if subdirectory is not None:
                 path /= subdirectory
             # end amend plugin dir
-            PythonFileLoader.load_files(path, recurse=recurse)
+            self._plugin_sources.append((path, recurse))
+            if lazy:
+                self._load_plugins_lazily(path, recurse)
+            else:
+                PythonFileLoader.load_files(path, recurse=recurse)
+            # end handle laziness
         # end load all plugins
     
     ## -- End Interface -- @}
+
+    # -------------------------
+    ## @name Snapshot Interface
+    # @{
+
+    def _restore_state(self, state):
+        super(HierarchicalContext, self)._restore_state(state)
+        self._trees = state['trees']
+        self._config_dirs = state['config_dirs']
+        self._config_files = state['config_files']
+        self._additional_config_files = state['additional_config_files']
+        self._settings_keys = state['settings_keys']
+        self._plugin_sources = state['plugin_sources']
+        self._config_contents = dict()
+
+    def snapshot_state(self):
+        """@return our state, including our configuration directories and files"""
+        state = super(HierarchicalContext, self).snapshot_state()
+        state.update(trees=self._trees, config_dirs=self._config_dirs, config_files=self.config_files(), 
+                     additional_config_files=self._additional_config_files, settings_keys=self._settings_keys,
+                     plugin_sources=self._plugin_sources)
+        return state
+
+    def snapshot_sources(self):
+        """@return all directories which could contain configuration, our configuration files, and the 
+        directories and files we loaded plugins from"""
+        sources = super(HierarchicalContext, self).snapshot_sources()
+        sources.extend(self._config_tree_candidates())
+        sources.extend(self._config_dirs)
+        sources.extend(self.config_files())
+        for path, recurse in self._plugin_sources:
+            if recurse:
+                sources.extend(dirpath for dirpath, dirnames, filenames in os.walk(path, followlinks=True))
+            else:
+                sources.append(path)
+            # end handle recursion
+            sources.extend(py_file for py_file, mod_name in PythonFileLoader.find_files(path, recurse=recurse))
+        # end for each plugin directory
+        return sources
+
+    ## -- End Snapshot Interface -- @}
     
 # end class HierarchicalContext
@@ -0,0 +1,230 @@
+#-*-coding:utf-8-*-
+"""
+@package bcontext.snapshot
+@brief A versioned, binary file format to store the contexts of a ContextStack and restore them later
+
+@author Sebastian Thiel
+@copyright [GNU Lesser General Public License](https://www.gnu.org/licenses/lgpl.html)
+"""
+__all__ = ['ContextStackSnapshot', 'StackSnapshotError']
+
+import os
+import sys
+import struct
+import thread
+import hashlib
+import logging
+
+from cPickle import ( loads,
+                      dumps,
+                      HIGHEST_PROTOCOL )
+
+from butility import ( FileHashCache,
+                       PythonFileLoader )
+
+log = logging.getLogger('bcontext.snapshot')
+
+
+class StackSnapshotError(ValueError):
+    """Thrown if a snapshot can't be created, read or restored"""
+    __slots__ = ()
+
+# end class StackSnapshotError
+
+
+class ContextStackSnapshot(object):
+    """The state of all contexts of a ContextStack, including the aggregated settings of each level of the stack.
+    It can be written to a file, and read and restored in another process with ContextStack.restore(),
+    which is much faster than finding, parsing and merging configuration files again.
+
+    Each snapshot has a fingerprint of all files and directories its contexts were built from, see
+    Context.snapshot_sources(). If any of them changed, the snapshot is invalid and shouldn't be restored.
+    Additionally, a tag can be used to identify the way the contexts were built.
+
+    The file consists of a header with magic, the sha1 digest of the payload and its size, followed
+    by the pickled payload.
+    """
+    __slots__ = (
+                    '_tag',         ## a string identifying the way the contexts were built
+                    '_sources',     ## list of paths our contexts were built from
+                    '_fingerprint', ## fingerprint of all our sources at the time we were created
+                    '_levels'       ## list of (context type reference, state, aggregated settings) tuples
+                )
+
+    # -------------------------
+    ## @name Configuration
+    # @{
+
+    ## Identifies our file format and its version. Files of other versions can't be read
+    magic = 'BCSNAP01'
+
+    ## -- End Configuration -- @}
+
+    ## magic, sha1 digest of payload, size of payload
+    _header = struct.Struct('<8s20sQ')
+
+    def __init__(self, levels, sources, tag='', fingerprint=None):
+        """Initialize this instance
+        @param levels list of (context type reference, state, aggregated settings) tuples, one per level of the
+        stack, bottom first. The state is obtained by Context.snapshot_state()
+        @param sources list of paths the contexts were built from
+        @param tag a string identifying the way the contexts were built
+        @param fingerprint if None, it will be computed from the current state of the sources"""
+        self._levels = levels
+        self._sources = sources
+        self._tag = tag
+        if fingerprint is None:
+            fingerprint = self.fingerprint_of(sources)
+        # end compute fingerprint
+        self._fingerprint = fingerprint
+
+    # -------------------------
+    ## @name Utilities
+    # @{
+
+    @classmethod
+    def type_reference(cls, typ):
+        """@return a picklable reference to the given type, suitable for resolve_type()
+        @throws StackSnapshotError if the type isn't accessible from its module, like types defined in functions"""
+        module = sys.modules.get(typ.__module__)
+        if getattr(module, typ.__name__, None) is not typ:
+            raise StackSnapshotError("Type %s.%s can't be referenced by name" % (typ.__module__, typ.__name__))
+        # end assure type can be found
+        path = getattr(module, '__file__', None)
+        if path is not None and path.endswith(('.pyc', '.pyo')):
+            path = path[:-1]
+        # end prefer source files
+        return typ.__module__, typ.__name__, path
+
+    @classmethod
+    def resolve_type(cls, reference):
+        """@return the type matching the given reference, as obtained by type_reference()
+        If its module wasn't imported yet, it will be imported, or loaded from its file if it can't be imported.
+        @throws StackSnapshotError if the type couldn't be found"""
+        module_name, name, path = reference
+        module = sys.modules.get(module_name)
+        try:
+            if module is None:
+                try:
+                    __import__(module_name)
+                    module = sys.modules[module_name]
+                except ImportError:
+                    if path is None or not os.path.isfile(path):
+                        raise
+                    # end handle modules loaded from files
+                    module = PythonFileLoader.load_file(path, module_name)
+                # end handle import
+            # end import module
+            return getattr(module, name)
+        except Exception, err:
+            raise StackSnapshotError("Could not resolve type %s.%s: %s" % (module_name, name, err))
+        # end convert exceptions
+
+    @classmethod
+    def fingerprint_of(cls, sources):
+        """@return a string which changes whenever the contents of the given files or the entries of the given
+        directories change, or when they are created or removed
+        @param sources iterable of paths to files or directories"""
+        hashes = FileHashCache.instance()
+        sha = hashlib.sha1(cls.magic)
+        for path in sources:
+            sha.update('\0%s\0' % path)
+            try:
+                if os.path.isdir(path):
+                    sha.update('d' + '\0'.join(sorted(os.listdir(path))))
+                else:
+                    sha.update('f' + hashes.digest(path))
+                # end handle path type
+            except (OSError, IOError):
+                sha.update('-')
+            # end handle missing paths
+        # end for each source
+        hashes.flush()
+        return sha.hexdigest()
+
+    ## -- End Utilities -- @}
+
+    # -------------------------
+    ## @name Interface
+    # @{
+
+    def tag(self):
+        """@return the tag we were created with"""
+        return self._tag
+
+    def sources(self):
+        """@return list of paths our contexts were built from"""
+        return self._sources
+
+    def fingerprint(self):
+        """@return the fingerprint of our sources at the time we were created"""
+        return self._fingerprint
+
+    def levels(self):
+        """@return list of (context type reference, state, aggregated settings) tuples, bottom first"""
+        return self._levels
+
+    def is_valid(self, tag=None):
+        """@return True if none of our sources changed since we were created
+        @param tag if not None, our tag must match the given one as well"""
+        if tag is not None and tag != self._tag:
+            return False
+        # end check tag
+        return self._fingerprint == self.fingerprint_of(self._sources)
+
+    def write(self, path):
+        """Write this snapshot to the file at the given path, atomically replacing existing files
+        @return this instance"""
+        payload = dumps((self._tag, self._sources, self._fingerprint, self._levels), HIGHEST_PROTOCOL)
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # end assure directory exists
+        # writers may be in different processes and threads
+        tmp_path = '%s.%i.%i.tmp' % (path, os.getpid(), thread.get_ident())
+        fp = open(tmp_path, 'wb')
+        try:
+            try:
+                fp.write(self._header.pack(self.magic, hashlib.sha1(payload).digest(), len(payload)))
+                fp.write(payload)
+            finally:
+                fp.close()
+            # end assure file is closed
+            os.rename(tmp_path, path)
+        except Exception:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            # end cleanup
+            raise
+        # end handle write errors
+        return self
+
+    @classmethod
+    def read(cls, path):
+        """@return a new snapshot read from the file at the given path
+        @throws StackSnapshotError if the file is malformed or was written in another version of our format
+        @throws IOError if the file couldn't be read"""
+        fp = open(path, 'rb')
+        try:
+            data = fp.read()
+        finally:
+            fp.close()
+        # end assure file is closed
+
+        if len(data) < cls._header.size:
+            raise StackSnapshotError("Snapshot at '%s' is truncated" % path)
+        # end check size
+        magic, digest, size = cls._header.unpack_from(data)
+        if magic != cls.magic:
+            raise StackSnapshotError("Snapshot at '%s' has unknown format '%s'" % (path, magic))
+        # end check magic
+        payload = data[cls._header.size:]
+        if len(payload) != size or hashlib.sha1(payload).digest() != digest:
+            raise StackSnapshotError("Snapshot at '%s' is corrupted" % path)
+        # end check integrity
+        tag, sources, fingerprint, levels = loads(payload)
+        return cls(levels, sources, tag, fingerprint)
+
+    ## -- End Interface -- @}
+
+# end class ContextStackSnapshot
@@ -9,16 +9,50 @@
 """
 __all__ = []
 
+import time
+
 from butility import (InterfaceBase,
                       abstractmethod)
 
 from .base import TestContextBase
 from butility import PythonFileLoader
+from butility.tests import with_rw_directory
 
 from bkvstore import KeyValueStoreModifier
+from bdiff import IterativeTwoWayDiff
 from bcontext import *
 
 
+# ==============================================================================
+## @name Lazy Plugin Utilities
+# ------------------------------------------------------------------------------
+# Used by plugin files written during test_lazy_plugins
+## @{
+
+## The stack the plugin files will register their plugins in
+lazy_plugin_stack = ContextStack()
+
+## names of the plugin files, in import order
+lazy_plugin_imports = list()
+
+class LazyPlugin(Plugin):
+    __slots__ = ()
+    _stack_ = lazy_plugin_stack
+# end class LazyPlugin
+
+
+class ILazyA(InterfaceBase):
+    __slots__ = ()
+# end class ILazyA
+
+
+class ILazyB(InterfaceBase):
+    __slots__ = ()
+# end class ILazyB
+
+## -- End Lazy Plugin Utilities -- @}
+
+
 class TestPlugin(TestContextBase):
 
     def test_context(self):
@@ -101,6 +135,203 @@ class TestPlugin(TestContextBase):
         stack.new_instances(str, args=[5], take_ownership=True)
         assert len(stack.instances(str)) == 1
 
+    def test_registry_index(self):
+        """Verify indexed lookups yield the same results as scanning all registrees"""
+        class IBase(InterfaceBase):
+            __slots__ = ()
+        class IDerived(IBase):
+            __slots__ = ()
+        class IVirtual(InterfaceBase):
+            __slots__ = ()
+        class Base(IBase):
+            __slots__ = ()
+        class Derived(IDerived):
+            __slots__ = ()
+        class Unrelated(object):
+            __slots__ = ()
+        IVirtual.register(Unrelated)
+
+        def scan(stack, interface, want_types, find_all=True):
+            res = list()
+            for ctx in reversed(stack.stack()):
+                items = [item for item in reversed(ctx._registry) 
+                              if (isinstance(item, interface) or 
+                                  (isinstance(item, type) and issubclass(item, interface))) and
+                                 isinstance(item, type) == want_types]
+                res += items
+                if items and not find_all:
+                    break
+                # end handle early abort
+            # end for each context
+            return res
+        # end brute-force reference
+
+        def verify(stack):
+            for interface in (object, type, IBase, IDerived, IVirtual, Base, Derived, Unrelated, int):
+                assert stack.types(interface) == scan(stack, interface, True)
+                assert stack.instances(interface, find_all=True) == scan(stack, interface, False)
+                assert stack.instances(interface) == scan(stack, interface, False, find_all=False)
+            # end for each interface
+        # end utility
+
+        stack = ContextStack()
+        verify(stack)
+        lower = stack.push('lower')
+        for item in (Base, Derived(), Unrelated(), 1):
+            stack.register(item)
+        # end for each item
+        verify(stack)
+        upper = stack.push('upper')
+        verify(stack)
+        for item in (Derived, Base(), Base(), Unrelated):
+            stack.register(item)
+            verify(stack)
+        # end for each item
+
+        # registering in lower contexts is seen too
+        rev = lower.revision()
+        lower.register(Derived())
+        assert lower.revision() != rev
+        verify(stack)
+
+        assert stack.types(IBase, lambda cls: cls is Base) == [Base]
+        assert len(stack.instances(IBase, lambda inst: isinstance(inst, Derived), find_all=True)) == 2
+
+        stack.pop()
+        verify(stack)
+        stack.push(upper)
+        verify(stack)
+        upper.reset()
+        verify(stack)
+        stack.remove(lower)
+        verify(stack)
+        stack.insert(0, lower)
+        verify(stack)
+
+    @with_rw_directory
+    def test_lazy_plugins(self, rw_dir):
+        """Verify plugin files are only imported once their plugins are queried"""
+        plugin_dir = rw_dir / 'etc' / 'plug-ins'
+        plugin_dir.makedirs()
+        header = ("from bcontext.tests.test_base import (lazy_plugin_imports, LazyPlugin, ILazyA, ILazyB)\n"
+                  "lazy_plugin_imports.append(__name__)\n")
+        open(plugin_dir / 'lazy_a.py', 'w').write(header + "class ImplA(LazyPlugin, ILazyA):\n  pass\nImplA()\n")
+        open(plugin_dir / 'lazy_b.py', 'w').write(header + "class ImplB(LazyPlugin, ILazyB):\n  pass\n")
+        open(plugin_dir / 'lazy_none.py', 'w').write(header)
+
+        class ManifestCache(PluginManifestCache):
+            __slots__ = ()
+
+            def __init__(self):
+                super(ManifestCache, self).__init__(rw_dir / 'cache')
+        # end class ManifestCache
+
+        class LazyContext(HierarchicalContext):
+            __slots__ = ()
+            PluginManifestCacheType = ManifestCache
+        # end class LazyContext
+
+        def names(items):
+            return [getattr(item, '__name__', type(item).__name__) for item in items]
+        # end utility
+
+        # eager loading as reference, which creates the manifest as well
+        order = [mod_name for py_file, mod_name in PythonFileLoader.find_files(plugin_dir)]
+        expected = list()
+        for lazy in (False, True):
+            del lazy_plugin_imports[:]
+            lazy_plugin_stack.reset()
+            ctx = lazy_plugin_stack.push(LazyContext(rw_dir, traverse_settings_hierarchy=False))
+            ctx.load_plugins(lazy=lazy)
+            assert lazy_plugin_imports == order
+            assert not ctx.instances(LazyPluginModule)
+            expected.append(names(ctx.types(object)) + names(ctx.instances(object)))
+        # end for each mode
+        assert expected[0] == expected[1]
+        assert sorted(expected[0]) == ['ImplA', 'ImplA', 'ImplB']
+        assert len(ManifestCache()._entries()) == 1, "there should be one manifest"
+
+        # with a manifest, no plugin is imported right away
+        del lazy_plugin_imports[:]
+        lazy_plugin_stack.reset()
+        ctx = lazy_plugin_stack.push(LazyContext(rw_dir, traverse_settings_hierarchy=False))
+        ctx.load_plugins(lazy=True)
+        assert not lazy_plugin_imports
+        assert len(ctx.instances(LazyPluginModule)) == 2, "files without plugins are not registered"
+
+        # plugins end up in their context, even if it is not on top of the stack anymore
+        lazy_plugin_stack.push('top')
+        assert names(lazy_plugin_stack.types(ILazyA)) == ['ImplA']
+        assert names(lazy_plugin_stack.instances(ILazyA)) == ['ImplA']
+        assert lazy_plugin_imports == ['lazy_a']
+        assert not lazy_plugin_stack.top().types(object)
+        assert len(ctx.instances(LazyPluginModule)) == 1
+        assert names(lazy_plugin_stack.new_instances(ILazyB)) == ['ImplB']
+        assert lazy_plugin_imports == ['lazy_a', 'lazy_b']
+
+        # the order is the same as if the plugins were loaded right away
+        assert names(ctx.types(object)) + names(ctx.instances(object)) == expected[0]
+
+    @with_rw_directory
+    def test_stack_snapshot(self, rw_dir):
+        """Verify stacks can be written to snapshots and restored from them"""
+        etc = rw_dir / 'etc'
+        plugin_dir = etc / 'plug-ins'
+        plugin_dir.makedirs()
+        open(etc / 'settings.yaml', 'w').write("snapshot:\n  value: 1\n")
+        open(plugin_dir / 'snapshot_a.py', 'w').write(
+                            "from bcontext.tests.test_base import (LazyPlugin, ILazyA)\n"
+                            "class SnapshotImplA(LazyPlugin, ILazyA):\n  pass\nSnapshotImplA()\n")
+
+        lazy_plugin_stack.reset()
+        lazy_plugin_stack.push('base')
+        ctx = lazy_plugin_stack.push(HierarchicalContext(rw_dir, traverse_settings_hierarchy=False))
+        ctx.load_plugins()
+        top = Context('top')
+        top.set_settings(KeyValueStoreModifier({'snapshot' : {'other' : 2}}))
+        lazy_plugin_stack.push(top)
+        expected = lazy_plugin_stack.settings().data()
+        assert expected.snapshot.value == 1 and expected.snapshot.other == 2
+
+        snapshot_file = rw_dir / 'snapshot.bin'
+        snapshot = lazy_plugin_stack.snapshot('tag')
+        assert snapshot.is_valid() and snapshot.is_valid('tag') and not snapshot.is_valid('other')
+        snapshot.write(snapshot_file)
+
+        stack = ContextStack().restore(ContextStackSnapshot.read(snapshot_file))
+        assert [type(level) for level in stack.stack()] == [type(level) for level in lazy_plugin_stack.stack()]
+        assert stack.settings().data() == expected
+        assert stack.stack()[1].config_files() == ctx.config_files()
+        assert [type(item).__name__ for item in stack.instances(ILazyA)] == ['SnapshotImplA']
+        assert stack.types(ILazyA)[0] is lazy_plugin_stack.types(ILazyA)[0]
+        assert not [item for item in lazy_plugin_stack.types(ILazyA) if item is not stack.types(ILazyA)[0]], \
+                                                                            "restoring must not register anything"
+
+        # changes to configuration and plugin directories invalidate the snapshot
+        for new_file in (etc / 'new.yaml', plugin_dir / 'new.py'):
+            open(new_file, 'w').write("")
+            assert not snapshot.is_valid()
+            new_file.remove()
+            assert snapshot.is_valid()
+        # end for each new file
+        time.sleep(0.01)
+        open(etc / 'settings.yaml', 'w').write("snapshot:\n  value: 2\n")
+        assert not ContextStackSnapshot.read(snapshot_file).is_valid()
+
+        # corrupted and truncated files are detected
+        data = open(snapshot_file, 'rb').read()
+        for corrupted in (data[:-1] + chr((ord(data[-1]) + 1) % 256), data[:10], 'BCSNAP00' + data[8:]):
+            open(snapshot_file, 'wb').write(corrupted)
+            self.failUnlessRaises(StackSnapshotError, ContextStackSnapshot.read, snapshot_file)
+        # end for each corruption
+
+        # types which can't be imported by name can't be snapshotted
+        class LocalContext(Context):
+            __slots__ = ()
+        # end class LocalContext
+        lazy_plugin_stack.push(LocalContext('local'))
+        self.failUnlessRaises(StackSnapshotError, lazy_plugin_stack.snapshot)
+
     def test_stack_settings(self):
         """test settings aggregation"""
         kv1 = KeyValueStoreModifier({'one' : {'one' : 1,
@@ -135,6 +366,88 @@ class TestPlugin(TestContextBase):
         kvd = stack.settings().data()
         assert kvd.to_dict() == kv1.data()
 
+        # snapshots are reused when popping and pushing, and invalidated when the stack changes beneath them
+        base_kvstore = stack.settings()
+        stack.push(ctx)
+        assert stack.settings().data().three == 3
+        stack.pop()
+        assert stack.settings() is base_kvstore, "popping should reuse the snapshot of the previous level"
+
+        stack.insert(0, Context('inserted'))
+        assert stack.settings() is not base_kvstore
+        assert stack.settings().data().to_dict() == kv1.data()
+        stack.remove(stack.stack()[0])
+        assert stack.settings().data().to_dict() == kv1.data()
+
+    def test_stack_settings_sharing(self):
+        """Verify snapshots share all branches which are not changed by the context on top"""
+        stack = ContextStack()
+        for name, data in (('first', {'one' : {'value' : 1},
+                                      'two' : {'list' : [1]}}),
+                           ('second', {'two' : {'value' : 2}})):
+            ctx = Context(name)
+            ctx.set_settings(KeyValueStoreModifier(data))
+            stack.push(ctx)
+        # end for each context
+
+        kvstore = stack.settings()
+        lower, upper = [snapshot._data() for ctx, snapshot in stack._snapshots]
+        assert upper['one'] is lower['one'], "untouched branches should be shared"
+        assert upper['two'] is not lower['two']
+        assert upper['two']['list'] is lower['two']['list']
+        assert kvstore.data().two.value == 2
+
+        # the kvstore may still be changed, without affecting the snapshot below, and copying only what changes
+        kvstore.set_value('one.value', 5)
+        assert kvstore.value('one.value', 0) == 5
+        assert lower['one']['value'] == 1
+        assert kvstore._data()['two'] is upper['two']
+        kvstore.delete_value('two.list')
+        assert lower['two']['list'] == [1]
+
+    def test_stack_settings_reuse(self):
+        """Verify switching the top-most context only merges the new context onto the snapshots below"""
+        class CountingTwoWayDiff(IterativeTwoWayDiff):
+            __slots__ = ()
+            num_diffs = 0
+
+            def diff(self, *args, **kwargs):
+                CountingTwoWayDiff.num_diffs += 1
+                return super(CountingTwoWayDiff, self).diff(*args, **kwargs)
+        # end class CountingTwoWayDiff
+
+        class CountingContextStack(ContextStack):
+            __slots__ = ()
+            TwoWayDiffAlgorithmType = CountingTwoWayDiff
+        # end class CountingContextStack
+
+        def new_context(name, num_keys):
+            ctx = Context(name)
+            ctx.set_settings(KeyValueStoreModifier(dict(('%s-%i' % (name, kid), { 'value' : kid, 
+                                                                                   'tree' : { 'list' : [kid] } })
+                                                        for kid in range(num_keys))))
+            return ctx
+        # end utility
+
+        num_keys = 10
+        depth = 8
+        stack = CountingContextStack()
+        for level in range(depth):
+            stack.push(new_context('level-%i' % level, num_keys))
+        # end for each level
+        assert len(stack.settings().keys()) == depth * num_keys
+        assert CountingTwoWayDiff.num_diffs == depth
+        lower = [kvstore for ctx, kvstore in stack._snapshots[:-1]]
+
+        for switch in range(3):
+            CountingTwoWayDiff.num_diffs = 0
+            stack.pop()
+            stack.push(new_context('scene-%i' % switch, num_keys))
+            assert len(stack.settings().keys()) == depth * num_keys
+            assert CountingTwoWayDiff.num_diffs == 1, "only the new context should be merged"
+            assert all(new is old for new, old in zip((kvstore for ctx, kvstore in stack._snapshots), lower))
+        # end for each scene switch
+
     def test_plugin(self):
         """verify plugin type registration works"""
         stack = ContextStack()
@@ -16,3 +16,4 @@ from .base import *
 from .delegates import *
 from .algorithms import *
 from .utility import *
+from .fingerprint import *
@@ -6,11 +6,13 @@
 @author Sebastian Thiel
 @copyright [GNU Lesser General Public License](https://www.gnu.org/licenses/lgpl.html)
 """
-__all__ = ['TwoWayDiff']
+__all__ = ['TwoWayDiff', 'IterativeTwoWayDiff']
 
 from .base import (RootKey,
                    NoValue,
-                   TreeItem)
+                   TreeItem,
+                   TwoWayDiffDelegateInterface)
+from butility import DictObject
 
 class TwoWayDiff(object):
     """A type implementing an two-way diff algorithm.
@@ -21,12 +23,33 @@ class TwoWayDiff(object):
     
     @note the algorithm works in an unordered fashion, such that additions and deletion events will be send
     in a particular order determined by the code, and not by the underlying data. This means that after a merge,
-    your order of keys might be different"""
-    __slots__ = ( )
+    your order of keys might be different
+    
+    Delegates which implement `register_unchanged_tree()` will be informed about trees which are known to be 
+    identical, instead of receiving events for all of their values. Trees are identical if they are the same 
+    object, or if they have the same fingerprint within the SubtreeFingerprints instance we are configured with.
+    Similarly, delegates implementing `register_tree_change()` may handle entire trees which were added or 
+    deleted."""
+    __slots__ = ( 
+                    '_fingerprints',    # a SubtreeFingerprints instance, or None
+                )
+
+    ## Cache of (delegate type, method names) => True if the delegate uses the default implementation
+    _default_method_cache = dict()
+
+    def __init__(self, fingerprints=None):
+        """Initialize this instance
+        @param fingerprints if not None, a SubtreeFingerprints instance to use for finding identical trees.
+        It may be shared among multiple diffs, as long as the trees it knows don't change."""
+        self._fingerprints = fingerprints
     
     # -------------------------
     ## @name Interface
     # @{
+
+    def fingerprints(self):
+        """@return the SubtreeFingerprints instance we use, or None"""
+        return self._fingerprints
     
     def diff(self, delegate, left, right, _key=RootKey):
         """Compare the left and right nested tree with each other by recursively
@@ -54,6 +77,9 @@ class TwoWayDiff(object):
         @return this instance"""
         l_is_tree = delegate.is_tree(left)
         r_is_tree = delegate.is_tree(right)
+        if l_is_tree and r_is_tree and self._skip_unchanged_tree(delegate, _key, left, right):
+            return self
+        #end handle identical trees
         l_keys = r_keys = tuple()
 
         if l_is_tree:
@@ -115,6 +141,39 @@ class TwoWayDiff(object):
     # Utility methods which can be overridden by subtypes to add support 
     # for custom types
     # @{
+
+    @classmethod
+    def _uses_default(cls, delegate, *names):
+        """@return True if the delegate uses the default implementation of all methods with the given names"""
+        dtype = type(delegate)
+        key = (dtype, names)
+        try:
+            return cls._default_method_cache[key]
+        except KeyError:
+            base = TwoWayDiffDelegateInterface
+            res = all(getattr(getattr(dtype, name), 'im_func', None) is getattr(base, name).im_func 
+                      for name in names)
+            cls._default_method_cache[key] = res
+            return res
+        # end handle cache
+
+    def _skip_unchanged_tree(self, delegate, key, left, right):
+        """@return True if left and right are identical trees which were handled by the delegate in one go.
+        In that case, no other event must be sent for them.
+        @note fingerprints are only used if the delegate doesn't customize how trees and values are compared,
+        as they wouldn't reflect this"""
+        if self._uses_default(delegate, 'register_unchanged_tree'):
+            return False
+        # end bail out if delegate can't handle it
+        if left is not right:
+            fingerprints = self._fingerprints
+            if (fingerprints is None or
+                not self._uses_default(delegate, 'is_tree', 'keys', 'value_by_key', 'equal_values') or
+                not fingerprints.equal(left, right)):
+                return False
+            # end handle fingerprints
+        # end handle identity
+        return delegate.register_unchanged_tree(key, left, right)
     
     @classmethod
     def _register_recursive_change(cls, delegate, key, tree, tree_keys, 
@@ -145,6 +204,7 @@ class TwoWayDiff(object):
         #end utility
         
         left, right = left_right_in_order(tree)
+        tree_hook = not cls._uses_default(delegate, 'register_tree_change')
         
         delegate.push_tree_level(key, left, right)
 
@@ -152,7 +212,14 @@ class TwoWayDiff(object):
             value = delegate.value_by_key(tree, child_key)
             # depth first
             if delegate.is_tree(value):
-                cls._register_recursive_change(delegate, child_key, value, delegate.keys(value), 
+                child_keys = delegate.keys(value)
+                if child_keys and tree_hook:
+                    l_tree, r_tree = left_right_in_order(value)
+                    if delegate.register_tree_change(child_key, l_tree, r_tree, change_type):
+                        continue
+                    # end skip trees handled by delegate
+                # end handle whole trees
+                cls._register_recursive_change(delegate, child_key, value, child_keys, 
                                                         right_is_none, change_type)
             else:
                 left, right = left_right_in_order(value)
@@ -164,3 +231,245 @@ class TwoWayDiff(object):
         
     ## -- End Internal Utilities -- @}
 # end class TwoWayDiff
+
+
+class IterativeTwoWayDiff(TwoWayDiff):
+    """A TwoWayDiff which sends the same events to its delegate, but uses an explicit work stack instead 
+    of recursion. This makes it immune to the recursion limit, and avoids most of the per-node overhead.
+
+    Delegates which don't override `subtract_key_lists()` and `possibly_modified_keys()` get their key sets 
+    computed with just two sets per node, preserving the order of keys.
+
+    Delegates which have `batch_changes` set receive the changes of a tree level in lists, using
+    `register_changes()`. Pending changes are sent right before the level is popped, or before a nested level is 
+    pushed, which keeps them in order. Changes found when comparing two non-trees at the root are passed to 
+    `register_change()` as usual.
+    
+    @note this type can be used wherever a TwoWayDiff is used, like in the KeyValueStoreProvider.
+    """
+    __slots__ = ()
+
+    # Instructions on our work stack
+    _NODE, _PUSH, _POP, _CHANGES, _RECURSIVE = range(5)
+
+    ## The types TwoWayDiffDelegateInterface.is_tree() considers trees
+    _tree_types = (dict, DictObject)
+
+    # -------------------------
+    ## @name Interface
+    # @{
+
+    def diff(self, delegate, left, right, _key=RootKey):
+        """Compare the left and right tree exactly like TwoWayDiff.diff(), without recursion
+        @return this instance"""
+        for _ in self.iter_diff(delegate, left, right, _key):
+            pass
+        # end for each step
+        return self
+
+    def iter_diff(self, delegate, left, right, _key=RootKey):
+        """Similar to diff(), but returns a generator which runs the diff step by step. 
+        Each step executes one instruction, which may or may not cause calls to the delegate. This allows to 
+        look at the findings of the delegate while the diff is running, and to stop it early by not 
+        exhausting the generator.
+        @return generator yielding None once per step"""
+        NODE, PUSH, POP, CHANGES, RECURSIVE = self._NODE, self._PUSH, self._POP, self._CHANGES, self._RECURSIVE
+        is_tree = delegate.is_tree
+        keys_of = delegate.keys
+        value_by_key = delegate.value_by_key
+        register_change = delegate.register_change
+        equal_values = delegate.equal_values
+        added, deleted = delegate.added, delegate.deleted
+        modified, unchanged = delegate.modified, delegate.unchanged
+        default_keys = self._uses_default(delegate, 'subtract_key_lists', 'possibly_modified_keys')
+        # If the delegate doesn't customize it, we check for trees and get values without calling it
+        tree_types = self._uses_default(delegate, 'is_tree') and self._tree_types or None
+        default_values = self._uses_default(delegate, 'value_by_key')
+        batched = getattr(delegate, 'batch_changes', False)
+        skip_unchanged = not self._uses_default(delegate, 'register_unchanged_tree')
+        tree_hook = not self._uses_default(delegate, 'register_tree_change')
+        # one list of pending changes per pushed level, used if we are batched
+        batches = list()
+
+        stack = [(NODE, _key, left, right)]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            yield
+            item = pop()
+            op = item[0]
+            if op == NODE:
+                _, key, left, right = item
+                if tree_types:
+                    l_is_tree = isinstance(left, tree_types)
+                    r_is_tree = isinstance(right, tree_types)
+                else:
+                    l_is_tree = is_tree(left)
+                    r_is_tree = is_tree(right)
+                # end handle tree check
+                if not (l_is_tree or r_is_tree):
+                    # none of the items is a tree, compare by value - this only happens at the root
+                    change_type = equal_values(left, right) and unchanged or modified
+                    register_change(key, left, right, change_type)
+                    continue
+                # end handle values
+
+                if skip_unchanged and l_is_tree and r_is_tree:
+                    if batched and batches and batches[-1]:
+                        # keep changes in order
+                        delegate.register_changes(batches[-1])
+                        batches[-1] = list()
+                    # end flush pending changes
+                    if self._skip_unchanged_tree(delegate, key, left, right):
+                        continue
+                    # end handle identical trees
+                # end handle unchanged trees
+
+                l_keys = l_is_tree and keys_of(left) or tuple()
+                r_keys = r_is_tree and keys_of(right) or tuple()
+                keys_to_check = tuple()
+                if default_keys:
+                    if l_is_tree and r_is_tree:
+                        l_set = set(l_keys)
+                        r_set = set(r_keys)
+                        keys_added = [k for k in r_keys if k not in l_set]
+                        keys_deleted = [k for k in l_keys if k not in r_set]
+                        keys_to_check = [k for k in r_keys if k in l_set]
+                    else:
+                        keys_added, keys_deleted = r_keys, l_keys
+                    # end handle key subtraction
+                else:
+                    keys_added = delegate.subtract_key_lists(r_keys, l_keys)
+                    keys_deleted = delegate.subtract_key_lists(l_keys, r_keys)
+                    if l_is_tree and r_is_tree:
+                        keys_to_check = delegate.possibly_modified_keys(l_keys, r_keys, keys_added)
+                    # end handle modifications
+                # end handle delegate type
+
+                # Items are pushed in reverse order of execution
+                if l_is_tree and r_is_tree:
+                    push((POP,))
+                    # Compare leafs right away, only trees need another iteration
+                    children = list()
+                    leafs = list()
+                    for k in keys_to_check:
+                        if default_values:
+                            l_value, r_value = left[k], right[k]
+                        else:
+                            l_value, r_value = value_by_key(left, k), value_by_key(right, k)
+                        # end handle value access
+                        if tree_types:
+                            has_tree = isinstance(l_value, tree_types) or isinstance(r_value, tree_types)
+                        else:
+                            has_tree = is_tree(l_value) or is_tree(r_value)
+                        # end handle tree check
+                        if has_tree:
+                            if leafs:
+                                children.append((CHANGES, leafs))
+                                leafs = list()
+                            # end keep leafs in order
+                            children.append((NODE, k, l_value, r_value))
+                        else:
+                            change_type = equal_values(l_value, r_value) and unchanged or modified
+                            leafs.append((k, l_value, r_value, change_type))
+                        # end handle value type
+                    # end for each key to check
+                    if leafs:
+                        children.append((CHANGES, leafs))
+                    # end handle remaining leafs
+                    children.reverse()
+                    stack.extend(children)
+                    push((PUSH, key, left, right))
+                elif l_is_tree:
+                    push((CHANGES, [(key, TreeItem, right, added)]))
+                else:
+                    push((CHANGES, [(key, left, TreeItem, deleted)]))
+                # end handle tree types
+                if keys_deleted:
+                    push((RECURSIVE, key, left, keys_deleted, True, deleted, False))
+                if keys_added:
+                    push((RECURSIVE, key, right, keys_added, False, added, False))
+                # end handle added and deleted keys
+            elif op == CHANGES:
+                if batched and batches:
+                    batches[-1].extend(item[1])
+                else:
+                    for change in item[1]:
+                        register_change(*change)
+                    # end for each change
+                # end handle batching
+            elif op == PUSH:
+                if batched:
+                    # pending changes of the parent level must be sent before we enter the next one
+                    if batches and batches[-1]:
+                        delegate.register_changes(batches[-1])
+                        batches[-1] = list()
+                    # end flush parent level
+                    batches.append(list())
+                # end handle batching
+                delegate.push_tree_level(item[1], item[2], item[3])
+            elif op == POP:
+                if batched:
+                    changes = batches.pop()
+                    if changes:
+                        delegate.register_changes(changes)
+                    # end handle changes
+                # end handle batching
+                delegate.pop_tree_level()
+            else:
+                _, key, tree, tree_keys, right_is_none, change_type, whole_tree = item
+                if right_is_none:
+                    l_tree, r_tree = tree, NoValue
+                else:
+                    l_tree, r_tree = NoValue, tree
+                # end assign sides
+                if whole_tree and tree_hook:
+                    if batched and batches and batches[-1]:
+                        delegate.register_changes(batches[-1])
+                        batches[-1] = list()
+                    # end flush pending changes
+                    if delegate.register_tree_change(key, l_tree, r_tree, change_type):
+                        continue
+                    # end skip trees handled by delegate
+                # end handle whole trees
+                push((POP,))
+                children = list()
+                leafs = list()
+                for child_key in tree_keys:
+                    if default_values:
+                        value = tree[child_key]
+                    else:
+                        value = value_by_key(tree, child_key)
+                    # end handle value access
+                    if tree_types:
+                        value_is_tree = isinstance(value, tree_types)
+                    else:
+                        value_is_tree = is_tree(value)
+                    # end handle tree check
+                    if value_is_tree:
+                        child_keys = keys_of(value)
+                        if child_keys:
+                            if leafs:
+                                children.append((CHANGES, leafs))
+                                leafs = list()
+                            # end keep leafs in order
+                            children.append((RECURSIVE, child_key, value, child_keys, right_is_none, change_type, True))
+                        # end skip empty trees
+                    elif right_is_none:
+                        leafs.append((child_key, value, NoValue, change_type))
+                    else:
+                        leafs.append((child_key, NoValue, value, change_type))
+                    # end handle tree type
+                # end for each child
+                if leafs:
+                    children.append((CHANGES, leafs))
+                # end handle remaining leafs
+                children.reverse()
+                stack.extend(children)
+                push((PUSH, key, l_tree, r_tree))
+            # end handle instruction
+        # end while there is work
+
+    ## -- End Interface -- @}
+
+# end class IterativeTwoWayDiff
@@ -75,6 +75,16 @@ class TwoWayDiffDelegateInterface(object):
     change_types = (added, deleted, modified, unchanged)
     
     ## -- End Change Types -- @}
+
+    # -------------------------
+    ## @name Configuration
+    # @{
+
+    ## If True, algorithms which support it will call register_changes() once per tree level instead of 
+    ## calling register_change() for each change
+    batch_changes = False
+
+    ## -- End Configuration -- @}
     
 
     # -------------------------
@@ -206,6 +216,45 @@ class TwoWayDiffDelegateInterface(object):
           + left_value equals right_value
         """
         
+    def register_changes(self, changes):
+        """Register all changes found on the current tree level at once. It is called instead of 
+        register_change() if batch_changes is True and the algorithm supports it, right before the level
+        is popped.
+        @param changes a list of (key, left_value, right_value, change_type) tuples, see register_change(), 
+        in the order in which they were found
+        @note the base implementation calls register_change() for each change"""
+        register_change = self.register_change
+        for key, left_value, right_value, change_type in changes:
+            register_change(key, left_value, right_value, change_type)
+        # end for each change
+
+
+    def register_unchanged_tree(self, key, left_tree, right_tree):
+        """Called instead of walking two trees which are known to be identical, for instance because they are 
+        the same object, or have the same fingerprint.
+        
+        Delegates which implement it may handle the entire tree at once, without receiving any other event for it.
+        @param key under which both trees can be found, may be RootKey
+        @param left_tree the previous tree
+        @param right_tree the current tree, with the same contents as left_tree
+        @return True if the trees were handled, or False if the algorithm should walk them as usual, sending 
+        unchanged events for each of their values.
+        @note the base implementation returns False. Algorithms don't call it unless it is overridden"""
+        return False
+
+    def register_tree_change(self, key, left_tree, right_tree, change_type):
+        """Called before walking a non-empty tree which was added or deleted as a whole, to allow handling it 
+        in one go.
+        @param key under which the tree can be found
+        @param left_tree the deleted tree, or NoValue if it was added
+        @param right_tree the added tree, or NoValue if it was deleted
+        @param change_type either `added` or `deleted`
+        @return True if the tree was handled, or False if the algorithm should walk it as usual, sending
+        an event for each of its values.
+        @note the base implementation returns False. Algorithms don't call it unless it is overridden"""
+        return False
+        
+
     ## -- End TwoWayDiff Interface -- @}
     
 # end class TwoWayDiffDelegateInterface
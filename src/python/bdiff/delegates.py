@@ -9,10 +9,14 @@
 __all__ = [ 'DiffRecord', 'DiffIndex', 'DiffIndexDelegate', 'QualifiedKeyDiffDelegateBase', 'MergeDelegate',
             'AdditiveMergeDelegate', 'ApplyDifferenceMergeDelegate', 'AutoResolveAdditiveMergeDelegate']
 
+from collections import deque
+
 from .base import (TwoWayDiffDelegateInterface,
                    RootKey,
                    NoValue)
+from .algorithms import IterativeTwoWayDiff
 from butility import (OrderedDict,
+                      PersistentOrderedDict,
                       smart_deepcopy)
 
 # ==============================================================================
@@ -72,7 +76,7 @@ class DiffRecord(object):
     
     def key(self):
         """@return key identifying the stored values"""
-        return self.key
+        return self._key
         
     def value_left(self):
         """@return our left-hand side value, representing the previous state"""
@@ -98,9 +102,120 @@ class DiffIndex(OrderedDict):
     This instance is an ordered mapping of key-value pairs, where each key is a
     hierarchical string, which separates each level using a separation character.
     
-    The associated value is DiffRecord compatible item."""
-    __slots__ = ()
-    
+    The associated value is DiffRecord compatible item.
+
+    Records are kept in buckets by change type, and by key prefix, which makes querying them by change type 
+    or prefix independent of the total amount of records. Buckets are built on first use, and kept up-to-date
+    from there on. This way, building the index isn't slowed down by them.
+    iterate() uses these buckets automatically for predicates created by by_change_type() and by_key_prefix().
+    """
+    __slots__ = (
+                    '_key_separator',       # separator between key levels
+                    '_change_type_buckets', # None or change_type => OrderedDict(key => record)
+                    '_prefix_buckets'       # None or prefix => OrderedDict(key => record)
+                )
+
+    ## The separator between key levels, matching the one of QualifiedKeyDiffDelegateBase
+    key_separator = '/'
+
+    def __init__(self, items=(), key_separator=None):
+        """Initialize this instance
+        @param items an iterable of (key, record) pairs or a dict to initialize us with
+        @param key_separator if not None, the separator between key levels, overriding the one of our type"""
+        object.__setattr__(self, '_key_separator', key_separator or self.key_separator)
+        super(DiffIndex, self).__init__(items)
+
+    # -------------------------
+    ## @name Protocol Methods
+    # @{
+
+    def clear(self):
+        super(DiffIndex, self).clear()
+        object.__setattr__(self, '_change_type_buckets', None)
+        object.__setattr__(self, '_prefix_buckets', None)
+
+    def __setitem__(self, key, record):
+        if self._change_type_buckets is not None:
+            if key in self:
+                previous = dict.__getitem__(self, key)
+                if previous.change_type() != record.change_type():
+                    self._remove_from_bucket(self._change_type_buckets, previous.change_type(), key)
+                # end handle changed change type
+            # end handle replaced record
+            self._add_to_bucket(self._change_type_buckets, record.change_type(), key, record)
+        # end handle change type buckets
+        if self._prefix_buckets is not None:
+            for prefix in self._prefixes(key):
+                self._add_to_bucket(self._prefix_buckets, prefix, key, record)
+            # end for each prefix
+        # end handle prefix buckets
+        OrderedDict.__setitem__(self, key, record)
+
+    def __delitem__(self, key):
+        if self._change_type_buckets is not None:
+            self._remove_from_bucket(self._change_type_buckets, self[key].change_type(), key)
+        # end handle change type buckets
+        if self._prefix_buckets is not None:
+            for prefix in self._prefixes(key):
+                self._remove_from_bucket(self._prefix_buckets, prefix, key)
+            # end for each prefix
+        # end handle prefix buckets
+        OrderedDict.__delitem__(self, key)
+
+    def __reduce__(self):
+        return (type(self), (self.items(), self._key_separator))
+
+    ## -- End Protocol Methods -- @}
+
+    # -------------------------
+    ## @name Utilities
+    # @{
+
+    def _prefixes(self, key):
+        """@return list of all prefixes of the given key, including the key itself"""
+        sep = self._key_separator
+        tokens = key.split(sep)
+        return [sep.join(tokens[:count]) for count in xrange(1, len(tokens) + 1)]
+
+    @staticmethod
+    def _add_to_bucket(buckets, bucket_key, key, record):
+        """Put key and record into the bucket at bucket_key, creating it if required"""
+        bucket = buckets.get(bucket_key)
+        if bucket is None:
+            bucket = buckets[bucket_key] = OrderedDict()
+        # end create bucket
+        bucket[key] = record
+
+    @staticmethod
+    def _remove_from_bucket(buckets, bucket_key, key):
+        """Remove key from the bucket at bucket_key, and remove the bucket if it is empty"""
+        bucket = buckets[bucket_key]
+        del bucket[key]
+        if not bucket:
+            del buckets[bucket_key]
+        # end remove empty buckets
+
+    def _buckets(self, name):
+        """@return the buckets stored in the given slot, building them if required"""
+        buckets = getattr(self, name)
+        if buckets is None:
+            buckets = dict()
+            if name == '_prefix_buckets':
+                for key, record in self.iteritems():
+                    for prefix in self._prefixes(key):
+                        self._add_to_bucket(buckets, prefix, key, record)
+                    # end for each prefix
+                # end for each record
+            else:
+                for key, record in self.iteritems():
+                    self._add_to_bucket(buckets, record.change_type(), key, record)
+                # end for each record
+            # end handle bucket type
+            object.__setattr__(self, name, buckets)
+        # end build buckets lazily
+        return buckets
+
+    ## -- End Utilities -- @}
     
     # -------------------------
     ## @name Predicate Generators
@@ -114,7 +229,22 @@ class DiffIndex(OrderedDict):
             """Filter by stored change type"""
             return record.change_type() == change_type
         #end predicate definition
+        by_change_type_predicate.change_type = change_type
         return by_change_type_predicate
+
+    @classmethod
+    def by_key_prefix(cls, prefix):
+        """@return a predicate which will return true for all records whose key is prefix, or which are 
+        below it in the hierarchy
+        @param prefix a fully qualified key, using our key_separator, or '' to match all records"""
+        sep = cls.key_separator
+        def by_key_prefix_predicate(record):
+            """Filter by the position of the record's key in the hierarchy"""
+            key = record.key()
+            return not prefix or key == prefix or key.startswith(prefix + sep)
+        # end predicate definition
+        by_key_prefix_predicate.key_prefix = prefix
+        return by_key_prefix_predicate
     
     ## -- End Predicate Generators -- @}
     
@@ -125,12 +255,40 @@ class DiffIndex(OrderedDict):
     def iterate(self, predicate):
         """@return iterator which yields all stored DiffRecord instances for which
         predicate returns True
-        @param predicate `fun(record)` returning True for each record which matches"""
-        for record in self.itervalues():
+        @param predicate `fun(record)` returning True for each record which matches
+        @note predicates created by by_change_type() and by_key_prefix() only visit matching records"""
+        change_type = getattr(predicate, 'change_type', NoValue)
+        if change_type is not NoValue:
+            records = self.records_by_change_type(change_type)
+        elif hasattr(predicate, 'key_prefix'):
+            records = self.records_by_key_prefix(predicate.key_prefix)
+        else:
+            records = self.itervalues()
+        # end handle known predicates
+        for record in records:
             if predicate(record):
                 yield record
             #end if predicate matches
         #end for each key and record
+
+    def records_by_change_type(self, change_type):
+        """@return list of all records of the given change type, in order
+        @note records which replaced a record of a different change type will be last"""
+        bucket = self._buckets('_change_type_buckets').get(change_type)
+        return bucket is not None and bucket.values() or list()
+
+    def records_by_key_prefix(self, prefix):
+        """@return list of all records with the given key, or whose key is below the given one, in order
+        @param prefix a fully qualified key, or '' to obtain all records"""
+        if not prefix:
+            return self.values()
+        # end handle root
+        bucket = self._buckets('_prefix_buckets').get(prefix)
+        return bucket is not None and bucket.values() or list()
+
+    def change_types(self):
+        """@return list of all change types of our records"""
+        return self._buckets('_change_type_buckets').keys()
     
     ## -- End Interface -- @}
     
@@ -207,9 +365,13 @@ class DiffIndexDelegate(QualifiedKeyDiffDelegateBase):
     """A diff delegate which builds up a generic DiffIndex.
     
     It requires all keys to be strings which do not contain the separator
+
+    Use iter_records() to obtain records while the diff is running, instead of building up an index.
+    Subclasses should use _add_record() to record their findings to support this.
     """
     __slots__ = (
                     '_diff_index',  # the diff index we build 
+                    '_pending'      # None, or a deque of records which were not yet yielded by iter_records()
                 )
 
     # -------------------------
@@ -219,6 +381,11 @@ class DiffIndexDelegate(QualifiedKeyDiffDelegateBase):
     
     DiffRecordType = DiffRecord
     DiffIndexType = DiffIndex
+    ## The algorithm to use in iter_records(), it must provide an iter_diff() method
+    TwoWayDiffAlgorithmType = IterativeTwoWayDiff
+
+    ## We can handle all changes of a level at once
+    batch_changes = True
     
     ## -- End Types and Constants -- @}
     
@@ -232,7 +399,8 @@ class DiffIndexDelegate(QualifiedKeyDiffDelegateBase):
         
     def reset(self):
         """reset our internal state to support a clean plate"""
-        self._diff_index = self.DiffIndexType()
+        self._diff_index = self.DiffIndexType(key_separator=self.key_separator)
+        self._pending = None
         return super(DiffIndexDelegate, self).reset()
         
     def register_change(self, key, left_leaf, right_leaf, change_type):
@@ -240,10 +408,91 @@ class DiffIndexDelegate(QualifiedKeyDiffDelegateBase):
             return
         #end ignore unchanged values
         qualified_key = self._qualified_key(key)
-        self._diff_index[qualified_key] = self.DiffRecordType(qualified_key, left_leaf, right_leaf, change_type)
+        self._add_record(qualified_key, self.DiffRecordType(qualified_key, left_leaf, right_leaf, change_type))
+        
+    def register_changes(self, changes):
+        """Register all changes of the current level, computing the qualified key of the level only once"""
+        if type(self).register_change.im_func is not DiffIndexDelegate.register_change.im_func:
+            # respect subclasses which customize how changes are recorded
+            return super(DiffIndexDelegate, self).register_changes(changes)
+        # end handle overrides
+        sep = self.key_separator
+        prefix = sep.join(self._key_stack) + sep
+        plen = len(sep)
+        record_type = self.DiffRecordType
+        unchanged = self.unchanged
+        to_string_key = self._to_string_key
+        if self._pending is None:
+            index = self._diff_index
+            for key, left_leaf, right_leaf, change_type in changes:
+                if change_type is unchanged:
+                    continue
+                # end ignore unchanged values
+                qualified_key = (prefix + to_string_key(key))[plen:]
+                index[qualified_key] = record_type(qualified_key, left_leaf, right_leaf, change_type)
+            # end for each change
+        else:
+            append = self._pending.append
+            for key, left_leaf, right_leaf, change_type in changes:
+                if change_type is not unchanged:
+                    qualified_key = (prefix + to_string_key(key))[plen:]
+                    append(record_type(qualified_key, left_leaf, right_leaf, change_type))
+                # end ignore unchanged values
+            # end for each change
+        # end handle streaming
+
+
+    def register_unchanged_tree(self, key, left_tree, right_tree):
+        """Unchanged values are not part of the index, which is why identical trees can be ignored entirely"""
+        return type(self).register_change.im_func is DiffIndexDelegate.register_change.im_func
         
     ## -- End Interface Implementation -- @}
 
+    # -------------------------
+    ## @name Subclass Interface
+    # @{
+
+    def _add_record(self, qualified_key, record):
+        """Add the given record to our index, or provide it to iter_records() if it is running"""
+        if self._pending is None:
+            self._diff_index[qualified_key] = record
+        else:
+            self._pending.append(record)
+        # end handle streaming
+
+    ## -- End Subclass Interface -- @}
+
+    # -------------------------
+    ## @name Interface
+    # @{
+
+    def iter_records(self, left, right):
+        """Diff left and right and yield each record as soon as it was found. Records are not added to our 
+        index, which allows to stop the diff early, for instance at the first problematic change, without 
+        materializing all records.
+        @param left the left-hand tree, as it would be passed to TwoWayDiff.diff()
+        @param right the right-hand tree
+        @return generator yielding DiffRecordType instances in the order they were found
+        @note we will be reset before the diff starts, and once it is done or was stopped"""
+        self.reset()
+        pending = self._pending = deque()
+        popleft = pending.popleft
+        try:
+            for _ in self.TwoWayDiffAlgorithmType().iter_diff(self, left, right):
+                while pending:
+                    yield popleft()
+                # end for each pending record
+            # end for each diff step
+            while pending:
+                yield popleft()
+            # end yield remaining records
+        finally:
+            # the diff may have been interrupted
+            self.reset()
+        # end assure we can be used normally again
+
+    ## -- End Interface -- @}
+
 # end class DiffIndexDelegate
 
 
@@ -260,6 +509,10 @@ class MergeDelegate(QualifiedKeyDiffDelegateBase):
     
     @note Technically we don't need the QualifiedKeyDiffDelegateBase as a base, however, for now its 
     easier and more useful to have it maintained automatically. If this should be problematic, it can be changed.
+    
+    Trees of type PersistentOrderedDict are never changed. Instead, the levels we enter are copied, sharing 
+    everything else. Entire trees of that type which are added, deleted or unchanged will be shared instead of 
+    copied if that doesn't change the result.
     """
     __slots__ = (   
                     '_merged_value',  # the final composed value
@@ -273,6 +526,16 @@ class MergeDelegate(QualifiedKeyDiffDelegateBase):
     
     ## If True, empty trees/dictionaries will be deleted
     delete_empty_trees = True
+
+    ## Methods which must not be overridden to handle entire trees in one go
+    _walk_methods = ('register_change', 'register_changes', 'push_tree_level', 'pop_tree_level', 
+                     '_set_merged_value', 'is_tree', 'keys', 'value_by_key')
+
+    ## Cache of (type, owner, names) => result of _uses_default_walk()
+    _default_walk_cache = dict()
+
+    ## Changes only affect their own key on the current level, which is why we can receive them in batches
+    batch_changes = True
     
     # -------------------------
     ## @name Interface
@@ -302,12 +565,18 @@ class MergeDelegate(QualifiedKeyDiffDelegateBase):
             assert len(self._tree_stack) == 0, "Should have empty tree stack"
             if self._merged_value is NoValue:
                 self._merged_value = self.DictType()
+            elif isinstance(self._merged_value, PersistentOrderedDict):
+                self._merged_value = self._merged_value.thaw(self.DictType)
             #end assure we reuse root-level values if we had one
             self._tree_stack.append(self._merged_value)
         else:
             assert self._tree_stack, "Should have at least one tree already"
             # connect parents - we can run through the hierarchy multiple times
             self._merged_value = self._tree_stack[-1].setdefault(key, self.DictType())
+            if isinstance(self._merged_value, PersistentOrderedDict):
+                # copy-on-write - the immutable tree remains shared by everyone else
+                self._merged_value = self._tree_stack[-1][key] = self._merged_value.thaw(self.DictType)
+            # end handle immutable trees
             # If or left tree is actually not a tree, but a scalar (which is when it is NoValue)
             # We want to be sure that the merged_value can hold the values which might be coming in
             # Therefore we enforce a dict
@@ -379,7 +648,101 @@ class MergeDelegate(QualifiedKeyDiffDelegateBase):
         if value_to_set is not NoValue:
             self._set_merged_value(key, smart_deepcopy(value_to_set))
         #end set value is possible
+
+    def register_unchanged_tree(self, key, left_tree, right_tree):
+        """Copy the right tree into our merged value in one go, if that would be the outcome of walking it.
+        This is the case if unchanged values are handled by the base implementation, and if the key doesn't 
+        exist in the merged value yet. Immutable trees are shared instead of copied"""
+        if key is RootKey or not self._uses_default_walk(MergeDelegate, '_handle_unchanged'):
+            return False
+        # end handle customizations
+        parent_tree = self._tree_stack[-1]
+        if key in parent_tree:
+            return False
+        # end values would have to be merged
+        for tree in (left_tree, right_tree):
+            if isinstance(tree, PersistentOrderedDict) and not tree.has_empty_trees():
+                parent_tree[key] = tree
+                return True
+            # end share immutable trees
+        # end for each tree
+        tree = self._copy_unchanged_tree(right_tree)
+        if tree or not self.delete_empty_trees:
+            parent_tree[key] = tree
+        # end prune empty trees
+        return True
+
+    def register_tree_change(self, key, left_tree, right_tree, change_type):
+        """Share added immutable trees, and ignore deleted trees which aren't part of our merged value"""
+        if not self.is_tree(self._merged_value):
+            return False
+        # end handle non-trees
+        parent_tree = self._merged_value
+        if key in parent_tree:
+            return False
+        # end values would have to be merged
+        if change_type is self.added:
+            if (isinstance(right_tree, PersistentOrderedDict) and not right_tree.has_empty_trees() and
+                self._uses_default_walk(MergeDelegate, '_handle_added')):
+                parent_tree[key] = right_tree
+                return True
+            # end share immutable trees
+        elif change_type is self.deleted:
+            # walking it would create empty trees and delete them right away
+            return self.delete_empty_trees and self._uses_default_walk(MergeDelegate, '_handle_deleted')
+        # end handle change type
+        return False
     ## -- End TwoWayDiff Interface -- @}
+
+    # -------------------------
+    ## @name Utilities
+    # @{
+
+    @classmethod
+    def _uses_default_walk(cls, owner, *names):
+        """@return True if our type walks trees like the MergeDelegate, and if the methods with the given names 
+        are implemented by owner. Only then we can predict the outcome of walking an entire tree"""
+        key = (cls, owner, names)
+        try:
+            return cls._default_walk_cache[key]
+        except KeyError:
+            res = all(getattr(cls, name).im_func is getattr(MergeDelegate, name).im_func 
+                      for name in cls._walk_methods)
+            res = res and all(getattr(cls, name).im_func is getattr(owner, name).im_func for name in names)
+            cls._default_walk_cache[key] = res
+            return res
+        # end handle cache
+
+    @classmethod
+    def _has_empty_trees(cls, tree):
+        """@return True if the given tree, or any of its sub-trees, is empty"""
+        if isinstance(tree, PersistentOrderedDict):
+            return tree.has_empty_trees()
+        # end use cached information
+        if not tree:
+            return True
+        # end handle empty tree
+        return any(isinstance(value, dict) and cls._has_empty_trees(value) for value in tree.itervalues())
+
+    def _copy_unchanged_tree(self, tree):
+        """@return a copy of the given tree using our DictType, with all empty trees pruned if 
+        delete_empty_trees is set"""
+        out = self.DictType()
+        for key in self.keys(tree):
+            value = tree[key]
+            if self.is_tree(value):
+                value = self._copy_unchanged_tree(value)
+                if not value and self.delete_empty_trees:
+                    continue
+                # end prune empty trees
+            else:
+                value = smart_deepcopy(value)
+            # end handle value type
+            out[key] = value
+        # end for each item
+        return out
+
+    ## -- End Utilities -- @}
     
     # -------------------------
     ## @name Subclass Interface
@@ -501,6 +864,16 @@ class AdditiveMergeDelegate(MergeDelegate):
         if key is not RootKey and key not in parent_tree:
             parent_tree[key] = previous_value
         # handle key type
+
+    def register_tree_change(self, key, left_tree, right_tree, change_type):
+        """Keep deleted immutable trees by sharing them"""
+        if (change_type is self.deleted and isinstance(left_tree, PersistentOrderedDict) and 
+            not left_tree.has_empty_trees() and self.is_tree(self._merged_value) and 
+            key not in self._merged_value and self._uses_default_walk(AdditiveMergeDelegate, '_handle_deleted')):
+            self._merged_value[key] = left_tree
+            return True
+        # end share deleted immutable trees
+        return super(AdditiveMergeDelegate, self).register_tree_change(key, left_tree, right_tree, change_type)
         
 # end class AdditiveMergeDelegate
 
@@ -519,6 +892,19 @@ class ApplyDifferenceMergeDelegate(MergeDelegate):
     def _handle_unchanged(self, key, value):
         """We only want to keep different values, so unchanged ones will just be dropped"""
         return NoValue
+
+    def register_unchanged_tree(self, key, left_tree, right_tree):
+        """Identical trees can be ignored, unless walking them would prune empty trees from our merged value"""
+        if (key is RootKey or not self.delete_empty_trees or 
+            not self._uses_default_walk(ApplyDifferenceMergeDelegate, '_handle_unchanged')):
+            return False
+        # end handle customizations
+        parent_tree = self._tree_stack[-1]
+        if key not in parent_tree:
+            return True
+        # end walking would create empty trees and remove them right away
+        value = parent_tree[key]
+        return isinstance(value, self.DictType) and not self._has_empty_trees(value)
         
 # end class ApplyDifferenceMergeDelegate
 
@@ -0,0 +1,140 @@
+#-*-coding:utf-8-*-
+"""
+@package bdiff.fingerprint
+@brief Content fingerprints of trees, to quickly find identical branches
+
+@author Sebastian Thiel
+@copyright [GNU Lesser General Public License](https://www.gnu.org/licenses/lgpl.html)
+"""
+__all__ = ['SubtreeFingerprints']
+
+import hashlib
+
+from butility import DictObject
+
+
+class SubtreeFingerprints(object):
+    """A side-table of Merkle-style content fingerprints of trees and all of their sub-trees.
+
+    A fingerprint is a digest of all keys and values within a tree, regardless of their order. Two trees
+    with equal fingerprints are considered identical, which allows a diff algorithm to skip them entirely.
+
+    Fingerprints are keyed by the id of the tree they were computed for, and hold a reference to it, to
+    assure the id isn't reused. As trees are mutable, it's up to the user of this type to assure a tree
+    doesn't change while its fingerprint is cached. Use a version to do that, or call invalidate() or clear().
+
+    @note values are fingerprinted by their type and representation, which works for all values with a
+    repr() that distinguishes unequal values, as is the case for all types in a kvstore.
+    """
+    __slots__ = (
+                    '_entries',     ## id(tree) => (tree, version, digest)
+                    '_max_entries'  ## the maximum amount of entries we keep
+                )
+
+    # -------------------------
+    ## @name Configuration
+    # @{
+
+    ## The default amount of trees to keep fingerprints for
+    max_entries = 100000
+
+    ## The types we consider trees, matching TwoWayDiffDelegateInterface.is_tree()
+    tree_types = (dict, DictObject)
+
+    ## -- End Configuration -- @}
+
+    def __init__(self, max_entries=None):
+        """Initialize this instance
+        @param max_entries if not None, the amount of trees to keep fingerprints for at most. If there are
+        more, all fingerprints will be discarded"""
+        self._entries = dict()
+        self._max_entries = max_entries is None and self.max_entries or max_entries
+
+    # -------------------------
+    ## @name Utilities
+    # @{
+
+    def _value_digest(self, value):
+        """@return digest of a value which is not a tree"""
+        return hashlib.sha1('%s:%r' % (type(value).__name__, value)).digest()
+
+    def _tree_digest(self, tree, version):
+        """@return digest of the given tree, computing and caching it for all sub-trees if required"""
+        entry = self._entries.get(id(tree))
+        if entry is not None and entry[0] is tree and (version is None or entry[1] == version):
+            return entry[2]
+        # end handle cache hit
+
+        items = list()
+        for key, value in tree.items():
+            if isinstance(value, self.tree_types):
+                digest = self._tree_digest(value, version)
+            else:
+                digest = self._value_digest(value)
+            # end handle value type
+            items.append((repr(key), digest))
+        # end for each item
+        items.sort()
+
+        sha = hashlib.sha1('tree:%i' % len(items))
+        for key, digest in items:
+            sha.update(key)
+            sha.update(digest)
+        # end for each item
+        digest = sha.digest()
+
+        if len(self._entries) >= self._max_entries:
+            self._entries.clear()
+        # end limit size
+        self._entries[id(tree)] = (tree, version, digest)
+        return digest
+
+    ## -- End Utilities -- @}
+
+    # -------------------------
+    ## @name Interface
+    # @{
+
+    def fingerprint(self, tree, version=None):
+        """@return a binary digest of the contents of the given tree
+        @param tree a tree, i.e. a dict
+        @param version if not None, a cached fingerprint is only used if it was computed with the same version.
+        This allows to use a version counter of a data structure to invalidate fingerprints automatically.
+        @note fingerprints of all sub-trees are cached as well"""
+        return self._tree_digest(tree, version)
+
+    def has_fingerprint(self, tree):
+        """@return True if we have a fingerprint cached for the given tree"""
+        entry = self._entries.get(id(tree))
+        return entry is not None and entry[0] is tree
+
+    def equal(self, left_tree, right_tree):
+        """@return True if both trees have the same contents, based on their fingerprints. Fingerprints are
+        computed as needed"""
+        if left_tree is right_tree:
+            return True
+        # end handle identity
+        return self._tree_digest(left_tree, None) == self._tree_digest(right_tree, None)
+
+    def invalidate(self, tree):
+        """Forget the fingerprint of the given tree, for instance as it was changed
+        @note fingerprints of its parents must be invalidated as well
+        @return self"""
+        entry = self._entries.get(id(tree))
+        if entry is not None and entry[0] is tree:
+            del self._entries[id(tree)]
+        # end handle entry
+        return self
+
+    def clear(self):
+        """Forget all fingerprints
+        @return self"""
+        self._entries.clear()
+        return self
+
+    def __len__(self):
+        return len(self._entries)
+
+    ## -- End Interface -- @}
+
+# end class SubtreeFingerprints
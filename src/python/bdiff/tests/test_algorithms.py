@@ -8,10 +8,14 @@
 """
 __all__ = []
 
+import random
+
 from unittest import TestCase
 
 # test * import
 from bdiff import *
+from butility import (OrderedDict,
+                      smart_deepcopy)
 
 
 class TestDiffAlgorithms(TestCase):
@@ -49,6 +53,13 @@ class TestDiffAlgorithms(TestCase):
         self.delegate = DiffIndexDelegate()
         self.twoway = TwoWayDiff()
     
+    @classmethod
+    def _random_tree(cls, rng, depth):
+        if depth == 0 or rng.random() < 0.3:
+            return rng.choice((1, 'a', None, [1, 2]))
+        # end handle leaf
+        return dict((str(rng.randint(0, 6)), cls._random_tree(rng, depth - 1)) for _ in range(rng.randint(0, 5)))
+
     def test_twoway_simple(self):
         """basic tests using the twoway algorithm and the diff index"""
         ## [two way diff]
@@ -89,6 +100,75 @@ class TestDiffAlgorithms(TestCase):
             assert len(list(didx.iterate(modified_items))) == 2, "Invalid number of modified items"
         #end for each diff reversal mode
         
+    def test_diff_index_buckets(self):
+        """Verify queries by change type and key prefix match the ones by predicate on all records"""
+        def linear(didx, predicate):
+            return [record for record in didx.itervalues() if predicate(record)]
+        # end utility
+
+        rng = random.Random(5)
+        delegate = DiffIndexDelegate()
+        for iteration in range(20):
+            delegate.reset()
+            self.twoway.diff(delegate, self._random_tree(rng, 4), self._random_tree(rng, 4))
+            didx = delegate.result()
+
+            # change the index after the prefix buckets were built
+            for modification in range(2):
+                for change_type in (delegate.added, delegate.deleted, delegate.modified):
+                    predicate = DiffIndex.by_change_type(change_type)
+                    assert list(didx.iterate(predicate)) == linear(didx, predicate)
+                    assert didx.records_by_change_type(change_type) == linear(didx, predicate)
+                # end for each change type
+                assert set(didx.change_types()) == set(record.change_type() for record in didx.itervalues())
+
+                for key in didx.keys()[:5] + ['', '0', '1/2', 'doesnt-exist']:
+                    predicate = DiffIndex.by_key_prefix(key)
+                    assert list(didx.iterate(predicate)) == linear(didx, predicate)
+                    assert didx.records_by_key_prefix(key) == linear(didx, predicate)
+                # end for each key
+
+                for key in didx.keys()[::3]:
+                    del didx[key]
+                # end for each record to delete
+                for key in didx.keys()[::4]:
+                    didx[key] = DiffRecord(key, None, 1, didx[key].change_type())
+                # end for each record to change
+            # end for each modification
+        # end for each iteration
+
+        # records which change their type are moved to their new bucket
+        key = didx.keys()[0]
+        didx[key] = DiffRecord(key, 1, None, delegate.deleted)
+        didx[key] = DiffRecord(key, None, 1, delegate.added)
+        assert didx.records_by_change_type(delegate.added)[-1] is didx[key]
+        assert key not in [record.key() for record in didx.records_by_change_type(delegate.deleted)]
+        assert didx.records_by_key_prefix(key)[0] is didx[key]
+
+    def test_streaming_diff(self):
+        """Verify records can be obtained while the diff is running"""
+        rng = random.Random(6)
+        delegate = DiffIndexDelegate()
+        for iteration in range(20):
+            left, right = self._random_tree(rng, 4), self._random_tree(rng, 4)
+            delegate.reset()
+            IterativeTwoWayDiff().diff(delegate, left, right)
+            didx = delegate.result()
+
+            records = list(delegate.iter_records(left, right))
+            assert [record.key() for record in records] == didx.keys()
+            assert records == didx.values()
+            assert len(delegate.result()) == 0, "streamed records are not indexed"
+        # end for each iteration
+
+        # stop early
+        stream = delegate.iter_records(self.tree_a, self.tree_b)
+        record = stream.next()
+        assert isinstance(record, DiffRecord)
+        stream.close()
+        self.twoway.diff(delegate, self.tree_a, self.tree_b)
+        assert len(delegate.result()) > 1, "delegate should index records once streaming stopped"
+
     def test_check_two_items(self):
         """Compare two non-tree items with each other"""
         # check two items
@@ -181,4 +261,205 @@ class TestDiffAlgorithms(TestCase):
         assert res['one']['one'] == 1
         assert res['one']['two'] == 2
         
+    def test_unchanged_trees(self):
+        """Identical trees are reported in one go to delegates which support it"""
+        shared = {'x' : 1, 'y' : {'z' : [1, 2]}}
+        left = {'a' : shared, 'b' : {'c' : {'d' : 1}, 'e' : 1}, 'f' : 1}
+        right = {'a' : shared, 'b' : {'c' : {'d' : 1}, 'e' : 2}, 'f' : 2}
+
+        # identical objects are detected without fingerprints
+        delegate = _UnchangedTreeRecordingDelegate()
+        self.twoway.diff(delegate, left, right)
+        assert delegate.unchanged_trees == ['a']
+        assert not [e for e in delegate.result() if e[0] in ('a', 'a/x', 'a/y/z')]
+
+        # equal trees are detected by fingerprint
+        fingerprints = SubtreeFingerprints()
+        twoway = type(self.twoway)(fingerprints=fingerprints)
+        assert twoway.fingerprints() is fingerprints
+        delegate.reset()
+        twoway.diff(delegate, left, right)
+        assert delegate.unchanged_trees == ['a', 'b/c']
+        assert ('b/e', 1, 2, delegate.modified) in delegate.result()
+
+        # delegates which don't implement it get all events
+        delegate = _RecordingDelegate()
+        twoway.diff(delegate, left, right)
+        assert ('a/x', 1, 1, delegate.unchanged) in delegate.result()
+
+        # results don't change, with identical branches or without
+        rng = random.Random(7)
+        for _ in range(300):
+            left = self._random_tree(rng, 4)
+            right = rng.random() < 0.5 and self._random_tree(rng, 4) or smart_deepcopy(left)
+            if isinstance(left, dict) and isinstance(right, dict) and left:
+                key = rng.choice(left.keys())
+                right[key] = rng.random() < 0.5 and left[key] or smart_deepcopy(left[key])
+                if rng.random() < 0.5:
+                    right[str(rng.randint(0, 6))] = 'changed'
+                # end add a change
+            # end share branches
+            for delegate_type in (DiffIndexDelegate, AdditiveMergeDelegate, ApplyDifferenceMergeDelegate,
+                                  AutoResolveAdditiveMergeDelegate):
+                for base in (NoValue, {'9' : 1}):
+                    plain, fast = delegate_type(), delegate_type()
+                    if base is not NoValue and isinstance(plain, MergeDelegate):
+                        plain._merged_value, fast._merged_value = dict(base), dict(base)
+                    # end initialize merge base
+                    self.twoway.diff(plain, left, right)
+                    twoway.diff(fast, left, right)
+                    pres, fres = plain.result(), fast.result()
+                    if isinstance(pres, DiffIndex):
+                        assert sorted(pres.keys()) == sorted(fres.keys())
+                    else:
+                        assert pres == fres
+                    # end handle result type
+                # end for each merge base
+            # end for each delegate type
+        # end for each sample
+
+    def test_fingerprints(self):
+        """Fingerprints reflect the contents of trees, regardless of their order"""
+        fingerprints = SubtreeFingerprints()
+        tree = OrderedDict([('a', 1), ('b', {'c' : [1, 2]})])
+        other = OrderedDict([('b', {'c' : [1, 2]}), ('a', 1)])
+        assert fingerprints.fingerprint(tree) == fingerprints.fingerprint(other)
+        assert fingerprints.has_fingerprint(tree) and fingerprints.has_fingerprint(tree['b'])
+        assert len(fingerprints) == 4
+        assert fingerprints.equal(tree, other)
+
+        for changed in ({'a' : 1, 'b' : {'c' : [1, 3]}},
+                        {'a' : '1', 'b' : {'c' : [1, 2]}},
+                        {'a' : 1, 'b' : {'c' : [1, 2]}, 'd' : dict()},
+                        {'a' : 1, 'b' : {'c' : {'1' : 2}}}):
+            assert not fingerprints.equal(tree, changed)
+        # end for each changed tree
+
+        # changes are only seen after invalidation, or with a new version
+        digest = fingerprints.fingerprint(tree)
+        tree['a'] = 2
+        assert fingerprints.fingerprint(tree) == digest
+        assert fingerprints.fingerprint(tree, version=1) != digest
+        assert fingerprints.invalidate(tree).fingerprint(tree) == fingerprints.fingerprint(tree, version=1)
+        assert not fingerprints.clear()
+        assert len(SubtreeFingerprints(max_entries=2).clear()) == 0
+
 # end class TestDiff
+
+
+class _RecordingDelegate(QualifiedKeyDiffDelegateBase):
+    """Records all events it receives"""
+    __slots__ = ('events', 'batches')
+
+    def reset(self):
+        self.events = list()
+        self.batches = list()
+        return super(_RecordingDelegate, self).reset()
+
+    def result(self):
+        return self.events
+
+    def push_tree_level(self, key, left_tree, right_tree):
+        super(_RecordingDelegate, self).push_tree_level(key, left_tree, right_tree)
+        self.events.append(('push', self._qualified_key(key), left_tree is NoValue, right_tree is NoValue))
+
+    def pop_tree_level(self):
+        super(_RecordingDelegate, self).pop_tree_level()
+        self.events.append(('pop',))
+
+    def register_change(self, key, left_value, right_value, change_type):
+        self.events.append((self._qualified_key(key), left_value, right_value, change_type))
+
+    def register_changes(self, changes):
+        self.batches.append(len(changes))
+        super(_RecordingDelegate, self).register_changes(changes)
+
+# end class _RecordingDelegate
+
+
+class _UnchangedTreeRecordingDelegate(_RecordingDelegate):
+    """Records identical trees as well"""
+    __slots__ = ('unchanged_trees')
+
+    def reset(self):
+        self.unchanged_trees = list()
+        return super(_UnchangedTreeRecordingDelegate, self).reset()
+
+    def register_unchanged_tree(self, key, left_tree, right_tree):
+        assert left_tree == right_tree
+        self.unchanged_trees.append(self._qualified_key(key))
+        return True
+
+# end class _UnchangedTreeRecordingDelegate
+
+
+class _BatchedRecordingDelegate(_RecordingDelegate):
+    __slots__ = ()
+
+    batch_changes = True
+
+# end class _BatchedRecordingDelegate
+
+
+class TestIterativeDiffAlgorithms(TestDiffAlgorithms):
+    """Runs all tests with the iterative implementation"""
+    __slots__ = ()
+
+    def setUp(self):
+        super(TestIterativeDiffAlgorithms, self).setUp()
+        self.twoway = IterativeTwoWayDiff()
+
+    def test_equivalence(self):
+        """The iterative implementation must produce the same events and results as the recursive one"""
+        rng = random.Random(5)
+        for _ in range(500):
+            left, right = self._random_tree(rng, 4), self._random_tree(rng, 4)
+            for delegate_type in (_RecordingDelegate, _BatchedRecordingDelegate):
+                recursive, iterative = delegate_type(), delegate_type()
+                TwoWayDiff().diff(recursive, left, right)
+                self.twoway.diff(iterative, left, right)
+                # the order of siblings may differ, as the recursive implementation uses sets
+                assert sorted(recursive.result()) == sorted(iterative.result())
+            # end for each delegate type
+            for delegate_type in (DiffIndexDelegate, AdditiveMergeDelegate, ApplyDifferenceMergeDelegate):
+                recursive, iterative = delegate_type(), delegate_type()
+                TwoWayDiff().diff(recursive, left, right)
+                self.twoway.diff(iterative, left, right)
+                rres, ires = recursive.result(), iterative.result()
+                if isinstance(rres, DiffIndex):
+                    assert sorted(rres.keys()) == sorted(ires.keys())
+                    assert [r.change_type() for k, r in sorted(rres.items())] == \
+                           [r.change_type() for k, r in sorted(ires.items())]
+                else:
+                    assert rres == ires or (hasattr(rres, 'to_dict') and rres.to_dict() == ires.to_dict())
+                # end handle result type
+            # end for each delegate type
+        # end for each sample
+
+    def test_batched_delegate(self):
+        """Batched delegates receive lists of changes, in order"""
+        delegate = _BatchedRecordingDelegate()
+        left = OrderedDict([('a', 1), ('b', OrderedDict([('c', 1)])), ('d', 2), ('e', 3)])
+        right = OrderedDict([('a', 2), ('b', OrderedDict([('c', 2)])), ('d', 3), ('e', 3)])
+        self.twoway.diff(delegate, left, right)
+        assert delegate.batches == [1, 1, 2], "one batch per run of leafs on each level"
+        keys = [event[0] for event in delegate.result() if event[0] not in ('push', 'pop')]
+        assert keys == ['a', 'b/c', 'd', 'e'], "order of keys is preserved"
+
+        # merges keep the order of keys
+        delegate = AdditiveMergeDelegate()
+        self.twoway.diff(delegate, OrderedDict(), left)
+        assert delegate.result().keys() == left.keys()
+
+    def test_deep_trees(self):
+        """We are not limited by the recursion limit"""
+        tree = node = dict()
+        for _ in range(5000):
+            node['k'] = dict()
+            node = node['k']
+        # end for each level
+        node['v'] = 1
+        self.twoway.diff(self.delegate, dict(), tree)
+        assert len(self.delegate.result()) == 1
+
+# end class TestIterativeDiffAlgorithms
@@ -46,8 +46,12 @@ _init_yaml_persistence()
 
 from .base import *
 from .serialize import *
+from .cache import *
 from .persistence import *
 from .schema import *
 from .diff import *
 from .types import *
+from .view import *
+from .compiler import *
+from .resolve import *
 from .utility import *
@@ -13,17 +13,21 @@ import copy
 import logging
 
 from bdiff import ( ApplyDifferenceMergeDelegate,
-                    TwoWayDiff,
+                    IterativeTwoWayDiff,
                     RootKey,
                     NoValue,
                     merge_data)
 
 from butility import  (OrderedDict,
+                       PersistentOrderedDict,
+                       DictObject,
                        smart_deepcopy)
 
 from .diff import ( KeyValueStoreProviderDiffDelegate,
                     KeyValueStoreModifierDiffDelegate,
                     KeyValueStoreModifierBaseSwapDelegate )
+from .view import KeyValueStoreValueView
+from .compiler import KeyValueStoreSchemaCompiler
 
 
 # ==============================================================================
@@ -88,7 +92,10 @@ class KeyValueStoreProvider(object):
     Access a key's value by providing its name. The name may be hierarchical,
     such as `section.option`
     """
-    __slots__ = ('_value_dict')
+    __slots__ = (
+                    '_value_dict',      # our data
+                    '_resolver'         # a FormatStringResolver for our data, or None if it wasn't needed yet
+                )
 
     ## Our class-wide logging facility
     log = logging.getLogger("bkvstore.base")
@@ -97,11 +104,17 @@ class KeyValueStoreProvider(object):
     key_separator = KeyValueStoreProviderDiffDelegate.key_separator
 
     ## The algorithm we use to diff trees
-    TwoWayDiffAlgorithmType = TwoWayDiff
+    TwoWayDiffAlgorithmType = IterativeTwoWayDiff
 
     ## The delegate for the diff algorithm
     DiffProviderDelegateType = KeyValueStoreProviderDiffDelegate
 
+    ## The type compiling schemas into functions which obtain their values without a diff
+    SchemaCompilerType = KeyValueStoreSchemaCompiler
+
+    ## If True, schemas will be compiled, which obtains their values much faster
+    compile_schemas = True
+
     def __init__(self, value_dict, take_ownership=True):
         """Initialize this instance with the value_dict which contains the
         values to be retrieved or modified
@@ -113,6 +126,7 @@ class KeyValueStoreProvider(object):
             assert hasattr(value_dict, attr), "Dictionary type (%s) needs to implement %s" % (value_dict, attr)    
         #end for each attr
         self._value_dict = NoValue
+        self._resolver = None
         self._set_data(value_dict, take_ownership)
               
     def __str__(self, path = [], indention = 0):
@@ -126,7 +140,7 @@ class KeyValueStoreProvider(object):
     ## @name Interface Implementation
     # @{
 
-    def value(self, key, default, resolve=False):
+    def value(self, key, default, resolve=False, view=False):
         """Query the value for the given key
 
         @param key a name string which may be made up of multiple names, each
@@ -153,15 +167,24 @@ class KeyValueStoreProvider(object):
 
         In any way its to be assured that changes to the returned value are not
         affecting the in-memory representation of the original values.
+        @param view if True and if default is a tree, a KeyValueStoreValueView will be returned instead
+        of a copy. It computes values lazily when they are accessed, and copies them only when changed.
+        This is useful if you only read a few values of a large tree.
         @throw If no default value is provided, as it is None, a `NoSuchKeyError` is thrown"""
         # value can be None - we diff against it anyway
         value = self._resolve_value(key, self._value_dict)
-        args = [key, self.log]
-        if resolve:
-            args.append(self._value_dict)
-        # end handle resolver
+        if view and isinstance(default, (dict, DictObject)):
+            return KeyValueStoreValueView(self, key, value, default, resolve)
+        # end handle view
         
-        delegate = self.DiffProviderDelegateType(*args)
+        delegate = self._new_value_delegate(key, resolve)
+        compiled = self._compiled_schema(default, type(delegate), resolve)
+        if compiled is not None:
+            result = compiled.extract(value, delegate)
+            if result is not NoValue:
+                return result
+            # end use compiled result
+        # end handle compiled schemas
         self.TwoWayDiffAlgorithmType().diff(delegate, value, default)
 
         value = delegate.result()
@@ -171,10 +194,10 @@ class KeyValueStoreProvider(object):
         #end handle no value
         return value
         
-    def value_by_schema(self, schema, resolve=False):
+    def value_by_schema(self, schema, resolve=False, view=False):
         """Similar to value(), but a single schema is enough to obain the value
-        @return a deep copy of data conforming to the given schema"""
-        return self.value(schema.key(), schema, resolve=resolve)
+        @return a deep copy of data conforming to the given schema, or a view if view is True"""
+        return self.value(schema.key(), schema, resolve=resolve, view=view)
         
     def has_value(self, key):
         """@return true if there is a value stored for the given key"""
@@ -208,6 +231,31 @@ class KeyValueStoreProvider(object):
     ## @name Subclass Utilities
     # @{
 
+    def _new_value_delegate(self, key, resolve):
+        """@return a new delegate to obtain a value at the given key, as used by value()"""
+        if not resolve:
+            return self.DiffProviderDelegateType(key, self.log)
+        # end handle no resolver
+        return self.DiffProviderDelegateType(key, self.log, self._value_dict, self._format_string_resolver())
+
+    def _compiled_schema(self, default, delegate_type, resolve):
+        """@return a CompiledKeyValueStoreSchema for the given default value, or None if value() has to use
+        the diff algorithm to obtain it. Only schemas are compiled, as they are reused."""
+        if (not self.compile_schemas or not isinstance(default, DictObject) or
+            self.TwoWayDiffAlgorithmType not in self.SchemaCompilerType.algorithm_types):
+            return None
+        # end handle compilation
+        return self.SchemaCompilerType.compiled(default, delegate_type, resolve)
+
+    def _format_string_resolver(self):
+        """@return a resolver for format strings in our data, which is shared until our data changes"""
+        if self._resolver is None:
+            delegate_type = self.DiffProviderDelegateType
+            self._resolver = delegate_type.FormatStringResolverType(self._value_dict,
+                                                                    delegate_type.StringFormatterType)
+        # end create resolver on demand
+        return self._resolver
+
     @classmethod
     def _split_key(cls, key):
         """@return key split into tokens, separator is '.'"""
@@ -246,6 +294,7 @@ class KeyValueStoreProvider(object):
             value_dict = copy.deepcopy(value_dict)
         # end handle take ownership
         self._value_dict = value_dict
+        self._resolver = None
         return self
 
     ## -- End Subclass Utilities -- @}
@@ -282,12 +331,33 @@ class KeyValueStoreModifier(KeyValueStoreProvider):
     Generally, we will keep two trees, one is the base value, one is a copy which will actually be modified.
     Whenever there is the need to determine changes, we can just diff the two trees accordingly.
 
+    Schema Cache
+    ------------
+    Each modification increments our version(). Results of value_by_schema() are kept in a bounded cache,
+    which is valid for the current version only. This makes repeated queries for the same schema cheap.
+    Similarly, format strings are resolved only once per version.
+
     @note we are also value provider as it is common to have read access when you have write-access too.
     """
-    __slots__ = ()
+    __slots__ = (
+                    '_version',                 # amount of changes made to our data so far
+                    '_schema_cache',            # OrderedDict of (id(schema), resolve) => (schema, value) pairs
+                    '_schema_cache_hits',       # amount of times a value was served from our schema cache
+                    '_schema_cache_misses'      # amount of times a value was not in our schema cache
+                )
 
     KeyValueStoreModifierDiffDelegateType = KeyValueStoreModifierDiffDelegate
 
+    ## The maximum amount of values we keep in our schema cache. 0 disables the cache
+    schema_cache_size = 64
+
+    def __init__(self, value_dict, take_ownership=True):
+        """Initialize our version and schema cache"""
+        self._version = 0
+        self._schema_cache = OrderedDict()
+        self._schema_cache_hits = self._schema_cache_misses = 0
+        super(KeyValueStoreModifier, self).__init__(value_dict, take_ownership)
+
     @classmethod
     def copy(cls, kvstoremodifier):
         """ copy constructor """
@@ -301,7 +371,8 @@ class KeyValueStoreModifier(KeyValueStoreProvider):
 
         @param key fully qualified key
         @param initial_tree_value tree-like value that will be used initially .
-        It will be changed, as new children of the same type will be added
+        It will be changed, as new children of the same type will be added. Immutable trees on the way will be
+        replaced by mutable copies of their level, which keeps sharing their sub-trees.
         @return tuple(parent_tree, leaf_key)
         @note if a key 'section.option' is given, you receive the tree for 'section' and the leaf-key 'option'.
         """
@@ -309,15 +380,82 @@ class KeyValueStoreModifier(KeyValueStoreProvider):
             return initial_tree_value, RootKey
         tokens = key.split(self.key_separator)
         value = initial_tree_value
+        dict_type = type(initial_tree_value)
         while len(tokens) > 1:
-            value = value.setdefault(tokens.pop(0), type(initial_tree_value)())
+            token = tokens.pop(0)
+            child = value.setdefault(token, dict_type())
+            if isinstance(child, PersistentOrderedDict):
+                child = value[token] = child.thaw(dict_type)
+            # end copy immutable trees on write
+            value = child
         #end while we have n - 1 tokens
         return value, tokens[0]
 
+    def _writable_data(self):
+        """@return our data dict, after assuring it can be changed
+        @note our data may be immutable if it is shared with others"""
+        if isinstance(self._value_dict, PersistentOrderedDict):
+            self._value_dict = self._value_dict.thaw(self.KeyValueStoreModifierDiffDelegateType.DictType)
+        # end copy immutable data on write
+        return self._value_dict
+
+    def _set_data(self, data_dict, take_ownership=True):
+        """Set our data and invalidate cached values"""
+        self._increment_version()
+        return super(KeyValueStoreModifier, self)._set_data(data_dict, take_ownership)
+
+    @classmethod
+    def _copy_cached_value(cls, value):
+        """@return a copy of the given cached value, which copies leafs just like our delegates do.
+        @note a plain deep copy would fail for some immutable leaf types, like compiled regular expressions"""
+        if isinstance(value, dict):
+            if isinstance(value, PersistentOrderedDict):
+                copied = OrderedDict()
+            else:
+                copied = type(value)()
+            # end handle immutable trees
+            for key, item in value.iteritems():
+                copied[key] = cls._copy_cached_value(item)
+            # end for each item
+            return copied
+        # end handle trees
+        return smart_deepcopy(value)
+
+    def _increment_version(self):
+        """Indicate our data changed, which invalidates our schema cache and format string resolver
+        @return this instance"""
+        self._version += 1
+        self._schema_cache.clear()
+        self._resolver = None
+        return self
+
     # -------------------------
     ## @name Interface Implementation
     # @{
 
+    def value_by_schema(self, schema, resolve=False, view=False):
+        """Similar to KeyValueStoreProvider.value_by_schema(), but values are cached until our data changes
+        @note cached values are copied before they are returned, just like any other value"""
+        if view or not self.schema_cache_size:
+            return super(KeyValueStoreModifier, self).value_by_schema(schema, resolve, view)
+        # end handle uncached values
+
+        cache = self._schema_cache
+        cache_key = (id(schema), resolve)
+        entry = cache.pop(cache_key, None)
+        # the identity check protects against reused ids of schemas which don't exist anymore
+        if entry is not None and entry[0] is schema:
+            self._schema_cache_hits += 1
+        else:
+            self._schema_cache_misses += 1
+            entry = (schema, super(KeyValueStoreModifier, self).value_by_schema(schema, resolve))
+            while len(cache) >= self.schema_cache_size:
+                cache.popitem(last=False)
+            # end evict least recently used values
+        # end handle cache hit
+        cache[cache_key] = entry
+        return self._copy_cached_value(entry[1])
+
     def set_value(self, key, new_value):
         """Set the value associated with the given key to a new value in a
         type-safe fashion
@@ -341,12 +479,13 @@ class KeyValueStoreModifier(KeyValueStoreProvider):
 
         # find the spot for the new value to be placed - its technically the parent of value
         # ignore what value was (could be None), and start searching the parent from the root tree
-        value, leaf_key = self._resolve_value_with_dict(key, self._value_dict)
+        value, leaf_key = self._resolve_value_with_dict(key, self._writable_data())
         if leaf_key is RootKey:
             # NOTE: Should be use _set_data() here ?
             self._value_dict = delegate.result()
         else:
             value[leaf_key] = delegate.result()
+        self._increment_version()
 
         return self
         
@@ -372,11 +511,22 @@ class KeyValueStoreModifier(KeyValueStoreProvider):
             self.log.debug("Value at key '%s' didn't exist for deletion - ignoring it", key)
             return self
         #end if there is no value
-        value, leaf_key = self._resolve_value_with_dict(key, self._value_dict)
+        value, leaf_key = self._resolve_value_with_dict(key, self._writable_data())
         del(value[leaf_key])
+        self._increment_version()
 
         return self
 
+    def version(self):
+        """@return an integer which is incremented each time our data changes"""
+        return self._version
+
+    def schema_cache_info(self):
+        """@return dict with information about our schema cache, namely the amount of 'hits' and 'misses',
+        its current 'size' and our data 'version'"""
+        return dict(hits=self._schema_cache_hits, misses=self._schema_cache_misses, 
+                    size=len(self._schema_cache), version=self._version)
+
     ## -- End Interface Implementation -- @}
 
 # end class KeyValueStoreModifier
@@ -384,23 +534,53 @@ class KeyValueStoreModifier(KeyValueStoreProvider):
 
 class ChangeTrackingKeyValueStoreModifier(KeyValueStoreModifier):
     """A base tracking changes to allow to query and re-apply them if the underlying data changes
+
+    If we copy the base value, the copy is immutable and shared by our value. Only the parts of our value 
+    which are changed are copied.
+
+    Change Journal
+    --------------
+    If journal_changes is True, all keys changed through set_value(), delete_value() and set_changes() are 
+    recorded in an ordered journal. changes() and _set_data() will then only diff the values at these keys,
+    which makes them scale with the amount of edits, instead of the size of our data.
     
     @note Make sure it is listed before the KeyValueStore base in your base class array
     """
     __slots__ = (
-                    '_base_value_dict'          # copy of the _value_dict
+                    '_base_value_dict',         # copy of the _value_dict
+                    '_journal'                  # None, or OrderedDict of key => operation, in order of change
                 )
     
+    # -------------------------
+    ## @name Configuration
+    # @{
+    
     ## A delegate to pick up changes and re-apply them to a different base data structure
     KeyValueStoreModifierBaseSwapDiffDelegateType = KeyValueStoreModifierBaseSwapDelegate
     ## A delegate to find differences between a base and actual values, which is used to find changes
     KeyValueStoreModifierApplyDifferenceDelegateType = ApplyDifferenceMergeDelegate
+
+    ## If True, changed keys will be recorded to only diff their values when looking for changes.
+    ## Changes made to our data without using our interface will not be noticed in that case.
+    journal_changes = False
+
+    ## -- End Configuration -- @}
+
+    ## Journal operation of set_value() and set_changes()
+    JOURNAL_SET = 'set'
+    ## Journal operation of delete_value()
+    JOURNAL_DELETE = 'delete'
     
     
     def __init__(self, value_dict, take_ownership=True):
         """Initialize this instance and keep a copy of the original value for later comparison"""
         # need initialization here as super call will call our set-data
         self._base_value_dict = NoValue
+        if self.journal_changes:
+            self._journal = OrderedDict()
+        else:
+            self._journal = None
+        # end setup journal
         super(ChangeTrackingKeyValueStoreModifier, self).__init__(value_dict, take_ownership=take_ownership)
         assert self.KeyValueStoreModifierApplyDifferenceDelegateType
         
@@ -422,11 +602,14 @@ class ChangeTrackingKeyValueStoreModifier(KeyValueStoreModifier):
         3. Reapply the differences
 
         All this is done to assure consistency with previous changes
-        We expect our delegate type to perform all this at once.
+        We expect our delegate type to perform all this at once. If we journal changes, only the changed keys
+        are diffed and re-applied.
         @param data_dict a dictionary whose type matches our data dictionary. The data dictionary will be copied
         to assure we do not keep links to the outside world (in case it is changed), unless take_ownership is True
         @param take_ownership if True, the input dict will not be copied. This is the default
         @return this instance
+        @note copies are made as immutable PersistentOrderedDict, which serves as our base, and which is shared 
+        by our value.
         """
         if not isinstance(data_dict, self.KeyValueStoreModifierDiffDelegateType.DictType):
             raise TypeError("Input data was of type %s, we expected %s"
@@ -436,22 +619,26 @@ class ChangeTrackingKeyValueStoreModifier(KeyValueStoreModifier):
         if self._value_dict is NoValue:
             super(ChangeTrackingKeyValueStoreModifier, self)._set_data(data_dict, take_ownership)
         # end initialize value dict
+        self._increment_version()
         
         if not take_ownership or data_dict is self._value_dict:
             # The data_dict check has to be done in case someone feeds us our own data dict to make an update
-            data_dict = copy.deepcopy(data_dict)
+            # The copy is immutable, which allows our value to share everything with it until it is changed
+            data_dict = PersistentOrderedDict.freeze(data_dict)
         # end handle ownership
         
         # initial value ? Then we don't have to diff anything
         if self._base_value_dict is NoValue:
-            # Need to copy here, as this dict is already owned by our provider - thus is a requirement
             self._base_value_dict = data_dict
+            if isinstance(data_dict, PersistentOrderedDict):
+                self._value_dict = data_dict.thaw(self.KeyValueStoreModifierDiffDelegateType.DictType)
+            # end share immutable base
         else:
             # otherwise, diff base and current value and apply the changes to a copy of data dict
             # This copy will be our new current value, whereas a copy of the original input dict
             # will be the new base
             delegate = self.KeyValueStoreModifierBaseSwapDiffDelegateType(data_dict)
-            self.TwoWayDiffAlgorithmType().diff(delegate, self._base_value_dict, self._value_dict)
+            self.TwoWayDiffAlgorithmType().diff(delegate, *self._changed_trees())
 
             self._base_value_dict = data_dict
             self._value_dict = delegate.result()
@@ -459,8 +646,103 @@ class ChangeTrackingKeyValueStoreModifier(KeyValueStoreModifier):
         assert self._value_dict is not self._base_value_dict
         
         return self
+
+    def _record_change(self, operation, key):
+        """Record the given operation on key in our journal, if we keep one
+        @param operation one of our JOURNAL_* constants
+        @param key fully qualified key, or RootKey
+        @return self"""
+        if self._journal is not None:
+            # re-insert to keep the journal in order of the most recent change
+            self._journal.pop(key, None)
+            self._journal[key] = operation
+        # end handle journal
+        return self
+
+    def _record_changes(self, data):
+        """Record all top-level keys of the given data dictionary as changed, which is useful if data was 
+        merged into our value
+        @return self"""
+        for key in data:
+            self._record_change(self.JOURNAL_SET, key)
+        # end for each key
+        return self
     
     ## -- End Subclass Interface -- @}
+
+    # -------------------------
+    ## @name Utilities
+    # @{
+
+    def _journal_trie(self):
+        """@return a nested dict of key tokens of all changed keys, where None marks a changed value, or None
+        if we don't have a journal, or if our entire value must be considered changed"""
+        if self._journal is None or RootKey in self._journal:
+            return None
+        # end handle full diff
+        trie = dict()
+        for key in self._journal:
+            level = trie
+            tokens = key.split(self.key_separator)
+            for token in tokens[:-1]:
+                level = level.setdefault(token, dict())
+                if level is None:
+                    # a parent value changed, which includes this one
+                    break
+                # end handle changed parent
+            else:
+                level[tokens[-1]] = None
+            # end for each parent token
+        # end for each changed key
+        return trie
+
+    @classmethod
+    def _project_trees(cls, trie, left_tree, right_tree, dict_type):
+        """@return tuple(left_tree, right_tree) with just the values at the keys in the given trie, as 
+        returned by _journal_trie(). Values are not copied, and the order of keys is retained"""
+        left_values, right_values = dict(), dict()
+        for token, subtrie in trie.iteritems():
+            left_value = left_tree.get(token, NoValue)
+            right_value = right_tree.get(token, NoValue)
+            if subtrie is not None and isinstance(left_value, dict) and isinstance(right_value, dict):
+                left_value, right_value = cls._project_trees(subtrie, left_value, right_value, dict_type)
+                if not (left_value or right_value):
+                    continue
+                # end skip parents without changes
+            # end handle parent trees
+            left_values[token] = left_value
+            right_values[token] = right_value
+        # end for each changed token
+
+        res = list()
+        for tree, values in ((left_tree, left_values), (right_tree, right_values)):
+            if len(values) > 1:
+                keys = [key for key in tree if key in values]
+            else:
+                keys = values.keys()
+            # end retain order
+            projected = dict_type()
+            for key in keys:
+                if values[key] is not NoValue:
+                    projected[key] = values[key]
+                # end skip missing values
+            # end for each key
+            res.append(projected)
+        # end for each tree
+        return tuple(res)
+
+    def _changed_trees(self):
+        """@return tuple(base_tree, value_tree) which contain all changes between base and value. If we keep
+        a journal, these are projections containing only the changed keys"""
+        assert self._base_value_dict is not NoValue and self._value_dict is not NoValue
+        trie = self._journal_trie()
+        if trie is None:
+            return self._base_value_dict, self._value_dict
+        # end handle full trees
+        return self._project_trees(trie, self._base_value_dict, self._value_dict, 
+                                   self.KeyValueStoreModifierDiffDelegateType.DictType)
+
+    ## -- End Utilities -- @}
     
     # -------------------------
     ## @name Interface
@@ -469,10 +751,10 @@ class ChangeTrackingKeyValueStoreModifier(KeyValueStoreModifier):
     def changes(self):
         """@return a dictionary which contains all added and changed values
         @note deleted values are, for obvious reasons, not included
+        @note if we keep a journal, only the values at changed keys are compared
         """
         delegate = self.KeyValueStoreModifierApplyDifferenceDelegateType()
-        assert self._base_value_dict is not NoValue and self._value_dict is not NoValue
-        self.TwoWayDiffAlgorithmType().diff(delegate, self._base_value_dict, self._value_dict)
+        self.TwoWayDiffAlgorithmType().diff(delegate, *self._changed_trees())
         return delegate.result()
     
     def set_changes(self, data):
@@ -481,8 +763,28 @@ class ChangeTrackingKeyValueStoreModifier(KeyValueStoreModifier):
         @return self"""
         if data:
             self._value_dict = merge_data(data, self._value_dict)
+            self._record_changes(data)
+            self._increment_version()
         # end handle re-apply changes
         return self
+
+    def set_value(self, key, new_value):
+        """Set the value and record the change in our journal"""
+        super(ChangeTrackingKeyValueStoreModifier, self).set_value(key, new_value)
+        return self._record_change(self.JOURNAL_SET, key)
+
+    def delete_value(self, key):
+        """Delete the value and record the change in our journal"""
+        super(ChangeTrackingKeyValueStoreModifier, self).delete_value(key)
+        return self._record_change(self.JOURNAL_DELETE, key)
+
+    def journal(self):
+        """@return list of (operation, key) tuples of all changes in the order they were made, with one entry 
+        per key, or None if we don't keep a journal. operation is one of our JOURNAL_* constants"""
+        if self._journal is None:
+            return None
+        # end handle no journal
+        return [(operation, key) for key, operation in self._journal.iteritems()]
     
     ## -- End Interface -- @}
     
@@ -0,0 +1,310 @@
+#-*-coding:utf-8-*-
+"""
+@package bkvstore.cache
+@brief An on-disk cache for deserialized and merged kvstore data
+
+@author Sebastian Thiel
+@copyright [GNU Lesser General Public License](https://www.gnu.org/licenses/lgpl.html)
+"""
+__all__ = ['SerializedDataCache']
+
+import os
+import hashlib
+import logging
+import cPickle
+import thread
+
+from butility import FileHashCache
+
+log = logging.getLogger('bkvstore.cache')
+
+
+class SerializedDataCache(object):
+    """A simple on-disk cache which stores pickled data-structures, one file per entry.
+
+    Entries are keyed by digests which are produced from the inputs that affect the data, like the path,
+    modification time, size and content of a file. That way, entries never have to be invalidated explicitly,
+    as changed inputs will simply produce a new key. Stale entries are evicted in least-recently-used order
+    once there are more than max_entries of them.
+
+    @note all operations are failsafe - if the cache directory cannot be read or written, it will behave
+    as if it was empty.
+    @note the cache is disabled by default, see is_enabled()
+    """
+    __slots__ = (
+                    '_directory',   ## directory containing all our cache files
+                    '_max_entries'  ## maximum amount of entries we may keep
+                )
+
+    # -------------------------
+    ## @name Configuration
+    # @{
+
+    ## If this environment variable is set to '0', the cache will be disabled, if set to '1', it will be enabled
+    enable_env_var = 'BKVSTORE_CACHE'
+
+    ## If True, the cache is used unless disabled by the enable_env_var
+    enabled_by_default = False
+
+    ## If set, this environment variable contains the directory for our cache files
+    directory_env_var = 'BKVSTORE_CACHE_DIR'
+
+    ## Directory used if the directory_env_var isn't set
+    default_directory = os.path.join('~', '.cache', 'bkvstore')
+
+    ## The maximum amount of cache entries we will keep
+    max_entries = 1024
+
+    ## Old entries are evicted after the first write of a process, and after every this many writes
+    eviction_interval = 64
+
+    ## extension of our cache files
+    file_extension = '.kvcache'
+
+    ## Changing this will invalidate all existing entries, i.e. if the format of cached data changes
+    cache_version = 1
+
+    ## If not None, the permissions of the cache directory if we create it
+    directory_mode = None
+
+    ## If not None, the permissions of our cache files. Otherwise they are created according to the umask
+    file_mode = None
+
+    ## -- End Configuration -- @}
+
+    ## If not None, a dict of key -> pickled data shared by all instances of the process, see retain_in_memory()
+    _memory = None
+
+    ## The amount of entries written by instances of our type in this process
+    _writes = 0
+
+    def __init__(self, directory=None, max_entries=None):
+        """Initialize this instance
+        @param directory if not None, the directory to keep the cache files in. Otherwise it will be obtained
+        from the directory_env_var or the default_directory
+        @param max_entries if not None, the amount of entries to keep at most, overriding our configuration"""
+        if directory is None:
+            directory = os.environ.get(self.directory_env_var, self.default_directory)
+        # end handle directory
+        self._directory = os.path.expanduser(directory)
+        self._max_entries = max_entries is None and self.max_entries or max_entries
+
+    # -------------------------
+    ## @name Utilities
+    # @{
+
+    def _entry_path(self, key):
+        """@return path to the cache file for the given key"""
+        return os.path.join(self._directory, key + self.file_extension)
+
+    def _entries(self):
+        """@return list of paths to all cache files we currently have"""
+        try:
+            names = os.listdir(self._directory)
+        except OSError:
+            return list()
+        # end handle missing directory
+        return [os.path.join(self._directory, name) for name in names if name.endswith(self.file_extension)]
+
+    def _remember(self, key, pickled):
+        """Keep the given pickled data in memory, if enabled"""
+        memory = self._memory
+        if memory is None:
+            return
+        # end handle disabled memory
+        if key not in memory and len(memory) >= self._max_entries:
+            memory.popitem()
+        # end keep within limits
+        memory[key] = pickled
+
+    def _evict(self):
+        """Remove the least recently used entries until we are within our limits"""
+        entries = self._entries()
+        if len(entries) <= self._max_entries:
+            return
+        # end early bailout
+
+        def last_used(path):
+            # get() updates the modification time of the entries it reads
+            try:
+                return os.stat(path).st_mtime
+            except OSError:
+                return 0
+            # end handle concurrent removal
+        # end utility
+        entries.sort(key=last_used)
+        for path in entries[:len(entries) - self._max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            # end ignore concurrent removal
+        # end for each entry to remove
+
+    ## -- End Utilities -- @}
+
+    # -------------------------
+    ## @name Interface
+    # @{
+
+    @classmethod
+    def is_enabled(cls):
+        """@return True if the cache should be used. This is the case if the enable_env_var is set to '1', or if
+        it isn't set, and we are enabled_by_default or retain our entries in memory"""
+        default = (cls.enabled_by_default or cls._memory is not None) and '1' or '0'
+        return os.environ.get(cls.enable_env_var, default) != '0'
+
+    @classmethod
+    def retain_in_memory(cls, enabled=True):
+        """Keep all entries read or written by instances of this type in memory, to prevent them from being read
+        from disk again. This is useful for long-running processes which fork, as their children will inherit
+        the entries. This enables the cache, unless it is disabled explicitly, see is_enabled().
+        @param enabled if False, entries will not be kept anymore, and the memory will be freed"""
+        if enabled:
+            cls._memory = dict()
+        else:
+            cls._memory = None
+        # end handle enabled
+
+    def directory(self):
+        """@return the directory containing our cache files"""
+        return self._directory
+
+    def key(self, *args):
+        """@return a key suitable for use with get() and set(), produced from all the given strings
+        @param args strings that, together, uniquely identify the data to be cached"""
+        sha = hashlib.sha1(str(self.cache_version))
+        for arg in args:
+            sha.update('\0')
+            sha.update(arg)
+        # end for each arg
+        return sha.hexdigest()
+
+    def file_key(self, identifier, path, content=None):
+        """@return a key for data deserialized from the file at the given path, or None if it cannot be read
+        @param identifier a string identifying the deserializer
+        @param path the path of the file
+        @param content the file's content as string, or None. The content is only needed if the
+        FileHashCache doesn't know the file's digest yet, and will be read if necessary"""
+        try:
+            st = os.stat(path)
+            digest = FileHashCache.instance().digest(path, content)
+        except (OSError, IOError):
+            return None
+        # end handle file vanished
+        return self.key(identifier, os.path.abspath(path), repr(st.st_mtime), str(st.st_size),
+                        digest.encode('hex'))
+
+    def get(self, key):
+        """@return the data previously stored for key, or None if there was no such entry
+        @param key as previously obtained by key() or file_key()"""
+        if self._memory is not None:
+            pickled = self._memory.get(key)
+            if pickled is not None:
+                return cPickle.loads(pickled)
+            # end handle memory hit
+        # end check memory
+
+        path = self._entry_path(key)
+        try:
+            fp = open(path, 'rb')
+        except IOError:
+            return None
+        # end handle cache miss
+
+        try:
+            try:
+                pickled = fp.read()
+            finally:
+                fp.close()
+            # end assure file is closed
+            data = cPickle.loads(pickled)
+        except Exception:
+            log.warn("Failed to read cache entry at '%s' - it will be removed", path, exc_info=True)
+            self.invalidate(key)
+            return None
+        # end handle corruption
+
+        # mark entry as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        # end ignore utime errors
+        self._remember(key, pickled)
+        return data
+
+    def set(self, key, data):
+        """Store the given data under the given key, evicting old entries as needed
+        @param key as previously obtained by key() or file_key()
+        @param data a pickleable data structure
+        @return this instance"""
+        path = self._entry_path(key)
+        # writers may be in different processes and threads
+        tmp_path = '%s.%i.%i.tmp' % (path, os.getpid(), thread.get_ident())
+        try:
+            if not os.path.isdir(self._directory):
+                if self.directory_mode is None:
+                    os.makedirs(self._directory)
+                else:
+                    os.makedirs(self._directory, self.directory_mode)
+                # end handle permissions
+            # end assure directory exists
+            pickled = cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL)
+            self._remember(key, pickled)
+            if self.file_mode is None:
+                fp = open(tmp_path, 'wb')
+            else:
+                # the file must never be accessible with other permissions, not even temporarily
+                fp = os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, self.file_mode), 'wb')
+            # end handle permissions
+            try:
+                fp.write(pickled)
+            finally:
+                fp.close()
+            # end assure file is closed
+            # rename is atomic, concurrent readers will never see partial entries
+            os.rename(tmp_path, path)
+        except Exception:
+            log.warn("Failed to write cache entry at '%s'", path, exc_info=True)
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            # end cleanup
+            return self
+        # end handle write errors
+
+        # Listing the directory is expensive, don't do it for every entry
+        cls = type(self)
+        if cls._writes % self.eviction_interval == 0:
+            self._evict()
+        # end evict once in a while
+        cls._writes += 1
+        return self
+
+    def invalidate(self, key=None):
+        """Remove the entry with the given key, or all entries if key is None
+        @return this instance"""
+        if key is None:
+            paths = self._entries()
+            if self._memory is not None:
+                self._memory.clear()
+            # end forget all entries
+        else:
+            paths = [self._entry_path(key)]
+            if self._memory is not None:
+                self._memory.pop(key, None)
+            # end forget entry
+        # end handle paths to remove
+
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            # end ignore missing files
+        # end for each path
+        return self
+
+    ## -- End Interface -- @}
+
+# end class SerializedDataCache
@@ -0,0 +1,559 @@
+#-*-coding:utf-8-*-
+"""
+@package bkvstore.compiler
+@brief Compiles schemas into specialized functions which extract values from stored data
+
+@author Sebastian Thiel
+@copyright [GNU Lesser General Public License](https://www.gnu.org/licenses/lgpl.html)
+"""
+__all__ = ['KeyValueStoreSchemaCompiler', 'CompiledKeyValueStoreSchema']
+
+import logging
+
+from bdiff import ( NoValue,
+                    TwoWayDiff,
+                    IterativeTwoWayDiff )
+
+from butility import ( OrderedDict,
+                       DictObject,
+                       smart_deepcopy )
+
+from .diff import ( AnyKey,
+                    KeyValueStoreProviderDiffDelegate )
+
+
+log = logging.getLogger('bkvstore.compiler')
+
+
+# ==============================================================================
+## @name Utilities
+# ------------------------------------------------------------------------------
+## @{
+
+class _SchemaMismatch(Exception):
+    """Raised by compiled functions if the stored data has a shape they don't handle"""
+    __slots__ = ()
+
+# end class _SchemaMismatch
+
+
+def _is_any_key(key):
+    """@return True if key is AnyKey"""
+    return isinstance(key, type) and issubclass(key, AnyKey)
+
+
+def _qualified_key(delegate, parts):
+    """@return the fully qualified key for the given key parts, exactly like the delegate would produce it"""
+    separator = delegate.key_separator
+    suffix = separator.join(parts)
+    if suffix:
+        return "%s%s%s" % (delegate._base_key, separator, suffix)
+    return delegate._base_key
+
+
+def _deleted_value_handler(dict_type, keep_values, delete_empty_trees, separator):
+    """@return function(parent, key, value, resolve) which handles a stored value that is unknown to the schema,
+    exactly like the diff would do when walking it as deleted value.
+    @param dict_type the type of trees to create
+    @param keep_values if True, unknown values are kept
+    @param delete_empty_trees if True, empty trees will be removed
+    @param separator key separator, which must not be part of any key"""
+    tree_types = (dict, DictObject)
+
+    def handle(parent, key, value, resolve):
+        if not isinstance(key, basestring) or separator in key:
+            raise _SchemaMismatch(key)
+        # end malformed keys are reported by the diff
+        if not isinstance(value, tree_types):
+            if keep_values:
+                value = smart_deepcopy(value)
+                if resolve is not None:
+                    value = resolve(key, value)
+                # end handle resolution
+                if key not in parent or not isinstance(parent[key], dict_type):
+                    parent[key] = value
+                # end don't override trees
+            # end handle leaf
+            return
+        # end handle leafs
+
+        keys = value.keys()
+        if not keys:
+            return
+        # end empty trees are never walked
+        tree = parent.setdefault(key, dict_type())
+        for child_key in keys:
+            handle(tree, child_key, value[child_key], resolve)
+        # end for each child
+        if delete_empty_trees and not tree:
+            del(parent[key])
+        # end prune empty trees
+    # end handler
+
+    return handle
+
+## -- End Utilities -- @}
+
+
+# ==============================================================================
+## @name Types
+# ------------------------------------------------------------------------------
+## @{
+
+class CompiledKeyValueStoreSchema(object):
+    """A function which extracts the value of a schema from stored data, along with the information required to
+    know whether it still represents its schema.
+
+    It produces the same values as KeyValueStoreProvider.value() using the diff engine would, but
+    only handles the shapes of data it was specialized for. Otherwise it returns NoValue, and the caller is
+    expected to use the generic diff instead.
+
+    @note the order of keys in the returned trees is the one of the schema, followed by the ones which are
+    not in the schema. value() makes no promises about the order of keys either.
+    """
+    __slots__ = (
+                    '_schema',      # the schema we were compiled from
+                    '_snapshots',   # a list of (tree_dict, copy_of_tree_dict) pairs, one per schema tree
+                    '_extract',     # function(value, delegate) => tree
+                    '_source'       # the source code of our function
+                )
+
+    def __init__(self, schema, snapshots, extract, source):
+        """Initialize this instance
+        @param schema the schema we were compiled from
+        @param snapshots list of (dict, copy) pairs to check for schema changes
+        @param extract the compiled function
+        @param source the source code of the compiled function"""
+        self._schema = schema
+        self._snapshots = snapshots
+        self._extract = extract
+        self._source = source
+
+    # -------------------------
+    ## @name Interface
+    # @{
+
+    def schema(self):
+        """@return the schema we were compiled from"""
+        return self._schema
+
+    def source(self):
+        """@return the source code of the function extracting values"""
+        return self._source
+
+    def is_current(self):
+        """@return True if the schema wasn't changed since it was compiled"""
+        for tree, snapshot in self._snapshots:
+            if tree != snapshot:
+                return False
+        # end for each snapshot
+        return True
+
+    def extract(self, value, delegate):
+        """@return the value of our schema merged with the given stored value, or NoValue if the value has to be
+        obtained using the generic diff
+        @param value the stored value, or NoValue if there is none
+        @param delegate the KeyValueStoreProviderDiffDelegate the generic diff would use. It provides the
+        resolver for format strings, and the logger for warnings"""
+        try:
+            return self._extract(value, delegate)
+        except _SchemaMismatch:
+            return NoValue
+        # end handle unsupported data
+
+    ## -- End Interface -- @}
+
+# end class CompiledKeyValueStoreSchema
+
+
+class KeyValueStoreSchemaCompiler(object):
+    """Turns a schema into a python function which extracts its value from stored data.
+
+    The generic way of obtaining a value for a schema is to diff it against the stored data, which involves
+    plenty of indirections per key. Compiled functions access keys directly, with converters and defaults
+    bound as constants, and handle AnyKey and TypedList defaults in code prepared for them.
+
+    Compiled schemas are cached per schema, delegate type and resolve flag.
+
+    @note only delegates which behave like the KeyValueStoreProviderDiffDelegate are supported, i.e. which
+    differ only in their configuration.
+    """
+    __slots__ = (
+                    '_delegate_type',    # the delegate type whose behaviour we mimic
+                    '_resolve',          # if True, we resolve format strings
+                    '_lines',            # lines of source code
+                    '_namespace',        # the namespace for the compiled function
+                    '_snapshots',        # list of (dict, copy) pairs of all schema trees
+                    '_count'             # counter for unique names
+                )
+
+    # -------------------------
+    ## @name Configuration
+    # @{
+
+    ## Amount of compiled schemas we keep
+    cache_size = 256
+
+    ## The diff algorithms whose results we reproduce
+    algorithm_types = (TwoWayDiff, IterativeTwoWayDiff)
+
+    ## Methods of the delegate type which must not be overridden
+    delegate_methods = ('register_change', 'register_changes', 'register_tree_change',
+                        'register_unchanged_tree', 'push_tree_level', 'pop_tree_level', '_set_merged_value',
+                        'is_tree', 'keys', 'value_by_key', 'equal_values', 'subtract_key_lists',
+                        'possibly_modified_keys', 'should_resolve_values', '_resolve_value',
+                        '_resolve_scalar_value', '_qualified_key', '_to_string_key')
+
+    ## -- End Configuration -- @}
+
+    ## (id(schema), delegate_type, resolve) => CompiledKeyValueStoreSchema or None
+    _cache = OrderedDict()
+
+    def __init__(self, delegate_type, resolve):
+        """Initialize this instance
+        @param delegate_type a KeyValueStoreProviderDiffDelegate type whose behaviour we should mimic
+        @param resolve if True, format strings will be resolved"""
+        self._delegate_type = delegate_type
+        self._resolve = resolve
+        self._lines = list()
+        self._namespace = None
+        self._snapshots = list()
+        self._count = 0
+
+    # -------------------------
+    ## @name Interface
+    # @{
+
+    @classmethod
+    def supports(cls, delegate_type):
+        """@return True if we can produce functions which behave like the given delegate type"""
+        if not issubclass(delegate_type, KeyValueStoreProviderDiffDelegate):
+            return False
+        # end handle type
+        base = KeyValueStoreProviderDiffDelegate
+        return all(getattr(delegate_type, name).im_func is getattr(base, name).im_func
+                   for name in cls.delegate_methods)
+
+    @classmethod
+    def compiled(cls, schema, delegate_type, resolve):
+        """@return a cached CompiledKeyValueStoreSchema for the given schema, or None if it cannot be compiled
+        @param schema a KeyValueStoreSchema or any other tree of default values
+        @param delegate_type the type of delegate which would be used by the generic diff
+        @param resolve if True, format strings will be resolved"""
+        cache = cls._cache
+        cache_key = (id(schema), delegate_type, resolve)
+        entry = cache.pop(cache_key, None)
+        # the identity check protects against reused ids of schemas which don't exist anymore
+        if entry is None or entry[0] is not schema or (entry[1] is not None and not entry[1].is_current()):
+            compiled = None
+            if cls.supports(delegate_type):
+                compiled = cls(delegate_type, resolve).compile(schema)
+            # end handle supported delegates
+            entry = (schema, compiled)
+            while len(cache) >= cls.cache_size:
+                cache.popitem(last=False)
+            # end evict least recently used schemas
+        # end handle cache miss
+        cache[cache_key] = entry
+        return entry[1]
+
+    def compile(self, schema):
+        """@return a new CompiledKeyValueStoreSchema for the given schema, or None if the schema cannot be
+        compiled, in which case the generic diff must be used"""
+        dtype = self._delegate_type
+        self._lines = list()
+        self._snapshots = list()
+        self._count = 0
+        self._namespace = dict(DictType = dtype.DictType,
+                               TreeTypes = (dict, DictObject),
+                               NoValue = NoValue,
+                               SchemaMismatch = _SchemaMismatch,
+                               copy = smart_deepcopy,
+                               qualified_key = _qualified_key,
+                               handle_deleted = _deleted_value_handler(dtype.DictType,
+                                                                       dtype.keep_values_not_in_schema,
+                                                                       dtype.delete_empty_trees,
+                                                                       dtype.key_separator))
+        try:
+            self._emit_function(schema)
+            source = '\n'.join(self._lines) + '\n'
+            code = compile(source, '<compiled schema %s>' % getattr(schema, '_key', id(schema)), 'exec')
+            exec code in self._namespace
+        except (_SchemaMismatch, SyntaxError, RuntimeError), err:
+            log.debug("Schema at %s cannot be compiled: %s", getattr(schema, '_key', None), err)
+            return None
+        # end handle schemas we can't handle
+
+        return CompiledKeyValueStoreSchema(schema, self._snapshots, self._namespace['extract'], source)
+
+    ## -- End Interface -- @}
+
+    # -------------------------
+    ## @name Code Generation
+    # @{
+
+    def _emit(self, level, line):
+        """Add the given line of code at the given indentation level"""
+        self._lines.append('    ' * level + line)
+
+    def _name(self, prefix):
+        """@return a new unique variable name"""
+        self._count += 1
+        return '%s%i' % (prefix, self._count)
+
+    def _constant(self, value):
+        """@return the name of a constant with the given value"""
+        name = 'c%i' % id(value)
+        self._namespace[name] = value
+        return name
+
+    def _is_tree(self, value):
+        return isinstance(value, (dict, DictObject))
+
+    def _tree_keys(self, tree):
+        """@return the keys of the given schema tree, after verifying them and taking a snapshot of the tree
+        @throws _SchemaMismatch if the tree's keys are not supported"""
+        if isinstance(tree, DictObject):
+            tree_dict = tree.__dict__
+        else:
+            tree_dict = tree
+        # end handle tree type
+        self._snapshots.append((tree_dict, dict(tree_dict)))
+        keys = tree.keys()
+        separator = self._delegate_type.key_separator
+        if any(_is_any_key(key) for key in keys):
+            if len(keys) > 1:
+                raise _SchemaMismatch("AnyKey must be the only key of a tree")
+            # end check AnyKey
+            return keys
+        # end handle AnyKey
+        for key in keys:
+            if not isinstance(key, basestring) or separator in key:
+                raise _SchemaMismatch("Invalid key: %r" % (key, ))
+            # end check key
+            value = tree[key]
+            if isinstance(value, type) and issubclass(value, NoValue):
+                raise _SchemaMismatch("Marker types are no valid defaults: %r" % (value, ))
+            # end check default
+        # end for each key
+        return keys
+
+    def _has_any_key(self, keys):
+        return len(keys) == 1 and _is_any_key(keys[0])
+
+    def _resolved(self, key, value):
+        """@return expression resolving the value expression, if we are resolving"""
+        if self._resolve:
+            return 'resolve(%s, %s)' % (key, value)
+        return value
+
+    def _emit_function(self, schema):
+        """Generate the extract function for the given schema"""
+        emit = self._emit
+        keys = self._tree_keys(schema)
+        emit(0, 'def extract(value, delegate):')
+        if self._resolve:
+            emit(1, 'resolve = delegate._resolve_value')
+        else:
+            emit(1, 'resolve = None')
+        # end handle resolver
+        emit(1, 'if isinstance(value, TreeTypes):')
+        emit(2, 'm = DictType()')
+        self._emit_tree(2, schema, keys, 'value', 'm', ())
+        emit(2, 'return m')
+        if keys and not self._has_any_key(keys):
+            emit(1, 'if value is NoValue:')
+            emit(2, 'm = DictType()')
+            for key in keys:
+                self._emit_added(2, repr(key), schema[key], 'm', ())
+            # end for each key
+            emit(2, 'return m')
+        # end handle missing values
+        # All other cases are rare, and handled by the generic diff
+        emit(1, 'raise SchemaMismatch()')
+
+    def _emit_tree(self, level, schema, keys, value, merged, path):
+        """Generate code filling the merged tree with the values of the stored tree and the schema tree.
+        @param keys verified keys of the schema
+        @param value name of the variable with the stored tree
+        @param merged name of the variable with the tree to fill
+        @param path tuple of expressions with the keys leading to the tree"""
+        emit = self._emit
+        if self._has_any_key(keys):
+            key = self._name('k')
+            emit(level, 'for %s in %s.keys():' % (key, value))
+            emit(level + 1, 'if not isinstance(%s, basestring) or %r in %s:'
+                            % (key, self._delegate_type.key_separator, key))
+            emit(level + 2, 'raise SchemaMismatch(%s)' % key)
+            child = self._name('v')
+            emit(level + 1, '%s = %s[%s]' % (child, value, key))
+            self._emit_check(level + 1, key, schema.values()[0], child, merged, path)
+            return
+        # end handle AnyKey
+
+        for key in keys:
+            child = self._name('v')
+            emit(level, 'if %r in %s:' % (key, value))
+            emit(level + 1, '%s = %s[%r]' % (child, value, key))
+            self._emit_check(level + 1, repr(key), schema[key], child, merged, path)
+            emit(level, 'else:')
+            self._emit_added(level + 1, repr(key), schema[key], merged, path)
+        # end for each key
+
+        dtype = self._delegate_type
+        if dtype.keep_values_not_in_schema or not dtype.delete_empty_trees:
+            key = self._name('k')
+            emit(level, 'for %s in %s.keys():' % (key, value))
+            emit(level + 1, 'if %s not in %s:' % (key, self._constant(frozenset(keys))))
+            emit(level + 2, 'handle_deleted(%s, %s, %s[%s], resolve)' % (merged, key, value, key))
+        # end handle values not in schema
+
+    def _emit_prune(self, level, parent, key, merged):
+        """Generate code to remove merged from parent if it is empty"""
+        if self._delegate_type.delete_empty_trees:
+            self._emit(level, 'if not %s:' % merged)
+            self._emit(level + 1, 'del(%s[%s])' % (parent, key))
+        # end handle pruning
+
+    def _emit_check(self, level, key, schema, value, merged, path):
+        """Generate code to merge a stored value with its default value
+        @param key expression of the key
+        @param schema the default value
+        @param value name of the variable with the stored value"""
+        emit = self._emit
+        dtype = self._delegate_type
+        if self._is_tree(schema):
+            keys = self._tree_keys(schema)
+            emit(level, 'if isinstance(%s, TreeTypes):' % value)
+            tree = self._name('m')
+            emit(level + 1, '%s = %s[%s] = DictType()' % (tree, merged, key))
+            self._emit_tree(level + 1, schema, keys, value, tree, path + (key, ))
+            self._emit_prune(level + 1, merged, key, tree)
+            emit(level, 'else:')
+            if keys and not self._has_any_key(keys):
+                self._emit_added(level + 1, key, schema, merged, path)
+            # end add default tree
+            if dtype.keep_values_not_in_schema:
+                emit(level + 1, 'if %s not in %s or not isinstance(%s[%s], DictType):' % (key, merged, merged, key))
+                emit(level + 2, '%s[%s] = %s' % (merged, key, self._resolved(key, 'copy(%s)' % value)))
+            else:
+                emit(level + 1, 'pass')
+            # end keep stored leaf
+            return
+        # end handle trees
+
+        emit(level, 'if isinstance(%s, TreeTypes):' % value)
+        # The stored tree is unknown to the schema, and the default is used unless a tree is kept
+        if dtype.keep_values_not_in_schema or not dtype.delete_empty_trees:
+            emit(level + 1, 'handle_deleted(%s, %s, %s, resolve)' % (merged, key, value))
+            emit(level + 1, 'if %s not in %s or not isinstance(%s[%s], DictType):' % (key, merged, merged, key))
+            self._emit_default(level + 2, key, schema, merged)
+        else:
+            self._emit_default(level + 1, key, schema, merged)
+        # end handle stored trees
+        emit(level, 'else:')
+        self._emit_leaf(level + 1, key, schema, value, merged, path)
+
+    def _emit_added(self, level, key, schema, merged, path):
+        """Generate code to add the given default value, for which there is no stored value"""
+        emit = self._emit
+        if self._is_tree(schema):
+            keys = self._tree_keys(schema)
+            if not keys:
+                # empty trees are not walked
+                emit(level, 'pass')
+                return
+            # end handle empty trees
+            if self._has_any_key(keys):
+                # The diff has special handling for this, which we leave to it
+                emit(level, 'raise SchemaMismatch()')
+                return
+            # end handle AnyKey
+            tree = self._name('m')
+            emit(level, '%s = %s[%s] = DictType()' % (tree, merged, key))
+            for child_key in keys:
+                self._emit_added(level, repr(child_key), schema[child_key], tree, path + (key, ))
+            # end for each key
+            self._emit_prune(level, merged, key, tree)
+            return
+        # end handle trees
+        self._emit_default(level, key, schema, merged)
+
+    def _emit_default(self, level, key, schema, merged):
+        """Generate code to set the default value at key"""
+        default = self._constant(schema)
+        if isinstance(schema, type):
+            # new instances are not shared with anyone, copying them would just produce another new instance
+            default += '()'
+        else:
+            default = 'copy(%s)' % default
+        # end instantiate types
+        self._emit(level, '%s[%s] = %s' % (merged, key, self._resolved(key, default)))
+
+    def _emit_leaf(self, level, key, schema, value, merged, path):
+        """Generate code to merge a stored leaf value with its default value, converting it if required"""
+        emit = self._emit
+        default = self._constant(schema)
+        is_type = isinstance(schema, type)
+        if is_type:
+            emit(level, 'ri = %s()' % default)
+            is_list = issubclass(schema, list)
+        else:
+            emit(level, 'ri = %s' % default)
+            is_list = isinstance(schema, list)
+        # end handle default instance
+
+        emit(level, 'if %s == %s:' % (value, default))
+        emit(level + 1, 'a = %s' % value)
+        emit(level, 'else:')
+        level += 1
+        if schema is None:
+            emit(level, 'a = %s' % value)
+        else:
+            emit(level, 'x = %s' % value)
+            emit(level, 'try:')
+            emit(level + 1, 'if x is None:')
+            emit(level + 2, 'a = ri')
+            if is_list:
+                emit(level + 1, 'elif not isinstance(x, list):')
+                if self._resolve:
+                    emit(level + 2, 'ri = resolve(%s, copy(ri))' % key)
+                # end handle resolution
+                emit(level + 2, 'a = type(ri)()')
+                emit(level + 2, 'a.append(x)')
+            # end handle list packing
+            emit(level + 1, 'else:')
+            if is_type:
+                if self._resolve:
+                    emit(level + 2, 'x = resolve(%s, copy(x))' % key)
+                # end handle resolution
+                emit(level + 2, 'a = %s(x)' % default)
+            else:
+                # only convert instances if necessary, not all types can be constructed from a value
+                default_type = self._constant(type(schema))
+                emit(level + 2, 'if isinstance(x, %s):' % default_type)
+                emit(level + 3, 'a = x')
+                emit(level + 2, 'else:')
+                if self._resolve:
+                    emit(level + 3, 'x = resolve(%s, x)' % key)
+                # end handle resolution
+                emit(level + 3, 'a = %s(x)' % default_type)
+            # end handle types
+            emit(level, 'except Exception, err:')
+            emit(level + 1, 'a = ri')
+            if self._resolve:
+                msg = "Could not convert value type %s of value '%s' at key '%s' "
+                msg += "to the desired type %s one of the default value with error: %s"
+                msg += ", using default value instead"
+                emit(level + 1, 'delegate._log.warn(%r, type(x), str(x), qualified_key(delegate, (%s)), '
+                                'type(a), str(err))' % (msg, ''.join('%s, ' % part for part in path + (key, ))))
+            # end handle logging
+        # end handle None
+        level -= 1
+        emit(level, '%s[%s] = %s' % (merged, key, self._resolved(key, 'copy(a)')))
+
+    ## -- End Code Generation -- @}
+
+# end class KeyValueStoreSchemaCompiler
+
+## -- End Types -- @}
@@ -18,9 +18,11 @@ from bdiff import ( NoValue,
                     ApplyDifferenceMergeDelegate )
 
 from butility import ( smart_deepcopy,
-                       OrderedDict )
+                       OrderedDict,
+                       PersistentOrderedDict )
 
 from .utility import KVStringFormatter
+from .resolve import FormatStringResolver
 
 
 # ==============================================================================
@@ -28,9 +30,6 @@ from .utility import KVStringFormatter
 # ------------------------------------------------------------------------------
 ## @{
 
-## Amount of iterations when resolving values in kvstore
-MAX_ITERATIONS = 6
-
 class AnyKey(object):
     """A marker key that will match any key.
     
@@ -184,7 +183,9 @@ class KeyValueStoreProviderDiffDelegate(_KeyValueStoreDiffDelegateBase):
     The structure we create will only use values from the respective sources, never the trees/dicts that contained
     them. Mutable values will be copied into this structure to prevent any change to the value they originate
     from."""    
-    __slots__ = ()
+    __slots__ = (
+                    '_resolver'     # FormatStringResolver for our data, or None if it wasn't needed yet
+                )
     
     # -------------------------
     ## @name Configuration
@@ -196,9 +197,20 @@ class KeyValueStoreProviderDiffDelegate(_KeyValueStoreDiffDelegateBase):
 
     ## The type used for formatting strings
     StringFormatterType = KVStringFormatter
+
+    ## The type used to resolve format strings against our data
+    FormatStringResolverType = FormatStringResolver
     
     ## -- End Configuration -- @}
 
+    def __init__(self, base_key, log, data=None, resolver=None):
+        """Initialize the instance
+        @param resolver an optional FormatStringResolverType instance for data. If None, it will be created
+        once it is needed. Sharing it among delegates of the same data saves a lot of time.
+        @note see base class for all other parameters"""
+        super(KeyValueStoreProviderDiffDelegate, self).__init__(base_key, log, data)
+        self._resolver = resolver
+
     # -------------------------
     ## @name TwoWayDiff Interface
     # @{
@@ -297,6 +309,13 @@ class KeyValueStoreProviderDiffDelegate(_KeyValueStoreDiffDelegateBase):
         if actual_value is not NoValue:
             self._set_merged_value(key, smart_deepcopy(actual_value))
 
+    def _format_string_resolver(self):
+        """@return the resolver for format strings in our data"""
+        if self._resolver is None:
+            self._resolver = self.FormatStringResolverType(self._data, self.StringFormatterType)
+        # end create resolver on demand
+        return self._resolver
+
     def _resolve_scalar_value(self, key, value):
         """@return a resolved single scalar string value"""
         # Actually, all of the values we see should be strings
@@ -305,23 +324,12 @@ class KeyValueStoreProviderDiffDelegate(_KeyValueStoreDiffDelegateBase):
             return value
         # end ignore non-string types
 
-        formatter = self.StringFormatterType()
         try:
-            last_value = ''
-            count = 0
-            while last_value != value:
-                count += 1
-                last_value = value
-                new_value = formatter.vformat(value, [], self._data)
-                # we could have string-like types, and format degenerates them to just strings
-                if type(new_value) is not type(value):
-                    new_value = type(value)(new_value)
-                value = new_value
-                if count > MAX_ITERATIONS:
-                    raise AssertionError("Value at '%s' could not be resolved after %i iterations - recursive values detected, last value was '%s', new value was '%s'" % (key, count, last_value, new_value))
-                # end 
-            # end recursive resolution
-            return value
+            new_value = self._format_string_resolver().resolve(value)
+            # we could have string-like types, and format degenerates them to just strings
+            if type(new_value) is not type(value):
+                new_value = type(value)(new_value)
+            return new_value
         except (KeyError, AttributeError, ValueError, TypeError), err:
             msg = "Failed to resolve value '%s' at key '%s' with error: %s"
             self._log.warn(msg, value, key, str(err))
@@ -410,9 +418,14 @@ class KeyValueStoreModifierBaseSwapDelegate(ApplyDifferenceMergeDelegate):
 
     def __init__(self, initial_value):
         """Initialize ourselves with the base value to apply the changes to.
-        We will copy the value to be sure - this needs to be done !"""
+        We will copy the value to be sure - this needs to be done ! Immutable values are not copied, as 
+        only the parts we change will be copied."""
         super(KeyValueStoreModifierBaseSwapDelegate, self).__init__()
-        self._merged_value = copy.deepcopy(initial_value)
+        if isinstance(initial_value, PersistentOrderedDict):
+            self._merged_value = initial_value
+        else:
+            self._merged_value = copy.deepcopy(initial_value)
+        # end handle immutable values
 
 # end class KeyValueStoreModifierBaseSwapDelegate
 
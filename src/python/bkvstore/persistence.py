@@ -8,20 +8,25 @@ from the actual yaml package from within this package
 @author Sebastian Thiel
 @copyright [GNU Lesser General Public License](https://www.gnu.org/licenses/lgpl.html)
 """
-__all__ = ['OrderedDictYAMLLoader']
+__all__ = ['OrderedDictYAMLLoader', 'PythonOrderedDictYAMLLoader', 'CompiledOrderedDictYAMLLoader',
+           'yaml_loader_env_var']
+
+import os
+import sys
+import logging
 
 import yaml.constructor
 import yaml.representer
 
-try:
-    from yaml import CLoader as Loader
-except ImportError:
-    from yaml import Loader
-# end get fastest loader
-
 from butility import ( OrderedDict,
+                       PersistentOrderedDict,
                        DictObject )
 
+log = logging.getLogger('bkvstore.persistence')
+
+## If set to 'python', the pure-python loader will be used even if a compiled one is available
+yaml_loader_env_var = 'BKVSTORE_YAML_LOADER'
+
 # ==============================================================================
 ## \name Yaml Tools
 # ------------------------------------------------------------------------------
@@ -38,17 +43,21 @@ def initialize_yaml_overrides():
     we write much prettier.
     """
     yaml.add_representer(OrderedDict, represent_ordereddict)
+    yaml.add_representer(PersistentOrderedDict, represent_ordereddict)
     yaml.add_representer(DictObject, represent_dictobject)
 
 
-class OrderedDictYAMLLoader(Loader):
-    """ A YAML loader that loads mappings into ordered dictionaries.
+class _OrderedDictConstructorMixin(object):
+    """ A YAML constructor override that loads mappings into ordered dictionaries.
 
     It is required to assure that iterating keys during serialization and
     deserialization will not change the order of the keys.
     Otherwise it would be confusing as files being written back unchanged
     will result in a different file with a mostly unpredictable order.
 
+    As it only operates on composed nodes, it works with the pure-python parser as well as with
+    the compiled one.
+
     @note based on https://gist.github.com/844388
     """
 
@@ -68,7 +77,8 @@ class OrderedDictYAMLLoader(Loader):
         tag_suffix = None
 
         # prefer our own mapping override - don't use plugin types for this!
-        if isinstance(node, yaml.MappingNode):
+        # NOTE: we check the node id, as compiled parsers may use node types of another yaml package
+        if node.id == 'mapping':
             constructor = self.__class__.construct_mapping
         elif node.tag in self.yaml_constructors:
             constructor = self.yaml_constructors[node.tag]
@@ -84,12 +94,10 @@ class OrderedDictYAMLLoader(Loader):
                     constructor = self.yaml_multi_constructors[None]
                 elif None in self.yaml_constructors:
                     constructor = self.yaml_constructors[None]
-                elif isinstance(node, yaml.ScalarNode):
+                elif node.id == 'scalar':
                     constructor = self.__class__.construct_scalar
-                elif isinstance(node, yaml.SequenceNode):
+                elif node.id == 'sequence':
                     constructor = self.__class__.construct_sequence
-                elif isinstance(node, yaml.MappingNode):
-                    constructor = self.__class__.construct_mapping
         if tag_suffix is None:
             data = constructor(self, node)
         else:
@@ -112,7 +120,7 @@ class OrderedDictYAMLLoader(Loader):
     def construct_mapping(self, node, deep=False):
         """Called preferably - all we do is use an ordered dict. Unfortunately
         the dict type is nothing we could easily override"""
-        if isinstance(node, yaml.MappingNode):
+        if node.id == 'mapping':
             self.flatten_mapping(node)
         else:
             raise yaml.constructor.ConstructorError(None, None,
@@ -138,12 +146,70 @@ class OrderedDictYAMLLoader(Loader):
         
     # Support for older yaml versions - this is required to make it work
     # For some reason, it pulls another version of yaml in which is missing this method
-    if not hasattr(Loader, 'dispose'):
+    if not hasattr(yaml.Loader, 'dispose'):
         def dispose(self):
             """noop
             @todo remove this """
             pass
 
+# end class _OrderedDictConstructorMixin
+
+
+class PythonOrderedDictYAMLLoader(_OrderedDictConstructorMixin, yaml.Loader):
+    """An ordered dict loader which always uses the pure-python parser"""
+
+# end class PythonOrderedDictYAMLLoader
+
+
+def _compiled_loader_type():
+    """@return an ordered dict loader type based on the libyaml parser, or None if there is no usable one.
+    @note we try our own yaml package as well as the one in sys.modules, which may be the system's one.
+    Each candidate is verified to yield the same result as the pure-python loader, as the compiled parser
+    and the constructor must use the same node types to work together"""
+    probe = "a: {c: [1, 'two', 3.0]}\nb: &anchor\n  x: 1\n<<: *anchor\n"
+    expected = yaml.load(probe, Loader=PythonOrderedDictYAMLLoader)
+
+    candidates = list()
+    for module in (yaml, sys.modules.get('yaml')):
+        loader = getattr(module, 'CLoader', None)
+        if loader is not None and loader not in candidates:
+            candidates.append(loader)
+        # end keep unique loaders
+    # end for each yaml module
+
+    for loader in candidates:
+        class CompiledOrderedDictYAMLLoader(_OrderedDictConstructorMixin, loader):
+            """An ordered dict loader which uses the libyaml based parser"""
+        # end class CompiledOrderedDictYAMLLoader
+
+        try:
+            if yaml.load(probe, Loader=CompiledOrderedDictYAMLLoader) == expected:
+                return CompiledOrderedDictYAMLLoader
+            # end verify parity
+        except Exception:
+            pass
+        # end ignore incompatible loaders
+        log.debug("Compiled yaml loader %s isn't compatible with the pure-python one - ignoring it", loader)
+    # end for each loader
+    return None
+
+
+## A loader using the compiled libyaml parser, or None if there is no such parser
+CompiledOrderedDictYAMLLoader = _compiled_loader_type()
+
+if CompiledOrderedDictYAMLLoader is not None and os.environ.get(yaml_loader_env_var) != 'python':
+    _Loader = CompiledOrderedDictYAMLLoader
+else:
+    _Loader = PythonOrderedDictYAMLLoader
+# end get fastest loader
+
+
+class OrderedDictYAMLLoader(_Loader):
+    """An ordered dict loader using the fastest parser available, which is the compiled one if possible.
+    The pure-python version can be enforced by setting the yaml_loader_env_var to 'python'."""
+
+# end class OrderedDictYAMLLoader
+
 
 class OrderedDictRepresenter(yaml.representer.Representer):
     """Provide a standard-dict representation for ordered dicts as well.
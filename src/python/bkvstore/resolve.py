@@ -0,0 +1,379 @@
+#-*-coding:utf-8-*-
+"""
+@package bkvstore.resolve
+@brief Contains an engine to resolve format strings which reference values of a kvstore
+
+@author Sebastian Thiel
+@copyright [GNU Lesser General Public License](https://www.gnu.org/licenses/lgpl.html)
+"""
+__all__ = ['FormatStringResolver', 'ResolveError']
+
+import copy
+
+from butility import DictObject
+
+from .utility import KVStringFormatter
+
+
+class ResolveError(ValueError):
+    """Thrown if a format string could not be resolved, for instance because it references a value
+    which is unresolvable itself, or which is part of a reference cycle"""
+    __slots__ = ()
+
+# end class ResolveError
+
+
+class FormatStringResolver(object):
+    """Resolves format strings, like `{site.name}/{site.root_path.base}`, against the values of a kvstore.
+
+    Format strings are parsed only once into token lists, which are cached for all instances.
+    The first time a value is resolved, all format strings within the data are resolved at once, in topological
+    order of the keys they reference. That way, each referenced value is final by the time it is substituted, and
+    no iteration is required to find the fixed-point.
+
+    Reference cycles are detected up-front, before anything is formatted. All values in a cycle, as well as
+    all values depending on them, are considered unresolvable.
+
+    As the data is not expected to change, an instance should be used only for a single version of a kvstore.
+
+    @note escaped braces, like `{{` and `}}`, are handled just like str.format() does, i.e. they will yield
+    literal braces.
+    """
+    __slots__ = (
+                    '_data',        ## the tree with the raw values to resolve against
+                    '_formatter',   ## the formatter instance used to retrieve and format fields
+                    '_resolved',    ## a copy of _data with all format strings resolved, or None
+                    '_errors',      ## a dict of path-tuple => exception for all unresolvable values in _data
+                    '_templates',   ## a dict of path-tuple => format string for all format strings in _data
+                    '_results'      ## a dict of format string => result or exception
+                )
+
+    # -------------------------
+    ## @name Configuration
+    # @{
+
+    ## Mapping from format string to its token list, shared by all instances
+    _token_cache = dict()
+
+    ## The maximum amount of entries in the token cache. If there are more, it will be cleared
+    max_cached_tokens = 16384
+
+    ## -- End Configuration -- @}
+
+    def __init__(self, data, formatter_type=KVStringFormatter):
+        """Initialize this instance
+        @param data a possibly nested dict with values to resolve format strings against.
+        It will not be altered.
+        @param formatter_type a KVStringFormatter compatible type to retrieve and format fields"""
+        self._data = data
+        self._formatter = formatter_type()
+        self._resolved = None
+        self._errors = dict()
+        self._templates = None
+        self._results = dict()
+
+    # -------------------------
+    ## @name Utilities
+    # @{
+
+    @staticmethod
+    def _is_tree(value):
+        return isinstance(value, (dict, DictObject))
+
+    @staticmethod
+    def _is_template(value):
+        """@return True if the given value may be changed by formatting it"""
+        return isinstance(value, basestring) and ('{' in value or '}' in value)
+
+    def _tokens(self, format_string):
+        """@return a tuple of (literal_text, field_name, format_spec, conversion) tuples, where format_spec is
+        a nested token tuple if it is a format string itself.
+        @throws ValueError if the format string is malformed"""
+        try:
+            return self._token_cache[format_string]
+        except KeyError:
+            pass
+        # end handle cache hit
+
+        tokens = list()
+        for literal_text, field_name, format_spec, conversion in self._formatter.parse(format_string):
+            if format_spec and self._is_template(format_spec):
+                format_spec = self._tokens(format_spec)
+            # end compile nested format specification
+            tokens.append((literal_text, field_name, format_spec, conversion))
+        # end for each token
+        tokens = tuple(tokens)
+
+        cache = self._token_cache
+        if len(cache) >= self.max_cached_tokens:
+            cache.clear()
+        # end limit cache size
+        cache[format_string] = tokens
+        return tokens
+
+    def _field_names(self, tokens):
+        """@return a list of all field names in the given token list, including the ones in nested
+        format specifications"""
+        names = list()
+        for literal_text, field_name, format_spec, conversion in tokens:
+            if field_name is not None:
+                names.append(field_name)
+            # end handle field
+            if isinstance(format_spec, tuple):
+                names.extend(self._field_names(format_spec))
+            # end handle nested tokens
+        # end for each token
+        return names
+
+    def _referenced_path(self, field_name):
+        """@return a tuple of keys and list-indices to the value in our data the given field name refers to.
+        It is empty if the field doesn't reference anything in our data.
+        @note attributes of leaf values, like `path.dirname`, are not part of the path"""
+        first, rest = field_name._formatter_field_name_split()
+        node = self._data
+        if not self._is_tree(node) or first not in node:
+            return tuple()
+        # end handle unknown key
+        path = [first]
+        node = node[first]
+        for is_attr, name in rest:
+            if self._is_tree(node):
+                if name not in node:
+                    break
+                # end handle attributes of trees
+            elif isinstance(node, list):
+                if is_attr or not isinstance(name, (int, long)) or not (0 <= name < len(node)):
+                    break
+                # end handle invalid index
+            else:
+                break
+            # end handle node type
+            path.append(name)
+            node = node[name]
+        # end for each part of the field
+        return tuple(path)
+
+    def _collect_templates(self, node, path, out):
+        """Find all format strings in the given node and put them into out, keyed by their path"""
+        if self._is_tree(node):
+            items = node.iteritems()
+        elif isinstance(node, list):
+            items = enumerate(node)
+        else:
+            if self._is_template(node):
+                out[path] = node
+            # end keep format strings
+            return
+        # end handle node type
+        for key, value in items:
+            self._collect_templates(value, path + (key,), out)
+        # end for each item
+
+    def _dependencies(self, tokens):
+        """@return a list of path-tuples of all format strings in our data the given tokens depend on"""
+        deps = list()
+        for field_name in self._field_names(tokens):
+            path = self._referenced_path(field_name)
+            if not path:
+                continue
+            # end ignore unknown references
+            if path in self._templates:
+                deps.append(path)
+                continue
+            # end handle direct references
+            # references to trees depend on all format strings within them
+            num_tokens = len(path)
+            for template_path in self._templates:
+                if template_path[:num_tokens] == path:
+                    deps.append(template_path)
+                # end handle sub-path
+            # end for each template
+        # end for each field
+        return deps
+
+    def _sorted_templates(self, graph):
+        """@return a list of all paths in the given dependency graph, dependencies first.
+        Paths which are part of a reference cycle are put into our _errors dict instead.
+        @param graph a dict of path => list(dependency_paths)"""
+        visiting, done = 1, 2
+        state = dict()
+        order = list()
+
+        for root in graph:
+            if root in state:
+                continue
+            # end skip visited nodes
+            state[root] = visiting
+            stack = [(root, iter(graph[root]))]
+            while stack:
+                path, deps = stack[-1]
+                for dep in deps:
+                    dep_state = state.get(dep)
+                    if dep_state is None:
+                        state[dep] = visiting
+                        stack.append((dep, iter(graph[dep])))
+                        break
+                    elif dep_state is visiting:
+                        cycle = [item[0] for item in stack]
+                        cycle = cycle[cycle.index(dep):] + [dep]
+                        msg = "Reference cycle detected: %s" % ' -> '.join(self._format_path(p) for p in cycle)
+                        for cycle_path in cycle:
+                            self._errors.setdefault(cycle_path, ResolveError(msg))
+                        # end for each path in cycle
+                    # end handle dependency state
+                else:
+                    stack.pop()
+                    state[path] = done
+                    order.append(path)
+                # end handle all dependencies visited
+            # end while there are nodes to visit
+        # end for each root
+        return order
+
+    @staticmethod
+    def _format_path(path):
+        """@return a string representation of the given path tuple, like 'foo.bar[0]'"""
+        out = list()
+        for token in path:
+            if isinstance(token, (int, long)):
+                out.append('[%i]' % token)
+            else:
+                out.append(out and '.%s' % token or str(token))
+            # end handle token type
+        # end for each token
+        return ''.join(out)
+
+    def _set_resolved_value(self, path, value, copied):
+        """Set the given value in our resolved tree, copying all containers on the way that are still shared
+        with the original data
+        @param copied a set with ids of all containers we already copied"""
+        node = self._resolved
+        for token in path[:-1]:
+            child = node[token]
+            if id(child) not in copied:
+                child = copy.copy(child)
+                copied.add(id(child))
+                node[token] = child
+            # end copy shared containers
+            node = child
+        # end for each token
+        node[path[-1]] = value
+
+    def _format(self, tokens):
+        """@return the string resulting from formatting the given tokens with our resolved data
+        @note this is what Formatter._vformat() does, without parsing"""
+        formatter = self._formatter
+        result = list()
+        for literal_text, field_name, format_spec, conversion in tokens:
+            if literal_text:
+                result.append(literal_text)
+            # end handle literal text
+            if field_name is None:
+                continue
+            # end handle text-only tokens
+            obj, _ = formatter.get_field(field_name, [], self._resolved)
+            obj = formatter.convert_field(obj, conversion)
+            if isinstance(format_spec, tuple):
+                format_spec = self._format(format_spec)
+            # end handle nested format specification
+            result.append(formatter.format_field(obj, format_spec))
+        # end for each token
+        return ''.join(result)
+
+    def _resolve_all(self):
+        """Resolve all format strings in our data, in topological order"""
+        self._templates = templates = dict()
+        self._collect_templates(self._data, tuple(), templates)
+        self._resolved = self._data
+        if not templates:
+            return
+        # end early bailout
+        self._resolved = copy.copy(self._data)
+
+        tokens = dict()
+        graph = dict()
+        for path, format_string in templates.iteritems():
+            try:
+                tokens[path] = self._tokens(format_string)
+            except ValueError, err:
+                self._errors[path] = err
+                graph[path] = list()
+                continue
+            # end handle malformed format strings
+            graph[path] = self._dependencies(tokens[path])
+        # end for each format string
+
+        copied = set((id(self._resolved),))
+        for path in self._sorted_templates(graph):
+            if path in self._errors:
+                continue
+            # end skip known errors
+            failed = [dep for dep in graph[path] if dep in self._errors]
+            if failed:
+                self._errors[path] = ResolveError("Value at '%s' is unresolvable: %s"
+                                                  % (self._format_path(failed[0]), self._errors[failed[0]]))
+                continue
+            # end handle failed dependencies
+            try:
+                value = self._format(tokens[path])
+            except Exception, err:
+                # Failures must only affect this value and the ones depending on it. resolve() will raise
+                # the exception once this value is used
+                self._errors[path] = err
+                continue
+            # end handle format errors
+            self._set_resolved_value(path, value, copied)
+        # end for each path in order
+
+    ## -- End Utilities -- @}
+
+    # -------------------------
+    ## @name Interface
+    # @{
+
+    def data(self):
+        """@return the data we resolve against, as passed to our constructor"""
+        return self._data
+
+    def resolve(self, format_string):
+        """@return the string resulting from resolving format_string against our data. Referenced values
+        which are format strings themselves are fully resolved.
+        @param format_string a string which may contain format fields referencing values in our data
+        @throws ResolveError if a referenced value is unresolvable or part of a reference cycle
+        @throws KeyError, AttributeError, ValueError, TypeError if the format string can't be formatted"""
+        try:
+            result = self._results[format_string]
+        except KeyError:
+            if self._templates is None:
+                self._resolve_all()
+            # end resolve data on first use
+            try:
+                tokens = self._tokens(format_string)
+                failed = [dep for dep in self._dependencies(tokens) if dep in self._errors]
+                if failed:
+                    raise ResolveError("Value at '%s' is unresolvable: %s"
+                                       % (self._format_path(failed[0]), self._errors[failed[0]]))
+                # end handle failed dependencies
+                result = self._format(tokens)
+            except (KeyError, AttributeError, ValueError, TypeError), err:
+                result = err
+            # end handle errors
+            self._results[format_string] = result
+        # end handle cache miss
+
+        if isinstance(result, Exception):
+            raise result
+        # end re-raise errors
+        return result
+
+    def errors(self):
+        """@return a dict of 'key' => exception pairs for all format strings in our data which can't be
+        resolved, keyed by their fully qualified key, like 'site.paths[0]'"""
+        if self._templates is None:
+            self._resolve_all()
+        # end assure we are resolved
+        return dict((self._format_path(path), err) for path, err in self._errors.iteritems())
+
+    ## -- End Interface -- @}
+
+# end class FormatStringResolver
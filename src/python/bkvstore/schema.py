@@ -25,6 +25,7 @@ from butility import (Path,
                       DictObject)
 
 from .diff import transform_value
+from .utility import KVStringFormatter
 
 from .base import ( Error,
                     KeyValueStoreProvider )
@@ -80,6 +81,7 @@ class SchemaDiffRecord(DiffRecord):
 # end class SchemaDiffRecord
 
 
+@KVStringFormatter.register_type
 class KVPath(NativePath):
     """The version of the path which allows to access most common path operations as property.
     That way, it is suitable for substitution within the kvstore."""
@@ -155,6 +157,7 @@ class TypedList(list):
 # end class TypedList
 
 
+@KVStringFormatter.register_type
 class StringList(TypedList):
     """A list just for Strings - for use in KeyValueStoreSchema instances only"""
     __slots__ = ()
@@ -164,6 +167,7 @@ class StringList(TypedList):
 # end class StringList
 
 
+@KVStringFormatter.register_type
 class IntList(TypedList):
     """A list just for Integers - for use in KeyValueStoreSchema instances only"""
     __slots__ = ()
@@ -173,6 +177,7 @@ class IntList(TypedList):
 # end class IntList
 
 
+@KVStringFormatter.register_type
 class FloatList(TypedList):
     """A list just for floats - for use in KeyValueStoreSchema instances only"""
     __slots__ = ()
@@ -182,6 +187,7 @@ class FloatList(TypedList):
 # end class IntList
 
 
+@KVStringFormatter.register_type
 class PathList(TypedList):
     """A list just for Paths - for use in KeyValueStoreSchema instances only"""
     __slots__ = ()
@@ -207,6 +213,7 @@ class PathList(TypedList):
     ## -- End Properties -- @}
 
 
+@KVStringFormatter.register_type
 class KVPathList(PathList):
     """uses KVPaths instead"""
     __slots__ = ()
@@ -274,7 +281,7 @@ class ValidateKeyValueStoreDiffIndexDelegate(DiffIndexDelegate):
 
         if msg is not None:
             record = self.DiffRecordType(qualified_key, left_value, right_value, change_type, msg)
-            self._diff_index[qualified_key] = record
+            self._add_record(qualified_key, record)
         #end handle record creation
 
 # end class ValidateKeyValueStoreDiffIndexDelegate
@@ -352,14 +359,28 @@ class KeyValueStoreSchemaValidator(list):
         @throws InvalidSchema when this schema is not valid by itself. When validating the provider,
         the schema will be validated automatically, and cause this error if its not valid
         """
+        delegate = ValidateKeyValueStoreDiffIndexDelegate()
+        TwoWayDiff().diff(delegate, kvs_provider._data(), self._valid_schema_data())
+
+        return delegate.result()
+
+    def iter_provider_issues(self, kvs_provider):
+        """Similar to validate_provider(), but yields issues as soon as they are found, which allows to stop
+        at the first one without validating the entire provider
+        @param kvs_provider a `KeyValueStoreProvider` instance.
+        @return generator yielding SchemaDiffRecord instances
+        @throws InvalidSchema when this schema is not valid by itself"""
+        schema_data = self._valid_schema_data()
+        return ValidateKeyValueStoreDiffIndexDelegate().iter_records(kvs_provider._data(), schema_data)
+
+    def _valid_schema_data(self):
+        """@return merged schema data
+        @throws InvalidSchema if there are clashing keys"""
         schema_data, clashing_keys = self.validate_schema()
         if clashing_keys:
             raise InvalidSchema(clashing_keys)
         # end assure valid schema
-        delegate = ValidateKeyValueStoreDiffIndexDelegate()
-        TwoWayDiff().diff(delegate, kvs_provider._data(), schema_data)
-
-        return delegate.result()
+        return schema_data
         
     @classmethod
     def merge_schemas(cls, schemas, merge_root_keys = True):
@@ -418,6 +439,7 @@ class KeyValueStoreSchema(DictObject, dict):
         """
         super(KeyValueStoreSchema, self).__init__(in_dict)
         self._key = key
+        KVStringFormatter.register_types_by_schema(self)
 
     # -------------------------
     ## @name Interface
@@ -10,11 +10,17 @@
 """
 __all__ = ['ChangeTrackingSerializingKeyValueStoreModifierBase', 'SerializingKeyValueStoreModifierBase']
 
+import os
 import logging
 
+from cStringIO import StringIO
+
 
 from butility import (Path,
                       InterfaceBase,
+                      concurrent_map,
+                      FileHashCache,
+                      PhaseProfiler,
                       abstractmethod)
 
 from bdiff import (NoValue,
@@ -84,13 +90,24 @@ class _SerializingKeyValueStoreModifierMixin(object):
     ## A type to use for serialization
     ## To be set by subclass
     StreamSerializerType = None
+
+    ## A type compatible to the SerializedDataCache, used to cache deserialized and merged data of files
+    ## read by reload(). If None, no caching will be done
+    DataCacheType = None
+
+    ## The maximum amount of threads to use for reading, hashing and parsing input files concurrently, which
+    ## helps on high-latency filesystems. If 1 or less, all inputs are processed serially
+    read_workers_count = 1
+
+    ## If set, this environment variable overrides the read_workers_count
+    read_workers_env_var = 'BKVSTORE_READ_WORKERS'
     
     ## -- End Subclass Configuration -- @}
 
     ## our logging instance
     log = logging.getLogger("bkvstore.serializer")
 
-    def __init__(self, input_paths, take_ownership = True):
+    def __init__(self, input_paths, take_ownership = True, keys = None, contents = None):
         """Initialize this instance with a set of paths from which to read values and to which to write the
         changed values.
 
@@ -99,12 +116,23 @@ class _SerializingKeyValueStoreModifierMixin(object):
         The iterable may also yield file-like object which provides a read() method.
         It may be empty, which is when you will have an empty KVStore.
         @param take_ownership has no effect, we always have ownership
+        @param keys if not None, an iterable of keys like 'section' or 'section.subsection'. Only values
+        below these keys will be loaded, and files which don't define any of them will not be deserialized
+        at all if their key index is cached. If None, all values will be loaded.
+        @param contents if not None, a dict mapping input paths to their contents as string, as previously
+        read by the caller. These will be used instead of reading the respective files during the initial load.
+        @note keys deeper than two levels are treated like their two-level prefix
         """
         assert self.StreamSerializerType and self.SerializingKeyValueStoreModifierDiffDelegateType
         
         # init with empty dict
         super(_SerializingKeyValueStoreModifierMixin, self).__init__(self.KeyValueStoreModifierDiffDelegateType.DictType())
         self._set_input_paths(input_paths)
+        self._keys = None
+        if keys is not None:
+            self._keys = tuple(keys)
+        # end handle keys
+        self._contents = contents
         
         # force updating our data
         self.reload()
@@ -119,6 +147,98 @@ class _SerializingKeyValueStoreModifierMixin(object):
             # end handle type
             self._input_paths.append(path_or_stream)
         #end for each path
+
+    @classmethod
+    def read_workers(cls):
+        """@return the maximum amount of threads to use when reading input files"""
+        try:
+            return int(os.environ.get(cls.read_workers_env_var, cls.read_workers_count))
+        except ValueError:
+            cls.log.warn("Invalid value for %s - using %i read workers", cls.read_workers_env_var,
+                                                                         cls.read_workers_count)
+            return cls.read_workers_count
+        # end handle invalid values
+
+    def _key_selection(self):
+        """@return dict mapping top-level keys to a set of second-level keys, or to None if the entire
+        top-level value is selected. Returns None if all keys are selected"""
+        if self._keys is None:
+            return None
+        # end handle no filter
+        selection = dict()
+        for key in self._keys:
+            tokens = key.split(self.key_separator)
+            top = tokens[0]
+            if len(tokens) == 1:
+                selection[top] = None
+            elif top not in selection:
+                selection[top] = set((tokens[1], ))
+            elif selection[top] is not None:
+                selection[top].add(tokens[1])
+            # end handle key depth
+        # end for each key
+        return selection
+
+    @classmethod
+    def _key_index(cls, data):
+        """@return a dict mapping each top-level key of data to a tuple of its second-level keys, or
+        to None if its value is not a dictionary. Returns None if data itself is no dictionary"""
+        if not isinstance(data, dict):
+            return None
+        # end handle unstructured data
+        index = dict()
+        for key, value in data.iteritems():
+            if isinstance(value, dict):
+                index[key] = tuple(value.keys())
+            else:
+                index[key] = None
+            # end handle leaf
+        # end for each top-level key
+        return index
+
+    @classmethod
+    def _is_selected(cls, index, selection):
+        """@return True if a file with the given key index defines any of the selected keys"""
+        if index is None:
+            return True
+        # end unstructured data must always be loaded
+        for top, subkeys in selection.iteritems():
+            if top not in index:
+                continue
+            # end skip undefined keys
+            if subkeys is None or index[top] is None or not subkeys.isdisjoint(index[top]):
+                return True
+            # end handle match
+        # end for each selected key
+        return False
+
+    def _select(self, data, selection):
+        """@return a copy of data which contains only the values below the given key selection"""
+        if not isinstance(data, dict):
+            return data
+        # end handle unstructured data
+        DictType = self.KeyValueStoreModifierDiffDelegateType.DictType
+        res = DictType()
+        for key, value in data.iteritems():
+            if key not in selection:
+                continue
+            # end skip unselected keys
+            subkeys = selection[key]
+            if subkeys is not None and isinstance(value, dict):
+                subtree = DictType()
+                for subkey, subvalue in value.iteritems():
+                    if subkey in subkeys:
+                        subtree[subkey] = subvalue
+                    # end keep selected values
+                # end for each second-level key
+                if not subtree:
+                    continue
+                # end skip empty trees
+                value = subtree
+            # end handle second-level selection
+            res[key] = value
+        # end for each top-level key
+        return res
         
     # -------------------------
     ## @name Serialization Interface
@@ -138,6 +258,11 @@ class _SerializingKeyValueStoreModifierMixin(object):
         not fail though
         @note changes will only be reapplied if our subclass also derives from KeyValueStoreChangeTrackerMixin.
         Otherwise, we will just reload from disk without any special handling
+        @note if we were initialized with keys, only values below them are loaded. The top-level and
+        second-level keys of each file are cached in a key index, which allows to skip files that don't
+        contribute to the selected keys without deserializing them.
+        @note if read_workers() is larger than 1, files are read, hashed and parsed concurrently. They are
+        always merged in order.
         """
         if input_paths is not None:
             self._set_input_paths(input_paths)
@@ -148,44 +273,182 @@ class _SerializingKeyValueStoreModifierMixin(object):
         ##! [additive example]
         delegate = self.SerializingKeyValueStoreModifierDiffDelegateType()
         streamer = self.StreamSerializerType()
-
-        def load_and_merge_safely(path_or_stream):
-            """Load a file and merge the result using our delegate"""
+        workers = self.read_workers()
+        selection = self._key_selection()
+        prefetched = self._contents or dict()
+        self._contents = None
+
+        cache = None
+        hashes = FileHashCache.instance()
+        profiler = PhaseProfiler.instance()
+        if self.DataCacheType is not None and self.DataCacheType.is_enabled():
+            cache = self.DataCacheType()
+        # end setup cache
+        
+        def read(path_or_stream):
+            """@return (path_or_stream, cache_key, content) tuple, with content being the file contents as string.
+            The key is None if the input cannot be cached, the content is None if it cannot be read or if it
+            wasn't needed to compute the key"""
+            if hasattr(path_or_stream, 'read'):
+                return path_or_stream, None, None
+            # end handle streams
+            content = prefetched.get(path_or_stream)
+            if content is None and cache is not None:
+                try:
+                    if hashes.cached_digest(path_or_stream) is not None:
+                        # the file will only be read if its data isn't cached
+                        return path_or_stream, cache.file_key(type(streamer).__name__, path_or_stream), None
+                    # end handle known digest
+                except OSError:
+                    return path_or_stream, None, None
+                # end handle missing files
+            # end try to avoid reading the file
+            if content is None:
+                try:
+                    fp = open(path_or_stream, 'rb')
+                    try:
+                        content = fp.read()
+                    finally:
+                        fp.close()
+                    # end assure file is closed
+                except (OSError, IOError):
+                    # let the actual load attempt handle the error
+                    return path_or_stream, None, None
+                # end handle read errors
+            # end read unless prefetched
+            if cache is None:
+                return path_or_stream, None, content
+            # end handle uncacheable input
+            return path_or_stream, cache.file_key(type(streamer).__name__, path_or_stream, content), content
+
+        def load_safely(path_or_stream, key, content):
+            """@return data deserialized from the given input, or None if it could not be read or parsed"""
+            if key is not None:
+                data = cache.get(key)
+                if data is not None:
+                    self.log.debug("loaded %s file '%s' from cache", streamer.file_extension, path_or_stream)
+                    return data
+                # end handle cache hit
+            # end check cache
             try:
                 # YES: THEY RETURN NONE IF THERE WAS NOTHING, INSTEAD OF DICT. GOD DAMNED ! Interface change !
                 stream = path_or_stream
-                if not hasattr(path_or_stream, 'read'):
+                if content is not None:
+                    stream = StringIO(content)
+                elif not hasattr(path_or_stream, 'read'):
                     stream = open(path_or_stream)
                 # end open stream as needed
-                data = streamer.deserialize(stream)
+                with profiler.span('%s.deserialize' % type(streamer).__name__, path=path_or_stream):
+                    data = streamer.deserialize(stream)
+                # end measure parsing
                 if hasattr(stream, 'close'):
                     stream.close()
                 # end handle stream close
             except (OSError, IOError):
                 self.log.error("Could not load %s file at '%s'", streamer.file_extension, path_or_stream, exc_info=True)
-                return
+                return None
             except Exception:
                 self.log.error("Invalid %s file at '%s'", streamer.file_extension, path_or_stream, exc_info=True)
-                return
+                return None
             #end handle exceptions
+            if key is not None:
+                cache.set(key, data)
+            # end update cache
+            return data
+        # end load_safely
+
+        def load(input):
+            """@return data deserialized from the given input, reduced to our selection, or None if it
+            could not be read or parsed. Returns NoValue if it doesn't define any selected key.
+            Uses the cached key index of cacheable inputs to skip them without loading them"""
+            path_or_stream, key, content = input
+            if selection is None:
+                return load_safely(path_or_stream, key, content)
+            # end handle no selection
+
+            data = None
+            if key is not None:
+                index_key = cache.key('key-index', key)
+                index = cache.get(index_key)
+                if index is None:
+                    data = load_safely(path_or_stream, key, content)
+                    if data is None:
+                        return None
+                    # end handle invalid files
+                    index = (self._key_index(data), )
+                    cache.set(index_key, index)
+                # end create index
+                if not self._is_selected(index[0], selection):
+                    return NoValue
+                # end skip files without selected keys
+            # end check index
+            if data is None:
+                data = load_safely(path_or_stream, key, content)
+                if data is None:
+                    return None
+                # end handle invalid files
+            # end load data
+            return self._select(data, selection)
+        # end load
+
+        def merge(path_or_stream, data):
+            """Merge the given data using our delegate"""
             # only in the first run, we have no result as basis yet
             self.log.debug("loaded and merged %s file '%s'", streamer.file_extension, path_or_stream)
             base = delegate.result()
             if base is NoValue:
                 base = self.KeyValueStoreModifierDiffDelegateType.DictType()
             #end set base
-            self.TwoWayDiffAlgorithmType().diff(delegate, base, data)
-        #end load_and_merge_safely
-        for path_or_stream in self._input_paths:
-            load_and_merge_safely(path_or_stream)
-        #end for each input path
-
-        # tell our base class to non-destructively update with the new data
-        res = delegate.result()
-        if res is NoValue:
-            # happens if we had no input, and no valid file to read from, just be empty then
-            res = self.KeyValueStoreModifierDiffDelegateType.DictType()
-        # end handle no value
+            with profiler.span('%s.merge' % self.TwoWayDiffAlgorithmType.__name__, path=path_or_stream):
+                self.TwoWayDiffAlgorithmType().diff(delegate, base, data)
+            # end measure merge
+        #end merge
+
+        # Read and hash all inputs, possibly concurrently.
+        # The merged result can only be cached if each input can be cached as well
+        with profiler.span('%s.read' % type(self).__name__, count=len(self._input_paths)):
+            inputs = concurrent_map(read, self._input_paths, workers)
+        # end measure reading
+
+        res = None
+        merged_key = None
+        if inputs and not [key for path_or_stream, key, content in inputs if key is None]:
+            keys = [key for path_or_stream, key, content in inputs]
+            if selection is not None:
+                keys.append(cache.key('keys', *sorted(self._keys)))
+            # end make selection part of the key
+            merged_key = cache.key(type(delegate).__name__, *keys)
+            res = cache.get(merged_key)
+            if res is not None:
+                self.log.debug("loaded merged result of %i %s files from cache", len(inputs), streamer.file_extension)
+            # end handle cache hit
+        # end check merged cache
+
+        if res is None:
+            # Parsing may happen concurrently, but merging must happen in order to be deterministic
+            for (path_or_stream, key, content), data in zip(inputs, concurrent_map(load, inputs, workers)):
+                if data is None:
+                    merged_key = None
+                    continue
+                # end ignore invalid files
+                if data is NoValue:
+                    self.log.debug("skipped %s file '%s' as it doesn't define any selected key",
+                                   streamer.file_extension, path_or_stream)
+                    continue
+                # end skip files without selected keys
+                merge(path_or_stream, data)
+            # end for each input
+
+            # tell our base class to non-destructively update with the new data
+            res = delegate.result()
+            if res is NoValue:
+                # happens if we had no input, and no valid file to read from, just be empty then
+                res = self.KeyValueStoreModifierDiffDelegateType.DictType()
+            elif merged_key is not None:
+                cache.set(merged_key, res)
+            # end handle no value
+        # end handle merge
+        hashes.flush()
         
         self._set_data(res)
         return self
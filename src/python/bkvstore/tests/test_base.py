@@ -394,6 +394,255 @@ class TestKeyValueStoreProvider(TestConfigurationBase):
         assert not hasattr(value.worse, 'five'), 'five was not in schema, so it shouldnt be there'
         assert len(value.worse.multi.keys()) == 0
 
+    def test_value_view(self):
+        """Verify views provide the same values as value(), but lazily and with copy-on-write"""
+        schema = KeyValueStoreSchema('root', { 'packages' : { AnyKey : { 'one' : str, 
+                                                                         'two' : 'default', 
+                                                                         'multi' : { AnyKey : int },
+                                                                         'list' : IntList }},
+                                               'site' : { 'name' : str,
+                                                          'location' : 'nowhere' }
+                                             })
+        data = OrderedDict({'root' : OrderedDict({
+                                'packages' : OrderedDict({
+                                    'good' : OrderedDict({'one' : 'g-one',
+                                                          'multi' : OrderedDict({'foo' : '1', 'bar' : 2}),
+                                                          'list' : ['1', 2]}),
+                                    'worse' : OrderedDict({'one' : 5, 'two' : None, 'five' : 42})}),
+                                'site' : OrderedDict({'name' : 'bapp-{root.site.location}',
+                                                      'location' : 'munich'})
+                            })
+        })
+
+        for kvstore_type in (KeyValueStoreProvider, LooseKeyValueStoreProvider):
+            kvstore = kvstore_type(data)
+            for resolve in range(2):
+                value = kvstore.value_by_schema(schema, resolve=resolve)
+                view = kvstore.value_by_schema(schema, resolve=resolve, view=True)
+                assert isinstance(view, KeyValueStoreValueView)
+                assert view == value, "views must yield the same values"
+                assert sorted(view.keys()) == sorted(value.keys())
+            # end for each resolve mode
+        # end for each provider type
+
+        kvstore = KeyValueStoreProvider(data)
+        view = kvstore.value(schema.key(), schema, resolve=True, view=True)
+        assert not view._children, "nothing is computed until it is accessed"
+        assert view.site.name == 'bapp-munich'
+        assert len(view._children) == 1 and len(view.site._children) == 1, "only accessed values are computed"
+        assert view.packages.good.multi.foo == 1
+        assert view.packages['good']['list'] == [1, 2]
+        assert view.packages.good.list is view.packages.good.list, "values are computed only once"
+        assert 'five' not in view.packages.worse, "unknown values are dropped"
+        self.failUnlessRaises(AttributeError, getattr, view.packages.worse, 'five')
+        assert view.get('doesntexist') is None
+
+        # copy on write
+        view.packages.good.one = 'changed'
+        view.packages.good.multi['new'] = 5
+        del(view.packages.worse['two'])
+        assert view.packages.good.one == 'changed' and view.packages.good.multi.new == 5 and 'two' not in view.packages.worse
+        assert data['root']['packages']['good']['one'] == 'g-one', "the store must never be changed"
+        assert 'new' not in data['root']['packages']['good']['multi']
+        assert data['root']['packages']['worse']['two'] is None
+
+        copied = view.copy()
+        assert isinstance(copied, OrderedDict) and isinstance(copied.packages.good.multi, OrderedDict)
+        assert copied.packages.good.one == 'changed'
+
+        # non-trees are not put into views
+        assert kvstore.value('root.site.location', str(), view=True) == 'munich'
+
+    def test_schema_cache(self):
+        """Verify values by schema are cached until the data changes"""
+        schema = KeyValueStoreSchema('section', { 'string' : str,
+                                                  'list' : StringList,
+                                                  'int' : 5 })
+        other_schema = KeyValueStoreSchema('section', { 'int' : 5 })
+        kvstore = KeyValueStoreModifier(self.config_data('basic.yaml'))
+        info = kvstore.schema_cache_info()
+        assert info['hits'] == info['misses'] == info['size'] == 0
+
+        value = kvstore.value_by_schema(schema)
+        assert kvstore.value_by_schema(schema) == value
+        info = kvstore.schema_cache_info()
+        assert info['hits'] == 1 and info['misses'] == 1 and info['size'] == 1
+
+        # returned values are copies
+        value.list.append('new')
+        assert kvstore.value_by_schema(schema).list != value.list, "cached values must not be changed by clients"
+
+        # resolve flag and schema identity are part of the cache key
+        kvstore.value_by_schema(schema, resolve=True)
+        kvstore.value_by_schema(other_schema)
+        assert kvstore.schema_cache_info()['misses'] == 3
+
+        # any change invalidates the cache
+        for modify in (lambda: kvstore.set_value('section.int', 42),
+                       lambda: kvstore.delete_value('section.string'),
+                       lambda: kvstore._set_data(kvstore.data())):
+            version = kvstore.version()
+            modify()
+            assert kvstore.version() > version
+            assert kvstore.schema_cache_info()['size'] == 0
+            assert kvstore.value_by_schema(schema) == kvstore.value(schema.key(), schema)
+        # end for each modification
+        assert kvstore.value_by_schema(schema).int == 42
+
+        # least recently used values are evicted
+        prev_size = KeyValueStoreModifier.schema_cache_size
+        KeyValueStoreModifier.schema_cache_size = 2
+        try:
+            for schema_type in (schema, other_schema, schema, KeyValueStoreSchema('other', { 'int' : 1 })):
+                kvstore.value_by_schema(schema_type)
+            # end for each schema
+            assert kvstore.schema_cache_info()['size'] == 2
+            misses = kvstore.schema_cache_info()['misses']
+            kvstore.value_by_schema(schema)
+            assert kvstore.schema_cache_info()['misses'] == misses, "most recently used schema should be cached"
+        finally:
+            KeyValueStoreModifier.schema_cache_size = prev_size
+        # end restore class configuration
+
+    def test_format_string_resolver(self):
+        """Verify format strings are resolved in dependency order, and cycles are detected up-front"""
+        data = OrderedDict({'site' : OrderedDict({ 'root' : '{site.base}/root',
+                                                   'base' : '/{site.name}',
+                                                   'name' : 'munich',
+                                                   'paths' : ['{site.root}/p1', '{site.paths[0]}/p2'],
+                                                   'padded' : '{site.name:>{site.width}}',
+                                                   'width' : 8,
+                                                   'cycle' : '{site.other}',
+                                                   'other' : '{site.cycle}/x',
+                                                   'self' : 'a{site.self}',
+                                                   'broken' : '{site.cycle}/{site.name}',
+                                                   'missing' : '{foo.bar}'})})
+        resolver = FormatStringResolver(data)
+        assert resolver.resolve('{site.root}') == '/munich/root'
+        assert resolver.resolve('{site.paths[1]}') == '/munich/root/p1/p2'
+        assert resolver.resolve('{site.padded}') == '  munich'
+        assert resolver.resolve('no format') == 'no format'
+        assert resolver.resolve('{{escaped}}') == '{escaped}'
+        assert data.site.root == '{site.base}/root', "data must not be changed"
+        assert data.site.paths[0] == '{site.root}/p1'
+
+        errors = resolver.errors()
+        assert set(errors) == set(('site.cycle', 'site.other', 'site.self', 'site.broken', 'site.missing'))
+        assert isinstance(errors['site.cycle'], ResolveError) and 'cycle' in str(errors['site.cycle'])
+        assert isinstance(errors['site.broken'], ResolveError)
+        for key in ('cycle', 'self', 'broken'):
+            self.failUnlessRaises(ResolveError, resolver.resolve, '{site.%s}' % key)
+        # end for each unresolvable key
+        self.failUnlessRaises(AttributeError, resolver.resolve, '{foo}')
+        self.failUnlessRaises(ValueError, resolver.resolve, 'single }')
+
+        # format strings are parsed only once
+        assert '{site.base}/root' in FormatStringResolver._token_cache
+
+        # kvstores share a resolver until their data changes
+        schema = KeyValueStoreSchema('site', { 'root' : str, 'cycle' : 'default' })
+        kvstore = KeyValueStoreModifier(data, take_ownership=False)
+        value = kvstore.value_by_schema(schema, resolve=True)
+        assert value.root == '/munich/root'
+        assert value.cycle == '', 'cyclic values are unresolvable'
+        resolver = kvstore._format_string_resolver()
+        assert kvstore._format_string_resolver() is resolver
+        kvstore.set_value('site.name', 'berlin')
+        assert kvstore._format_string_resolver() is not resolver
+        assert kvstore.value_by_schema(schema, resolve=True).root == '/berlin/root'
+
+    def test_formatter_type_registry(self):
+        """Verify types for the 'as_' syntax are obtained from a registry"""
+        for name in ('KVPath', 'Path', 'Version', 'StringList', 'IntList', 'FloatList', 'PathList'):
+            assert KVStringFormatter._type_by_name(name).__name__ == name
+        # end for each default type
+
+        class SchemaType(str):
+            pass
+        # end class SchemaType
+        KeyValueStoreSchema('registry', { 'nested' : { 'value' : SchemaType } })
+        assert KVStringFormatter._type_by_name('SchemaType') is SchemaType, "schema types are registered"
+
+        scans = KVStringFormatter.type_registry_info()['fallback_scans']
+        data = OrderedDict({'path' : '/foo/bar'})
+        resolver = FormatStringResolver(data)
+        assert resolver.resolve('{path.as_KVPath.basename}') == 'bar'
+        assert resolver.resolve('{path.as_SchemaType}') == '/foo/bar'
+        self.failUnlessRaises(ValueError, resolver.resolve, '{path.as_TestConfigurationBase}')
+        assert KVStringFormatter.type_registry_info()['fallback_scans'] == scans, "registered types don't scan"
+
+        prev_scan = KVStringFormatter.scan_modules_for_types
+        KVStringFormatter.scan_modules_for_types = True
+        try:
+            assert KVStringFormatter._type_by_name('TestConfigurationBase') is TestConfigurationBase
+            assert KVStringFormatter.type_registry_info()['fallback_scans'] == scans + 1
+            KVStringFormatter._type_by_name('TestConfigurationBase')
+            assert KVStringFormatter.type_registry_info()['fallback_scans'] == scans + 1, "scan results are kept"
+        finally:
+            KVStringFormatter.scan_modules_for_types = prev_scan
+            del(KVStringFormatter._type_cache['TestConfigurationBase'])
+        # end restore configuration
+
+    def test_change_journal(self):
+        """Verify journaled changes match the ones found by diffing the entire value"""
+        class JournalingKeyValueStoreModifier(ChangeTrackingKeyValueStoreModifier):
+            __slots__ = ()
+            journal_changes = True
+        # end class JournalingKeyValueStoreModifier
+
+        data = self.config_data('basic.yaml')
+        full = ChangeTrackingKeyValueStoreModifier(deepcopy(data))
+        journaled = JournalingKeyValueStoreModifier(deepcopy(data))
+        assert full.journal() is None and journaled.journal() == []
+        assert journaled.changes() == full.changes() and not full.changes()
+
+        modifications = (('set_value', 'section.subsection.string', 'changed'),
+                         ('set_value', 'section.int', 42),
+                         ('delete_value', 'section.float'),
+                         ('set_value', 'section.new.tree', { 'value' : 1 }),
+                         ('set_value', 'section.new', { 'other' : 2 }),
+                         ('delete_value', 'section.other_tree.foo'),
+                         ('set_value', 'section.other_tree.bar', 3),
+                         ('delete_value', 'doesnt.exist'),
+                         ('set_value', 'section.int', 1))
+        for method, key, args in ((m[0], m[1], m[2:]) for m in modifications):
+            for kvstore in (full, journaled):
+                getattr(kvstore, method)(key, *args)
+            # end for each kvstore
+            assert journaled.changes() == full.changes()
+        # end for each modification
+        assert journaled.changes().section.int == 1
+        assert journaled.journal()[-1] == (journaled.JOURNAL_SET, 'section.int')
+        assert journaled.journal()[-2] == (journaled.JOURNAL_DELETE, 'doesnt.exist')
+        assert len(journaled.journal()) == len(modifications) - 1, "one entry per key"
+
+        # changes are re-applied to a new base
+        new_data = deepcopy(data)
+        new_data.section.subsection['string'] = 'new base value'
+        new_data.section['list'] = ['new']
+        new_data['new_section'] = { 'value' : 1 }
+        for kvstore in (full, journaled):
+            kvstore._set_data(deepcopy(new_data))
+        # end for each kvstore
+        assert journaled._data() == full._data()
+        assert journaled.changes() == full.changes()
+        assert journaled.value('section.list', list()) == ['new']
+        assert journaled.value('section.subsection.string', str) == 'changed'
+
+        # changes set as a whole
+        for kvstore in (full, journaled):
+            kvstore.set_changes({ 'new_section' : { 'value' : 2 } })
+        # end for each kvstore
+        assert journaled.changes() == full.changes()
+        assert journaled.changes().new_section.value == 2
+
+        # changing the root makes everything a change
+        for kvstore in (full, journaled):
+            kvstore.set_value(RootKey, { 'section' : { 'int' : 5 } })
+        # end for each kvstore
+        assert journaled.changes() == full.changes()
+        assert journaled.changes().section.int == 5
+
     def test_kvpath(self):
         """Assure properties turn out as expected"""
         path = KVPath()
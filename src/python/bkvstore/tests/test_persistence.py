@@ -8,12 +8,14 @@
 """
 __all__ = []
 
+import os
 import yaml
+import nose
 
 from .base import TestConfigurationBase
 
 # test * imports (could have defective '__all__')
-from bkvstore.persistence import OrderedDictYAMLLoader
+from bkvstore.persistence import *
 from butility import OrderedDict
 
 class TestConfigurationCore(TestConfigurationBase):
@@ -54,4 +56,46 @@ class TestConfigurationCore(TestConfigurationBase):
         data_duplicate = yaml.load(yaml_data, Loader = OrderedDictYAMLLoader)
         assert data_duplicate == data
         verify_data(data_duplicate)
-        
+
+    def _fixture_files(self):
+        """@return all yaml files we have as fixtures, here and in bprocess"""
+        roots = (self.fixture_path(''),
+                 self.fixture_root.dirname().dirname() / 'bprocess' / 'tests' / 'etc')
+        for root in roots:
+            for dirpath, dirnames, filenames in os.walk(root):
+                for name in sorted(filenames):
+                    if name.endswith('.yaml'):
+                        yield os.path.join(dirpath, name)
+                # end for each file
+            # end for each directory
+        # end for each root
+
+    def _load(self, path, loader):
+        """@return data loaded with the given loader, or the name of the exception type raised"""
+        try:
+            return yaml.load(open(path), Loader=loader)
+        except Exception, err:
+            # loaders may be from different yaml packages, which use different exception types
+            return type(err).__name__
+        # end handle errors
+
+    def test_loader_parity(self):
+        """All our loaders produce exactly the same result, including the order of keys"""
+        files = list(self._fixture_files())
+        assert len(files) > 10, "didn't find our fixtures"
+
+        for path in files:
+            data = self._load(path, PythonOrderedDictYAMLLoader)
+            assert isinstance(data, (OrderedDict, str)) or data is None, "'%s' should be loaded as ordered dict" % path
+            assert self._load(path, OrderedDictYAMLLoader) == data
+
+            if CompiledOrderedDictYAMLLoader is not None:
+                compiled_data = self._load(path, CompiledOrderedDictYAMLLoader)
+                assert compiled_data == data, "compiled loader yielded different result for '%s'" % path
+                assert type(compiled_data) is type(data)
+            # end check compiled loader
+        # end for each fixture
+
+        if CompiledOrderedDictYAMLLoader is None:
+            raise nose.SkipTest("compiled yaml loader is unavailable - couldn't test it")
+        # end skip if untested
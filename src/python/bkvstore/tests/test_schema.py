@@ -14,9 +14,19 @@ from . import test_serialize
 
 # Try * imports
 from bkvstore.schema import *
-from bdiff import RootKey
-from bkvstore import YAMLKeyValueStoreModifier
-from butility import wraps
+from bdiff import ( RootKey,
+                    NoValue )
+from bkvstore import ( YAMLKeyValueStoreModifier,
+                       KeyValueStoreProvider,
+                       KeyValueStoreProviderDiffDelegate,
+                       RelaxedKeyValueStoreProviderDiffDelegate,
+                       KeyValueStoreSchemaCompiler,
+                       AnyKey )
+from butility import ( wraps,
+                       DictObject )
+
+import copy
+import random
 
 
 def validator_backup(func):
@@ -113,10 +123,122 @@ class TestSchema(TestConfigurationBase):
         
         issue_index = collector.validate_provider(cmod)
         assert len(issue_index) == 2, "Should have two issues"
+        issues = list(collector.iter_provider_issues(cmod))
+        assert [issue.key() for issue in issues] == issue_index.keys(), "streaming should find the same issues"
+        issue = iter(collector.iter_provider_issues(cmod)).next()
+        assert issue.key() == issues[0].key(), "it's possible to stop at the first issue"
         
         # Simple test to see how the schema can be used to safely access values
         qc_gui_schema = collector[-2]
         assert cmod.value(qc_gui_schema.key(), qc_gui_schema).do_it_right == True
+
+    def test_schema_compiler(self):
+        """Verify compiled schemas produce exactly what the diff produces, for all kinds of stored data"""
+        schema = KeyValueStoreSchema('section', dict(string = 'value',
+                                                     int = int,
+                                                     float = 5.0,
+                                                     none = None,
+                                                     strings = StringList,
+                                                     ints = IntList(),
+                                                     paths = PathList,
+                                                     formats = StringList(['a', '{section.string}']),
+                                                     path = KVPath,
+                                                     empty = dict(),
+                                                     sub = dict(string = str,
+                                                                nested = dict(value = 1, names = list)),
+                                                     any = {AnyKey : dict(value = int,
+                                                                          name = '{section.string}',
+                                                                          list = StringList)},
+                                                     any_value = {AnyKey : float}))
+
+        leafs = (None, '5', 'abc', 5, 2.5, True, [], ['a', 1], '{section.string}', '{section.int}', '{missing}',
+                 dict(), dict(x=1), dict(x=dict()))
+
+        def random_value(rng, default, depth=0):
+            """@return a random value which matches the default more or less"""
+            if isinstance(default, (dict, DictObject)) and rng.random() < 0.8 and depth < 5:
+                value = dict()
+                if default.keys() == [AnyKey]:
+                    for index in range(rng.randint(0, 3)):
+                        value['key%i' % index] = random_value(rng, default.values()[0], depth + 1)
+                    # end for each key
+                else:
+                    for key in default.keys():
+                        if rng.random() < 0.7:
+                            value[key] = random_value(rng, default[key], depth + 1)
+                        # end maybe skip key
+                    # end for each key
+                # end handle AnyKey
+                for index in range(rng.randint(0, 2)):
+                    value['unknown%i' % index] = random_value(rng, dict(x=1), depth + 1)
+                # end for each value which isn't in the schema
+                return value
+            # end handle trees
+            if rng.random() < 0.3 and not isinstance(default, (type, dict, DictObject)):
+                return copy.deepcopy(default)
+            # end use default
+            return copy.deepcopy(rng.choice(leafs))
+
+        def comparable(value):
+            """@return the value in a form which includes all types, but ignores the order of keys"""
+            if isinstance(value, (dict, DictObject)):
+                return (type(value), dict((key, comparable(value[key])) for key in value.keys()))
+            elif isinstance(value, list):
+                return (type(value), [comparable(item) for item in value])
+            # end handle value type
+            return (type(value), value)
+
+        def outcome(provider_type, data, resolve):
+            """@return the comparable value obtained by the given provider type, or the exception type"""
+            try:
+                return comparable(provider_type(copy.deepcopy(data)).value(schema.key(), schema, resolve=resolve))
+            except Exception, err:
+                return type(err)
+            # end handle exceptions
+
+        class KeepEmptyTreesDelegate(KeyValueStoreProviderDiffDelegate):
+            __slots__ = ()
+            delete_empty_trees = False
+        # end class KeepEmptyTreesDelegate
+
+        class RelaxedKeepEmptyTreesDelegate(RelaxedKeyValueStoreProviderDiffDelegate):
+            __slots__ = ()
+            delete_empty_trees = False
+        # end class RelaxedKeepEmptyTreesDelegate
+
+        rng = random.Random(7)
+        for delegate_type in (KeyValueStoreProviderDiffDelegate, RelaxedKeyValueStoreProviderDiffDelegate,
+                              KeepEmptyTreesDelegate, RelaxedKeepEmptyTreesDelegate):
+            compiled_type = type('Compiled', (KeyValueStoreProvider, ), dict(DiffProviderDelegateType=delegate_type))
+            generic_type = type('Generic', (compiled_type, ), dict(compile_schemas=False))
+            for iteration in range(150):
+                if iteration < 3:
+                    data = (dict(), dict(section=5), dict(section=dict()))[iteration]
+                else:
+                    data = dict(section=random_value(rng, schema))
+                # end handle edge cases
+                for resolve in (False, True):
+                    compiled = outcome(compiled_type, data, resolve)
+                    assert compiled == outcome(generic_type, data, resolve), \
+                                    "%s(resolve=%s) mismatch for %s" % (delegate_type.__name__, resolve, data)
+                # end for each resolve mode
+            # end for each iteration
+        # end for each delegate type
+
+        # well-formed data is handled by the compiled function
+        compiled = KeyValueStoreSchemaCompiler.compiled(schema, KeyValueStoreProviderDiffDelegate, False)
+        assert compiled is KeyValueStoreSchemaCompiler.compiled(schema, KeyValueStoreProviderDiffDelegate, False)
+        assert 'def extract' in compiled.source()
+        value = compiled.extract(dict(int='5', any=dict(one=dict(value='1')), any_value=dict()), None)
+        assert value is not NoValue and value['int'] == 5 and value['any']['one']['value'] == 1
+        assert compiled.extract(5, None) is NoValue, "unsupported data is left to the diff"
+
+        # changing the schema invalidates the compiled function
+        schema.sub.string = 'changed'
+        assert not compiled.is_current()
+        recompiled = KeyValueStoreSchemaCompiler.compiled(schema, KeyValueStoreProviderDiffDelegate, False)
+        assert recompiled is not compiled
+        assert recompiled.extract(dict(any=dict(), any_value=dict()), None)['sub']['string'] == 'changed'
         
         
 # end class TestSchema
@@ -8,6 +8,7 @@
 """
 __all__ = []
 
+import os
 import yaml
 
 from .base import TestConfigurationBase
@@ -20,6 +21,7 @@ from bkvstore import ( KeyValueStoreProviderDiffDelegate,
 from bkvstore.serialize import *
 from bkvstore.persistence import OrderedDictYAMLLoader
 from bkvstore.types import YAMLKeyValueStoreModifier
+from bkvstore.cache import SerializedDataCache
 from butility import tagged_file_paths
 
 
@@ -150,6 +152,194 @@ class TestYamlConfiguration(TestConfigurationBase):
         store = YAMLKeyValueStoreModifier((basic, err_indent, inexistent))
 
         assert store.data() == YAMLKeyValueStoreModifier((basic, )).data(), "invalid files shouldn't affect the outcome, but be ignored"
+
+    @with_rw_directory
+    def test_data_cache(self, rw_dir):
+        """Verify deserialized and merged data is cached and invalidated"""
+        cache_dir = rw_dir / 'cache'
+        basic = rw_dir / 'basic.yaml'
+        basic_ovr = rw_dir / 'basic_overrides.yaml'
+        self.fixture_path('basic.yaml').copyfile(basic)
+        self.fixture_path('basic_overrides.yaml').copyfile(basic_ovr)
+
+        class CachingYAMLKeyValueStoreModifier(YAMLKeyValueStoreModifier):
+            __slots__ = ()
+
+            class DataCacheType(SerializedDataCache):
+                __slots__ = ()
+                max_entries = 3
+                eviction_interval = 1
+                enabled_by_default = True
+
+                def __init__(self):
+                    super(CachingYAMLKeyValueStoreModifier.DataCacheType, self).__init__(cache_dir)
+            # end class DataCacheType
+        # end class CachingYAMLKeyValueStoreModifier
+
+        # the cache is opt-in
+        assert not SerializedDataCache.is_enabled()
+        os.environ[SerializedDataCache.enable_env_var] = '1'
+        try:
+            assert SerializedDataCache.is_enabled()
+        finally:
+            del os.environ[SerializedDataCache.enable_env_var]
+        # end assure environment is restored
+
+        cache = CachingYAMLKeyValueStoreModifier.DataCacheType()
+        assert not cache._entries()
+        inputs = (basic, basic_ovr)
+        expected = CachingYAMLKeyValueStoreModifier(inputs).data()
+        assert len(cache._entries()) == 3, "expected one entry per file, and one for the merged result"
+        assert CachingYAMLKeyValueStoreModifier(inputs).data() == expected, "cached result must be the same"
+        assert len(cache._entries()) == 3, "no new entries are created if everything was cached"
+
+        # the merged result depends on the order
+        assert CachingYAMLKeyValueStoreModifier(reversed(inputs)).data() != expected
+        assert len(cache._entries()) == 3, "least recently used entries are evicted"
+
+        # changes to files invalidate the entries
+        fp = open(basic_ovr, 'a')
+        fp.write('\nnew_section:\n  value: 42\n')
+        fp.close()
+        expected_changed = CachingYAMLKeyValueStoreModifier(inputs).data()
+        assert expected_changed.new_section.value == 42
+
+        # Invalid files are not cached
+        err_indent = self.fixture_path('with_error/invalid_indent.yaml')
+        assert CachingYAMLKeyValueStoreModifier((basic, err_indent)).data() == \
+               CachingYAMLKeyValueStoreModifier((basic, )).data()
+
+        # streams are not cached
+        cache.invalidate()
+        assert not cache._entries()
+        CachingYAMLKeyValueStoreModifier((open(basic), ))
+        assert not cache._entries()
+
+        # corrupted entries are treated as missing
+        CachingYAMLKeyValueStoreModifier((basic, ))
+        for path in cache._entries():
+            open(path, 'wb').write('garbage')
+        # end for each entry to corrupt
+        assert CachingYAMLKeyValueStoreModifier((basic, )).data() == YAMLKeyValueStoreModifier((basic, )).data()
+
+        # the cache can be disabled
+        cache.invalidate()
+        os.environ[SerializedDataCache.enable_env_var] = '0'
+        try:
+            CachingYAMLKeyValueStoreModifier(inputs)
+            assert not cache._entries()
+        finally:
+            del os.environ[SerializedDataCache.enable_env_var]
+        # end assure environment is restored
+
+        # entries can be kept in memory, and are shared by all instances of the type
+        SerializedDataCache.retain_in_memory()
+        assert SerializedDataCache.is_enabled(), "retaining entries enables the cache"
+        SerializedDataCache.retain_in_memory(False)
+        CachingYAMLKeyValueStoreModifier.DataCacheType.retain_in_memory()
+        try:
+            CachingYAMLKeyValueStoreModifier(inputs)
+            for path in cache._entries():
+                os.remove(path)
+            # end for each entry to remove
+            assert CachingYAMLKeyValueStoreModifier(inputs).data() == expected_changed
+            assert not cache._entries(), "nothing was written as everything was read from memory"
+            cache.invalidate()
+            assert not cache._memory
+        finally:
+            CachingYAMLKeyValueStoreModifier.DataCacheType.retain_in_memory(False)
+        # end assure memory is released
+        assert SerializedDataCache._memory is None
+
+    @with_rw_directory
+    def test_key_selection(self, rw_dir):
+        """Verify only selected keys are loaded, and that files without them are skipped using the key index"""
+        cache_dir = rw_dir / 'cache'
+        basic = rw_dir / 'basic.yaml'
+        basic_ovr = rw_dir / 'basic_overrides.yaml'
+        other = rw_dir / 'other.yaml'
+        self.fixture_path('basic.yaml').copyfile(basic)
+        self.fixture_path('basic_overrides.yaml').copyfile(basic_ovr)
+        open(other, 'w').write('other:\n  value: 1\nsection:\n  extra: 2\n')
+        requested = list()
+
+        class CachingYAMLKeyValueStoreModifier(YAMLKeyValueStoreModifier):
+            __slots__ = ()
+
+            class DataCacheType(SerializedDataCache):
+                __slots__ = ()
+                enabled_by_default = True
+
+                def __init__(self):
+                    super(CachingYAMLKeyValueStoreModifier.DataCacheType, self).__init__(cache_dir)
+
+                def get(self, key):
+                    requested.append(key)
+                    return super(CachingYAMLKeyValueStoreModifier.DataCacheType, self).get(key)
+            # end class DataCacheType
+        # end class CachingYAMLKeyValueStoreModifier
+
+        inputs = (basic, other, basic_ovr)
+        expected = YAMLKeyValueStoreModifier(inputs).data()
+        for modifier_type in (YAMLKeyValueStoreModifier, CachingYAMLKeyValueStoreModifier):
+            # run twice to use cached indices and results
+            for run in range(2):
+                data = modifier_type(inputs, keys=('section.list', 'other')).data()
+                assert data.keys() == ['section', 'other'], "order of keys is retained"
+                assert data.section.keys() == ['list']
+                assert data.section.list == expected.section.list
+                assert data.other == expected.other
+
+                data = modifier_type(inputs, keys=('section', )).data()
+                assert data == dict(section=expected.section)
+                assert not modifier_type(inputs, keys=('doesntexist', )).data()
+                assert modifier_type(inputs, keys=None).data() == expected
+            # end for each run
+        # end for each modifier type
+
+        # Files which don't define selected keys are not loaded once their index is known
+        cache = CachingYAMLKeyValueStoreModifier.DataCacheType()
+        basic_key = cache.file_key('YAMLStreamSerializer', basic, open(basic, 'rb').read())
+        del requested[:]
+        assert CachingYAMLKeyValueStoreModifier(inputs, keys=('other.value', )).data() == dict(other=expected.other)
+        assert requested and basic_key not in requested
+
+        # changed files are re-indexed
+        open(basic, 'a').write('\nother:\n  new_value: 2\n')
+        del requested[:]
+        assert CachingYAMLKeyValueStoreModifier(inputs, keys=('other.new_value', )).data().other.new_value == 2
+
+    @with_rw_directory
+    def test_concurrent_reads(self, rw_dir):
+        """Verify files can be read concurrently and from previously read contents, without altering the result"""
+        inputs = list(self.config_fixtures(('lnx', 'maya')))
+        inputs.append(self.fixture_path('with_error/invalid_indent.yaml'))
+        inputs.append(rw_dir / 'doesntexist.yaml')
+        expected = YAMLKeyValueStoreModifier(inputs).data()
+
+        assert YAMLKeyValueStoreModifier.read_workers() == YAMLKeyValueStoreModifier.read_workers_count
+        for workers in ('4', '1', 'invalid'):
+            os.environ[YAMLKeyValueStoreModifier.read_workers_env_var] = workers
+            try:
+                if workers != 'invalid':
+                    assert YAMLKeyValueStoreModifier.read_workers() == int(workers)
+                # end check parsing
+                for cache_enabled in ('0', '1'):
+                    os.environ[SerializedDataCache.enable_env_var] = cache_enabled
+                    assert YAMLKeyValueStoreModifier(inputs).data() == expected
+                # end for each cache mode
+            finally:
+                del os.environ[YAMLKeyValueStoreModifier.read_workers_env_var]
+                del os.environ[SerializedDataCache.enable_env_var]
+            # end assure environment is restored
+        # end for each amount of workers
+
+        # Given contents are used instead of the file, but only once
+        basic = rw_dir / 'basic.yaml'
+        self.fixture_path('basic.yaml').copyfile(basic)
+        kvstore = YAMLKeyValueStoreModifier((basic, ), contents={basic: 'prefetched: 1\n'})
+        assert kvstore.data() == dict(prefetched=1)
+        assert kvstore.reload().data() == YAMLKeyValueStoreModifier((basic, )).data()
         
         
 # end class TestYamlConfiguration
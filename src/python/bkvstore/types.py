@@ -16,6 +16,7 @@ from bdiff import AutoResolveAdditiveMergeDelegate
 from butility import OrderedDict
 
 from .persistence import OrderedDictYAMLLoader
+from .cache import SerializedDataCache
 
 from .serialize import ( SerializingKeyValueStoreModifierBase,
                          ChangeTrackingSerializingKeyValueStoreModifierBase,
@@ -47,6 +48,9 @@ class YAMLKeyValueStoreModifier(SerializingKeyValueStoreModifierBase):
     ## the extension of files we can read
     StreamSerializerType = YAMLStreamSerializer
 
+    ## yaml parsing is expensive, and configuration rarely changes
+    DataCacheType = SerializedDataCache
+
 # end class YAMLKeyValueStoreModifier
 
 
@@ -11,6 +11,11 @@ __all__ = ['KVStringFormatter']
 import sys
 from string import Formatter
 
+from butility import ( Path,
+                       NativePath,
+                       Version,
+                       DictObject )
+
 
 class KVStringFormatter(Formatter):
     """A formatter which introduces a way to specify the type to convert to. That way, it is possible to use
@@ -32,9 +37,18 @@ class KVStringFormatter(Formatter):
         '{path.as_KVPath.dirname}'
 
     The example above will use the 'as_' prefix as a hint for desired conversion. The following text, 'KVPath'
-    is interpreted as a type name which is looked for in all currently loaded modules.
+    is interpreted as a type name which is looked up in our type registry.
+
+    Type Registry
+    =============
 
-    When found once, the result is cached for later.
+    Types become available to the 'as_' syntax by registering them, using register_type(), which may be used
+    as class decorator as well. Path, NativePath and Version are registered by default, and so are all types
+    used in KeyValueStoreSchema instances.
+
+    If scan_modules_for_types is True, unregistered types are searched for in all currently loaded modules, 
+    which is slow and depends on the import order. Found types are registered for later use.
+    Use type_registry_info() to learn how often that happened.
 
     Customization
     =============
@@ -52,6 +66,17 @@ class KVStringFormatter(Formatter):
     _type_cache = dict()
     ## Mapping from key name to type (configured by users)
     _custom_types = dict()
+    ## Amount of times we had to search all modules for a type
+    _fallback_scans = 0
+
+    # -------------------------
+    ## @name Configuration
+    # @{
+
+    ## If True, types which are not registered will be searched in all loaded modules
+    scan_modules_for_types = False
+
+    ## -- End Configuration -- @}
 
     # -------------------------
     ## @name Utilities
@@ -64,8 +89,18 @@ class KVStringFormatter(Formatter):
         try:
             return cls._type_cache[name]
         except KeyError:
+            if not cls.scan_modules_for_types:
+                raise ValueError("No type registered under name '%s' - use register_type() to make it known"
+                                 % name)
+            # end handle no fallback
+
             # cache miss - search in modules and update cache
-            for mod in sys.modules.itervalues():
+            KVStringFormatter._fallback_scans += 1
+            # NOTE: iterate a copy, as imports triggered by getattr may change sys.modules
+            for mod in sys.modules.values():
+                if mod is None:
+                    continue
+                # end skip placeholders of failed relative imports
                 try:
                     typ = getattr(mod, name)
                 except AttributeError:
@@ -120,6 +155,42 @@ class KVStringFormatter(Formatter):
     ## @name Interface
     # @{
 
+    @classmethod
+    def register_type(cls, typ, name=None):
+        """Make the given type available to the 'as_<name>' syntax, replacing previous registrations.
+        Can be used as class decorator.
+        @param typ the type to register
+        @param name if not None, the name to register the type under. Otherwise the name of the type is used
+        @return typ"""
+        cls._type_cache[name or typ.__name__] = typ
+        return typ
+
+    @classmethod
+    def register_types_by_schema(cls, schema):
+        """Register all types used as values in the given schema, or in any schema nested in it.
+        Existing registrations will not be changed.
+        @param schema a KeyValueStoreSchema instance, or any nested dict
+        @return this type"""
+        for value in schema.values():
+            if isinstance(value, (dict, DictObject)):
+                cls.register_types_by_schema(value)
+                continue
+            # end handle nested schemas
+            typ = isinstance(value, type) and value or type(value)
+            cls._type_cache.setdefault(typ.__name__, typ)
+            member_type = getattr(typ, 'MemberType', None)
+            if isinstance(member_type, type):
+                cls._type_cache.setdefault(member_type.__name__, member_type)
+            # end handle typed lists
+        # end for each value
+        return cls
+
+    @classmethod
+    def type_registry_info(cls):
+        """@return dict with information about our type registry, with 'size' being the amount of registered
+        types, and 'fallback_scans' being the amount of times all modules were searched for a type"""
+        return dict(size=len(cls._type_cache), fallback_scans=cls._fallback_scans)
+
     @classmethod
     def set_key_type(cls, key_name, type):
         """Associate the given type with the key_name.
@@ -127,6 +198,7 @@ class KVStringFormatter(Formatter):
         the desired type, retrying the attribute access"""
         assert '.' not in key_name
         cls._custom_types[key_name] = type
+        cls._type_cache.setdefault(type.__name__, type)
 
     @classmethod
     def set_key_type_by_schema(cls, schema, keys, sep='.'):
@@ -160,3 +232,9 @@ class KVStringFormatter(Formatter):
     
 
 # end class KVStringFormatter
+
+
+for typ in (Path, NativePath, Version):
+    KVStringFormatter.register_type(typ)
+# end for each default type
+del typ
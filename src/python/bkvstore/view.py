@@ -0,0 +1,296 @@
+#-*-coding:utf-8-*-
+"""
+@package bkvstore.view
+@brief Contains a lazy, copy-on-write view onto values of a kvstore
+
+@author Sebastian Thiel
+@copyright [GNU Lesser General Public License](https://www.gnu.org/licenses/lgpl.html)
+"""
+__all__ = ['KeyValueStoreValueView']
+
+from UserDict import DictMixin
+
+from bdiff import ( NoValue,
+                    RootKey )
+from butility import ( DictObject,
+                       OrderedDict )
+
+from .diff import AnyKey
+
+
+class KeyValueStoreValueView(DictMixin, object):
+    """A read-only, lazily evaluated view onto a tree within a KeyValueStoreProvider, merged with a default
+    tree or schema.
+
+    It shares its structure with the store it was obtained from, and will only compute the values which are
+    actually accessed. Each leaf value is obtained exactly like KeyValueStoreProvider.value() would obtain it,
+    including type conversions and resolution of format strings. This makes reading a few keys of large trees
+    cost O(accessed keys) instead of O(tree size).
+
+    Changes made to the view will never affect the store. Instead, the first change will make the respective
+    tree level a private copy (copy-on-write). Nested trees of that level remain lazy views.
+
+    @note the order of keys is the one of the default, followed by values not in the default.
+    value() makes no promises about the order of keys either.
+    @note as values are computed on demand, changes to the store will be visible in the view until the
+    respective values were accessed. Use copy() to obtain a snapshot instead.
+    """
+    __slots__ = (
+                    '_provider',    ## the KeyValueStoreProvider we are a view of
+                    '_key',         ## the fully qualified key at which our values are located
+                    '_stored',      ## the stored tree, or NoValue
+                    '_default',     ## the default tree, or NoValue
+                    '_resolve',     ## if True, we resolve format strings
+                    '_children',    ## a dict of computed child values, keyed by name
+                    '_keys',        ## a cached list of our keys
+                    '_own'          ## a private copy of our values, or None if we are unchanged
+                )
+
+    def __init__(self, provider, key, stored, default, resolve=False):
+        """Initialize this instance
+        @param provider the KeyValueStoreProvider whose values we show
+        @param key at which stored is located in provider's data, may be RootKey
+        @param stored tree with stored values, or NoValue
+        @param default tree with default values, like a KeyValueStoreSchema, or NoValue
+        @param resolve if True, format strings will be resolved"""
+        self._provider = provider
+        self._key = key
+        self._stored = self._is_tree(stored) and stored or NoValue
+        self._default = self._is_tree(default) and default or NoValue
+        self._resolve = resolve
+        self._children = dict()
+        self._keys = None
+        self._own = None
+
+    # -------------------------
+    ## @name Utilities
+    # @{
+
+    @staticmethod
+    def _is_tree(value):
+        """@return True if the value is a tree, the same way the diff delegates see it"""
+        return isinstance(value, (dict, DictObject))
+
+    def _keep_values_not_in_schema(self):
+        return self._provider.DiffProviderDelegateType.keep_values_not_in_schema
+
+    def _any_key_default(self):
+        """@return the default value at AnyKey, or NoValue if there is no such key"""
+        if self._default is NoValue:
+            return NoValue
+        # end handle no default
+        keys = self._default.keys()
+        if len(keys) == 1 and isinstance(keys[0], type) and issubclass(keys[0], AnyKey):
+            # NOTE: schemas can't be indexed with AnyKey, and AnyKey is always the only key
+            return self._default.values()[0]
+        # end handle any key
+        return NoValue
+
+    def _qualified_key(self, name):
+        """@return fully qualified key to our child with the given name"""
+        if self._key is RootKey:
+            return name
+        # end handle root
+        return '%s%s%s' % (self._key, self._provider.key_separator, name)
+
+    def _candidate_keys(self):
+        """@return list of keys which may have a value, in order"""
+        stored_keys = self._stored is not NoValue and self._stored.keys() or list()
+        if self._any_key_default() is not NoValue:
+            return list(stored_keys)
+        # end handle any key
+
+        keys = self._default is not NoValue and list(self._default.keys()) or list()
+        if self._keep_values_not_in_schema():
+            default_keys = set(keys)
+            keys.extend(key for key in stored_keys if key not in default_keys)
+        # end keep stored keys
+        return keys
+
+    def _child(self, name):
+        """@return the value of the child with the given name, or NoValue if there is None"""
+        try:
+            return self._children[name]
+        except KeyError:
+            pass
+        # end handle cache
+
+        default = NoValue
+        if self._default is not NoValue:
+            if name in self._default:
+                default = self._default[name]
+            else:
+                default = self._any_key_default()
+            # end handle any key
+        # end handle default
+        stored = NoValue
+        if self._stored is not NoValue and name in self._stored:
+            stored = self._stored[name]
+        # end handle stored value
+
+        if default is NoValue and stored is NoValue:
+            value = NoValue
+        elif self._is_tree(default) or (default is NoValue and self._is_tree(stored)):
+            if default is NoValue and not self._keep_values_not_in_schema():
+                value = NoValue
+            else:
+                value = type(self)(self._provider, self._qualified_key(name), stored, default, self._resolve)
+            # end handle values not in schema
+        else:
+            # let the delegate handle the leaf value, exactly like value() would do it
+            left, right = dict(), dict()
+            if stored is not NoValue:
+                left[name] = stored
+            # end handle stored value
+            if default is not NoValue:
+                right[name] = default
+            # end handle default value
+            delegate = self._provider._new_value_delegate(self._key, self._resolve)
+            self._provider.TwoWayDiffAlgorithmType().diff(delegate, left, right)
+            result = delegate.result()
+            value = NoValue
+            if result is not NoValue and name in result:
+                value = result[name]
+            # end handle result
+        # end handle value type
+        self._children[name] = value
+        return value
+
+    def _is_pruned(self, value):
+        """@return True if the given child value should not be visible"""
+        if value is NoValue:
+            return True
+        if not isinstance(value, KeyValueStoreValueView):
+            return False
+        # end handle leafs
+        if not self._provider.DiffProviderDelegateType.delete_empty_trees:
+            return False
+        # Trees underneath AnyKey are kept even if they are empty
+        return value._any_key_default() is NoValue and not value
+
+    def _materialize(self):
+        """@return our own private copy of our values, making it if required"""
+        if self._own is None:
+            own = OrderedDict()
+            for key in self.keys():
+                own[key] = self[key]
+            # end for each key
+            self._own = own
+        # end create copy
+        return self._own
+
+    ## -- End Utilities -- @}
+
+    # -------------------------
+    ## @name Protocols
+    # @{
+
+    def __getitem__(self, name):
+        if self._own is not None:
+            return self._own[name]
+        # end handle own copy
+        value = self._child(name)
+        if self._is_pruned(value):
+            raise KeyError(name)
+        # end handle missing value
+        return value
+
+    def __getattr__(self, name):
+        """Provides read access to our values"""
+        if name.startswith('_'):
+            raise AttributeError(name)
+        # end don't handle private attributes
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError("No attribute named '%s'" % name)
+        #end handle getitem
+
+    def __setattr__(self, name, value):
+        if name in KeyValueStoreValueView.__slots__:
+            return super(KeyValueStoreValueView, self).__setattr__(name, value)
+        # end handle slots
+        self[name] = value
+
+    def __setitem__(self, name, value):
+        self._materialize()[name] = value
+
+    def __delitem__(self, name):
+        del(self._materialize()[name])
+
+    def __contains__(self, name):
+        if self._own is not None:
+            return name in self._own
+        # end handle own copy
+        return not self._is_pruned(self._child(name))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __nonzero__(self):
+        if self._own is not None:
+            return bool(self._own)
+        # end handle own copy
+        for name in self._candidate_keys():
+            if name in self:
+                return True
+        # end for each candidate
+        return False
+
+    def __eq__(self, other):
+        if hasattr(other, 'to_dict'):
+            other = other.to_dict()
+        # end convert other
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self.items())
+
+    ## -- End Protocols -- @}
+
+    # -------------------------
+    ## @name Interface
+    # @{
+
+    def keys(self):
+        """@return list of all keys we have"""
+        if self._own is not None:
+            return self._own.keys()
+        # end handle own copy
+        if self._keys is None:
+            self._keys = [name for name in self._candidate_keys() if name in self]
+        # end cache keys
+        return list(self._keys)
+
+    def copy(self):
+        """@return a fully evaluated, independent copy of this view, using the same types as value()
+        would return"""
+        out = OrderedDict()
+        for key, value in self.iteritems():
+            if isinstance(value, KeyValueStoreValueView):
+                value = value.copy()
+            # end handle views
+            out[key] = value
+        # end for each item
+        return out
+
+    def to_dict(self):
+        """@return a recursive copy of this view, using standard dicts"""
+        out = dict()
+        for key, value in self.iteritems():
+            if hasattr(value, 'to_dict'):
+                value = value.to_dict()
+            # end convert trees
+            out[key] = value
+        # end for each item
+        return out
+
+    ## -- End Interface -- @}
+
+# end class KeyValueStoreValueView
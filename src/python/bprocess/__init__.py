@@ -19,3 +19,6 @@ from .schema import *
 from .components import *
 from .app import *
 from .utility import *
+from .plan import *
+from .snapshot import *
+from .zygote import *
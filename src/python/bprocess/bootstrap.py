@@ -17,6 +17,7 @@ __all__ = ['Bootstrapper']
 
 import sys
 import os
+import errno
 import logging
 from itertools import chain
 
@@ -67,6 +68,13 @@ class Bootstrapper(object):
     ## a per-directory file carrying information on where to find the bootstrapper
     boot_info_file = '.bprocess_path'
 
+    ## If set, this environment variable contains the path to the unix socket of a bprocess.ZygoteServer.
+    ## It will be used to launch the program, unless the server can't be reached
+    zygote_socket_env_var = 'BPROCESS_ZYGOTE_SOCKET'
+
+    ## Signals we forward to the process launched by the zygote
+    zygote_forwarded_signals = ('SIGINT', 'SIGTERM', 'SIGHUP', 'SIGQUIT')
+
     ## -- End Configuration -- @}
 
     # -------------------------
@@ -101,11 +109,9 @@ class Bootstrapper(object):
         # otherwise, treat it as relative to the executable dir
         return os.path.join(os.path.dirname(executable), link)
         
-    def _process_controller_class(self, executable):
-        """Try to make our root-package available which should include the components framework
-        to do that actual woractual_executablek for us
-        Raise an error if that didn't work
-        @return root module, controller type"""
+    def _resolve_root_package_path(self, executable):
+        """@return path to the directory containing our root package, as used by the given executable
+        @throws AssertionError if it couldn't be found"""
         # If we have an override, use it
         if self.package_path_env_var in os.environ:
             root_package_path = os.environ[self.package_path_env_var]
@@ -131,8 +137,14 @@ class Bootstrapper(object):
                 raise AssertionError(msg % executable)
             # end handle root_package not found
         # end allow environment override of rootpackage 
-            
-        module = self._init_root_package_from_path(root_package_path)
+        return root_package_path
+
+    def _process_controller_class(self, executable):
+        """Try to make our root-package available which should include the components framework
+        to do that actual woractual_executablek for us
+        Raise an error if that didn't work
+        @return root module, controller type"""
+        module = self._init_root_package_from_path(self._resolve_root_package_path(executable))
         
         try:
             return module, getattr(module, self.process_controller_type_name)
@@ -164,17 +176,159 @@ implementation: %s" % (module_for_import, root_package_path, str(err)))
         # end handle import
         
         return imported_module
+
+    def _zygote_peer_is_trusted(self, sock, socket_path):
+        """@return True if the process at the other end of the given connected unix socket runs as our user.
+        Where the peer's credentials can't be obtained, the owner of the socket file is checked instead"""
+        import socket
+        import struct
+        uid = os.getuid()
+        peercred = getattr(socket, 'SO_PEERCRED', sys.platform.startswith('linux') and 17 or None)
+        if peercred is not None:
+            # struct ucred: pid, uid, gid
+            ucred = struct.Struct('3i')
+            return ucred.unpack(sock.getsockopt(socket.SOL_SOCKET, peercred, ucred.size))[1] == uid
+        # end handle platforms with peer credentials
+        return os.stat(socket_path).st_uid == uid
+
+    def _zygote_launch(self, executable, args, fds=(0, 1, 2)):
+        """Launch the program through the ZygoteServer listening at the socket set in our zygote_socket_env_var.
+        The server runs our main() in a forked, pre-initialized process, which receives our file descriptors,
+        environment, umask and resource limits. Signals we receive are forwarded to it.
+        @param fds file descriptors to use as stdin, stdout and stderr of the launched program
+        @return the program's exit code, or None if there is no server to launch it. In that case,
+        the program wasn't launched. Servers run by other users are never used, and servers refuse to launch
+        programs whose root package differs from their own
+        @note if the launched program dies from a signal, we will kill ourselves using the same signal"""
+        socket_path = os.environ.get(self.zygote_socket_env_var)
+        if not socket_path:
+            return None
+        # end handle no server
+
+        import socket
+        import signal
+        import struct
+        import cPickle
+        try:
+            import resource
+            from _multiprocessing import sendfd
+        except ImportError:
+            return None
+        # end handle platforms without file descriptor passing
+
+        try:
+            package_path = os.path.realpath(self._resolve_root_package_path(executable))
+        except (AssertionError, EnvironmentError):
+            # let the normal launch report the error
+            return None
+        # end handle missing root package
+
+        umask = os.umask(0)
+        os.umask(umask)
+        rlimits = dict()
+        for name in dir(resource):
+            if name.startswith('RLIMIT_'):
+                rlimits[name] = resource.getrlimit(getattr(resource, name))
+            # end handle limit
+        # end for each resource limit
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                sock.connect(socket_path)
+                # Don't hand our file descriptors and environment to anyone else
+                if not self._zygote_peer_is_trusted(sock, socket_path):
+                    logging.getLogger('bprocess.bootstrap').warn("zygote at '%s' is run by another user - ignoring it",
+                                                                 socket_path)
+                    return None
+                # end handle untrusted server
+                for fd in fds:
+                    sendfd(sock.fileno(), fd)
+                # end for each file descriptor
+                request = cPickle.dumps(dict(executable=executable, args=list(args), cwd=os.getcwd(),
+                                             environ=dict(os.environ), umask=umask, rlimits=rlimits,
+                                             package_path=package_path), 
+                                        cPickle.HIGHEST_PROTOCOL)
+                sock.sendall(struct.pack('!Q', len(request)) + request)
+            except (socket.error, OSError):
+                # The server will not launch anything without the full request
+                logging.getLogger('bprocess.bootstrap').debug("zygote at '%s' unavailable", socket_path, 
+                                                              exc_info=True)
+                return None
+            # end handle server unavailable
+
+            def receive_int():
+                """@return integer read from the socket"""
+                data = ''
+                while len(data) < 4:
+                    try:
+                        chunk = sock.recv(4 - len(data))
+                    except socket.error, err:
+                        if err.args[0] == errno.EINTR:
+                            continue
+                        # end retry on interrupted system calls
+                        raise
+                    # end handle signals
+                    if not chunk:
+                        raise EnvironmentError("zygote at '%s' closed the connection unexpectedly" % socket_path)
+                    # end handle server shutdown
+                    data += chunk
+                # end while receiving
+                return struct.unpack('!i', data)[0]
+            # end utility
+
+            pid = receive_int()
+            if not pid:
+                logging.getLogger('bprocess.bootstrap').debug("zygote at '%s' uses a different root package "
+                                                              "than %s - ignoring it", socket_path, package_path)
+                return None
+            # end handle refused request
+            previous_handlers = dict()
+            for name in self.zygote_forwarded_signals:
+                signum = getattr(signal, name, None)
+                if signum is not None:
+                    previous_handlers[signum] = signal.signal(signum, lambda signum, frame: os.kill(pid, signum))
+                # end handle platform specific signals
+            # end for each signal to forward
+            try:
+                status = receive_int()
+            finally:
+                for signum, handler in previous_handlers.iteritems():
+                    signal.signal(signum, handler)
+                # end for each handler to restore
+            # end restore signal handlers
+        finally:
+            sock.close()
+        # end assure socket is closed
+
+        if os.WIFSIGNALED(status):
+            signal.signal(os.WTERMSIG(status), signal.SIG_DFL)
+            os.kill(os.getpid(), os.WTERMSIG(status))
+            # like shells do, should we still be alive
+            return 128 + os.WTERMSIG(status)
+        # end die like our program
+        return os.WEXITSTATUS(status)
+
     ## -- End Utiltiies -- @}
     
     # -------------------------
     ## @name Interface
     # @{
     
-    def main(self, executable, args = list()):
+    def main(self, executable, args = list(), use_zygote = True):
         """Main entry point
         Initialize this instance
         @param executable file we are running (never /bin/python)
-        @param args all arguments the program received"""
+        @param args all arguments the program received
+        @param use_zygote if True, the program will be launched through a ZygoteServer, if one is configured
+        and reachable. See zygote_socket_env_var"""
+        if use_zygote:
+            returncode = self._zygote_launch(executable, args)
+            if returncode is not None:
+                sys.exit(returncode)
+            # end handle launched by zygote
+        # end try zygote
+
         root_module, process_controller_type = self._process_controller_class(executable)
 
         # allow extensions to be used transparently to help starting the right interpreter on windows.
@@ -192,6 +346,8 @@ implementation: %s" % (module_for_import, root_package_path, str(err)))
             sys.stderr.write(controller.application().context()._contents_str())
         except root_module.DisplaySettingsException:
             sys.stderr.write(str(controller.application().context().settings().data()))
+        except root_module.DisplayLaunchPlanException:
+            sys.stderr.write(str(controller.launch_plan()))
         except root_module.DisplayLoadedYamlException:
             for ctx in controller.application().context().stack():
                 if hasattr(ctx, 'config_files'):
@@ -7,7 +7,7 @@
 @copyright [GNU Lesser General Public License](https://www.gnu.org/licenses/lgpl.html)
 """
 __all__ = ['ProcessController', 'DisplayContextException', 'DisplaySettingsException', 
-           'DisplayHelpException', 'DisplayLoadedYamlException']
+           'DisplayHelpException', 'DisplayLoadedYamlException', 'DisplayLaunchPlanException']
 
 import sys
 import os
@@ -23,11 +23,13 @@ from butility import ( Path,
                        update_env_path,
                        GraphIteratorBase,
                        LazyMixin,
+                       PhaseProfiler,
                        PythonFileLoader,
                        DictObject,
                        set_log_level )
 
-from bcontext import Context
+from bcontext import ( Context,
+                       HierarchicalContext )
 from bkvstore import KeyValueStoreModifier
 from bapp import         ( Application,
                            ApplicationSettingsClient,
@@ -42,6 +44,8 @@ from .schema import ( controller_schema,
                       package_manager_schema )
 from .utility import  ( ProcessControllerPackageSpecification, 
                         PythonPackageIterator )
+from .plan import ( LaunchPlan,
+                    LaunchPlanCache )
 
 
 log = logging.getLogger('bprocess.controller')
@@ -86,6 +90,13 @@ class DisplayLoadedYamlException(Exception):
 # end class DisplayLoadedYamlException
 
 
+class DisplayLaunchPlanException(Exception):
+    """A marker to indicate we want to see the launch plan instead of launching the program"""
+    __slots__ = ()
+
+# end class DisplayLaunchPlanException
+
+
 class _ProcessControlCommandlineOverridesContext(Context):
     """An environment with a custom initializer to allow storing an arbitrary dict as kvstore override"""
     __slots__ = ()
@@ -171,7 +182,11 @@ class ProcessController(GraphIteratorBase, LazyMixin, ApplicationSettingsClient)
                     '_package_data_cache',# intermediate data cache, to reduce overhead during iteration
                     '_resolve_args',      # if True, we will resolve arguments in some way
                     '_debug_mode',        # a flag to indicate we are in debug mode
-                    '_next_exception'     # type of exception to throw if something goes wrong during preparation
+                    '_next_exception',    # type of exception to throw if something goes wrong during preparation
+                    '_raw_args',          # the arguments we were initialized with, unaltered
+                    '_launch_plan',       # the LaunchPlan used or created by execute(), or None
+                    '_use_launch_plan_cache', # if False, launch plans will neither be used nor stored
+                    '_show_launch_plan'   # if True, we will show the launch plan instead of executing it
                 )
     
     # -------------------------
@@ -217,6 +232,11 @@ class ProcessController(GraphIteratorBase, LazyMixin, ApplicationSettingsClient)
         Print the settings, which are a fully merged result of the context
     ---debug-yaml
         Print paths to all yaml files in order of appearance on the context stack
+    ---no-plan-cache
+        Neither use nor store a cached launch plan, i.e. prepare the program launch from scratch
+    ---show-plan
+        Print the launch plan, i.e. executable, arguments, environment and working directory, and abort 
+        program execution. It will be taken from the cache if possible.
     ---help
         Prints this help and exits.
 
@@ -246,6 +266,19 @@ class ProcessController(GraphIteratorBase, LazyMixin, ApplicationSettingsClient)
 
     ## The kind of application we create if not provided during __init__
     ApplicationType = Application
+
+    ## The type used to cache launch plans
+    LaunchPlanCacheType = LaunchPlanCache
+
+    ## If True, launch plans will be cached and used to skip preparing the launch of a program whose
+    ## configuration didn't change. Only plans of processes which are not spawned and which don't use 
+    ## transactions will be cached, and only if their delegate is launch_plan_cacheable.
+    ## Off by default, as the delegate isn't called at all when a cached plan is used
+    use_launch_plan_cache = False
+
+    ## Names of environment variables which change often, but are not expected to affect the launch of programs.
+    ## All other environment variables must be unchanged for a launch plan to be used
+    launch_plan_volatile_environment_variables = ('_', 'PWD', 'OLDPWD', 'SHLVL')
     
     ## -- End Subclass Configuration -- @}
 
@@ -294,6 +327,7 @@ class ProcessController(GraphIteratorBase, LazyMixin, ApplicationSettingsClient)
         # end check
         self._boot_executable = Path(executable).abspath()
         self._args = list(args)
+        self._raw_args = list(args)
         # we will always use delegates that where explicitly set, but get it as service on first access
         self._delegate_override = delegate
         self._cwd = cwd or os.getcwd()
@@ -302,6 +336,10 @@ class ProcessController(GraphIteratorBase, LazyMixin, ApplicationSettingsClient)
         self._resolve_args = False
         self._next_exception = None
         self._debug_mode = False
+        self._launch_plan = None
+        self._use_launch_plan_cache = self.use_launch_plan_cache
+        self._show_launch_plan = False
+        self._parse_launch_flags()
         # NOTE: We can't set the _app attribute right away, as we rely on lazy mechanisms to initialize ourselves
         # when needed. The latter wouldn't work if we set the attribute directly
         self._prebuilt_app = application
@@ -310,7 +348,9 @@ class ProcessController(GraphIteratorBase, LazyMixin, ApplicationSettingsClient)
     def _set_cache_(self, name):
         if name in ('_app', '_executable_path', '_delegate'):
             try:
-                self._setup_execution_context()
+                with PhaseProfiler.instance().span('ProcessController._setup_execution_context'):
+                    self._setup_execution_context()
+                # end measure setup
             except Exception, err:
                 # convert to a custom type, in case we got that far, to respect stuff the user wanted
                 # prior to the issue. This makes sure we can show debug information, for instance
@@ -344,10 +384,12 @@ class ProcessController(GraphIteratorBase, LazyMixin, ApplicationSettingsClient)
         except KeyError:
             pass
         # end ignore cache miss
-        if not self._app.context().settings().has_value(key):
-            raise EnvironmentError("A package named '%s' did not exist in the database, searched at '%s'" % (name, key))
-        # end graceful key handling
-        pd = self._app.context().settings().value(key, self._package_data_schema, resolve=True)
+        with PhaseProfiler.instance().span('ProcessController._package_data', package=name):
+            if not self._app.context().settings().has_value(key):
+                raise EnvironmentError("A package named '%s' did not exist in the database, searched at '%s'" % (name, key))
+            # end graceful key handling
+            pd = self._app.context().settings().value(key, self._package_data_schema, resolve=True)
+        # end measure resolution
         self._package_data_cache[key] = pd
         return pd
         
@@ -367,8 +409,129 @@ class ProcessController(GraphIteratorBase, LazyMixin, ApplicationSettingsClient)
         @note especially gui launchers should override this method and close their GUI accordingly
         @todo close file handles
         """
+        # We will not exit regularly, write what was measured so far
+        PhaseProfiler.instance().write_results()
         # Its unbuffered, be sure we see whats part of our process before replacement
         sys.__stdout__.flush()
+
+    def _iter_wrapper_args(self, args):
+        """@return iterator yielding (prefix, arg) tuples for all arguments meant for us, with arg being
+        stripped of its prefix. Escaped and empty arguments are meant for the program, and are skipped"""
+        for arg in args:
+            for prefix in (self.wrapper_arg_prefix, self.wrapper_context_prefix):
+                if arg.startswith(prefix):
+                    break
+            else:
+                continue
+            # end ignore non-wrapper args
+            narg = arg[len(prefix):]
+            if not narg or prefix[0] == narg[0]:
+                continue
+            # end ignore args passed to the program
+            yield prefix, narg
+        # end for each argument
+
+    def _parse_launch_flags(self):
+        """Set our state according to the flags which are needed before the launch is prepared, as a
+        launch plan may be used instead"""
+        for prefix, arg in self._iter_wrapper_args(self._raw_args):
+            if prefix != self.wrapper_arg_prefix:
+                continue
+            elif arg == 'dry-run':
+                self._dry_run = True
+            elif arg == 'no-plan-cache':
+                self._use_launch_plan_cache = False
+            elif arg == 'show-plan':
+                self._show_launch_plan = True
+            # end handle flag
+        # end for each wrapper argument
+
+    def _launch_plan_key(self, cache):
+        """@return a key suitable for the given LaunchPlanCache, identifying the launch we are about to perform,
+        or None if it cannot be cached.
+        Launches are only cached if all wrapper arguments are kvstore overrides, or flags which don't alter the
+        way we prepare the launch"""
+        if not (self._use_launch_plan_cache and cache.is_enabled()):
+            return None
+        # end handle disabled cache
+        if self._prebuilt_app is not None or self._delegate_override is not None:
+            return None
+        # end handle custom setups, which may bring their own configuration
+        if self._spawn_override:
+            return None
+        # end handle spawned processes, which are never planned
+
+        for prefix, arg in self._iter_wrapper_args(self._raw_args):
+            if prefix != self.wrapper_arg_prefix:
+                return None
+            elif arg not in ('show-plan', 'dry-run') and self.wrapper_arg_kvsep not in arg:
+                return None
+            # end handle argument
+        # end for each argument
+
+        volatile = set(self.launch_plan_volatile_environment_variables)
+        env = sorted((k, v) for k, v in os.environ.iteritems() if k not in volatile)
+        return cache.key(type(self).__module__, type(self).__name__, str(self._boot_executable),
+                         str(self._cwd), repr(self._raw_args), repr(env))
+
+    def _launch_plan_config(self, delegate):
+        """@return tuple(config_files, config_dirs) of all configuration files that were loaded into our 
+        application's context, all plugin files and the modules implementing the given delegate, as well as
+        all directories that were searched for configuration and plugins"""
+        files, dirs = list(), list()
+        for ctx in self._app.context().stack():
+            if isinstance(ctx, StackAwareHierarchicalContext):
+                files.extend(ctx.hash_map().values())
+            # end handle hashed files
+            if isinstance(ctx, HierarchicalContext):
+                files.extend(ctx.config_files())
+                for config_dir in ctx.config_trees():
+                    plugin_dir = Path(config_dir) / 'plug-ins'
+                    dirs.append(config_dir)
+                    dirs.append(plugin_dir)
+                    files.extend(py_file for py_file, mod_name in PythonFileLoader.find_files(plugin_dir, 
+                                                                                             recurse=True))
+                # end for each configuration directory
+            # end handle hierarchical contexts
+        # end for each context
+
+        if isinstance(delegate, ProcessControllerDelegateProxy):
+            delegate = delegate._delegate
+        # end unwrap proxy
+        for cls in type(delegate).__mro__:
+            path = getattr(sys.modules.get(cls.__module__), '__file__', None)
+            if path is None:
+                continue
+            # end ignore builtin modules
+            if path.endswith(('.pyc', '.pyo')):
+                path = path[:-1]
+            # end prefer source files
+            files.append(os.path.abspath(path))
+        # end for each implementation of the delegate
+        return set(files), set(dirs)
+
+    def _execute_launch_plan(self, plan):
+        """Replace the current process with the one described by the given LaunchPlan
+        @return a DictObject with returncode if we are in dry-run mode. Otherwise it won't return"""
+        env = plan.environment(os.environ)
+        for name in self.launch_plan_volatile_environment_variables:
+            if name in env and name in os.environ:
+                env[name] = os.environ[name]
+            # end update volatile value
+        # end for each volatile variable
+
+        log.log(TRACE, "%s%s %s (replace process from cached launch plan)", self._dry_run and "WOULD RUN " or "",
+                                                                            plan.executable,
+                                                                            ' '.join(plan.args[1:]))
+        if self._dry_run:
+            return DictObject(dict(returncode = 0))
+        # end handle dry-run
+
+        self._pre_execve()
+        os.chdir(plan.cwd)
+        ##############################################
+        os.execve(plan.executable, plan.args, env)
+        ##############################################
         
     ## -- End Subclass Interface -- @}
     
@@ -592,8 +755,9 @@ class ProcessController(GraphIteratorBase, LazyMixin, ApplicationSettingsClient)
             arg = narg
             if arg == 'help':
                 raise DisplayHelpException(self._wrapper_arg_help)
-            elif arg == 'dry-run':
-                self._dry_run = True
+            elif arg in ('dry-run', 'no-plan-cache', 'show-plan'):
+                # handled by _parse_launch_flags()
+                pass
             elif arg in self.wrapper_logging_levels:
                 set_log_level(logging.root, getattr(logging, arg.upper()))
                 if arg == 'debug':
@@ -672,6 +836,7 @@ class ProcessController(GraphIteratorBase, LazyMixin, ApplicationSettingsClient)
         # Have to deal with the possibility that people don't provide an absolute directory or that the directory
         # is outside of the vincinity of the default configuration
         program = self._name()
+        profiler = PhaseProfiler.instance()
         
         bootstrap_dir = self._boot_executable.dirname()
         if not bootstrap_dir.isdir():
@@ -747,7 +912,8 @@ class ProcessController(GraphIteratorBase, LazyMixin, ApplicationSettingsClient)
             ###############
             # We have a basic envrionment now, load delegate plugins, before using the delegate the 
             # first time
-            self._load_plugins("process-controller-stage-1")
+            with profiler.span('ProcessController._load_plugins', stage=1):
+                self._load_plugins("process-controller-stage-1")
 
              # UPDATE DELEGATE
             ######################
@@ -764,7 +930,9 @@ class ProcessController(GraphIteratorBase, LazyMixin, ApplicationSettingsClient)
             prev_len = len(app.context())
 
 
-            self.delegate().prepare_context(self._executable_path, self._environ, self._args, self._cwd)
+            with profiler.span('ProcessController.prepare_context', delegate=type(self.delegate()).__name__):
+                self.delegate().prepare_context(self._executable_path, self._environ, self._args, self._cwd)
+            # end measure delegate
 
 
             # If there were changes to the contxt, which means we have to refresh all our data so far
@@ -829,7 +997,8 @@ class ProcessController(GraphIteratorBase, LazyMixin, ApplicationSettingsClient)
                 # If the delegate put on an additional environment, we have to reload everything
                 log.debug('reloading data after delegate altered environment')
                 # Reload plugins, delegate configuration could have changed
-                self._load_plugins("process-controller-stage-2")
+                with profiler.span('ProcessController._load_plugins', stage=2):
+                    self._load_plugins("process-controller-stage-2")
                 # delgate from context can be None, but future access will be delegate() only, which deals 
                 # with that
                 self.set_delegate(self._find_delegate(root_package, alias_package))
@@ -900,61 +1069,65 @@ class ProcessController(GraphIteratorBase, LazyMixin, ApplicationSettingsClient)
                     cwd_handled = True
                 # end first one to set cwd wins
                 
-                # Special Search Paths
-                #######################
-                resolve_evars = package.data().environment.resolve
-                for evar, paths in ((ld_env_var, package.data().environment.linker_search_paths),
-                                    (exec_env_var, package.data().environment.executable_search_paths)):
-                    for path in paths:
-                        if resolve_evars:
-                            path = delegate.resolve_value(path, self._environ)
-                        # end 
-                        path = delegate.verify_path(evar, package.to_abs_path(path))
-                        if path is not None:
-                            debug.setdefault(evar, list()).append((str(path), package_name))
-                            update_env_path(evar, path, append = True, environment = self._environ)
-                        # end append path if possible
-                    # end for each path
-                # end for each special environment variable
+                with profiler.span('ProcessController.build_environment', package=package_name):
+                    # Special Search Paths
+                    #######################
+                    resolve_evars = package.data().environment.resolve
+                    for evar, paths in ((ld_env_var, package.data().environment.linker_search_paths),
+                                        (exec_env_var, package.data().environment.executable_search_paths)):
+                        for path in paths:
+                            if resolve_evars:
+                                path = delegate.resolve_value(path, self._environ)
+                            # end 
+                            path = delegate.verify_path(evar, package.to_abs_path(path))
+                            if path is not None:
+                                debug.setdefault(evar, list()).append((str(path), package_name))
+                                update_env_path(evar, path, append = True, environment = self._environ)
+                            # end append path if possible
+                        # end for each path
+                    # end for each special environment variable
                 
-                # Set environment variables
-                ############################
-                for evar, values in package.data().environment.variables.items():
-                    evar_is_path = delegate.variable_is_path(evar)
-                    for value in values:
-                        # for now we append, as we walk dependencies breadth-first and items coming later
-                        # should be effective later
-                        if resolve_evars:
-                            value = delegate.resolve_value(value, self._environ)
-                        # end
-                        if evar_is_path:
-                            value = delegate.verify_path(evar, package.to_abs_path(value))
-                            if value is None:
-                                continue
-                            # end handle invalid path
-                        # end prepare path's value
+                    # Set environment variables
+                    ############################
+                    for evar, values in package.data().environment.variables.items():
+                        evar_is_path = delegate.variable_is_path(evar)
+                        for value in values:
+                            # for now we append, as we walk dependencies breadth-first and items coming later
+                            # should be effective later
+                            if resolve_evars:
+                                value = delegate.resolve_value(value, self._environ)
+                            # end
+                            if evar_is_path:
+                                value = delegate.verify_path(evar, package.to_abs_path(value))
+                                if value is None:
+                                    continue
+                                # end handle invalid path
+                            # end prepare path's value
                         
-                        if evar_is_path and delegate.variable_is_appendable(evar, value):
-                            debug.setdefault(evar, list()).append((str(value), package_name))
-                            update_env_path(evar, value, append = True, environment = self._environ)
-                        else:
-                            # Don't overwrite value with older/other values
-                            if evar not in self._environ:
-                                debug[evar] = (str(value), package_name)
-                                self._environ[evar] = str(value)
+                            if evar_is_path and delegate.variable_is_appendable(evar, value):
+                                debug.setdefault(evar, list()).append((str(value), package_name))
+                                update_env_path(evar, value, append = True, environment = self._environ)
                             else:
-                                log.debug("%s: can't set variable %s as its already set to %s", package_name, evar, self._environ[evar])
-                        #end handle path variables
-                    # end for each value to set
-                # end for each variable,values tuple
+                                # Don't overwrite value with older/other values
+                                if evar not in self._environ:
+                                    debug[evar] = (str(value), package_name)
+                                    self._environ[evar] = str(value)
+                                else:
+                                    log.debug("%s: can't set variable %s as its already set to %s", package_name, evar, self._environ[evar])
+                            #end handle path variables
+                        # end for each value to set
+                    # end for each variable,values tuple
+                # end measure environment
 
                 # BUILD TRANSACTION
                 ###################
                 for action_key in package.data().actions:
-                    Action = delegate.action(action_key)
-                    # TODO: It looks odd if it adds itself implicitly, possibly change that to be added explicitly
-                    log.debug("Adding action '%s'", action_key)
-                    Action(delegate.transaction(), action_key, Action.data(action_key), package_name, package.data())
+                    with profiler.span('ProcessController.create_action', action=action_key):
+                        Action = delegate.action(action_key)
+                        # TODO: It looks odd if it adds itself implicitly, possibly change that to be added explicitly
+                        log.debug("Adding action '%s'", action_key)
+                        Action(delegate.transaction(), action_key, Action.data(action_key), package_name, package.data())
+                    # end measure action
                 # end for each action
             # end for each program
         except KeyError, err:
@@ -1009,7 +1182,27 @@ class ProcessController(GraphIteratorBase, LazyMixin, ApplicationSettingsClient)
         calling this method
         @throws EnvironmentError if the executable cannot be found, or if program configuration could not be
         determined.
+        @throws DisplayLaunchPlanException if the launch plan should be shown instead, see launch_plan()
         """
+        # Use LAUNCH PLAN
+        ##################
+        # If nothing changed since the last launch, we skip the entire preparation
+        plan_cache = self.LaunchPlanCacheType()
+        plan_key = self._launch_plan_key(plan_cache)
+        # the environment the key was made for - plans only keep what they change
+        base_env = dict(os.environ)
+        if plan_key is not None:
+            plan = plan_cache.plan(plan_key)
+            if plan is not None:
+                log.debug("Using cached launch plan for '%s'", plan.executable)
+                self._launch_plan = plan
+                if self._show_launch_plan:
+                    raise DisplayLaunchPlanException()
+                # end handle plan display
+                return self._execute_launch_plan(plan)
+            # end handle cache hit
+        # end handle cacheable launch
+
         # Prepare EXECUTABLE
         #####################
         # Its not required to have a valid root unless the executable or one of the  is relative
@@ -1043,6 +1236,27 @@ class ProcessController(GraphIteratorBase, LazyMixin, ApplicationSettingsClient)
         # And be sure we have a list, in case people return tuples
         args = list(args)
         args.insert(0, str(executable))
+
+        # Record LAUNCH PLAN
+        #####################
+        # Plans are always created for display, but only stored if they can be replayed
+        cacheable = self._use_launch_plan_cache and not should_spawn and os.name != 'nt' and \
+                    getattr(delegate, 'launch_plan_cacheable', False) and not delegate.has_transaction()
+        if cacheable or self._show_launch_plan:
+            config_files, config_dirs = self._launch_plan_config(delegate)
+            snapshot_path = env.get(ControlledProcessInformation.snapshot_path_environment_variable)
+            if snapshot_path:
+                # the plan can't be used once the snapshot is gone
+                config_files.add(snapshot_path)
+            # end handle snapshot transport
+            self._launch_plan = LaunchPlan(executable, args, env, cwd, config_files, config_dirs, base_env)
+            if cacheable and plan_key is not None:
+                plan_cache.set(plan_key, self._launch_plan)
+            # end store plan
+        # end create plan
+        if self._show_launch_plan:
+            raise DisplayLaunchPlanException()
+        # end handle plan display
         
         if not self._dry_run:
             
@@ -1083,6 +1297,11 @@ class ProcessController(GraphIteratorBase, LazyMixin, ApplicationSettingsClient)
         """@return application object which keeps the context of the to-be-started program"""
         assert self._app
         return self._app
+
+    def launch_plan(self):
+        """@return the LaunchPlan used or created by execute(), or None if there was no such plan, for 
+        instance as execute() wasn't called yet, or as the launch is not cacheable"""
+        return self._launch_plan
         
     def is_debug_mode(self):
         """@return True if we are in debug mode"""
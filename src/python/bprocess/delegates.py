@@ -47,6 +47,8 @@ from butility import ( update_env_path,
                        StringChunker )
 
 from .actions import ActionDelegateMixin
+from .snapshot import ( SettingsSnapshot,
+                        SnapshotTree )
 
 from .schema import ( controller_schema,
                       process_schema,
@@ -144,7 +146,8 @@ class DelegateContextOverride(Context):
 
 
 class ControlledProcessInformation(IControlledProcessInformation, Singleton, LazyMixin):
-    """Store the entire kvstore (after cleanup) in a data string in the environment and allow to retrieve it
+    """Store the entire kvstore (after cleanup) in a data string in the environment and allow to retrieve it.
+    Alternatively, the data is stored in a SettingsSnapshot file, and only its path is passed in the environment.
     @note this class uses a cache to assure we don't get data more often than necessary. It is all static and 
     will not change"""
     __slots__ = (
@@ -153,19 +156,84 @@ class ControlledProcessInformation(IControlledProcessInformation, Singleton, Laz
                      '_procdata',
                      '_cmdline_overrides',
                      '_hash_map',
+                     '_snapshot',
+                     '_sections',   # envelope of separately encoded sections, see _encode_sections()
+                     '_section_cache', # section name => decoded section
+                     '_package_cache', # package name => decoded package data
                 )
 
     key_sep = ','
 
+    # -------------------------
+    ## @name Configuration
+    # @{
+
+    ## The type used to write and read snapshots
+    SettingsSnapshotType = SettingsSnapshot
+
+    ## If True, store() will write the data into a snapshot file instead of the environment
+    use_snapshot_transport = False
+
+    ## If set to '1' or '0', this environment variable enables or disables the snapshot transport, 
+    ## overriding use_snapshot_transport
+    snapshot_transport_environment_variable = 'BPROCESS_SNAPSHOT_TRANSPORT'
+
+    ## If True, store() will encode each top-level section and each package separately, to allow decoding 
+    ## them on demand. Process data and commandline overrides will use a fast binary codec instead of yaml
+    use_lazy_transport = False
+
+    ## If set to '1' or '0', this environment variable enables or disables the lazy transport, 
+    ## overriding use_lazy_transport
+    lazy_transport_environment_variable = 'BPROCESS_LAZY_TRANSPORT'
+
+    ## Prefix of values encoded with the separately encoded sections of the lazy transport
+    sections_marker = 'BPSECTIONS1:'
+
+    ## Prefix of values which are encoded with our fast codec instead of yaml
+    fast_codec_marker = 'BPPICKLE1:'
+    
+    ## -- End Configuration -- @}
+
+    ## Finds the names of packages referenced in format strings, like '{packages.name.root}'
+    _re_package_reference = re.compile(r"\{%s(?:\.|\[)([^.\[\]{}!:]+)" % re.escape(controller_schema.key()))
+
     def _set_cache_(self, name):
         if name == '_data':
             self._data = None
+            if self.snapshot() is not None:
+                self._data = self.snapshot().data()
+                return
+            # end handle snapshot transport
             if not self.has_data():
                 return
             # end handle not started that way
+            if self._sections is not None:
+                self._data = OrderedDict()
+                for name in self._sections['order']:
+                    self._data[name] = self.section(name)
+                # end for each section
+                return
+            # end handle lazy transport
             # just return it without regarding the order
-            keys = os.environ[self.storage_environment_variable].split(self.key_sep)
-            self._data = self._decode(''.join(os.environ[k] for k in keys))
+            self._data = self._decode(self._stored_string())
+        elif name == '_sections':
+            self._sections = None
+            if self.storage_environment_variable not in os.environ:
+                return
+            # end handle no environment transport
+            source = self._stored_string()
+            if source.startswith(self.sections_marker):
+                self._sections = loads(binascii.a2b_base64(source[len(self.sections_marker):]))
+            # end handle sections
+        elif name in ('_section_cache', '_package_cache'):
+            setattr(self, name, dict())
+        elif name == '_snapshot':
+            self._snapshot = None
+            path = os.environ.get(self.snapshot_path_environment_variable)
+            if path:
+                self._snapshot = self.SettingsSnapshotType(path, 
+                                                           os.environ.get(self.snapshot_digest_environment_variable))
+            # end handle snapshot
         elif name == '_kvstore':
             data = self.data()
             self._kvstore = None
@@ -194,11 +262,14 @@ class ControlledProcessInformation(IControlledProcessInformation, Singleton, Laz
     def _yaml_data(cls, evar):
         """@return object as loaded from the yaml string retrieved from the given environment variable,
         or None if it was unset
-        @note sibling of _store_yaml_data()"""
+        @note sibling of _store_yaml_data(). Also reads data stored with the fast codec"""
         yaml_string = os.environ.get(evar, None)
         if yaml_string is None:
             return None
         # end handle uncontrolled process
+        if yaml_string.startswith(cls.fast_codec_marker):
+            return loads(binascii.a2b_base64(yaml_string[len(cls.fast_codec_marker):]))
+        # end handle fast codec
         return yaml.load(yaml_string)
     
     @classmethod    
@@ -207,8 +278,72 @@ class ControlledProcessInformation(IControlledProcessInformation, Singleton, Laz
         @param evar environment variable
         @param env environment dict
         @param data structure to store
-        @note sibling of _yaml_data()"""
-        env[evar] = yaml.dump(data)
+        @note sibling of _yaml_data(). If the lazy transport is used, the data is stored with a fast codec"""
+        if cls._use_lazy_transport():
+            env[evar] = cls.fast_codec_marker + binascii.b2a_base64(dumps(data, 2))
+        else:
+            env[evar] = yaml.dump(data)
+        # end handle codec
+
+    @classmethod
+    def _use_lazy_transport(cls):
+        """@return True if data should be stored in separately encoded sections"""
+        value = os.environ.get(cls.lazy_transport_environment_variable)
+        if value in ('0', '1'):
+            return value == '1'
+        # end handle override
+        return cls.use_lazy_transport
+
+    @classmethod
+    def _encode_section(cls, data):
+        """@return data encoded into a compressed string"""
+        return zlib.compress(dumps(data, 2), 6)
+
+    @classmethod
+    def _encode_sections(cls, data):
+        """@return a string with the given data, with each top-level key and each package encoded separately,
+        prefixed with our sections_marker.
+        The envelope contains the order of all keys, and encoded strings per key, which is cheap to decode"""
+        packages_key = controller_schema.key()
+        envelope = dict(order=list(data.keys()), sections=dict(), packages_order=list(), packages=dict())
+        for name, value in data.items():
+            if name == packages_key and isinstance(value, dict):
+                envelope['packages_order'] = list(value.keys())
+                for package_name, package_data in value.items():
+                    envelope['packages'][package_name] = cls._encode_section(package_data)
+                # end for each package
+            else:
+                envelope['sections'][name] = cls._encode_section(value)
+            # end handle packages
+        # end for each section
+        return cls.sections_marker + binascii.b2a_base64(dumps(envelope, 2))
+
+    def _stored_string(self):
+        """@return the string stored in chunks in our environment"""
+        keys = os.environ[self.storage_environment_variable].split(self.key_sep)
+        return ''.join(os.environ[k] for k in keys)
+
+    @classmethod
+    def _use_snapshot_transport(cls):
+        """@return True if data should be stored in a snapshot file"""
+        value = os.environ.get(cls.snapshot_transport_environment_variable)
+        if value in ('0', '1'):
+            return value == '1'
+        # end handle override
+        return cls.use_snapshot_transport
+
+    @classmethod
+    def _remove_stored_data(cls, env):
+        """Remove data stored by any transport from the given environment dict, as it might have been inherited
+        from our own environment"""
+        keys = env.pop(cls.storage_environment_variable, None)
+        if keys:
+            for key in keys.split(cls.key_sep):
+                env.pop(key, None)
+            # end for each chunk
+        # end handle environment transport
+        env.pop(cls.snapshot_path_environment_variable, None)
+        env.pop(cls.snapshot_digest_environment_variable, None)
 
     @classmethod
     def _encode(cls, data):
@@ -229,7 +364,8 @@ class ControlledProcessInformation(IControlledProcessInformation, Singleton, Laz
         
     @classmethod
     def has_data(cls, environ = None):
-        return cls.storage_environment_variable in (environ or os.environ)
+        environ = environ or os.environ
+        return cls.storage_environment_variable in environ or cls.snapshot_path_environment_variable in environ
 
     def process_data(self):
         return self._procdata
@@ -251,13 +387,159 @@ class ControlledProcessInformation(IControlledProcessInformation, Singleton, Laz
         """@return a keyvalue store provider instance intialized with our data(), or None if this 
         process wasn't launched using process control"""
         return self._kvstore
+
+    def section(self, name):
+        """@return the data at the given top-level key, like 'process' or 'packages', or None if there is 
+        no such key or if this process wasn't launched using process control.
+        @note only the given section will be decoded, if possible"""
+        if self._sections is not None:
+            try:
+                return self._section_cache[name]
+            except KeyError:
+                pass
+            # end handle cache hit
+            if name == controller_schema.key() and name not in self._sections['sections']:
+                value = OrderedDict()
+                for package_name in self._sections['packages_order']:
+                    value[package_name] = self.package(package_name)
+                # end for each package
+            elif name in self._sections['sections']:
+                value = loads(zlib.decompress(self._sections['sections'][name]))
+            else:
+                value = None
+            # end handle section type
+            self._section_cache[name] = value
+            return value
+        elif self.snapshot() is not None:
+            value = self.snapshot().value(name)
+            return value.to_dict() if isinstance(value, SnapshotTree) else value
+        # end handle lazy transport
+        data = self.data()
+        if data is None:
+            return None
+        # end handle no data
+        return data.get(name)
+
+    def package(self, name):
+        """@return the raw data of the package with the given name, or None if there is no such package.
+        @note only the given package will be decoded, if possible"""
+        if self._sections is not None:
+            try:
+                return self._package_cache[name]
+            except KeyError:
+                pass
+            # end handle cache hit
+            value = self._sections['packages'].get(name)
+            if value is not None:
+                value = loads(zlib.decompress(value))
+            # end decode package
+            self._package_cache[name] = value
+            return value
+        elif self.snapshot() is not None:
+            value = self.snapshot().value(controller_schema.key() + '.' + name)
+            return value.to_dict() if isinstance(value, SnapshotTree) else value
+        # end handle lazy transport
+        packages = self.section(controller_schema.key())
+        if packages is None:
+            return None
+        # end handle no packages
+        return packages.get(name)
+
+    @classmethod
+    def _referenced_packages(cls, value):
+        """@return set of names of all packages referenced by format strings like '{packages.name.root}' within
+        the given value, which may be a string, or any nesting of dicts and lists"""
+        names = set()
+        remaining = [value]
+        while remaining:
+            value = remaining.pop()
+            if isinstance(value, basestring):
+                if '{' in value:
+                    names.update(cls._re_package_reference.findall(value))
+                # end check format strings only
+            elif isinstance(value, dict):
+                remaining.extend(value.itervalues())
+            elif isinstance(value, (list, tuple)):
+                remaining.extend(value)
+            # end handle value type
+        # end while there are values to check
+        return names
+
+    def package_kvstore(self, package_name):
+        """@return a keyvalue store provider with all data but the packages, and the data of the given package 
+        as well as all packages it requires, or None if this process wasn't launched using process control.
+        Packages referenced by format strings in the included data, like '{packages.name.root}', are included 
+        as well, so values can be resolved like in the kvstore returned by as_kvstore().
+        @param package_name name of the package at which to start
+        @note use it instead of as_kvstore() to iterate packages without decoding all of them"""
+        if self._sections is None and self.snapshot() is None:
+            return self.as_kvstore()
+        # end handle eager transports
+        if not self.has_data():
+            return None
+        # end handle no data
+
+        packages_key = controller_schema.key()
+        data = OrderedDict()
+        order = self._sections is not None and self._sections['order'] or self.snapshot().root().keys()
+        for name in order:
+            if name != packages_key:
+                data[name] = self.section(name)
+            # end skip packages
+        # end for each section
+        packages = data[packages_key] = OrderedDict()
+        remaining = [package_name]
+        remaining.extend(self._referenced_packages(data))
+        while remaining:
+            name = remaining.pop()
+            if name in packages:
+                continue
+            # end skip seen packages
+            pdata = self.package(name)
+            if pdata is None:
+                continue
+            # end ignore missing packages, the iteration will raise
+            packages[name] = pdata
+            requires = isinstance(pdata, dict) and pdata.get('requires') or list()
+            if isinstance(requires, basestring):
+                requires = [requires]
+            # end handle single values
+            remaining.extend(requires)
+            remaining.extend(self._referenced_packages(pdata))
+        # end while there are packages to decode
+        return KeyValueStoreProvider(data)
+
+    def snapshot(self):
+        """@return the SettingsSnapshot our data was stored in, or None if it was passed through the environment,
+        or if this process wasn't launched using process control.
+        @note use it to read individual values without decoding all data"""
+        return self._snapshot
         
     @classmethod
     def store(cls, env, context_stack):
         """Store the data within the given application context within the environment dict for later retrieval
         @param env the environment dict to be used for the soon-to-be-started process
         @param context_stack a ContextStack instance from which to store all data"""
-        source = cls._encode(context_stack.settings().data())
+        cls._remove_stored_data(env)
+        snapshot = None
+        if cls._use_snapshot_transport():
+            try:
+                snapshot = cls.SettingsSnapshotType.write(context_stack.settings().data())
+            except EnvironmentError:
+                log.warn("Failed to write settings snapshot - passing settings through the environment instead",
+                         exc_info=True)
+            # end handle unusable snapshot directory
+        # end handle snapshot transport
+        if snapshot is not None:
+            path, digest = snapshot
+            env[cls.snapshot_path_environment_variable] = path
+            env[cls.snapshot_digest_environment_variable] = digest
+            source = None
+        elif cls._use_lazy_transport():
+            source = cls._encode_sections(context_stack.settings().data())
+        else:
+            source = cls._encode(context_stack.settings().data())
+        # end handle transport
 
         if source:
             # Linux max-chunk size is actually not set, but now we chunk everything
@@ -345,6 +627,13 @@ class ProcessControllerDelegate(IProcessControllerDelegate, ActionDelegateMixin,
     ## Type used when instanating an environment to keep delegate configuration overrides
     DelegateContextOverrideType = DelegateContextOverride
     
+    ## If True, the ProcessController may cache the outcome of our launch preparation, and replace the process
+    ## without asking us next time, as long as the configuration didn't change. This means that none of our
+    ## methods, like prepare_context() or pre_start(), will be called in that case. Only set it True in
+    ## implementations whose launch preparation has no side-effects, and which don't depend on state which
+    ## is not part of the configuration, like the time of day
+    launch_plan_cacheable = False
+    
     ## -- End Configuration -- @}
     
     def prepare_context(self, executable, env, args, cwd):
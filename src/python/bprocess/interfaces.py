@@ -155,6 +155,12 @@ class IControlledProcessInformation(InterfaceBase):
     ## in BPROCESS_POST_LAUNCH_INFORMATION
     config_file_hash_map_environment_variable = 'BPROCESS_CONFIG_FILE_HASHMAP'
     
+    ## Path to a file with a binary snapshot of the data, as alternative to storage_environment_variable
+    snapshot_path_environment_variable = 'BPROCESS_SNAPSHOT_PATH'
+
+    ## The hexadecimal sha1 digest of the file at snapshot_path_environment_variable
+    snapshot_digest_environment_variable = 'BPROCESS_SNAPSHOT_DIGEST'
+    
     ## -- End Configuration -- @}
     
     # -------------------------
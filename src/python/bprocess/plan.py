@@ -0,0 +1,223 @@
+#-*-coding:utf-8-*-
+"""
+@package bprocess.plan
+@brief Contains types to persist the outcome of a process launch preparation, to be able to skip it next time
+
+@author Sebastian Thiel
+@copyright [GNU Lesser General Public License](https://www.gnu.org/licenses/lgpl.html)
+"""
+__all__ = ['LaunchPlan', 'LaunchPlanCache']
+
+import os
+import time
+import logging
+
+from pprint import pformat
+
+from butility import FileHashCache
+from bkvstore import SerializedDataCache
+from bapp import ApplicationContext
+
+
+log = logging.getLogger('bprocess.plan')
+
+
+class LaunchPlan(object):
+    """A simple structure keeping everything required to replace the current process with a prepared one.
+
+    Additionally, it knows about all configuration that was involved in creating it, which allows to verify
+    it is still valid.
+    """
+    __slots__ = (
+                    'executable',       ## path to the executable to start
+                    'args',             ## list of all arguments, including the executable as first argument
+                    'env_changes',      ## dict of environment variables the launch added or changed
+                    'env_removed',      ## list of names of environment variables the launch removed
+                    'cwd',              ## the working directory of the process
+                    'config_files',     ## dict of path => md5 digest of all configuration files involved
+                    'config_dirs',      ## dict of directory => sorted list of entries, for all configuration dirs
+                    'created',          ## time at which the plan was created, in seconds since epoch
+                    'from_cache'        ## True if the plan was loaded from a cache
+                )
+
+    def __init__(self, executable, args, env, cwd, config_files, config_dirs, base_env=None):
+        """Initialize this instance
+        @param executable path to the executable
+        @param args all arguments, including the executable as first argument
+        @param env environment dict
+        @param cwd working directory
+        @param config_files iterable of paths to configuration files used to create the plan
+        @param config_dirs iterable of directories which were searched for configuration files
+        @param base_env if not None, the environment of the caller the launch was prepared for. Only the 
+        differences to it are kept, see environment(). This prevents storing all variables of the caller, 
+        which may contain credentials, as long as the launch doesn't need to change them"""
+        self.executable = str(executable)
+        self.args = [str(arg) for arg in args]
+        env = dict((str(k), str(v)) for k, v in env.iteritems())
+        base_env = base_env or dict()
+        self.env_changes = dict((k, v) for k, v in env.iteritems() if base_env.get(k) != v)
+        self.env_removed = sorted(k for k in base_env if k not in env)
+        self.cwd = str(cwd)
+        self.config_files = dict((str(path), self.file_digest(path)) for path in config_files)
+        FileHashCache.instance().flush()
+        self.config_dirs = dict((str(path), self.dir_entries(path)) for path in config_dirs)
+        self.created = time.time()
+        self.from_cache = False
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+        # end for each item
+
+    def __str__(self):
+        lines = ["LAUNCH PLAN (%s)" % (self.from_cache and 'cached' or 'new'),
+                 "executable: %s" % self.executable,
+                 "arguments: %s" % ' '.join(self.args[1:]),
+                 "cwd: %s" % self.cwd,
+                 "environment changes:",
+                 pformat(self.env_changes),
+                 "removed environment variables: %s" % ' '.join(self.env_removed),
+                 "configuration files:"]
+        lines.extend(sorted(self.config_files))
+        return '\n'.join(lines) + '\n'
+
+    # -------------------------
+    ## @name Utilities
+    # @{
+
+    @staticmethod
+    def file_digest(path):
+        """@return md5 digest of the file at path, or None if it could not be read.
+        @note uses the same digest as StackAwareHierarchicalContext.hash_map()"""
+        try:
+            return FileHashCache.instance().digest(path)
+        except (OSError, IOError):
+            return None
+        # end handle unreadable files
+
+    @staticmethod
+    def dir_entries(path):
+        """@return sorted list of all entries in the given directory, or None if it could not be listed"""
+        try:
+            return sorted(os.listdir(path))
+        except OSError:
+            return None
+        # end handle missing directory
+
+    ## -- End Utilities -- @}
+
+    # -------------------------
+    ## @name Interface
+    # @{
+
+    def environment(self, base_env):
+        """@return a new dict with the environment of the process to launch, based on the given environment
+        @param base_env environment of the caller, which must be equal to the one the plan was created for"""
+        env = dict(base_env)
+        for name in self.env_removed:
+            env.pop(name, None)
+        # end for each variable to remove
+        env.update(self.env_changes)
+        return env
+
+    def is_valid(self, max_age=None):
+        """@return True if this plan may still be used, i.e. the executable still exists and no configuration
+        file or directory was changed since its creation.
+        @param max_age if not None, the amount of seconds after which a plan is considered outdated"""
+        if max_age is not None and time.time() - self.created > max_age:
+            return False
+        # end handle outdated plans
+        if not os.path.isfile(self.executable):
+            return False
+        # end handle missing executable
+        for path, entries in self.config_dirs.iteritems():
+            if self.dir_entries(path) != entries:
+                log.debug("Configuration directory '%s' changed - launch plan is invalid", path)
+                return False
+            # end handle changed directory
+        # end for each directory
+        for path, digest in self.config_files.iteritems():
+            if self.file_digest(path) != digest:
+                log.debug("Configuration file '%s' changed - launch plan is invalid", path)
+                return False
+            # end handle changed file
+        # end for each file
+        FileHashCache.instance().flush()
+        return True
+
+    ## -- End Interface -- @}
+
+# end class LaunchPlan
+
+
+class LaunchPlanCache(SerializedDataCache):
+    """A cache for LaunchPlan instances, located in the user's configuration directory by default.
+    Only the user may access the cache, as plans contain environment variables"""
+    __slots__ = ()
+
+    # -------------------------
+    ## @name Configuration
+    # @{
+
+    ## If this environment variable is set to '0', the cache will be disabled
+    enable_env_var = 'BPROCESS_LAUNCH_PLAN_CACHE'
+
+    ## Using plans is opt-in already, see ProcessController.use_launch_plan_cache
+    enabled_by_default = True
+
+    ## If set, this environment variable contains the directory for our cache files
+    directory_env_var = 'BPROCESS_LAUNCH_PLAN_CACHE_DIR'
+
+    ## Name of the directory within the user's configuration directory which keeps our cache files
+    directory_name = 'launch-plans'
+
+    ## The maximum amount of plans we will keep
+    max_entries = 256
+
+    ## The amount of seconds after which a plan will not be used anymore, or None to keep it forever
+    max_age = 24 * 60 * 60
+
+    ## extension of our cache files
+    file_extension = '.plan'
+
+    ## Plans store only environment changes since version 2
+    cache_version = 2
+
+    directory_mode = 0700
+
+    file_mode = 0600
+
+    ## -- End Configuration -- @}
+
+    def __init__(self, directory=None, max_entries=None):
+        """Initialize this instance, see SerializedDataCache for all parameters"""
+        if directory is None:
+            directory = os.environ.get(self.directory_env_var,
+                                       ApplicationContext.user_config_directory() / self.directory_name)
+        # end handle directory
+        super(LaunchPlanCache, self).__init__(directory, max_entries)
+
+    # -------------------------
+    ## @name Interface
+    # @{
+
+    def plan(self, key):
+        """@return a valid LaunchPlan stored under the given key, or None if there was no such plan
+        @param key as obtained by key()"""
+        plan = self.get(key)
+        if not isinstance(plan, LaunchPlan):
+            return None
+        # end handle cache miss or incompatible entry
+        if not plan.is_valid(self.max_age):
+            self.invalidate(key)
+            return None
+        # end handle invalid plan
+        plan.from_cache = True
+        return plan
+
+    ## -- End Interface -- @}
+
+# end class LaunchPlanCache
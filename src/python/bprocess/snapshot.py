@@ -0,0 +1,441 @@
+#-*-coding:utf-8-*-
+"""
+@package bprocess.snapshot
+@brief A compact, indexed binary format to pass settings to child processes through a file
+
+@author Sebastian Thiel
+@copyright [GNU Lesser General Public License](https://www.gnu.org/licenses/lgpl.html)
+"""
+__all__ = ['SettingsSnapshot', 'SnapshotTree', 'SnapshotError']
+
+import os
+import mmap
+import stat
+import struct
+import hashlib
+import tempfile
+import logging
+
+from cPickle import ( loads,
+                      dumps,
+                      HIGHEST_PROTOCOL )
+from UserDict import DictMixin
+
+from butility import ( OrderedDict,
+                        PersistentOrderedDict )
+
+log = logging.getLogger('bprocess.snapshot')
+
+
+class SnapshotError(ValueError):
+    """Thrown if a snapshot file is malformed, or doesn't match its digest"""
+    __slots__ = ()
+
+# end class SnapshotError
+
+
+class SnapshotTree(DictMixin, object):
+    """A read-only mapping onto a tree within a SettingsSnapshot.
+
+    Keys are read when the tree is first accessed, values are decoded on first access, and cached afterwards.
+    Nested trees are SnapshotTree instances as well, which is why reading a single key costs O(depth)
+    instead of O(tree size).
+    """
+    __slots__ = (
+                    '_snapshot',    ## the SettingsSnapshot we read from
+                    '_ordered',     ## True if the original tree was an OrderedDict
+                    '_keys',        ## list of our keys, in order
+                    '_offsets',     ## tuple of offsets to the node of each key, in order of _keys
+                    '_index',       ## dict of key => index into _keys, created on first lookup
+                    '_values'       ## dict of key => decoded value
+                )
+
+    def __init__(self, snapshot, ordered, keys, offsets):
+        """Initialize this instance
+        @param snapshot SettingsSnapshot instance to read values from
+        @param ordered if True, to_dict() will produce an OrderedDict
+        @param keys list of keys in order
+        @param offsets offsets to the node of each key"""
+        self._snapshot = snapshot
+        self._ordered = ordered
+        self._keys = keys
+        self._offsets = offsets
+        self._index = None
+        self._values = dict()
+
+    # -------------------------
+    ## @name Protocols
+    # @{
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        # end handle cache hit
+        if self._index is None:
+            self._index = dict((k, i) for i, k in enumerate(self._keys))
+        # end build index
+        value = self._snapshot._node(self._offsets[self._index[key]])
+        self._values[key] = value
+        return value
+
+    def __contains__(self, key):
+        if self._index is None:
+            self._index = dict((k, i) for i, k in enumerate(self._keys))
+        # end build index
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self._keys)
+
+    ## -- End Protocols -- @}
+
+    # -------------------------
+    ## @name Interface
+    # @{
+
+    def keys(self):
+        """@return list of all our keys, in order"""
+        return list(self._keys)
+
+    def to_dict(self):
+        """@return a fully decoded copy of this tree, using the same types as the tree that was stored"""
+        if self._ordered:
+            out = OrderedDict()
+        else:
+            out = dict()
+        # end handle type
+        for key in self._keys:
+            value = self[key]
+            if isinstance(value, SnapshotTree):
+                value = value.to_dict()
+            # end decode trees
+            out[key] = value
+        # end for each key
+        return out
+
+    ## -- End Interface -- @}
+
+# end class SnapshotTree
+
+
+class SettingsSnapshot(object):
+    """A read-only settings tree, stored in a binary file which is memory-mapped and decoded lazily.
+
+    Snapshot files are content-addressed, i.e. their name is the digest of their contents. This allows them to
+    be shared by all processes using the same settings, and to verify them when opened. The least recently 
+    written snapshots are removed once there are more than max_entries of them.
+
+    The format is a header, followed by nodes. Children are always written before their parents.
+
+    - header: magic, offset to root node
+    - tree node: tag, flags, number of children, length of pickled key list, key list, offsets to child nodes
+    - leaf node: tag, length of pickled value, pickled value
+
+    Trees are instances of dict, OrderedDict or PersistentOrderedDict, everything else is stored as leaf.
+    """
+    __slots__ = (
+                    '_path',    ## path to the file we read from
+                    '_map',     ## the mmap of our file
+                    '_root'     ## our root SnapshotTree, or None
+                )
+
+    # -------------------------
+    ## @name Configuration
+    # @{
+
+    ## If set, this environment variable contains the directory to write snapshots to. Like the default directory,
+    ## it must only be accessible by the current user
+    directory_env_var = 'BPROCESS_SNAPSHOT_DIR'
+
+    ## extension of our snapshot files
+    file_extension = '.snapshot'
+
+    ## Identifies our file format - change it if the format changes
+    magic = 'BPSNAP01'
+
+    ## The maximum amount of snapshot files we keep per directory. It should be large enough to never remove
+    ## snapshots of processes which didn't open them yet
+    max_entries = 256
+
+    ## Old snapshots are removed after the first write of a process, and after every this many writes
+    eviction_interval = 64
+
+    ## -- End Configuration -- @}
+
+    ## The amount of snapshots written in this process
+    _writes = 0
+
+    _header = struct.Struct('<8sQ')
+    _tree_header = struct.Struct('<cBII')
+    _leaf_header = struct.Struct('<cI')
+    TAG_TREE = 'T'
+    TAG_LEAF = 'L'
+    FLAG_ORDERED = 1
+
+    def __init__(self, path, digest=None):
+        """Open the snapshot file at the given path
+        @param path to a snapshot file as written by write()
+        @param digest if not None, the hexadecimal digest the file's contents must have
+        @throws SnapshotError if the file is malformed or doesn't match digest
+        @throws EnvironmentError if the file cannot be read"""
+        self._path = path
+        self._root = None
+        fp = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fp.close()
+        # end assure file is closed
+
+        if self._map.size() < self._header.size or self._map[:len(self.magic)] != self.magic:
+            raise SnapshotError("File at '%s' is not a settings snapshot" % path)
+        # end verify header
+        if digest is not None and hashlib.sha1(self._map[:]).hexdigest() != digest:
+            raise SnapshotError("Snapshot at '%s' doesn't match its digest '%s'" % (path, digest))
+        # end verify digest
+
+    # -------------------------
+    ## @name Utilities
+    # @{
+
+    @classmethod
+    def _is_tree(cls, value):
+        return type(value) in (dict, OrderedDict, PersistentOrderedDict)
+
+    @classmethod
+    def _encode_node(cls, value, chunks, offset):
+        """Append the encoded value to chunks, children first
+        @param offset position at which the next chunk will be written
+        @return tuple(offset of the node of value, offset after all written chunks)"""
+        if not cls._is_tree(value):
+            pickled = dumps(value, HIGHEST_PROTOCOL)
+            chunks.append(cls._leaf_header.pack(cls.TAG_LEAF, len(pickled)))
+            chunks.append(pickled)
+            return offset, offset + cls._leaf_header.size + len(pickled)
+        # end handle leaf
+
+        keys = value.keys()
+        offsets = list()
+        for key in keys:
+            node_offset, offset = cls._encode_node(value[key], chunks, offset)
+            offsets.append(node_offset)
+        # end for each child
+        pickled_keys = dumps(keys, HIGHEST_PROTOCOL)
+        flags = isinstance(value, OrderedDict) and cls.FLAG_ORDERED or 0
+        chunks.append(cls._tree_header.pack(cls.TAG_TREE, flags, len(keys), len(pickled_keys)))
+        chunks.append(pickled_keys)
+        chunks.append(struct.pack('<%iQ' % len(offsets), *offsets))
+        size = cls._tree_header.size + len(pickled_keys) + 8 * len(offsets)
+        return offset, offset + size
+
+    def _node(self, offset):
+        """@return the decoded value of the node at the given offset, which is a SnapshotTree for trees"""
+        data = self._map
+        tag = data[offset]
+        if tag == self.TAG_LEAF:
+            _, size = self._leaf_header.unpack_from(data, offset)
+            start = offset + self._leaf_header.size
+            return loads(data[start:start + size])
+        elif tag == self.TAG_TREE:
+            _, flags, count, keys_size = self._tree_header.unpack_from(data, offset)
+            start = offset + self._tree_header.size
+            keys = loads(data[start:start + keys_size])
+            offsets = struct.unpack_from('<%iQ' % count, data, start + keys_size)
+            return SnapshotTree(self, bool(flags & self.FLAG_ORDERED), keys, offsets)
+        # end handle node type
+        raise SnapshotError("Invalid node tag '%s' at offset %i in '%s'" % (tag, offset, self._path))
+
+    @classmethod
+    def _assure_private_directory(cls, directory):
+        """Create the given directory if needed, and verify only the current user can access it
+        @throws EnvironmentError if it isn't a directory owned by us, or if others have access to it"""
+        try:
+            os.makedirs(directory, 0700)
+            # our umask might have removed some of our permissions
+            os.chmod(directory, 0700)
+        except OSError:
+            # someone else might have created it in the meanwhile
+            if not os.path.isdir(directory):
+                raise
+        # end handle existing directory
+        if not hasattr(os, 'getuid'):
+            return
+        # end handle platforms without permissions
+        info = os.lstat(directory)
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or stat.S_IMODE(info.st_mode) != 0700:
+            raise EnvironmentError("Snapshot directory at '%s' must be a directory with mode 0700, owned by user %i"
+                                   % (directory, os.getuid()))
+        # end verify directory
+
+    @classmethod
+    def _has_contents(cls, path, encoded):
+        """@return True if the file at the given path is a regular file containing exactly the given string"""
+        try:
+            info = os.lstat(path)
+            if not stat.S_ISREG(info.st_mode) or info.st_size != len(encoded):
+                return False
+            # end handle size or type mismatch
+            fp = open(path, 'rb')
+            try:
+                return fp.read() == encoded
+            finally:
+                fp.close()
+            # end assure file is closed
+        except (OSError, IOError):
+            return False
+        # end handle unreadable files
+
+    @classmethod
+    def _evict(cls, directory):
+        """Remove the least recently written snapshots in the given directory until we are within our limits"""
+        try:
+            paths = [os.path.join(directory, name) for name in os.listdir(directory) 
+                                                    if name.endswith(cls.file_extension)]
+        except OSError:
+            return
+        # end handle unreadable directory
+        if len(paths) <= cls.max_entries:
+            return
+        # end early bailout
+
+        def last_written(path):
+            # write() updates the modification time of the snapshots it reuses
+            try:
+                return os.stat(path).st_mtime
+            except OSError:
+                return 0
+            # end handle concurrent removal
+        # end utility
+        paths.sort(key=last_written)
+        for path in paths[:len(paths) - cls.max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            # end ignore concurrent removal
+        # end for each snapshot to remove
+
+    ## -- End Utilities -- @}
+
+    # -------------------------
+    ## @name Interface
+    # @{
+
+    @classmethod
+    def encode(cls, data):
+        """@return a string with the encoded snapshot of the given data
+        @param data a tree of dicts, usually the data of a kvstore"""
+        chunks = list()
+        root_offset, _ = cls._encode_node(data, chunks, cls._header.size)
+        chunks.insert(0, cls._header.pack(cls.magic, root_offset))
+        return ''.join(chunks)
+
+    @classmethod
+    def directory(cls):
+        """@return directory into which snapshots are written by default. It is private to the current user"""
+        directory = os.environ.get(cls.directory_env_var)
+        if directory:
+            return directory
+        # end handle override
+        runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+        if runtime_dir:
+            return os.path.join(runtime_dir, 'bprocess')
+        # end handle runtime directory
+        if hasattr(os, 'getuid'):
+            user = os.getuid()
+        else:
+            user = os.environ.get('USERNAME', 'user')
+        # end handle platform
+        return os.path.join(tempfile.gettempdir(), 'bprocess-%s' % user)
+
+    @classmethod
+    def write(cls, data, directory=None):
+        """Write a snapshot of the given data into a content-addressed file. If it exists with the same contents, 
+        it will be reused.
+        @param data a tree of dicts to write
+        @param directory if not None, the directory to write the file to. Otherwise directory() is used.
+        It will be created if needed, and must only be accessible by the current user
+        @return tuple(path, digest) of the written file, with digest being a hexadecimal sha1 digest
+        @throws EnvironmentError if the file could not be written, or if the directory isn't private"""
+        directory = directory or cls.directory()
+        cls._assure_private_directory(directory)
+        encoded = cls.encode(data)
+        digest = hashlib.sha1(encoded).hexdigest()
+        path = os.path.join(directory, digest + cls.file_extension)
+        if cls._has_contents(path, encoded):
+            try:
+                # mark it used, see _evict()
+                os.utime(path, None)
+            except OSError:
+                pass
+            # end ignore utime errors
+            return path, digest
+        # end reuse existing files
+
+        # write atomically, as others might read it already
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        try:
+            os.write(fd, encoded)
+            os.close(fd)
+            os.rename(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            # end cleanup
+            raise
+        # end handle write errors
+        log.debug("Wrote settings snapshot of %i bytes to '%s'", len(encoded), path)
+
+        # Listing the directory is expensive, don't do it for every snapshot
+        if cls._writes % cls.eviction_interval == 0:
+            cls._evict(directory)
+        # end evict once in a while
+        cls._writes += 1
+        return path, digest
+
+    def path(self):
+        """@return path to the file we read from"""
+        return self._path
+
+    def root(self):
+        """@return a SnapshotTree onto all of our data"""
+        if self._root is None:
+            _, root_offset = self._header.unpack_from(self._map, 0)
+            self._root = self._node(root_offset)
+        # end decode root on first access
+        return self._root
+
+    def value(self, key, default=None, separator='.'):
+        """@return the value at the given key, like 'site.name', or default if there is no such key.
+        Trees will be returned as SnapshotTree
+        @param key a separated key into our data
+        @param default value to return if the key doesn't exist
+        @param separator the character separating the tokens of key"""
+        node = self.root()
+        for token in key.split(separator):
+            if not isinstance(node, SnapshotTree) or token not in node:
+                return default
+            # end handle missing key
+            node = node[token]
+        # end for each token
+        return node
+
+    def data(self):
+        """@return a fully decoded copy of all our data, like it was passed to write()"""
+        root = self.root()
+        if isinstance(root, SnapshotTree):
+            return root.to_dict()
+        # end handle trees
+        return root
+
+    ## -- End Interface -- @}
+
+# end class SettingsSnapshot
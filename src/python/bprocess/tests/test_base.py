@@ -13,14 +13,17 @@ if __name__ == '__main__':
 
 import sys
 import os
+import stat
 import tempfile
 
 import bapp
 
-from butility.tests import TestCaseBase
+from butility.tests import ( TestCaseBase,
+                             with_rw_directory )
 from bprocess import *
 from bapp.tests import preserve_application
-from butility import Path
+from butility import ( Path,
+                       OrderedDict )
 
 import subprocess
 
@@ -79,6 +82,15 @@ class TestProcessController(ProcessController):
 # end class TestProcessController
 
 
+class PlanCachingProcessController(TestProcessController):
+    """A controller which caches launch plans"""
+    __slots__ = ()
+
+    use_launch_plan_cache = True
+
+# end class PlanCachingProcessController
+
+
 def pseudo_executable(bin_name):
     """@return full path to pseudo_executable based on the given executable basename"""
     return Path(__file__).dirname() / bin_name
@@ -172,6 +184,88 @@ class TestProcessControl(TestCaseBase):
             assert pctrl.execute_in_current_context().returncode == 0
         # end for each program to test
 
+    @with_rw_directory
+    @preserve_application
+    def test_launch_plan_cache(self, rw_dir):
+        """Verify launch plans are cached and used as long as the configuration doesn't change"""
+        evar = LaunchPlanCache.directory_env_var
+        prev_value = os.environ.get(evar)
+        os.environ[evar] = str(rw_dir / 'plans')
+        os.environ['BPROCESS_TEST_SECRET'] = 'secret-value-of-caller'
+        try:
+            executable = pseudo_executable('load-from-directories')
+            # Neither controllers nor delegates cache plans by default
+            for pctrl in (TestProcessController(executable, dry_run=True),
+                          PlanCachingProcessController(executable, dry_run=True)):
+                assert pctrl.execute().returncode == 0
+                assert pctrl.launch_plan() is None
+            # end for each controller which doesn't cache
+            # ... but they can still show what they would do
+            pctrl = TestProcessController(executable, ['---show-plan'], dry_run=True)
+            self.failUnlessRaises(DisplayLaunchPlanException, pctrl.execute)
+            assert 'LAUNCH PLAN' in str(pctrl.launch_plan())
+            assert not os.path.exists(os.environ[evar]), "nothing should have been stored"
+
+            ProcessControllerDelegate.launch_plan_cacheable = True
+
+            pctrl = PlanCachingProcessController(executable, dry_run=True)
+            assert pctrl.launch_plan() is None
+            assert pctrl.execute().returncode == 0
+            plan = pctrl.launch_plan()
+            assert isinstance(plan, LaunchPlan) and not plan.from_cache
+            assert plan.config_files and plan.is_valid()
+            assert os.path.abspath(sys.modules[ProcessControllerDelegate.__module__].__file__.rstrip('co')) \
+                                            in plan.config_files, "delegate implementation should be tracked"
+            plugin_file = str(Path(__file__).dirname() / 'etc' / 'plug-ins' / 'test_plugin.py')
+            assert plugin_file in plan.config_files, "plugin files should be tracked"
+            assert plan.args[0] == plan.executable
+
+            pctrl = PlanCachingProcessController(executable, dry_run=True)
+            assert pctrl.execute().returncode == 0
+            cached_plan = pctrl.launch_plan()
+            assert cached_plan.from_cache
+            assert cached_plan.args == plan.args
+            assert cached_plan.environment(os.environ) == plan.environment(os.environ)
+
+            # only environment changes are stored, in files only we can read
+            plans_dir = rw_dir / 'plans'
+            assert stat.S_IMODE(os.stat(plans_dir).st_mode) == 0700
+            for name in os.listdir(plans_dir):
+                assert stat.S_IMODE(os.stat(plans_dir / name).st_mode) == 0600
+                assert os.environ['BPROCESS_TEST_SECRET'] not in open(plans_dir / name, 'rb').read()
+            # end for each plan file
+
+            # different arguments mean different plans
+            pctrl = PlanCachingProcessController(executable, ['---foo=bar'], dry_run=True)
+            pctrl.execute()
+            assert not pctrl.launch_plan().from_cache
+
+            # the cache can be bypassed
+            pctrl = PlanCachingProcessController(executable, ['---no-plan-cache'], dry_run=True)
+            pctrl.execute()
+            assert pctrl.launch_plan() is None
+
+            pctrl = PlanCachingProcessController(executable, ['---show-plan'], dry_run=True)
+            self.failUnlessRaises(DisplayLaunchPlanException, pctrl.execute)
+            assert 'LAUNCH PLAN' in str(pctrl.launch_plan())
+
+            # Changed configuration invalidates the plan
+            config_file = rw_dir / 'settings.yaml'
+            config_file.write_text('foo: bar\n')
+            plan.config_files[str(config_file)] = LaunchPlan.file_digest(config_file)
+            assert plan.is_valid()
+            config_file.write_text('foo: baz\n')
+            assert not plan.is_valid()
+        finally:
+            ProcessControllerDelegate.launch_plan_cacheable = False
+            del os.environ['BPROCESS_TEST_SECRET']
+            if prev_value is None:
+                del os.environ[evar]
+            else:
+                os.environ[evar] = prev_value
+            # end restore environment
+        # end assure environment is restored
+
     @preserve_application
     def test_iteration(self):
         """verify simple package iteration works (for those who want it)"""
@@ -187,6 +281,145 @@ class TestProcessControl(TestCaseBase):
         
         self.failUnlessRaises(EnvironmentError, TestProcessController(executable, args).iter_packages('foobar').next)
         
+    @with_rw_directory
+    @preserve_application
+    def test_settings_snapshot(self, rw_dir):
+        """Verify settings can be passed to child processes using snapshot files"""
+        data = OrderedDict(site=OrderedDict(name='foo', paths=['a', 'b']), count=5, tree=dict(x=OrderedDict()))
+        snapshot_dir = rw_dir / 'snapshots'
+        path, digest = SettingsSnapshot.write(data, snapshot_dir)
+        assert path.startswith(snapshot_dir) and digest in path
+        assert SettingsSnapshot.write(data, snapshot_dir) == (path, digest), "files are content-addressed"
+
+        snapshot = SettingsSnapshot(path, digest)
+        assert snapshot.value('site.name') == 'foo'
+        assert snapshot.value('site.paths') == ['a', 'b']
+        assert snapshot.value('site.foo', 42) == 42
+        assert isinstance(snapshot.value('tree'), SnapshotTree)
+        assert snapshot.root().keys() == data.keys()
+        decoded = snapshot.data()
+        assert decoded == data and type(decoded) is OrderedDict and type(decoded['tree']) is dict
+        self.failUnlessRaises(SnapshotError, SettingsSnapshot, path, 'invalid digest')
+
+        # existing files are only reused if they are intact
+        open(path, 'wb').write('corrupted')
+        assert SettingsSnapshot.write(data, snapshot_dir) == (path, digest)
+        assert SettingsSnapshot(path, digest).data() == data
+
+        # only private directories are used
+        public_dir = rw_dir / 'public'
+        public_dir.mkdir()
+        os.chmod(public_dir, 0755)
+        self.failUnlessRaises(EnvironmentError, SettingsSnapshot.write, data, public_dir)
+        assert not os.listdir(public_dir)
+
+        # old snapshots are removed
+        class BoundedSettingsSnapshot(SettingsSnapshot):
+            __slots__ = ()
+            max_entries = 2
+            eviction_interval = 1
+        # end class BoundedSettingsSnapshot
+
+        bounded_dir = rw_dir / 'bounded'
+        paths = [BoundedSettingsSnapshot.write(dict(count=count), bounded_dir)[0] for count in range(4)]
+        assert len(os.listdir(bounded_dir)) == 2
+        assert os.path.isfile(paths[-1]) and not os.path.isfile(paths[0])
+
+        # store() uses it if enabled, and removes inherited data of other transports
+        context = TestProcessController(pseudo_executable('py-program')).application().context()
+        env = {ControlledProcessInformation.storage_environment_variable : 'XY', 'XY' : 'foo'}
+        os.environ[ControlledProcessInformation.snapshot_transport_environment_variable] = '1'
+        os.environ[SettingsSnapshot.directory_env_var] = str(snapshot_dir)
+        try:
+            ControlledProcessInformation.store(env, context)
+        finally:
+            del os.environ[ControlledProcessInformation.snapshot_transport_environment_variable]
+            del os.environ[SettingsSnapshot.directory_env_var]
+        # end assure environment is restored
+        assert 'XY' not in env and ControlledProcessInformation.storage_environment_variable not in env
+        assert ControlledProcessInformation.has_data(env)
+        snapshot = SettingsSnapshot(env[ControlledProcessInformation.snapshot_path_environment_variable],
+                                    env[ControlledProcessInformation.snapshot_digest_environment_variable])
+        assert snapshot.data() == context.settings().data()
+
+        # empty and falsy values are returned as they are
+        class SnapshotProcessInformation(ControlledProcessInformation):
+            __slots__ = ()
+        # end class SnapshotProcessInformation
+
+        data = OrderedDict(empty=OrderedDict(), zero=0, packages=OrderedDict(foo=dict()))
+        path, digest = SettingsSnapshot.write(data, snapshot_dir)
+        prev_environ = os.environ.copy()
+        os.environ[ControlledProcessInformation.snapshot_path_environment_variable] = path
+        os.environ[ControlledProcessInformation.snapshot_digest_environment_variable] = digest
+        try:
+            info = SnapshotProcessInformation()
+            assert type(info.section('empty')) is OrderedDict and not info.section('empty')
+            assert info.section('zero') == 0
+            assert type(info.package('foo')) is dict and not info.package('foo')
+            assert info.package('bar') is None
+        finally:
+            os.environ.clear()
+            os.environ.update(prev_environ)
+        # end assure environment is restored
+
+    @preserve_application
+    def test_lazy_process_information(self):
+        """Verify sections and packages can be decoded individually"""
+        context = TestProcessController(pseudo_executable('py-program')).application().context()
+        env = dict()
+        prev_environ = os.environ.copy()
+        os.environ[ControlledProcessInformation.lazy_transport_environment_variable] = '1'
+        os.environ[ControlledProcessInformation.snapshot_transport_environment_variable] = '0'
+        try:
+            ControlledProcessInformation.store(env, context)
+            ControlledProcessInformation.store_commandline_overrides(env, dict(foo='bar'))
+        finally:
+            os.environ.clear()
+            os.environ.update(prev_environ)
+        # end assure environment is restored
+        for evar in (ControlledProcessInformation.process_information_environment_variable,
+                     ControlledProcessInformation.commandline_overrides_environment_variable):
+            assert env[evar].startswith(ControlledProcessInformation.fast_codec_marker)
+        # end for each fast-codec variable
+
+        # a new type is a new singleton, which reads our environment
+        class LazyProcessInformation(ControlledProcessInformation):
+            __slots__ = ()
+        # end class LazyProcessInformation
+
+        os.environ.update(env)
+        try:
+            info = LazyProcessInformation()
+            assert info.commandline_overrides() == dict(foo='bar')
+            assert info.process_data().id == 'py-program'
+            assert isinstance(info.process_data().executable, Path)
+
+            settings = context.settings().data()
+            assert info.package('py-program') == settings.packages['py-program']
+            assert info.package('foo') is None
+            assert len(info._package_cache) == 2, "only the requested packages should have been decoded"
+            assert info.section('process') == settings.process
+            assert info.section('foo') is None
+
+            store = info.package_kvstore('py-program')
+            packages = store.data().packages
+            assert 'py-program' in packages and 'test-environment' in packages, "required packages are included"
+            assert 'load-from-settings' not in packages
+            assert info.data() == settings
+
+            # packages referenced in format strings are included, so values can be resolved
+            assert LazyProcessInformation._referenced_packages(
+                            dict(a=['{packages.foo.root}/{packages[bar-baz].x}', 1], b='{other.foo}')) == \
+                                                                                        set(('foo', 'bar-baz'))
+            info.package('py-program')['referencing'] = '{packages.load-from-settings.executable}'
+            packages = info.package_kvstore('py-program').data().packages
+            assert 'load-from-settings' in packages
+        finally:
+            os.environ.clear()
+            os.environ.update(prev_environ)
+        # end assure environment is restored
+
     @preserve_application
     def test_post_launch_info(self):
         """Just some basic tests"""
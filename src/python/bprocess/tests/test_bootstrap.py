@@ -10,9 +10,14 @@ __all__ = []
 
 import sys
 import os.path
+import time
+import socket
+import resource
+import subprocess
 
 import bapp
-from butility.tests import TestCaseBase
+from butility.tests import ( TestCaseBase,
+                             with_rw_directory )
 from butility import PythonFileLoader
 
 # Dynamic loading of wrapper code - its not in a package for good reason
@@ -40,6 +45,88 @@ class TestBootstrap(TestCaseBase):
             # expected, as it will complain about it not being a symlink
             pass
         # end handle exception
-    
+
+    @with_rw_directory
+    def test_zygote(self, rw_dir):
+        """Launch programs through a zygote server, and fall back to the normal launch without it"""
+        socket_path = rw_dir / 'zygote'
+        program = os.path.abspath(os.path.join(dirname(__file__), 'bin', 'py-program'))
+        package_path = os.path.abspath(dirname(dirname(dirname(__file__))))
+        bootstrapper = bootstrap.Bootstrapper()
+
+        env_var = bootstrapper.zygote_socket_env_var
+        assert env_var not in os.environ
+        assert bootstrapper._zygote_launch(program, []) is None, "nothing configured"
+        client, server = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            assert bootstrapper._zygote_peer_is_trusted(client, rw_dir), "we trust ourselves"
+        finally:
+            client.close()
+            server.close()
+        # end assure sockets are closed
+        os.environ[env_var] = socket_path
+        try:
+            assert bootstrapper._zygote_launch(program, []) is None, "no server"
+
+            env = dict(os.environ)
+            env['PYTHONPATH'] = package_path
+            server = subprocess.Popen([sys.executable, '-m', 'bprocess.zygote', socket_path, dirname(program)],
+                                      cwd=rw_dir, env=env)
+            try:
+                for attempt in range(200):
+                    if socket_path.exists():
+                        break
+                    # end server is ready
+                    time.sleep(0.05)
+                # end wait for server
+                assert socket_path.exists(), "server should be listening by now"
+
+                stderr_path = rw_dir / 'stderr'
+                stderr = open(stderr_path, 'w')
+                try:
+                    fds = (0, 1, stderr.fileno())
+                    assert bootstrapper._zygote_launch(program, [], fds=fds) == 0
+                    assert bootstrapper._zygote_launch(program, ['---foo'], fds=fds) == 2
+
+                    # the program runs with our umask and resource limits, detached from the server's session
+                    nofile = resource.getrlimit(resource.RLIMIT_NOFILE)
+                    # The delegate expects the program to print the path to a file it created
+                    check = ("import os, resource, tempfile; "
+                             "assert os.umask(0) == 0027; "
+                             "assert resource.getrlimit(resource.RLIMIT_NOFILE) == %r; "
+                             "assert os.getsid(0) != %i; "
+                             "print tempfile.mkstemp()[1]" % ((nofile[1] - 1, nofile[1]), os.getsid(server.pid)))
+                    umask = os.umask(0027)
+                    resource.setrlimit(resource.RLIMIT_NOFILE, (nofile[1] - 1, nofile[1]))
+                    try:
+                        assert bootstrapper._zygote_launch(program, [check], fds=fds) == 0
+                    finally:
+                        os.umask(umask)
+                        resource.setrlimit(resource.RLIMIT_NOFILE, nofile)
+                    # end restore process state
+                finally:
+                    stderr.close()
+                # end assure file is closed
+                assert "'foo' unknown" in open(stderr_path).read(), "errors are written to our stderr"
+
+                # programs using another root package are not launched by the server
+                package_var = bootstrapper.package_path_env_var
+                assert package_var not in os.environ
+                os.environ[package_var] = rw_dir
+                try:
+                    assert bootstrapper._zygote_launch(program, []) is None, "server must refuse foreign packages"
+                finally:
+                    del os.environ[package_var]
+                # end assure environment is restored
+            finally:
+                server.terminate()
+                assert server.wait() == 0
+            # end assure server is stopped
+            assert not socket_path.exists(), "server removes its socket"
+            assert bootstrapper._zygote_launch(program, []) is None
+        finally:
+            del os.environ[env_var]
+        # end assure environment is restored
+
 
 # end class TestWrapper
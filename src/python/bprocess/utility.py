@@ -236,6 +236,15 @@ class PackageMetaDataChangeTracker( PersistentApplicationSettingsClient,
     
     """
     __slots__ = ('_package_name')
+
+    class SettingsType(PersistentApplicationSettingsClient.SettingsType):
+        """Settings which don't journal their changes, as their base value is owned by the caller, who may 
+        change it in place to update the package state"""
+        __slots__ = ()
+
+        journal_changes = False
+
+    # end class SettingsType
     
     _schema = PackageDataIteratorMixin.new_controller_schema(package_meta_data_schema)
     
@@ -484,7 +493,8 @@ class PythonPackageIterator(ApplicationSettingsClient, PackageDataIteratorMixin)
         @note this is a way to load plug-ins"""
         assert ControlledProcessInformation.has_data()
         info = ControlledProcessInformation()
-        store = info.as_kvstore()
+        # only decode the packages we actually need
+        store = info.package_kvstore(info.process_data().id)
         imported_modules = list()
         
         if store is None:
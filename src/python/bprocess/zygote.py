@@ -0,0 +1,364 @@
+#-*-coding:utf-8-*-
+"""
+@package bprocess.zygote
+@brief A daemon launching wrapped programs from a pre-initialized, forked interpreter
+
+@author Sebastian Thiel
+@copyright [GNU Lesser General Public License](https://www.gnu.org/licenses/lgpl.html)
+"""
+__all__ = ['ZygoteServer']
+
+import os
+import sys
+import stat
+import errno
+import struct
+import signal
+import socket
+import logging
+import resource
+import traceback
+
+from cPickle import loads
+
+import bapp
+from butility import ( Path,
+                       PhaseProfiler )
+from bkvstore import SerializedDataCache
+
+log = logging.getLogger('bprocess.zygote')
+
+
+class ZygoteServer(object):
+    """A server listening on a unix socket, which launches wrapped programs on behalf of the bootstrapper.
+
+    The server imports all packages needed to launch programs, and warms up process-wide caches, like
+    parsed configuration files, directory listings and file digests, once. For each launch request, it
+    forks a process which runs the bootstrapper's main(), using the file descriptors, environment, working
+    directory, umask, resource limits and arguments of the requesting bootstrapper. This saves the interpreter 
+    startup and all imports for each launch. The exit status of the launched program is passed back to the 
+    requesting bootstrapper.
+
+    The bootstrapper uses a server if the socket path is set in the environment variable named by
+    socket_env_var, and falls back to launching the program itself if the server can't be reached.
+
+    Protocol, all integers in network byte order:
+    * the client sends its stdin, stdout and stderr file descriptors
+    * the client sends the pickled request dict (executable, args, cwd, environ, umask, rlimits, package_path),
+      prefixed with its length as 8 byte integer. rlimits is a dict of resource.RLIMIT_* names to (soft, hard) 
+      tuples, package_path is the real path to the directory containing the client's bprocess package
+    * the server sends the process id of the launched process as 4 byte integer, or 0 if it refuses to launch
+      the program as package_path isn't the directory containing its own bprocess package. In that case, the
+      connection is closed
+    * the server sends the status of the launched process, as returned by waitpid(), as 4 byte integer
+
+    @note the server can be started using `python -m bprocess.zygote [socket_path [directory ...]]`. Make sure
+    the bcore packages are imported using absolute paths, as the launched processes change their working
+    directory. Don't start it from the directory containing the packages.
+    @note changes to the code of the server's packages require a restart of the server. Programs using 
+    a different bprocess package, for instance through their symlink or the bootstrapper's package_path_env_var,
+    are never launched by the server
+    @note launched programs run in a new session without controlling terminal, as they can't join the session
+    and process group of the requesting bootstrapper. They can read from and write to the bootstrapper's 
+    terminal through the passed file descriptors, but can't open /dev/tty, and don't receive signals sent by 
+    the terminal to its foreground process group, like SIGINT on Ctrl-C, or SIGTSTP on Ctrl-Z. The bootstrapper
+    forwards SIGINT, SIGTERM, SIGHUP and SIGQUIT though. Programs relying on job control should not be launched 
+    through the server.
+    @note only clients of the user running the server can connect to its socket, and clients will only use
+    servers run by their own user
+    """
+    __slots__ = (
+                    '_socket_path',     ## path to our unix socket
+                    '_directories',     ## directories whose configuration to load during warm-up
+                    '_socket',          ## our listening socket, if we are serving
+                    '_package_path',    ## real path to the directory containing our bprocess package
+                    '_warm_app'         ## the application we created during warm-up
+                )
+
+    # -------------------------
+    ## @name Configuration
+    # @{
+
+    ## Environment variable with the path to our socket, shared with the bootstrapper
+    socket_env_var = 'BPROCESS_ZYGOTE_SOCKET'
+
+    ## Amount of file descriptors we receive per request
+    num_fds = 3
+
+    ## Backlog of our listening socket
+    listen_backlog = 128
+
+    ## -- End Configuration -- @}
+
+    def __init__(self, socket_path=None, directories=tuple()):
+        """Initialize this instance
+        @param socket_path path at which to create our unix socket. If None, it will be read from our
+        socket_env_var
+        @param directories an iterable of directories whose configuration should be loaded during warm-up,
+        usually the ones containing bootstrapper symlinks, to have their configuration files parsed already
+        when the first program is launched
+        @throws EnvironmentError if no socket path was provided"""
+        if socket_path is None:
+            socket_path = os.environ.get(self.socket_env_var)
+            if not socket_path:
+                raise EnvironmentError("Please provide a socket path, or set %s" % self.socket_env_var)
+            # end handle unset variable
+        # end read socket path
+        self._socket_path = socket_path
+        self._directories = [Path(directory) for directory in directories]
+        self._socket = None
+        self._warm_app = None
+        self._package_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+    # -------------------------
+    ## @name Utilities
+    # @{
+
+    @classmethod
+    def _receive(cls, sock, size):
+        """@return exactly size bytes read from sock
+        @throws EOFError if the connection was closed prematurely"""
+        data = ''
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise EOFError("Connection closed after %i of %i bytes" % (len(data), size))
+            # end handle premature close
+            data += chunk
+        # end while receiving
+        return data
+
+    @classmethod
+    def _receive_request(cls, sock):
+        """@return (fds, request) tuple, with fds being a list of received file descriptors, and request
+        being a dict with executable, args, cwd and environ keys"""
+        from _multiprocessing import recvfd
+        fds = [recvfd(sock.fileno()) for count in range(cls.num_fds)]
+        size = struct.unpack('!Q', cls._receive(sock, 8))[0]
+        return fds, loads(cls._receive(sock, size))
+
+    def _warm_up(self):
+        """Initialize process-wide state once, to be inherited by all launched processes"""
+        with PhaseProfiler.instance().span('ZygoteServer._warm_up'):
+            SerializedDataCache.retain_in_memory()
+            self._warm_app = bapp.Application.new(settings_trees=self._directories,
+                                                  settings_hierarchy=True,
+                                                  setup_logging=False)
+        # end measure warm-up
+
+    @classmethod
+    def _apply_rlimits(cls, rlimits):
+        """Set the given resource limits in the current process, as far as possible
+        @param rlimits dict of resource.RLIMIT_* names to (soft, hard) tuples"""
+        for name, limits in rlimits.iteritems():
+            limit = getattr(resource, name, None)
+            if limit is None:
+                continue
+            # end ignore unknown limits
+            try:
+                resource.setrlimit(limit, limits)
+            except (ValueError, resource.error), err:
+                # We can't raise hard limits above our own, but can at least adjust the soft limit
+                hard = resource.getrlimit(limit)[1]
+                soft = limits[0]
+                if hard != resource.RLIM_INFINITY and (soft == resource.RLIM_INFINITY or soft > hard):
+                    soft = hard
+                # end clamp soft limit
+                try:
+                    resource.setrlimit(limit, (soft, hard))
+                except (ValueError, resource.error):
+                    pass
+                # end ignore failure
+                log.warn("Could not set %s to %s: %s", name, limits, err)
+            # end handle insufficient permissions
+        # end for each limit
+
+    def _launch(self, fds, request):
+        """Run the bootstrapper using the given file descriptors and request in the current, forked process.
+        Never returns"""
+        returncode = 2
+        try:
+            try:
+                for target_fd, fd in enumerate(fds):
+                    os.dup2(fd, target_fd)
+                    if fd > 2:
+                        os.close(fd)
+                    # end close duplicates
+                # end for each file descriptor
+
+                # absolute, as we may run as __main__. Import it before changing the directory, in case 
+                # our path is relative
+                from bprocess.bootstrap import Bootstrapper
+
+                os.chdir(request['cwd'])
+                os.environ.clear()
+                os.environ.update(request['environ'])
+                sys.argv = [request['executable']] + list(request['args'])
+                os.umask(request['umask'])
+                self._apply_rlimits(request['rlimits'])
+                # Detach from the server's terminal, if it has one, to prevent being stopped by it when reading 
+                # from the client's terminal. See the class documentation
+                os.setsid()
+
+                # Start from scratch, with settings from the new environment, as if bapp was just imported
+                # by the bootstrapper
+                PhaseProfiler.instance().disable().reset()
+                bapp._initialize()
+
+                Bootstrapper().main(request['executable'], request['args'], use_zygote=False)
+                returncode = 0
+            except SystemExit, err:
+                if err.code is None:
+                    returncode = 0
+                elif isinstance(err.code, int):
+                    returncode = err.code
+                else:
+                    sys.stderr.write('%s\n' % err.code)
+                    returncode = 1
+                # end handle exit code types
+            except BaseException:
+                traceback.print_exc()
+            # end handle exceptions
+
+            # We will not return, but exit handlers have to run nonetheless
+            import atexit
+            atexit._run_exitfuncs()
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(returncode & 0xff)
+        # end assure we never return
+
+    def _handle(self, connection):
+        """Handle a launch request on the given connection in the current, forked process, and send
+        the results. Never returns"""
+        status = 0
+        try:
+            try:
+                # Launched processes must not inherit our handlers
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                fds, request = self._receive_request(connection)
+                if request.get('package_path') != self._package_path:
+                    log.debug("refusing to launch %s, which uses the bprocess package at %s", 
+                              request['executable'], request.get('package_path'))
+                    for fd in fds:
+                        os.close(fd)
+                    # end for each file descriptor we don't need
+                    connection.sendall(struct.pack('!i', 0))
+                    return
+                # end handle foreign packages
+                log.debug("launching %s %s", request['executable'], ' '.join(request['args']))
+                sys.stdout.flush()
+                sys.stderr.flush()
+                pid = os.fork()
+                if pid == 0:
+                    self._socket.close()
+                    connection.close()
+                    self._launch(fds, request)
+                # end handle child
+                for fd in fds:
+                    os.close(fd)
+                # end for each file descriptor we don't need anymore
+                connection.sendall(struct.pack('!i', pid))
+                status = os.waitpid(pid, 0)[1]
+                connection.sendall(struct.pack('!i', status))
+            except Exception:
+                log.error("Failed to handle launch request", exc_info=True)
+                status = 1
+            # end handle exceptions
+        finally:
+            os._exit(status and 1 or 0)
+        # end assure we never return
+
+    ## -- End Utilities -- @}
+
+    # -------------------------
+    ## @name Interface
+    # @{
+
+    def socket_path(self):
+        """@return path to our unix socket"""
+        return self._socket_path
+
+    def serve_forever(self):
+        """Warm up, and serve launch requests until we are terminated. The socket file will be removed when
+        we are done. SIGTERM is handled like SIGINT.
+        @throws EnvironmentError if another server is listening at our socket path already"""
+        if os.path.exists(self._socket_path):
+            if not stat.S_ISSOCK(os.stat(self._socket_path).st_mode):
+                raise EnvironmentError("Won't replace file at '%s' which isn't a socket" % self._socket_path)
+            # end handle non-sockets
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                try:
+                    probe.connect(self._socket_path)
+                except socket.error:
+                    # stale socket of a server which didn't shut down properly
+                    os.remove(self._socket_path)
+                else:
+                    raise EnvironmentError("A server is listening at '%s' already" % self._socket_path)
+                # end handle server
+            finally:
+                probe.close()
+            # end assure probe is closed
+        # end handle existing socket
+
+        self._warm_up()
+
+        def terminate(signum, frame):
+            raise KeyboardInterrupt
+        # end handler
+        signal.signal(signal.SIGTERM, terminate)
+        # children are reaped automatically
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            previous_umask = os.umask(0077)
+            try:
+                self._socket.bind(self._socket_path)
+            finally:
+                os.umask(previous_umask)
+            # end assure only we can connect
+            self._socket.listen(self.listen_backlog)
+            log.info("Serving launch requests at '%s'", self._socket_path)
+
+            while True:
+                try:
+                    connection = self._socket.accept()[0]
+                except socket.error, err:
+                    if err.args[0] == errno.EINTR:
+                        continue
+                    # end retry on interrupted system calls
+                    raise
+                # end handle signals
+                try:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    if os.fork() == 0:
+                        self._handle(connection)
+                    # end handle child
+                finally:
+                    connection.close()
+                # end assure connection is closed in server
+            # end serve forever
+        except KeyboardInterrupt:
+            log.info("Shutting down")
+        finally:
+            self._socket.close()
+            self._socket = None
+            try:
+                os.remove(self._socket_path)
+            except OSError:
+                pass
+            # end ignore missing socket
+        # end assure socket is removed
+
+    ## -- End Interface -- @}
+
+# end class ZygoteServer
+
+
+if __name__ == '__main__':
+    ZygoteServer(len(sys.argv) > 1 and sys.argv[1] or None, sys.argv[2:]).serve_forever()
@@ -13,6 +13,8 @@ from .base import *
 from .path import *
 from .system import *
 from .types import *
+from .fscache import *
+from .timing import *
 
 __version__ = Version('0.1.0')
 
@@ -25,6 +25,7 @@ from itertools import chain
 from collections import deque
 
 from .path import Path
+from .fscache import DirectoryCache
 
 log = logging.getLogger('butility.base')
 
@@ -151,6 +152,7 @@ def tagged_file_paths(directory, taglist, pattern=None):
     @param pattern simple fnmatch pattern as used for globs or a list of them (allowing to match several
         different patterns at once)
     @return list of matches file paths (as mrv Path)
+    @note directory listings are cached by the process-wide DirectoryCache
     """
     log.debug('obtaining tagged files from %s, tags = %s', directory, ', '.join(taglist))
     
@@ -169,19 +171,19 @@ def tagged_file_paths(directory, taglist, pattern=None):
 
     # GET ALL FILES IN THE GIVEN DIRECTORY_LIST
     ########################################
+    # The cache keeps the tags of each file, per directory and pattern
+    cache = DirectoryCache.instance()
     matched_files = list()
     for folder in directory_list:
         for pattern in pattern_list:
-            matched_files.extend(Path(folder).files(pattern))
+            matched_files.extend(cache.tagged_files(folder, pattern))
         # END for each pattern/glob 
     # end for each directory
 
     # APPLY THE PATTERN SEARCH
     ############################
     tag_match_list = list()
-    for tagged_file in sorted(matched_files):
-        filetags = os.path.split(tagged_file)[1].split('.')[1:-1]
-
+    for tagged_file, filetags in matched_files:
         # match the tags - take the file if all can be found
         num_matched = 0
         for tag in taglist:
@@ -0,0 +1,528 @@
+#-*-coding:utf-8-*-
+"""
+@package butility.fscache
+@brief Process-wide caches for directory listings, stat results and file digests
+
+@author Sebastian Thiel
+@copyright [GNU Lesser General Public License](https://www.gnu.org/licenses/lgpl.html)
+"""
+__all__ = ['DirectoryCache', 'FileHashCache']
+
+import os
+import time
+import errno
+import fnmatch
+import hashlib
+import logging
+import cPickle
+import threading
+
+from .path import Path
+
+# Extended attributes are native in python 3, and available through optional modules in python 2
+if hasattr(os, 'getxattr'):
+    getxattr, setxattr = os.getxattr, os.setxattr
+else:
+    try:
+        from xattr import (getxattr,
+                           setxattr)
+    except ImportError:
+        getxattr = setxattr = None
+    # end handle optional module
+# end handle xattr support
+
+log = logging.getLogger('butility.fscache')
+
+
+class DirectoryCache(object):
+    """A cache for directory listings and isdir() queries, to be used when the same directory chains are
+    searched repeatedly, like when finding configuration directories and files.
+
+    Listings are validated using the modification time of their directory, which changes whenever entries
+    are added, removed or renamed. Listings of directories which were modified very recently are not cached,
+    as further changes might not alter the modification time (see racy_interval).
+    isdir() results can't be validated that way, which is why they are kept for at most stat_ttl seconds.
+
+    Counters allow to see how many system calls were saved. Use instance() to obtain the process-wide instance.
+    @note changes to the type of directory entries (e.g. a file replaced by a directory of the same name)
+    within the same second may go unnoticed
+    """
+    __slots__ = (
+                    '_stats',       ## path -> (time, isdir) tuple
+                    '_listings',    ## path -> (mtime, [(name, isfile), ...], {pattern: [(name, tags), ...]})
+                    '_counters',    ## name -> amount
+                    '_lock'         ## serializes access to our counters
+                )
+
+    # -------------------------
+    ## @name Configuration
+    # @{
+
+    ## If this environment variable is set to '0', the cache will be disabled
+    enable_env_var = 'BUTILITY_DIRECTORY_CACHE'
+
+    ## If set, this environment variable overrides the stat_ttl
+    stat_ttl_env_var = 'BUTILITY_STAT_CACHE_TTL'
+
+    ## The amount of seconds for which isdir() results are considered valid
+    stat_ttl = 2.0
+
+    ## Listings of directories modified less than this amount of seconds ago are not cached
+    racy_interval = 2.0
+
+    ## The names of all counters we maintain
+    counter_names = ('stat_hits', 'stat_misses', 'listing_hits', 'listing_misses', 'syscalls', 'syscalls_saved')
+
+    ## -- End Configuration -- @}
+
+    ## the process-wide instance
+    _instance = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.invalidate()
+        self.reset_counters()
+
+    # -------------------------
+    ## @name Utilities
+    # @{
+
+    def _count(self, **amounts):
+        """Add the given amounts to the respective counters"""
+        self._lock.acquire()
+        try:
+            for name, amount in amounts.iteritems():
+                self._counters[name] += amount
+            # end for each counter
+        finally:
+            self._lock.release()
+        # end assure lock is released
+
+    @classmethod
+    def _ttl(cls):
+        """@return the amount of seconds for which isdir() results are valid"""
+        try:
+            return float(os.environ.get(cls.stat_ttl_env_var, cls.stat_ttl))
+        except ValueError:
+            return cls.stat_ttl
+        # end handle invalid values
+
+    def _listing(self, directory):
+        """@return list of (name, isfile) tuples of all entries in the given directory, as well as the
+        pattern cache of the listing as tuple
+        @throws OSError if the directory cannot be listed"""
+        path = Path._expandvars(directory)
+        if not self.is_enabled():
+            return [(name, os.path.isfile(os.path.join(path, name))) for name in os.listdir(path)], dict()
+        # end handle disabled cache
+
+        mtime = os.stat(path).st_mtime
+        entry = self._listings.get(path)
+        if entry is not None and entry[0] == mtime:
+            self._count(listing_hits=1, syscalls=1, syscalls_saved=1 + len(entry[1]))
+            return entry[1], entry[2]
+        # end handle cache hit
+
+        names = os.listdir(path)
+        listing = [(name, os.path.isfile(os.path.join(path, name))) for name in names]
+        self._count(listing_misses=1, syscalls=2 + len(names))
+        patterns = dict()
+        if time.time() - mtime > self.racy_interval:
+            self._listings[path] = (mtime, listing, patterns)
+        # end handle racy directories
+        return listing, patterns
+
+    ## -- End Utilities -- @}
+
+    # -------------------------
+    ## @name Interface
+    # @{
+
+    @classmethod
+    def instance(cls):
+        """@return the process-wide instance of this type"""
+        if cls.__dict__.get('_instance') is None:
+            cls._instance = cls()
+        # end create instance
+        return cls._instance
+
+    @classmethod
+    def is_enabled(cls):
+        """@return True if the cache should be used, which is the default"""
+        return os.environ.get(cls.enable_env_var, '1') != '0'
+
+    def isdir(self, path):
+        """@return True if the given path is a directory, similar to Path.isdir()"""
+        path = Path._expandvars(path)
+        if not self.is_enabled():
+            return os.path.isdir(path)
+        # end handle disabled cache
+
+        now = time.time()
+        entry = self._stats.get(path)
+        if entry is not None and now - entry[0] <= self._ttl():
+            self._count(stat_hits=1, syscalls_saved=1)
+            return entry[1]
+        # end handle cache hit
+
+        res = os.path.isdir(path)
+        self._count(stat_misses=1, syscalls=1)
+        self._stats[path] = (now, res)
+        return res
+
+    def files(self, directory, pattern=None):
+        """@return list of Paths to files in the given directory, similar to Path.files()
+        @param directory path to the directory to list
+        @param pattern an optional fnmatch pattern that the names of the files have to match
+        @throws OSError if the directory cannot be listed"""
+        directory = Path(directory)
+        listing, patterns = self._listing(directory)
+        return [directory / name for name, isfile in listing
+                                 if isfile and (pattern is None or fnmatch.fnmatch(name, pattern))]
+
+    def tagged_files(self, directory, pattern=None):
+        """@return list of (path, tags) tuples of all files in the given directory which match pattern.
+        Tags are the '.' separated tokens of the file name, without the first and the last one, so
+        'file.lnx.64.yaml' has the tags ['lnx', '64'].
+        @param directory path to the directory to list
+        @param pattern an optional fnmatch pattern that the names of the files have to match
+        @throws OSError if the directory cannot be listed
+        @note the result is cached per directory and pattern, and must not be changed"""
+        directory = Path(directory)
+        listing, patterns = self._listing(directory)
+        res = patterns.get(pattern)
+        if res is None:
+            res = list()
+            for name, isfile in listing:
+                if isfile and (pattern is None or fnmatch.fnmatch(name, pattern)):
+                    res.append((directory / name, name.split('.')[1:-1]))
+                # end keep matching files
+            # end for each entry
+            patterns[pattern] = res
+        # end build tag index
+        return res
+
+    def counters(self):
+        """@return a dict with a copy of all our counters. 'syscalls' is the amount of system calls we made,
+        'syscalls_saved' the amount of calls we didn't have to make thanks to the cache."""
+        return dict(self._counters)
+
+    def reset_counters(self):
+        """Set all counters to zero
+        @return this instance"""
+        self._counters = dict((name, 0) for name in self.counter_names)
+        return self
+
+    def invalidate(self):
+        """Forget all cached listings and stat results
+        @return this instance"""
+        self._stats = dict()
+        self._listings = dict()
+        return self
+
+    ## -- End Interface -- @}
+
+# end class DirectoryCache
+
+
+class FileHashCache(object):
+    """A persistent cache for digests of file contents, to avoid reading files which didn't change.
+
+    Digests are keyed by the device, inode, size and modification time of the file. They are stored in an
+    extended attribute of the file itself if possible, which makes them available to all processes on all hosts.
+    As network filesystems assign devices per mount and client, attributes are keyed without the device,
+    which isn't needed to identify the file they are attached to anyway.
+    Otherwise, they are kept in a cache file in the user's home directory.
+    Digests of files which were modified very recently are not stored, as further changes might not alter
+    the modification time (see racy_interval).
+    Use instance() to obtain the process-wide instance, and flush() to write new digests to the cache file.
+    @note all operations are failsafe - if attributes or the cache file cannot be read or written, the digest
+    will just be computed from the file contents
+    """
+    __slots__ = (
+                    '_path',        ## path to our cache file
+                    '_entries',     ## stat key -> digest, or None if not yet loaded
+                    '_dirty',       ## if True, we have entries which are not yet in our cache file
+                    '_counters',    ## name -> amount
+                    '_lock'         ## serializes access to our entries
+                )
+
+    # -------------------------
+    ## @name Configuration
+    # @{
+
+    ## If this environment variable is set to '0', the cache will be disabled
+    enable_env_var = 'BUTILITY_HASH_CACHE'
+
+    ## If set, this environment variable contains the path to our cache file
+    file_env_var = 'BUTILITY_HASH_CACHE_FILE'
+
+    ## Path to the cache file if the file_env_var isn't set
+    default_file = os.path.join('~', '.cache', 'butility', 'file_hashes.pickle')
+
+    ## The name of the extended attribute to store digests in
+    xattr_name = 'user.butility.md5'
+
+    ## The maximum amount of digests to keep in the cache file
+    max_entries = 8192
+
+    ## Digests of files modified less than this amount of seconds ago are not stored
+    racy_interval = 2.0
+
+    ## The names of all counters we maintain
+    counter_names = ('xattr_hits', 'file_hits', 'misses')
+
+    ## -- End Configuration -- @}
+
+    ## the process-wide instance
+    _instance = None
+
+    def __init__(self, path=None):
+        """Initialize this instance
+        @param path if not None, the path to the cache file to use. Otherwise it will be obtained from
+        the file_env_var or the default_file"""
+        if path is None:
+            path = os.environ.get(self.file_env_var, self.default_file)
+        # end handle path
+        self._path = os.path.expanduser(path)
+        self._entries = None
+        self._dirty = False
+        self._lock = threading.Lock()
+        self.reset_counters()
+
+    # -------------------------
+    ## @name Utilities
+    # @{
+
+    @classmethod
+    def _stat_key(cls, path):
+        """@return (key, mtime) tuple, with key being a string identifying the current version of the file at path
+        @throws OSError if the file cannot be stat'ed"""
+        st = os.stat(Path._expandvars(path))
+        return '%i:%i:%i:%i' % (st.st_dev, st.st_ino, st.st_size, int(round(st.st_mtime * 1e9))), st.st_mtime
+
+    @classmethod
+    def _xattr_key(cls, stat_key):
+        """@return the given stat key without the device, suitable for attributes of the file itself"""
+        return stat_key.split(':', 1)[1]
+
+    def _count(self, name):
+        """Increment the counter with the given name"""
+        self._lock.acquire()
+        try:
+            self._counters[name] += 1
+        finally:
+            self._lock.release()
+        # end assure lock is released
+
+    def _read_entries(self):
+        """@return all entries stored in our cache file, or an empty dict"""
+        try:
+            fp = open(self._path, 'rb')
+        except IOError:
+            return dict()
+        # end handle missing file
+        try:
+            try:
+                entries = cPickle.load(fp)
+            finally:
+                fp.close()
+            # end assure file is closed
+        except Exception:
+            log.warn("Failed to read file hash cache at '%s' - it will be ignored", self._path, exc_info=True)
+            return dict()
+        # end handle corruption
+        if not isinstance(entries, dict):
+            return dict()
+        # end handle unexpected data
+        return entries
+
+    def _loaded_entries(self):
+        """@return our entries, loading them from the cache file if necessary. Must be called with our lock held"""
+        if self._entries is None:
+            self._entries = self._read_entries()
+        # end load entries
+        return self._entries
+
+    def _read_xattr(self, path, stat_key):
+        """@return digest stored in the extended attribute of path for the given stat key, or None"""
+        if getxattr is None:
+            return None
+        # end handle no xattr support
+        try:
+            value = getxattr(path, self.xattr_name)
+        except (IOError, OSError):
+            return None
+        # end handle missing attribute or no support
+        key, sep, digest = value.partition(' ')
+        if key != self._xattr_key(stat_key) or not digest:
+            return None
+        # end handle outdated attribute
+        return digest.decode('hex')
+
+    def _write_xattr(self, path, stat_key, digest):
+        """@return True if the digest could be stored in an extended attribute of path"""
+        if setxattr is None:
+            return False
+        # end handle no xattr support
+        try:
+            setxattr(path, self.xattr_name, '%s %s' % (self._xattr_key(stat_key), digest.encode('hex')))
+        except (IOError, OSError), err:
+            if err.errno not in (errno.ENOTSUP, errno.EPERM, errno.EACCES, errno.EROFS):
+                log.debug("Failed to set extended attribute on '%s'", path, exc_info=True)
+            # end log unexpected errors
+            return False
+        # end handle missing support or permissions
+        return True
+
+    ## -- End Utilities -- @}
+
+    # -------------------------
+    ## @name Interface
+    # @{
+
+    @classmethod
+    def instance(cls):
+        """@return the process-wide instance of this type"""
+        if cls.__dict__.get('_instance') is None:
+            cls._instance = cls()
+        # end create instance
+        return cls._instance
+
+    @classmethod
+    def is_enabled(cls):
+        """@return True if the cache should be used, which is the default"""
+        return os.environ.get(cls.enable_env_var, '1') != '0'
+
+    def path(self):
+        """@return path to our cache file"""
+        return self._path
+
+    def cached_digest(self, path):
+        """@return the md5 digest of the file at path if it is cached and up-to-date, or None
+        @throws OSError if the file cannot be stat'ed"""
+        stat_key, mtime = self._stat_key(path)
+        if not self.is_enabled():
+            return None
+        # end handle disabled cache
+
+        digest = self._read_xattr(Path._expandvars(path), stat_key)
+        if digest is not None:
+            self._count('xattr_hits')
+            return digest
+        # end handle attribute
+
+        self._lock.acquire()
+        try:
+            digest = self._loaded_entries().get(stat_key)
+        finally:
+            self._lock.release()
+        # end assure lock is released
+        if digest is not None:
+            self._count('file_hits')
+        # end count hits
+        return digest
+
+    def digest(self, path, content=None):
+        """@return the md5 digest of the file at path, which is computed if it isn't cached yet
+        @param path the file to obtain the digest for
+        @param content if not None, the contents of the file as string. It will be used instead of reading the
+        file if the digest isn't cached
+        @throws OSError or IOError if the file cannot be read"""
+        digest = self.cached_digest(path)
+        if digest is not None:
+            return digest
+        # end handle cache hit
+
+        # obtain the key before reading, to be sure it's not newer than the content we hash
+        path = Path._expandvars(path)
+        stat_key, mtime = self._stat_key(path)
+        if content is None:
+            fp = open(path, 'rb')
+            try:
+                content = fp.read()
+            finally:
+                fp.close()
+            # end assure file is closed
+        # end read content
+        digest = hashlib.md5(content).digest()
+        self._count('misses')
+
+        if not self.is_enabled() or time.time() - mtime <= self.racy_interval:
+            return digest
+        # end don't store digests of recently changed files
+        if not self._write_xattr(path, stat_key, digest):
+            self._lock.acquire()
+            try:
+                self._loaded_entries()[stat_key] = digest
+                self._dirty = True
+            finally:
+                self._lock.release()
+            # end assure lock is released
+        # end fall back to cache file
+        return digest
+
+    def flush(self):
+        """Write all new digests to our cache file, merging them with the ones written by other processes
+        in the meanwhile. Only the newest max_entries are kept.
+        @return this instance"""
+        self._lock.acquire()
+        try:
+            if not self._dirty:
+                return self
+            # end early bailout
+            entries = self._read_entries()
+            entries.update(self._entries)
+            if len(entries) > self.max_entries:
+                # there is no order, so we drop arbitrary ones, keeping ours
+                for key in entries.keys():
+                    if len(entries) <= self.max_entries:
+                        break
+                    # end stop once we are within our limits
+                    if key not in self._entries:
+                        del entries[key]
+                    # end keep our own entries
+                # end for each key
+            # end handle too many entries
+
+            directory = os.path.dirname(self._path)
+            tmp_path = '%s.%i.tmp' % (self._path, os.getpid())
+            try:
+                if directory and not os.path.isdir(directory):
+                    os.makedirs(directory)
+                # end assure directory exists
+                fp = open(tmp_path, 'wb')
+                try:
+                    cPickle.dump(entries, fp, cPickle.HIGHEST_PROTOCOL)
+                finally:
+                    fp.close()
+                # end assure file is closed
+                # rename is atomic, concurrent readers will never see partial files
+                os.rename(tmp_path, self._path)
+            except Exception:
+                log.warn("Failed to write file hash cache at '%s'", self._path, exc_info=True)
+                if os.path.isfile(tmp_path):
+                    os.remove(tmp_path)
+                # end cleanup
+                return self
+            # end handle write errors
+            self._entries = entries
+            self._dirty = False
+        finally:
+            self._lock.release()
+        # end assure lock is released
+        return self
+
+    def counters(self):
+        """@return a dict with a copy of all our counters"""
+        return dict(self._counters)
+
+    def reset_counters(self):
+        """Set all counters to zero
+        @return this instance"""
+        self._counters = dict((name, 0) for name in self.counter_names)
+        return self
+
+    ## -- End Interface -- @}
+
+# end class FileHashCache
@@ -7,7 +7,7 @@
 @copyright [GNU Lesser General Public License](https://www.gnu.org/licenses/lgpl.html)
 """
 __all__ = ['init_ipython_terminal', 'dylib_extension', 'login_name', 'uname', 'int_bits', 
-           'system_user_id', 'update_env_path', 'Thread', 'ConcurrentRun']
+           'system_user_id', 'update_env_path', 'concurrent_map', 'Thread', 'ConcurrentRun']
 
 import sys
 import os
@@ -116,6 +116,57 @@ def update_env_path(variable_name, path, append = False, environment = os.enviro
     # environment can only contain strings - at least if used for subprocess, which must be assumed
     environment[variable_name] = str(path)
 
+
+def concurrent_map(fun, items, max_workers = 8):
+    """Call fun for each of the given items on a pool of at most max_workers threads.
+    This is useful for I/O bound work, like reading many files from a high-latency filesystem.
+    @param fun callable taking a single item and returning a result
+    @param items an iterable of items to call fun with
+    @param max_workers the maximum amount of threads to use. If 1 or less, all items will be processed
+    serially in the calling thread
+    @return a list of results, in the order of the respective items
+    @throws the first exception raised by fun, in the order of the items, once all items are processed"""
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [fun(item) for item in items]
+    # end handle serial processing
+
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    indices = iter(range(len(items)))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                index = next(indices, None)
+            finally:
+                lock.release()
+            # end assure lock is released
+            if index is None:
+                return
+            # end handle no more work
+            try:
+                results[index] = fun(items[index])
+            except Exception:
+                errors[index] = sys.exc_info()
+            # end keep errors for the caller
+        # end while there is work
+    # end worker
+
+    threads = [Thread(target=worker).start() for tid in range(min(max_workers, len(items)))]
+    for thread in threads:
+        thread.join()
+    # end for each thread to join
+
+    for error in errors:
+        if error is not None:
+            raise error[0], error[1], error[2]
+        # end re-raise first error
+    # end for each error
+    return results
+
 # -- End System Related Functions -- @}
 
 
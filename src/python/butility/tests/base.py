@@ -11,15 +11,46 @@ import unittest
 import os
 import gc
 import sys
+import atexit
 import shutil
 import tempfile
 import inspect
 
 from butility import (Path,
                       MetaBase,
+                      FileHashCache,
                       wraps)
 
 
+# ==============================================================================
+## @name Test Environment
+# ------------------------------------------------------------------------------
+## @{
+
+def _use_temporary_caches():
+    """Make sure tests and the processes they launch keep their persistent caches in a temporary directory, 
+    instead of the user's home, unless configured otherwise"""
+    cache_dir = tempfile.mkdtemp(prefix='btest-caches-')
+    pid = os.getpid()
+    def remove_cache_dir():
+        # forked children must not remove the directory of their parent
+        if os.getpid() == pid:
+            shutil.rmtree(cache_dir, True)
+        # end handle forks
+    # end utility
+    atexit.register(remove_cache_dir)
+
+    # bkvstore.SerializedDataCache.directory_env_var, which we can't import
+    os.environ.setdefault('BKVSTORE_CACHE_DIR', os.path.join(cache_dir, 'bkvstore'))
+    os.environ.setdefault(FileHashCache.file_env_var, os.path.join(cache_dir, 'butility', 'file_hashes.pickle'))
+    # an instance created before we were imported would use the previous path
+    FileHashCache._instance = None
+
+_use_temporary_caches()
+
+## -- End Test Environment -- @}
+
+
 
 # ==============================================================================
 ## @name Decorators
@@ -8,9 +8,13 @@
 """
 __all__ = []
 
-from .base import TestCaseBase
+from .base import (TestCaseBase,
+                   with_rw_directory)
 import sys
 import os
+import time
+import hashlib
+import json
 
 # test from * import
 from butility import *
@@ -158,6 +162,281 @@ class TestUtility(TestCaseBase):
         dobjclone.there.other = 42
         assert dobj.there.other == 7
 
+    def test_persistent_ordered_dict(self):
+        """Verify persistent dicts are immutable and share all branches which didn't change"""
+        import copy
+        import pickle
+
+        data = OrderedDict()
+        data['one'] = 1
+        data['tree'] = dict(list=[1, 2], sub=dict(value=3))
+        data['empty'] = dict()
+        pdict = PersistentOrderedDict.freeze(data)
+
+        assert isinstance(pdict, OrderedDict) and pdict == data
+        assert pdict.keys() == data.keys(), "order must be retained"
+        assert isinstance(pdict['tree'], PersistentOrderedDict)
+        assert isinstance(pdict['tree']['sub'], PersistentOrderedDict)
+        assert pdict['tree']['list'] is not data['tree']['list'], "values are copied by default"
+        assert pdict.has_empty_trees() and not pdict['tree'].has_empty_trees()
+        assert PersistentOrderedDict.freeze(pdict) is pdict
+        assert pdict.copy() is pdict
+
+        for mutate in (lambda: pdict.__setitem__('one', 2),
+                       lambda: pdict.__delitem__('one'),
+                       lambda: pdict.update(one=2),
+                       lambda: pdict.pop('one'),
+                       lambda: pdict.popitem(),
+                       lambda: pdict.setdefault('new', 2),
+                       pdict.clear):
+            self.failUnlessRaises(TypeError, mutate)
+        # end for each mutation
+        assert pdict == data
+
+        # changes create new instances, sharing everything else
+        changed = pdict.set('one', 2)
+        assert changed['one'] == 2 and pdict['one'] == 1
+        assert changed['tree'] is pdict['tree']
+        assert changed.keys() == pdict.keys()
+        removed = changed.discard('empty')
+        assert 'empty' not in removed and 'empty' in changed
+        assert not removed.has_empty_trees()
+        assert removed.discard('doesntexist') is removed
+
+        # thawing is shallow
+        thawed = pdict.thaw()
+        assert type(thawed) is OrderedDict and thawed == pdict
+        assert thawed['tree'] is pdict['tree']
+        thawed['one'] = 5
+        assert pdict['one'] == 1
+
+        # copies are mutable
+        for copied in (copy.copy(pdict), copy.deepcopy(pdict)):
+            assert not isinstance(copied, PersistentOrderedDict) and copied == pdict
+            copied['one'] = 5
+        # end for each copy
+        deep = copy.deepcopy(pdict)
+        assert not isinstance(deep['tree'], PersistentOrderedDict)
+        deep['tree']['list'].append(3)
+        assert pdict['tree']['list'] == [1, 2]
+
+        # pickling keeps the type and order
+        restored = pickle.loads(pickle.dumps(pdict))
+        assert type(restored) is PersistentOrderedDict and restored == pdict
+        assert isinstance(restored['tree'], PersistentOrderedDict)
+
+    def test_concurrent_map(self):
+        """Verify results are returned in order, and that errors are propagated"""
+        items = range(50)
+        for max_workers in (0, 1, 4, 100):
+            assert concurrent_map(lambda item: item * 2, items, max_workers) == [item * 2 for item in items]
+            assert concurrent_map(lambda item: item, list(), max_workers) == list()
+        # end for each amount of workers
+
+        def fail(item):
+            if item % 10 == 9:
+                raise ValueError(item)
+            # end fail on some items
+            return item
+        # end fail
+
+        for max_workers in (1, 4):
+            try:
+                concurrent_map(fail, items, max_workers)
+            except ValueError, err:
+                assert err.args == (9, ), "the first error is raised"
+            else:
+                raise AssertionError("error should have been propagated")
+            # end handle error
+        # end for each amount of workers
+
+    @with_rw_directory
+    def test_directory_cache(self, rw_dir):
+        """Verify listings and stat results are cached and invalidated"""
+        def touch(*names):
+            for name in names:
+                open(rw_dir / name, 'w').close()
+            # end for each name
+            # listings of recently modified directories are not cached
+            past = time.time() - DirectoryCache.racy_interval * 2 - len(names)
+            os.utime(rw_dir, (past, past))
+        # end utility
+
+        (rw_dir / 'subdir.yaml').mkdir()
+        touch('file.yaml', 'file.lnx.64.yaml', 'file.txt')
+        cache = DirectoryCache()
+        assert DirectoryCache.instance() is DirectoryCache.instance()
+        assert DirectoryCache.instance() is not cache
+
+        expected = sorted(rw_dir.files('*.yaml'))
+        assert sorted(cache.files(rw_dir, '*.yaml')) == expected
+        assert cache.counters()['listing_misses'] == 1
+        assert sorted(cache.files(rw_dir, '*.yaml')) == expected
+        assert len(cache.files(rw_dir)) == 3
+        counters = cache.counters()
+        assert counters['listing_hits'] == 2 and counters['listing_misses'] == 1
+        assert counters['syscalls_saved'] > counters['listing_hits']
+
+        tags = dict((path.basename(), filetags) for path, filetags in cache.tagged_files(rw_dir, '*.yaml'))
+        assert tags == {'file.yaml' : [], 'file.lnx.64.yaml' : ['lnx', '64']}
+        assert cache.tagged_files(rw_dir, '*.yaml') is cache.tagged_files(rw_dir, '*.yaml')
+
+        # changes to the directory invalidate the listing
+        touch('other.yaml')
+        assert len(cache.files(rw_dir, '*.yaml')) == 3
+        assert len(cache.tagged_files(rw_dir, '*.yaml')) == 3
+        assert cache.counters()['listing_misses'] == 2
+        assert tagged_file_paths(rw_dir, ('lnx', '64'), '*.yaml')[-1].basename() == 'file.lnx.64.yaml'
+
+        # recently changed directories are not cached
+        open(rw_dir / 'new.yaml', 'w').close()
+        assert len(cache.files(rw_dir, '*.yaml')) == 4
+        assert cache.counters()['listing_misses'] == 3
+        assert len(cache.files(rw_dir, '*.yaml')) == 4
+        assert cache.counters()['listing_misses'] == 4
+
+        # stat results are kept for a while
+        subdir = rw_dir / 'subdir.yaml'
+        assert cache.isdir(subdir) and cache.isdir(subdir)
+        assert not cache.isdir(rw_dir / 'file.yaml')
+        counters = cache.counters()
+        assert counters['stat_hits'] == 1 and counters['stat_misses'] == 2
+        os.environ[DirectoryCache.stat_ttl_env_var] = '-1'
+        try:
+            assert cache.isdir(subdir)
+            assert cache.counters()['stat_misses'] == 3
+        finally:
+            del os.environ[DirectoryCache.stat_ttl_env_var]
+        # end assure environment is restored
+
+        # the cache can be disabled
+        cache.reset_counters()
+        os.environ[DirectoryCache.enable_env_var] = '0'
+        try:
+            assert cache.isdir(subdir)
+            assert len(cache.files(rw_dir, '*.yaml')) == 4
+            assert not [value for value in cache.counters().values() if value]
+        finally:
+            del os.environ[DirectoryCache.enable_env_var]
+        # end assure environment is restored
+
+        assert not cache.invalidate().isdir(rw_dir / 'doesntexist')
+        self.failUnlessRaises(OSError, cache.files, rw_dir / 'doesntexist')
+
+    @with_rw_directory
+    def test_file_hash_cache(self, rw_dir):
+        """Verify digests are cached until files change, and persist across instances"""
+        def write(path, content, age):
+            open(path, 'w').write(content)
+            past = time.time() - FileHashCache.racy_interval - age
+            os.utime(path, (past, past))
+        # end utility
+
+        def hits(cache):
+            counters = cache.counters()
+            return counters['xattr_hits'] + counters['file_hits']
+        # end utility
+
+        cache_file = rw_dir / 'cache' / 'hashes'
+        path = rw_dir / 'file.yaml'
+        write(path, 'content', 10)
+        cache = FileHashCache(cache_file)
+        assert FileHashCache.instance() is FileHashCache.instance()
+        assert cache.path() == cache_file
+
+        assert cache.cached_digest(path) is None
+        assert cache.digest(path) == hashlib.md5('content').digest()
+        assert cache.counters()['misses'] == 1
+        assert cache.digest(path) == cache.cached_digest(path) == hashlib.md5('content').digest()
+        assert hits(cache) == 2
+
+        # digests persist
+        assert cache.flush() is cache
+        other = FileHashCache(cache_file)
+        assert other.cached_digest(path) == hashlib.md5('content').digest()
+        assert hits(other) == 1
+
+        # changes are detected, and given content is used instead of reading the file
+        write(path, 'changed', 20)
+        assert cache.cached_digest(path) is None
+        assert cache.digest(path, 'given') == hashlib.md5('given').digest()
+        write(path, 'changed again', 30)
+        assert cache.digest(path) == hashlib.md5('changed again').digest()
+
+        # digests of recently changed files aren't stored
+        open(path, 'w').write('new')
+        assert cache.digest(path) == hashlib.md5('new').digest()
+        assert cache.cached_digest(path) is None
+
+        # the cache can be disabled
+        write(path, 'content', 10)
+        os.environ[FileHashCache.enable_env_var] = '0'
+        try:
+            assert cache.cached_digest(path) is None
+            assert cache.digest(path) == hashlib.md5('content').digest()
+        finally:
+            del os.environ[FileHashCache.enable_env_var]
+        # end assure environment is restored
+
+        self.failUnlessRaises(OSError, cache.digest, rw_dir / 'doesntexist')
+
+        # attributes are valid on all hosts, which see different devices on network filesystems
+        stat_key = cache._stat_key(path)[0]
+        digest = hashlib.md5('content').digest()
+        if cache._write_xattr(path, stat_key, digest):
+            st = os.stat(path)
+            other_device_key = '%i:%s' % (st.st_dev + 1, stat_key.split(':', 1)[1])
+            assert cache._read_xattr(path, other_device_key) == digest
+        # end handle xattr support
+
+    @with_rw_directory
+    def test_phase_profiler(self, rw_dir):
+        """Verify nested spans are measured, reported and written as trace"""
+        assert PhaseProfiler.instance() is PhaseProfiler.instance()
+        profiler = PhaseProfiler()
+        assert not profiler.is_enabled()
+        with profiler.span('disabled'):
+            pass
+        assert not profiler.events()
+
+        assert profiler.enable() is profiler and profiler.is_enabled()
+        with profiler.span('outer'):
+            for count in range(2):
+                with profiler.span('inner', count=count):
+                    time.sleep(0.01)
+            # end for each inner span
+        # end outer span
+        # exceptions pass through spans
+        def fail():
+            with profiler.span('failing'):
+                raise ValueError('failure')
+        # end utility
+        self.failUnlessRaises(ValueError, fail)
+
+        events = profiler.events()
+        assert [event[0] for event in events] == ['inner', 'inner', 'outer', 'failing']
+        assert [event[5] for event in events] == [1, 1, 0, 0]
+        assert events[0][-1] == dict(count=0) and events[2][-1] is None
+
+        summary = profiler.summary()
+        assert [item[0] for item in summary[:2]] == ['outer', 'inner']
+        name, count, total, self_total = summary[0]
+        assert count == 1 and total >= 0.02 and self_total < summary[1][2]
+        assert summary[1][1] == 2
+
+        report = profiler.report()
+        assert report.index('outer') < report.index('inner') < report.index('failing')
+        assert len(profiler.report(rows=1).splitlines()) == 2
+
+        trace_file = rw_dir / 'trace.json'
+        assert profiler.write_chrome_trace(trace_file) is profiler
+        trace = json.load(open(trace_file))
+        assert len(trace['traceEvents']) == len(events)
+        assert trace['traceEvents'][0]['ph'] == 'X' and trace['traceEvents'][0]['args'] == dict(count='0')
+
+        assert profiler.disable().reset() is profiler
+        assert not profiler.is_enabled() and not profiler.events()
+
     def test_python_file_loader(self):
         mod_name = 'test_module'
         mod = PythonFileLoader.load_file(self.fixture_path('module.py'), mod_name)
@@ -0,0 +1,260 @@
+#-*-coding:utf-8-*-
+"""
+@package butility.timing
+@brief A low-overhead profiler for nested phases of program startup
+
+@author Sebastian Thiel
+@copyright [GNU Lesser General Public License](https://www.gnu.org/licenses/lgpl.html)
+"""
+__all__ = ['PhaseProfiler']
+
+import os
+import sys
+import time
+import json
+import thread
+import atexit
+import logging
+import threading
+
+log = logging.getLogger('butility.timing')
+
+
+class _NullSpan(object):
+    """A span which does nothing, used while the profiler is disabled"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+# end class _NullSpan
+
+_null_span = _NullSpan()
+
+
+class _Span(object):
+    """A context manager measuring the time spent in a named phase"""
+    __slots__ = (
+                    '_profiler',    ## the PhaseProfiler we record to
+                    '_name',        ## name of our phase
+                    '_args',        ## dict with additional information, or None
+                    '_start',       ## time at which we were entered
+                    '_children'     ## time spent in nested spans
+                )
+
+    def __init__(self, profiler, name, args):
+        self._profiler = profiler
+        self._name = name
+        self._args = args
+        self._start = None
+        self._children = 0.0
+
+    def __enter__(self):
+        self._profiler._stack().append(self)
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.time() - self._start
+        stack = self._profiler._stack()
+        depth = len(stack) - 1
+        stack.pop()
+        if stack:
+            stack[-1]._children += duration
+        # end account for parent
+        self._profiler._events.append((self._name, thread.get_ident(), self._start, duration,
+                                       duration - self._children, depth, self._args))
+        return False
+
+# end class _Span
+
+
+class PhaseProfiler(object):
+    """Measures the time spent in named, possibly nested phases, like the ones passed through when starting
+    up an application.
+
+    Use span() as context manager around each phase. If the profiler is disabled, which is the default,
+    spans do nothing and are very cheap to use.
+    Recorded phases can be summarized in a text report, sorted by the total time spent in each phase, and
+    written as trace-event file which can be viewed in chrome://tracing.
+
+    Use instance() to obtain the process-wide instance.
+    """
+    __slots__ = (
+                    '_events',      ## list of (name, thread_id, start, duration, self_duration, depth, args)
+                    '_local',       ## thread-local storage for the stack of open spans
+                    '_enabled',     ## if True, we record spans
+                    '_epoch',       ## time at which we were created
+                    '_trace_path',  ## path to which to write a trace on exit, or None
+                    '_lock'         ## serializes writing of results
+                )
+
+    # -------------------------
+    ## @name Configuration
+    # @{
+
+    ## The amount of rows to show in the report by default
+    report_rows = 50
+
+    ## -- End Configuration -- @}
+
+    ## the process-wide instance
+    _instance = None
+
+    def __init__(self, enabled=False):
+        self._events = list()
+        self._local = threading.local()
+        self._enabled = enabled
+        self._epoch = time.time()
+        self._trace_path = None
+        self._lock = threading.Lock()
+
+    def _stack(self):
+        """@return list of open spans of the current thread"""
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = list()
+            return self._local.stack
+        # end handle new thread
+
+    def _write_results(self):
+        """Write the report to stderr, and the trace to our trace path. Used when exiting"""
+        self._lock.acquire()
+        try:
+            if self._trace_path is None or not self._events:
+                return
+            # end handle nothing to do
+            sys.stderr.write(self.report())
+            try:
+                self.write_chrome_trace(self._trace_path.replace('{pid}', str(os.getpid())))
+            except (OSError, IOError):
+                log.error("Could not write phase trace to '%s'", self._trace_path, exc_info=True)
+            # end handle write errors
+            # don't write the same events again
+            self._trace_path = None
+        finally:
+            self._lock.release()
+        # end assure lock is released
+
+    # -------------------------
+    ## @name Interface
+    # @{
+
+    @classmethod
+    def instance(cls):
+        """@return the process-wide instance of this type"""
+        if cls.__dict__.get('_instance') is None:
+            cls._instance = cls()
+        # end create instance
+        return cls._instance
+
+    def is_enabled(self):
+        """@return True if spans are recorded"""
+        return self._enabled
+
+    def enable(self, trace_path=None):
+        """Start recording spans.
+        @param trace_path if not None, the text report will be written to stderr and the trace-event file
+        to the given path when the process exits, or when write_results() is called. '{pid}' in the path will
+        be replaced with the id of the process, which is useful if launched processes are profiled as well
+        @return this instance"""
+        if trace_path is not None and self._trace_path is None:
+            atexit.register(self._write_results)
+        # end register only once
+        self._trace_path = trace_path
+        self._enabled = True
+        return self
+
+    def disable(self):
+        """Stop recording spans. Recorded spans are kept
+        @return this instance"""
+        self._enabled = False
+        return self
+
+    def reset(self):
+        """Forget all recorded spans
+        @return this instance"""
+        self._events = list()
+        return self
+
+    def span(self, name, **args):
+        """@return a context manager measuring the time spent in the phase of the given name.
+        @param name the name of the phase. Phases of the same name are summarized in the report
+        @param args additional information to show in the trace, like the path of a loaded file"""
+        if not self._enabled:
+            return _null_span
+        # end handle disabled profiler
+        return _Span(self, name, args or None)
+
+    def events(self):
+        """@return list of (name, thread_id, start, duration, self_duration, depth, args) tuples, one for each
+        recorded span, in order of completion. Times are in seconds"""
+        return list(self._events)
+
+    def summary(self):
+        """@return list of (name, count, total, self_total) tuples, one per phase name, sorted by total time
+        in descending order. Times are in seconds"""
+        phases = dict()
+        for name, tid, start, duration, self_duration, depth, args in self._events:
+            count, total, self_total = phases.get(name, (0, 0.0, 0.0))
+            phases[name] = (count + 1, total + duration, self_total + self_duration)
+        # end for each event
+        res = [(name, count, total, self_total) for name, (count, total, self_total) in phases.iteritems()]
+        res.sort(key=lambda item: (-item[2], item[0]))
+        return res
+
+    def report(self, rows=None):
+        """@return a text report listing the phases which took the most time, sorted by total time
+        @param rows the maximum amount of phases to show, or None to use report_rows"""
+        rows = self.report_rows if rows is None else rows
+        lines = ['%-60s %8s %12s %12s' % ('phase', 'count', 'total [ms]', 'self [ms]')]
+        for name, count, total, self_total in self.summary()[:rows]:
+            lines.append('%-60s %8i %12.3f %12.3f' % (name, count, total * 1000.0, self_total * 1000.0))
+        # end for each phase
+        return '\n'.join(lines) + '\n'
+
+    def chrome_trace(self):
+        """@return a dictionary in the trace-event format, suitable to be written as JSON and viewed in
+        chrome://tracing"""
+        pid = os.getpid()
+        trace_events = list()
+        for name, tid, start, duration, self_duration, depth, args in self._events:
+            event = {'name' : name,
+                     'cat' : 'phase',
+                     'ph' : 'X',
+                     'ts' : (start - self._epoch) * 1e6,
+                     'dur' : duration * 1e6,
+                     'pid' : pid,
+                     'tid' : tid}
+            if args:
+                event['args'] = dict((key, str(value)) for key, value in args.iteritems())
+            # end handle args
+            trace_events.append(event)
+        # end for each event
+        return {'traceEvents' : trace_events, 'displayTimeUnit' : 'ms'}
+
+    def write_chrome_trace(self, path):
+        """Write our spans in the trace-event format to the file at the given path
+        @return this instance"""
+        fp = open(path, 'w')
+        try:
+            json.dump(self.chrome_trace(), fp)
+        finally:
+            fp.close()
+        # end assure file is closed
+        return self
+
+    def write_results(self):
+        """Write the report and the trace file if a trace path was set in enable(), which would otherwise
+        happen when the process exits. Use it before replacing the process with execve()
+        @return this instance"""
+        self._write_results()
+        return self
+
+    ## -- End Interface -- @}
+
+# end class PhaseProfiler
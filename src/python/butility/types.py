@@ -6,7 +6,8 @@
 @author Sebastian Thiel
 @copyright [GNU Lesser General Public License](https://www.gnu.org/licenses/lgpl.html)
 """
-__all__ = ['StringChunker', 'Version', 'OrderedDict', 'DictObject', 'ProgressIndicator', 'PythonFileLoader']
+__all__ = ['StringChunker', 'Version', 'OrderedDict', 'PersistentOrderedDict', 'DictObject', 'ProgressIndicator', 
+           'PythonFileLoader']
 
 from UserDict import DictMixin
 import imp
@@ -17,6 +18,8 @@ import pprint
 import logging
 from copy import deepcopy
 from .path import Path
+from .base import smart_deepcopy
+from .timing import PhaseProfiler
 
 log = logging.getLogger(__name__)
 
@@ -576,6 +579,133 @@ class OrderedDict(dict, DictMixin):
         return not self == other
 
 # end class OrderedDict
+
+
+class PersistentOrderedDict(OrderedDict):
+    """An immutable OrderedDict, whose nested dicts are immutable as well.
+
+    As nothing can change it, a tree of this type can be shared safely by any amount of other trees, which 
+    only have to copy the nodes on the path to a value they want to change. Use thaw() to obtain a mutable 
+    copy of a single level, which still shares all of its sub-trees.
+
+    Copies obtained with the copy module are mutable OrderedDicts. Pickling preserves the type, as well as
+    sub-trees which are shared.
+
+    @note values which are not trees are not protected against changes, which is why you shouldn't change 
+    them in place.
+    """
+    __slots__ = (
+                    '_has_empty_trees',     # True if we, or any of our sub-trees, are empty
+                )
+
+    def __init__(self, items=()):
+        """Initialize this instance with the given items
+        @param items a mapping or an iterable of (key, value) pairs. Nested dicts which are not of our type
+        are converted, without copying their values"""
+        OrderedDict.clear(self)
+        if isinstance(items, dict):
+            items = items.iteritems()
+        # end handle mappings
+        setitem = OrderedDict.__setitem__
+        has_empty_trees = False
+        for key, value in items:
+            if isinstance(value, dict):
+                if not isinstance(value, PersistentOrderedDict):
+                    value = PersistentOrderedDict(value)
+                # end convert mutable trees
+                has_empty_trees = has_empty_trees or value._has_empty_trees
+            # end handle trees
+            setitem(self, key, value)
+        # end for each item
+        object.__setattr__(self, '_has_empty_trees', has_empty_trees or not self)
+
+    def _raise_immutable(self, *args, **kwargs):
+        raise TypeError("%s instances cannot be changed" % type(self).__name__)
+
+    __setitem__ = __delitem__ = __setattr__ = _raise_immutable
+    clear = update = pop = popitem = _raise_immutable
+
+    def __reduce__(self):
+        return type(self), ([(key, self[key]) for key in self],)
+
+    def __copy__(self):
+        return self.thaw()
+
+    def __deepcopy__(self, memo):
+        out = OrderedDict()
+        memo[id(self)] = out
+        for key, value in self.iteritems():
+            out[key] = deepcopy(value, memo)
+        # end for each item
+        return out
+
+    def copy(self):
+        """@return ourselves, as we are immutable"""
+        return self
+
+    # -------------------------
+    ## @name Interface
+    # @{
+
+    @classmethod
+    def freeze(cls, tree, copy_values=True):
+        """@return an instance of our type with the contents of the given tree. Sub-trees which already are of 
+        our type will be shared.
+        @param tree a possibly nested dict. If it is of our type, it will be returned as is
+        @param copy_values if True, values which are not trees will be deep-copied if they are mutable.
+        Otherwise they are shared with the given tree"""
+        if isinstance(tree, cls):
+            return tree
+        # end handle frozen trees
+        items = list()
+        for key, value in tree.iteritems():
+            if isinstance(value, dict):
+                value = cls.freeze(value, copy_values)
+            elif copy_values:
+                value = smart_deepcopy(value)
+            # end handle value type
+            items.append((key, value))
+        # end for each item
+        return cls(items)
+
+    def thaw(self, dict_type=OrderedDict):
+        """@return a mutable copy of this level, which shares all of our values and sub-trees
+        @param dict_type the type of dict to create"""
+        out = dict_type()
+        for key, value in self.iteritems():
+            out[key] = value
+        # end for each item
+        return out
+
+    def set(self, key, value):
+        """@return a new instance with key set to value, sharing all other values and sub-trees with us"""
+        items = list()
+        for k, v in self.iteritems():
+            if k == key:
+                v = value
+            # end replace value
+            items.append((k, v))
+        # end for each item
+        if key not in self:
+            items.append((key, value))
+        # end append new keys
+        return type(self)(items)
+
+    def discard(self, key):
+        """@return a new instance without key, sharing all other values and sub-trees with us, or self if
+        there is no such key"""
+        if key not in self:
+            return self
+        # end handle missing key
+        return type(self)((k, v) for k, v in self.iteritems() if k != key)
+
+    def has_empty_trees(self):
+        """@return True if we, or any of our sub-trees, are empty"""
+        return self._has_empty_trees
+
+    ## -- End Interface -- @}
+
+# end class PersistentOrderedDict
     
 
 class ProgressIndicator(object):
@@ -764,9 +894,9 @@ class PythonFileLoader(object):
     __slots__ = ()
         
     @classmethod
-    def _load_files(cls, path, files):
-        """load all python \a files from \a path
-        @return list of loaded files as full paths"""
+    def _python_files(cls, path, files):
+        """@return list of (python_file, module_name) tuples of all loadable python files in the given list of
+        file names, which are located in path"""
         res = list()
         def py_filter(f):
             return f.endswith('.py') and not \
@@ -776,6 +906,17 @@ class PythonFileLoader(object):
         for filename in filter(py_filter, files):
             py_file = os.sep.join([path, filename])
             (mod_name, _) = os.path.splitext(os.path.basename(py_file))
+            res.append((py_file, mod_name))
+        # end for each file
+        return res
+
+    @classmethod
+    def _load_files(cls, python_files):
+        """load all python files
+        @param python_files list of (python_file, module_name) tuples
+        @return list of loaded files as full paths"""
+        res = list()
+        for py_file, mod_name in python_files:
             try:
                 cls.load_file(py_file, mod_name)
             except Exception:
@@ -790,13 +931,12 @@ class PythonFileLoader(object):
     # -------------------------
     ## @name Interface
     # @{
-    
+
     @classmethod
-    def load_files(cls, path, recurse=False):
-        """Load all .py files found in the given directory, or load the file it points to
+    def find_files(cls, path, recurse=False):
+        """@return a list of (python_file, module_name) tuples of all files load_files() would load, in order
         @param path either path to directory, or path to py file.
-        @param recurse if True, path will be searched for usable files recursively
-        @return a list of files loaded successfully"""
+        @param recurse if True, path will be searched for usable files recursively"""
         # if we should recurse, we just use the standard dirwalk.
         # we use topdown so top directories should be loaded before their
         # subdirectories and we follow symlinks, since it seems likely that's
@@ -804,16 +944,24 @@ class PythonFileLoader(object):
         res = list()
         path = Path(path)
         if path.isfile():
-            res += cls._load_files(path.dirname(), [path.basename()])
+            res += cls._python_files(path.dirname(), [path.basename()])
         else:
             for path, dirs, files in os.walk(path, topdown=True, followlinks=True):
-                res += cls._load_files(path, files)
+                res += cls._python_files(path, files)
                 if not recurse:
                     break
                 # end handle recursion
             # end for each directory to walk
         # end handle file or directory
         return res
+    
+    @classmethod
+    def load_files(cls, path, recurse=False):
+        """Load all .py files found in the given directory, or load the file it points to
+        @param path either path to directory, or path to py file.
+        @param recurse if True, path will be searched for usable files recursively
+        @return a list of files loaded successfully"""
+        return cls._load_files(cls.find_files(path, recurse))
         
     @classmethod
     def load_file(cls, python_file, module_name):
@@ -821,7 +969,9 @@ class PythonFileLoader(object):
         If the module is already loaded, it will be reloaded
         @return the loaded module object
         @throws Exception any exception raised when trying to load the module"""
-        imp.load_source(module_name, python_file)
+        with PhaseProfiler.instance().span('PythonFileLoader.load_file', path=python_file):
+            imp.load_source(module_name, python_file)
+        # end measure import
         return sys.modules[module_name]
 
     ## -- End Interface -- @}